@@ -0,0 +1,32 @@
+"""Spend ledger
+
+Revision ID: 002_spend_ledger
+Revises: 001_initial
+Create Date: 2026-10-17 00:00:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+# revision identifiers, used by Alembic.
+revision = '002_spend_ledger'
+down_revision = '001_initial'
+branch_labels = None
+depends_on = None
+
+
+def upgrade() -> None:
+    # Running spend per budget scope and month; rebuilt from usage_events on
+    # startup when the current month has no rows yet
+    op.create_table(
+        'spend_ledger',
+        sa.Column('scope_type', sa.String(length=20), nullable=False),
+        sa.Column('scope_id', sa.Integer(), nullable=False),
+        sa.Column('period', sa.String(length=7), nullable=False),
+        sa.Column('spent', sa.Float(), nullable=False),
+        sa.PrimaryKeyConstraint('scope_type', 'scope_id', 'period')
+    )
+
+
+def downgrade() -> None:
+    op.drop_table('spend_ledger')
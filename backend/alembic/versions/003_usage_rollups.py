@@ -0,0 +1,39 @@
+"""Usage rollups
+
+Revision ID: 003_usage_rollups
+Revises: 002_spend_ledger
+Create Date: 2026-10-17 00:00:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+# revision identifiers, used by Alembic.
+revision = '003_usage_rollups'
+down_revision = '002_spend_ledger'
+branch_labels = None
+depends_on = None
+
+
+def upgrade() -> None:
+    # Populate existing history afterwards with scripts/backfill_rollups.py
+    op.create_table(
+        'usage_rollups',
+        sa.Column('granularity', sa.String(length=5), nullable=False),
+        sa.Column('bucket_start', sa.DateTime(), nullable=False),
+        sa.Column('virtual_key_id', sa.Integer(), nullable=False),
+        sa.Column('provider', sa.String(length=50), nullable=False),
+        sa.Column('model', sa.String(length=100), nullable=False),
+        sa.Column('request_count', sa.Integer(), nullable=False),
+        sa.Column('input_tokens', sa.Integer(), nullable=False),
+        sa.Column('output_tokens', sa.Integer(), nullable=False),
+        sa.Column('total_tokens', sa.Integer(), nullable=False),
+        sa.Column('total_cost', sa.Float(), nullable=False),
+        sa.PrimaryKeyConstraint('granularity', 'bucket_start', 'virtual_key_id', 'provider', 'model')
+    )
+    op.create_index('idx_usage_rollups_bucket', 'usage_rollups', ['granularity', 'bucket_start'], unique=False)
+
+
+def downgrade() -> None:
+    op.drop_index('idx_usage_rollups_bucket', table_name='usage_rollups')
+    op.drop_table('usage_rollups')
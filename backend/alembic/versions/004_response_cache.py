@@ -0,0 +1,29 @@
+"""Response cache
+
+Revision ID: 004_response_cache
+Revises: 003_usage_rollups
+Create Date: 2026-10-17 00:00:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+# revision identifiers, used by Alembic.
+revision = '004_response_cache'
+down_revision = '003_usage_rollups'
+branch_labels = None
+depends_on = None
+
+
+def upgrade() -> None:
+    op.add_column('virtual_keys', sa.Column('cache_responses', sa.Boolean(), nullable=True, server_default=sa.false()))
+    op.add_column('virtual_keys', sa.Column('cache_ttl_seconds', sa.Integer(), nullable=True))
+    op.add_column('usage_events', sa.Column('cache_hit', sa.Boolean(), nullable=True, server_default=sa.false()))
+    op.add_column('usage_events', sa.Column('saved_cost', sa.Float(), nullable=False, server_default='0'))
+
+
+def downgrade() -> None:
+    op.drop_column('usage_events', 'saved_cost')
+    op.drop_column('usage_events', 'cache_hit')
+    op.drop_column('virtual_keys', 'cache_ttl_seconds')
+    op.drop_column('virtual_keys', 'cache_responses')
@@ -0,0 +1,23 @@
+"""Coalesced usage events
+
+Revision ID: 005_coalesced_events
+Revises: 004_response_cache
+Create Date: 2026-10-17 00:00:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+# revision identifiers, used by Alembic.
+revision = '005_coalesced_events'
+down_revision = '004_response_cache'
+branch_labels = None
+depends_on = None
+
+
+def upgrade() -> None:
+    op.add_column('usage_events', sa.Column('coalesced', sa.Boolean(), nullable=True, server_default=sa.false()))
+
+
+def downgrade() -> None:
+    op.drop_column('usage_events', 'coalesced')
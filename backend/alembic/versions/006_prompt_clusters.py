@@ -0,0 +1,58 @@
+"""Near-duplicate prompt clusters
+
+Revision ID: 006_prompt_clusters
+Revises: 005_coalesced_events
+Create Date: 2026-10-17 00:00:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+# revision identifiers, used by Alembic.
+revision = '006_prompt_clusters'
+down_revision = '005_coalesced_events'
+branch_labels = None
+depends_on = None
+
+
+def upgrade() -> None:
+    # Only events recorded from now on carry a MinHash; older ones stay unclustered
+    op.add_column('usage_events', sa.Column('prompt_minhash', sa.LargeBinary(), nullable=True))
+    op.add_column('usage_events', sa.Column('prompt_cluster_id', sa.Integer(), nullable=True))
+    op.create_index('idx_usage_events_prompt_cluster', 'usage_events', ['prompt_cluster_id'], unique=False)
+    op.create_table(
+        'prompt_clusters',
+        sa.Column('id', sa.Integer(), nullable=False),
+        sa.Column('model', sa.String(length=100), nullable=False),
+        sa.Column('signature', sa.LargeBinary(), nullable=False),
+        sa.Column('prompt_hash', sa.String(length=64), nullable=True),
+        sa.Column('created_at', sa.DateTime(timezone=True), server_default=sa.text('now()'), nullable=True),
+        sa.PrimaryKeyConstraint('id')
+    )
+    op.create_table(
+        'prompt_cluster_bands',
+        sa.Column('band', sa.SmallInteger(), nullable=False),
+        sa.Column('key', sa.BigInteger(), nullable=False),
+        sa.Column('cluster_id', sa.Integer(), nullable=False),
+        sa.PrimaryKeyConstraint('band', 'key', 'cluster_id')
+    )
+    op.create_table(
+        'prompt_cluster_rollups',
+        sa.Column('cluster_id', sa.Integer(), nullable=False),
+        sa.Column('bucket_start', sa.DateTime(), nullable=False),
+        sa.Column('virtual_key_id', sa.Integer(), nullable=False),
+        sa.Column('request_count', sa.Integer(), nullable=False),
+        sa.Column('total_cost', sa.Float(), nullable=False),
+        sa.PrimaryKeyConstraint('cluster_id', 'bucket_start', 'virtual_key_id')
+    )
+    op.create_index('idx_prompt_cluster_rollups_bucket', 'prompt_cluster_rollups', ['bucket_start'], unique=False)
+
+
+def downgrade() -> None:
+    op.drop_index('idx_prompt_cluster_rollups_bucket', table_name='prompt_cluster_rollups')
+    op.drop_table('prompt_cluster_rollups')
+    op.drop_table('prompt_cluster_bands')
+    op.drop_table('prompt_clusters')
+    op.drop_index('idx_usage_events_prompt_cluster', table_name='usage_events')
+    op.drop_column('usage_events', 'prompt_cluster_id')
+    op.drop_column('usage_events', 'prompt_minhash')
@@ -0,0 +1,33 @@
+"""Repeated-prompt heavy hitter checkpoints
+
+Revision ID: 007_prompt_heavy_hitters
+Revises: 006_prompt_clusters
+Create Date: 2026-10-17 00:00:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+# revision identifiers, used by Alembic.
+revision = '007_prompt_heavy_hitters'
+down_revision = '006_prompt_clusters'
+branch_labels = None
+depends_on = None
+
+
+def upgrade() -> None:
+    op.create_table(
+        'prompt_heavy_hitters',
+        sa.Column('worker_id', sa.String(length=32), nullable=False),
+        sa.Column('scope_type', sa.String(length=20), nullable=False),
+        sa.Column('scope_id', sa.Integer(), nullable=False),
+        sa.Column('window_start', sa.DateTime(), nullable=False),
+        sa.Column('summary', sa.LargeBinary(), nullable=False),
+        sa.PrimaryKeyConstraint('worker_id', 'scope_type', 'scope_id', 'window_start')
+    )
+    op.create_index('idx_prompt_heavy_hitters_scope', 'prompt_heavy_hitters', ['scope_type', 'window_start'], unique=False)
+
+
+def downgrade() -> None:
+    op.drop_index('idx_prompt_heavy_hitters_scope', table_name='prompt_heavy_hitters')
+    op.drop_table('prompt_heavy_hitters')
@@ -0,0 +1,113 @@
+"""Partition usage_events by month (Postgres)
+
+Revision ID: 008_partition_usage_events
+Revises: 007_prompt_heavy_hitters
+Create Date: 2026-10-17 00:00:00.000000
+
+"""
+from datetime import datetime
+
+from alembic import op
+
+# revision identifiers, used by Alembic.
+revision = '008_partition_usage_events'
+down_revision = '007_prompt_heavy_hitters'
+branch_labels = None
+depends_on = None
+
+MONTHS_AHEAD = 3
+
+# (name, columns) of the secondary indexes on usage_events
+INDEXES = [
+    ('ix_usage_events_id', 'id'),
+    ('ix_usage_events_virtual_key_id', 'virtual_key_id'),
+    ('ix_usage_events_user_id', 'user_id'),
+    ('ix_usage_events_created_at', 'created_at'),
+    ('ix_usage_events_prompt_hash', 'prompt_hash'),
+    ('idx_usage_events_virtual_key_created', 'virtual_key_id, created_at'),
+    ('idx_usage_events_prompt_cluster', 'prompt_cluster_id'),
+]
+
+FOREIGN_KEYS = [
+    ('usage_events_virtual_key_id_fkey', 'virtual_key_id', 'virtual_keys'),
+    ('usage_events_user_id_fkey', 'user_id', 'users'),
+]
+
+
+def _month(year: int, month: int) -> str:
+    year, month = year + (month - 1) // 12, (month - 1) % 12 + 1
+    return f"{year:04d}-{month:02d}-01 00:00:00+00"
+
+
+def upgrade() -> None:
+    if op.get_bind().dialect.name != 'postgresql':
+        # SQLite has no declarative partitioning; scripts/maintain_usage_events.py
+        # rolls closed months out into per-month tables instead
+        return
+
+    # Existing rows become the history partition, bounded above by the start
+    # of next month. Everything that needs a scan of the existing table runs
+    # first under locks that don't block the proxy's inserts, so the swap
+    # itself is a short metadata change.
+    now = datetime.utcnow()
+    cutover = _month(now.year, now.month + 1)
+    with op.get_context().autocommit_block():
+        op.execute(
+            "CREATE UNIQUE INDEX CONCURRENTLY IF NOT EXISTS usage_events_history_id_created_at "
+            "ON usage_events (id, created_at)"
+        )
+        op.execute(
+            "ALTER TABLE usage_events ADD CONSTRAINT usage_events_history_bound "
+            f"CHECK (created_at IS NOT NULL AND created_at < '{cutover}') NOT VALID"
+        )
+        op.execute("ALTER TABLE usage_events VALIDATE CONSTRAINT usage_events_history_bound")
+
+    op.execute("ALTER TABLE usage_events RENAME TO usage_events_history")
+    op.execute("ALTER TABLE usage_events_history RENAME CONSTRAINT usage_events_pkey TO usage_events_history_pkey")
+    for name, _ in INDEXES:
+        op.execute(f"ALTER INDEX {name} RENAME TO {name.replace('usage_events', 'usage_events_history')}")
+    # Proven by the validated check constraint, so no table scan
+    op.execute("ALTER TABLE usage_events_history ALTER COLUMN created_at SET NOT NULL")
+
+    # The partition key has to be part of the primary key; ids stay unique
+    # through the shared sequence
+    op.execute(
+        "CREATE TABLE usage_events (LIKE usage_events_history INCLUDING DEFAULTS) "
+        "PARTITION BY RANGE (created_at)"
+    )
+    op.execute("ALTER TABLE usage_events ADD CONSTRAINT usage_events_pkey PRIMARY KEY (id, created_at)")
+    for name, column, target in FOREIGN_KEYS:
+        op.execute(f"ALTER TABLE usage_events ADD CONSTRAINT {name} FOREIGN KEY ({column}) REFERENCES {target} (id)")
+    for name, columns in INDEXES:
+        op.execute(f"CREATE INDEX {name} ON usage_events ({columns})")
+    op.execute("ALTER SEQUENCE usage_events_id_seq OWNED BY usage_events.id")
+
+    # Matching indexes and constraints on the history table are attached
+    # rather than rebuilt, and the check constraint skips the bound scan
+    op.execute(f"ALTER TABLE usage_events ATTACH PARTITION usage_events_history FOR VALUES FROM (MINVALUE) TO ('{cutover}')")
+
+    # No default partition: it would rule out DETACH ... CONCURRENTLY when
+    # expired months are archived. Partitions ahead of time are kept up by
+    # the app on startup and by scripts/maintain_usage_events.py.
+    for offset in range(1, MONTHS_AHEAD + 2):
+        start, end = _month(now.year, now.month + offset), _month(now.year, now.month + offset + 1)
+        name = "usage_events_" + start[:7].replace("-", "_")
+        op.execute(f"CREATE TABLE {name} PARTITION OF usage_events FOR VALUES FROM ('{start}') TO ('{end}')")
+
+
+def downgrade() -> None:
+    if op.get_bind().dialect.name != 'postgresql':
+        return
+
+    # Copies every row back into a plain table; expect this to take a while
+    op.execute("CREATE TABLE usage_events_plain (LIKE usage_events INCLUDING DEFAULTS)")
+    op.execute("INSERT INTO usage_events_plain SELECT * FROM usage_events")
+    op.execute("ALTER SEQUENCE usage_events_id_seq OWNED BY usage_events_plain.id")
+    op.execute("DROP TABLE usage_events CASCADE")
+    op.execute("ALTER TABLE usage_events_plain RENAME TO usage_events")
+    op.execute("ALTER TABLE usage_events ALTER COLUMN created_at DROP NOT NULL")
+    op.execute("ALTER TABLE usage_events ADD CONSTRAINT usage_events_pkey PRIMARY KEY (id)")
+    for name, column, target in FOREIGN_KEYS:
+        op.execute(f"ALTER TABLE usage_events ADD CONSTRAINT {name} FOREIGN KEY ({column}) REFERENCES {target} (id)")
+    for name, columns in INDEXES:
+        op.execute(f"CREATE INDEX {name} ON usage_events ({columns})")
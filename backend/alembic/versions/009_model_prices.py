@@ -0,0 +1,38 @@
+"""Model prices with effective dates
+
+Revision ID: 009_model_prices
+Revises: 008_partition_usage_events
+Create Date: 2026-10-17 00:00:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+# revision identifiers, used by Alembic.
+revision = '009_model_prices'
+down_revision = '008_partition_usage_events'
+branch_labels = None
+depends_on = None
+
+
+def upgrade() -> None:
+    # Empty to start with: models without rows keep the OPENAI_PRICING /
+    # ANTHROPIC_PRICING defaults from settings
+    op.create_table(
+        'model_prices',
+        sa.Column('id', sa.Integer(), nullable=False),
+        sa.Column('provider', sa.String(length=50), nullable=False),
+        sa.Column('model', sa.String(length=100), nullable=False),
+        sa.Column('input_price', sa.Float(), nullable=False),
+        sa.Column('output_price', sa.Float(), nullable=False),
+        sa.Column('effective_from', sa.DateTime(), nullable=False),
+        sa.Column('effective_to', sa.DateTime(), nullable=True),
+        sa.Column('created_at', sa.DateTime(timezone=True), server_default=sa.text('now()'), nullable=True),
+        sa.PrimaryKeyConstraint('id')
+    )
+    op.create_index('idx_model_prices_model', 'model_prices', ['provider', 'model', 'effective_from'], unique=True)
+
+
+def downgrade() -> None:
+    op.drop_index('idx_model_prices_model', table_name='model_prices')
+    op.drop_table('model_prices')
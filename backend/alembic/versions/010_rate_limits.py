@@ -0,0 +1,25 @@
+"""Virtual key rate limits
+
+Revision ID: 010_rate_limits
+Revises: 009_model_prices
+Create Date: 2026-10-17 00:00:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+# revision identifiers, used by Alembic.
+revision = '010_rate_limits'
+down_revision = '009_model_prices'
+branch_labels = None
+depends_on = None
+
+
+def upgrade() -> None:
+    op.add_column('virtual_keys', sa.Column('requests_per_minute', sa.Integer(), nullable=True))
+    op.add_column('virtual_keys', sa.Column('tokens_per_minute', sa.Integer(), nullable=True))
+
+
+def downgrade() -> None:
+    op.drop_column('virtual_keys', 'tokens_per_minute')
+    op.drop_column('virtual_keys', 'requests_per_minute')
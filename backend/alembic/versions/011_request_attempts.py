@@ -0,0 +1,43 @@
+"""Upstream attempts on usage events
+
+Revision ID: 011_request_attempts
+Revises: 010_rate_limits
+Create Date: 2026-10-17 00:00:00.000000
+
+"""
+import re
+
+from alembic import op
+import sqlalchemy as sa
+
+# revision identifiers, used by Alembic.
+revision = '011_request_attempts'
+down_revision = '010_rate_limits'
+branch_labels = None
+depends_on = None
+
+# SQLite keeps closed months in per-month copies of usage_events; PostgreSQL
+# partitions pick up columns added to the parent
+_MONTH_TABLE = re.compile(r"^usage_events_\d{4}_\d{2}$")
+
+
+def _tables():
+    tables = ['usage_events']
+    bind = op.get_bind()
+    if bind.dialect.name == 'sqlite':
+        tables.extend(sorted(name for name in sa.inspect(bind).get_table_names() if _MONTH_TABLE.match(name)))
+    return tables
+
+
+def upgrade() -> None:
+    for table in _tables():
+        op.add_column(table, sa.Column('attempt', sa.Integer(), nullable=False, server_default='1'))
+        op.add_column(table, sa.Column('hedge', sa.Boolean(), nullable=True, server_default=sa.false()))
+        op.add_column(table, sa.Column('served', sa.Boolean(), nullable=True, server_default=sa.true()))
+
+
+def downgrade() -> None:
+    for table in reversed(_tables()):
+        op.drop_column(table, 'served')
+        op.drop_column(table, 'hedge')
+        op.drop_column(table, 'attempt')
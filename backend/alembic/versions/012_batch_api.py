@@ -0,0 +1,85 @@
+"""Batch API files and batches submitted through the proxy, and batch usage events
+
+Revision ID: 012_batch_api
+Revises: 011_request_attempts
+Create Date: 2026-10-17 00:00:00.000000
+
+"""
+import re
+
+from alembic import op
+import sqlalchemy as sa
+
+# revision identifiers, used by Alembic.
+revision = '012_batch_api'
+down_revision = '011_request_attempts'
+branch_labels = None
+depends_on = None
+
+# SQLite keeps closed months in per-month copies of usage_events; PostgreSQL
+# partitions pick up columns added to the parent
+_MONTH_TABLE = re.compile(r"^usage_events_\d{4}_\d{2}$")
+
+
+def _tables():
+    tables = ['usage_events']
+    bind = op.get_bind()
+    if bind.dialect.name == 'sqlite':
+        tables.extend(sorted(name for name in sa.inspect(bind).get_table_names() if _MONTH_TABLE.match(name)))
+    return tables
+
+
+def upgrade() -> None:
+    for table in _tables():
+        op.add_column(table, sa.Column('batch_id', sa.String(length=255), nullable=True))
+    op.create_table(
+        'batch_files',
+        sa.Column('id', sa.String(length=255), nullable=False),
+        sa.Column('virtual_key_id', sa.Integer(), nullable=False),
+        sa.Column('upstream', sa.String(length=100), nullable=False),
+        sa.Column('model', sa.String(length=100), nullable=False),
+        sa.Column('endpoint', sa.String(length=100), nullable=False),
+        sa.Column('filename', sa.String(length=255), nullable=True),
+        sa.Column('bytes', sa.BigInteger(), nullable=False),
+        sa.Column('request_count', sa.Integer(), nullable=False),
+        sa.Column('estimated_cost', sa.Float(), nullable=False),
+        sa.Column('created_at', sa.DateTime(timezone=True), server_default=sa.text('now()'), nullable=True),
+        sa.ForeignKeyConstraint(['virtual_key_id'], ['virtual_keys.id']),
+        sa.PrimaryKeyConstraint('id')
+    )
+    op.create_index(op.f('ix_batch_files_virtual_key_id'), 'batch_files', ['virtual_key_id'], unique=False)
+    op.create_table(
+        'batch_jobs',
+        sa.Column('id', sa.String(length=255), nullable=False),
+        sa.Column('virtual_key_id', sa.Integer(), nullable=False),
+        sa.Column('input_file_id', sa.String(length=255), nullable=False),
+        sa.Column('upstream', sa.String(length=100), nullable=False),
+        sa.Column('model', sa.String(length=100), nullable=False),
+        sa.Column('status', sa.String(length=20), nullable=False),
+        sa.Column('output_file_id', sa.String(length=255), nullable=True),
+        sa.Column('error_file_id', sa.String(length=255), nullable=True),
+        sa.Column('estimated_cost', sa.Float(), nullable=False),
+        sa.Column('reserved_period', sa.String(length=7), nullable=False),
+        sa.Column('accounted_lines', sa.Integer(), nullable=False),
+        sa.Column('actual_cost', sa.Float(), nullable=False),
+        sa.Column('accounted_at', sa.DateTime(), nullable=True),
+        sa.Column('created_at', sa.DateTime(timezone=True), server_default=sa.text('now()'), nullable=True),
+        sa.Column('completed_at', sa.DateTime(), nullable=True),
+        sa.ForeignKeyConstraint(['input_file_id'], ['batch_files.id']),
+        sa.ForeignKeyConstraint(['virtual_key_id'], ['virtual_keys.id']),
+        sa.PrimaryKeyConstraint('id')
+    )
+    op.create_index(op.f('ix_batch_jobs_virtual_key_id'), 'batch_jobs', ['virtual_key_id'], unique=False)
+    op.create_index(op.f('ix_batch_jobs_output_file_id'), 'batch_jobs', ['output_file_id'], unique=False)
+    op.create_index(op.f('ix_batch_jobs_error_file_id'), 'batch_jobs', ['error_file_id'], unique=False)
+
+
+def downgrade() -> None:
+    op.drop_index(op.f('ix_batch_jobs_error_file_id'), table_name='batch_jobs')
+    op.drop_index(op.f('ix_batch_jobs_output_file_id'), table_name='batch_jobs')
+    op.drop_index(op.f('ix_batch_jobs_virtual_key_id'), table_name='batch_jobs')
+    op.drop_table('batch_jobs')
+    op.drop_index(op.f('ix_batch_files_virtual_key_id'), table_name='batch_files')
+    op.drop_table('batch_files')
+    for table in reversed(_tables()):
+        op.drop_column(table, 'batch_id')
@@ -0,0 +1,66 @@
+"""Budget caps on organizations, teams and projects
+
+Revision ID: 013_budget_hierarchy
+Revises: 012_batch_api
+Create Date: 2026-10-17 00:00:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+# revision identifiers, used by Alembic.
+revision = '013_budget_hierarchy'
+down_revision = '012_batch_api'
+branch_labels = None
+depends_on = None
+
+# Seed each ancestor's ledger rows from its keys' rows; from here on the usage
+# writer increments them along with the key's
+_ROLLUPS = {
+    'project': """
+        SELECT p.id, l.period, SUM(l.spent)
+        FROM spend_ledger l
+        JOIN virtual_keys k ON k.id = l.scope_id
+        JOIN projects p ON p.id = k.project_id
+        WHERE l.scope_type = 'virtual_key'
+        GROUP BY p.id, l.period
+    """,
+    'team': """
+        SELECT t.id, l.period, SUM(l.spent)
+        FROM spend_ledger l
+        JOIN virtual_keys k ON k.id = l.scope_id
+        LEFT JOIN projects p ON p.id = k.project_id
+        JOIN teams t ON t.id = COALESCE(p.team_id, k.team_id)
+        WHERE l.scope_type = 'virtual_key'
+        GROUP BY t.id, l.period
+    """,
+    'organization': """
+        SELECT o.id, l.period, SUM(l.spent)
+        FROM spend_ledger l
+        JOIN virtual_keys k ON k.id = l.scope_id
+        LEFT JOIN projects p ON p.id = k.project_id
+        LEFT JOIN teams t ON t.id = COALESCE(p.team_id, k.team_id)
+        JOIN organizations o ON o.id = COALESCE(p.organization_id, t.organization_id)
+        WHERE l.scope_type = 'virtual_key'
+        GROUP BY o.id, l.period
+    """,
+}
+
+
+def upgrade() -> None:
+    for table in ('organizations', 'teams', 'projects'):
+        op.add_column(table, sa.Column('monthly_budget_cap', sa.Float(), nullable=True))
+    op.add_column('batch_jobs', sa.Column('reserved_scopes', sa.String(length=255), nullable=True))
+
+    for scope_type, query in _ROLLUPS.items():
+        op.execute(
+            f"INSERT INTO spend_ledger (scope_type, scope_id, period, spent) "
+            f"SELECT '{scope_type}', rollup.* FROM ({query}) AS rollup"
+        )
+
+
+def downgrade() -> None:
+    op.execute("DELETE FROM spend_ledger WHERE scope_type <> 'virtual_key'")
+    op.drop_column('batch_jobs', 'reserved_scopes')
+    for table in ('projects', 'teams', 'organizations'):
+        op.drop_column(table, 'monthly_budget_cap')
@@ -0,0 +1,29 @@
+"""Cache hit, coalescing and saved cost counters on usage rollups
+
+Revision ID: 014_rollup_savings
+Revises: 013_budget_hierarchy
+Create Date: 2026-10-18 00:00:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+# revision identifiers, used by Alembic.
+revision = '014_rollup_savings'
+down_revision = '013_budget_hierarchy'
+branch_labels = None
+depends_on = None
+
+
+def upgrade() -> None:
+    # Existing buckets start at zero; refill the last week afterwards with
+    # scripts/backfill_rollups.py --since YYYY-MM-DD
+    op.add_column('usage_rollups', sa.Column('cache_hits', sa.Integer(), nullable=False, server_default='0'))
+    op.add_column('usage_rollups', sa.Column('coalesced_requests', sa.Integer(), nullable=False, server_default='0'))
+    op.add_column('usage_rollups', sa.Column('saved_cost', sa.Float(), nullable=False, server_default='0'))
+
+
+def downgrade() -> None:
+    op.drop_column('usage_rollups', 'saved_cost')
+    op.drop_column('usage_rollups', 'coalesced_requests')
+    op.drop_column('usage_rollups', 'cache_hits')
@@ -0,0 +1,22 @@
+"""Index prompt cluster bands by cluster for pruning
+
+Revision ID: 015_prompt_cluster_pruning
+Revises: 014_rollup_savings
+Create Date: 2026-10-18 00:00:00.000000
+
+"""
+from alembic import op
+
+# revision identifiers, used by Alembic.
+revision = '015_prompt_cluster_pruning'
+down_revision = '014_rollup_savings'
+branch_labels = None
+depends_on = None
+
+
+def upgrade() -> None:
+    op.create_index('idx_prompt_cluster_bands_cluster', 'prompt_cluster_bands', ['cluster_id'], unique=False)
+
+
+def downgrade() -> None:
+    op.drop_index('idx_prompt_cluster_bands_cluster', table_name='prompt_cluster_bands')
@@ -0,0 +1,24 @@
+"""Heartbeat on repeated-prompt checkpoints
+
+Revision ID: 016_heavy_hitter_heartbeats
+Revises: 015_prompt_cluster_pruning
+Create Date: 2026-10-18 00:00:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+# revision identifiers, used by Alembic.
+revision = '016_heavy_hitter_heartbeats'
+down_revision = '015_prompt_cluster_pruning'
+branch_labels = None
+depends_on = None
+
+
+def upgrade() -> None:
+    # Rows without one are treated as abandoned and taken over by the next checkpoint
+    op.add_column('prompt_heavy_hitters', sa.Column('updated_at', sa.DateTime(), nullable=True))
+
+
+def downgrade() -> None:
+    op.drop_column('prompt_heavy_hitters', 'updated_at')
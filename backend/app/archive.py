@@ -0,0 +1,194 @@
+import logging
+import os
+from datetime import datetime
+from typing import Dict, List, Optional, Sequence
+
+from sqlalchemy import BigInteger, Boolean, DateTime, Float, Integer, LargeBinary, select
+
+from app.config import settings
+from app.json_scan import dumps, loads
+from app.models import UsageEvent
+from app.partitions import Partition, add_months, current_period, delete_month_rows, month_source, month_start, partitions
+
+logger = logging.getLogger(__name__)
+
+# Expired months of usage_events are written to Parquet under
+# USAGE_ARCHIVE_DIR/usage_events/period=YYYY-MM/ and then removed from the
+# database. Each archive run for a month adds one part file; _manifest.json
+# records the rows and cost archived so far and the highest id written, so
+# a run that failed between writing and deleting is never archived twice.
+
+MANIFEST = "_manifest.json"
+
+
+def _pyarrow():
+    try:
+        import pyarrow
+        import pyarrow.parquet
+    except ImportError as exc:
+        raise RuntimeError("Archiving usage events requires pyarrow (pip install pyarrow)") from exc
+    return pyarrow
+
+
+def _arrow_schema(pa):
+    """Arrow schema mirroring the usage_events columns"""
+    fields = []
+    for column in UsageEvent.__table__.columns:
+        if isinstance(column.type, (Integer, BigInteger)):
+            kind = pa.int64()
+        elif isinstance(column.type, Float):
+            kind = pa.float64()
+        elif isinstance(column.type, Boolean):
+            kind = pa.bool_()
+        elif isinstance(column.type, DateTime):
+            kind = pa.timestamp("us", tz="UTC")
+        elif isinstance(column.type, LargeBinary):
+            kind = pa.binary()
+        else:
+            kind = pa.string()
+        fields.append(pa.field(column.name, kind))
+    return pa.schema(fields)
+
+
+def period_dir(period: str) -> str:
+    return os.path.join(settings.USAGE_ARCHIVE_DIR, "usage_events", f"period={period}")
+
+
+def read_manifest(period: str) -> Optional[dict]:
+    path = os.path.join(period_dir(period), MANIFEST)
+    if not os.path.exists(path):
+        return None
+    with open(path, "rb") as handle:
+        return loads(handle.read())
+
+
+def _write_manifest(period: str, manifest: dict) -> None:
+    path = os.path.join(period_dir(period), MANIFEST)
+    with open(path + ".tmp", "wb") as handle:
+        handle.write(dumps(manifest))
+    os.replace(path + ".tmp", path)
+
+
+def archived_periods() -> List[str]:
+    """Months with an archive on disk, oldest first"""
+    root = os.path.join(settings.USAGE_ARCHIVE_DIR, "usage_events")
+    if not os.path.isdir(root):
+        return []
+    return sorted(
+        name.split("=", 1)[1] for name in os.listdir(root)
+        if name.startswith("period=") and os.path.exists(os.path.join(root, name, MANIFEST))
+    )
+
+
+def archive_month(engine, partition: Partition, batch_size: int) -> dict:
+    """Write one month to Parquet, then remove it from the database
+
+    Rows are streamed through a server-side cursor in `batch_size` chunks, so
+    memory stays flat however large the month is. The part file is written
+    under a temporary name and renamed once complete; only after that and
+    the manifest update are the rows deleted, in short transactions.
+    """
+    pa = _pyarrow()
+    schema = _arrow_schema(pa)
+    manifest = read_manifest(partition.period) or {
+        "period": partition.period, "rows": 0, "total_cost": 0.0, "max_id": 0, "parts": 0
+    }
+    directory = period_dir(partition.period)
+    os.makedirs(directory, exist_ok=True)
+
+    source = month_source(partition)
+    start, end = month_start(partition.period), month_start(add_months(partition.period, 1))
+    # Rows at or below max_id were written by an earlier run that didn't get to delete them
+    query = select(*[source.c[field.name] for field in schema]).where(
+        source.c.created_at >= start,
+        source.c.created_at < end,
+        source.c.id > manifest["max_id"]
+    ).order_by(source.c.id)
+
+    path = os.path.join(directory, f"part-{manifest['parts']}.parquet")
+    rows = 0
+    total_cost = 0.0
+    max_id = manifest["max_id"]
+    id_index = schema.get_field_index("id")
+    cost_index = schema.get_field_index("total_cost")
+    with engine.connect() as conn:
+        result = conn.execution_options(stream_results=True, yield_per=batch_size).execute(query)
+        writer = None
+        try:
+            for chunk in result.partitions():
+                columns = list(zip(*chunk))
+                if writer is None:
+                    writer = pa.parquet.ParquetWriter(path + ".tmp", schema, compression="zstd")
+                writer.write_batch(pa.record_batch(
+                    [pa.array(values, type=field.type) for values, field in zip(columns, schema)],
+                    schema=schema
+                ))
+                rows += len(chunk)
+                total_cost += sum(value or 0.0 for value in columns[cost_index])
+                max_id = chunk[-1][id_index]
+        finally:
+            if writer is not None:
+                writer.close()
+
+    if rows:
+        os.replace(path + ".tmp", path)
+        manifest.update(
+            rows=manifest["rows"] + rows,
+            total_cost=manifest["total_cost"] + total_cost,
+            max_id=max_id,
+            parts=manifest["parts"] + 1,
+            archived_at=datetime.utcnow().isoformat()
+        )
+        _write_manifest(partition.period, manifest)
+
+    deleted = delete_month_rows(engine, partition, batch_size)
+    logger.info("Archived %s: %d rows to %s, %d deleted", partition.period, rows, path, deleted)
+    return manifest
+
+
+def archive_expired(engine, retention_months: int, batch_size: int) -> List[dict]:
+    """Archive every stored month older than `retention_months` (current month included)"""
+    if retention_months <= 0:
+        return []
+    cutoff = add_months(current_period(), 1 - retention_months)
+    with engine.connect() as conn:
+        expired = [partition for partition in partitions(conn) if partition.period < cutoff]
+    return [archive_month(engine, partition, batch_size) for partition in expired]
+
+
+def archived_usage(period: str, virtual_key_ids: Optional[Sequence[int]] = None) -> List[Dict]:
+    """Usage per provider and model for an archived month
+
+    Reads only the columns it needs and pushes the key filter down to the
+    Parquet reader. Blocking; call it from a worker thread.
+    """
+    pa = _pyarrow()
+    filters = None
+    if virtual_key_ids is not None:
+        if not virtual_key_ids:
+            return []
+        filters = [("virtual_key_id", "in", list(virtual_key_ids))]
+    table = pa.parquet.read_table(
+        period_dir(period),
+        columns=["provider", "model", "id", "input_tokens", "output_tokens", "total_tokens", "total_cost"],
+        filters=filters
+    )
+    grouped = table.group_by(["provider", "model"]).aggregate([
+        ("id", "count"),
+        ("input_tokens", "sum"),
+        ("output_tokens", "sum"),
+        ("total_tokens", "sum"),
+        ("total_cost", "sum"),
+    ])
+    return [
+        {
+            "provider": row["provider"],
+            "model": row["model"],
+            "request_count": row["id_count"],
+            "input_tokens": row["input_tokens_sum"] or 0,
+            "output_tokens": row["output_tokens_sum"] or 0,
+            "total_tokens": row["total_tokens_sum"] or 0,
+            "total_cost": row["total_cost_sum"] or 0.0,
+        }
+        for row in grouped.to_pylist()
+    ]
@@ -0,0 +1,295 @@
+import asyncio
+import logging
+from dataclasses import dataclass
+from datetime import datetime
+from typing import Any, BinaryIO, Dict, List, Optional, Tuple
+
+from prometheus_client import Counter
+from sqlalchemy import select, update
+
+from app.config import settings
+from app.database import AsyncSessionLocal
+from app.embeddings import embedding_inputs, estimate_tokens
+from app.instrumentation import record_usage_metrics
+from app.json_scan import loads
+from app.ledger import (
+    VIRTUAL_KEY_SCOPE, BudgetScope, LocalSpendLedger, Reservation, ScopeId, current_period, parse_scopes, spend_ledger
+)
+from app.models import BatchJob, VirtualKey
+from app.upstream import UpstreamTarget, get_upstream_pool
+from app.usage_writer import usage_writer
+from app.utils import calculate_cost
+
+logger = logging.getLogger(__name__)
+
+BATCH_LINES_ACCOUNTED = Counter(
+    'batch_result_lines_accounted_total', 'Batch API result lines written as usage events', ['status']
+)
+
+# Batch statuses after which its output and error files no longer change
+FINAL_STATUSES = frozenset({"completed", "failed", "expired", "cancelled"})
+# When the batch reached each final status, as reported on the batch object
+_FINAL_TIMESTAMPS = ("completed_at", "failed_at", "expired_at", "cancelled_at")
+
+
+class BatchFileError(ValueError):
+    """An uploaded batch input file that can't be read or estimated"""
+
+
+class BatchAccountingConflict(Exception):
+    """Another worker advanced the batch's accounting first"""
+
+
+@dataclass
+class BatchEstimate:
+    """What a batch input file asks for, priced at batch rates"""
+    model: str
+    endpoint: str
+    request_count: int
+    estimated_cost: float
+
+
+def estimate_batch_file(file: BinaryIO) -> BatchEstimate:
+    """Read a batch input file line by line and estimate its worst-case cost
+
+    Input tokens are estimated from each request's size (1 token ≈ 4
+    chars), output tokens from its max_tokens or the default reservation,
+    like a single request's budget hold. Every line must target the same
+    model and endpoint, as the Batch API requires. Memory use doesn't grow
+    with the file.
+    """
+    model = endpoint = None
+    request_count = input_tokens = output_tokens = 0
+    for number, line in enumerate(file, start=1):
+        if not line.strip():
+            continue
+        try:
+            request = loads(line)
+        except ValueError:
+            raise BatchFileError(f"Line {number} is not valid JSON")
+        body = request.get("body") if isinstance(request, dict) else None
+        if not isinstance(body, dict) or not isinstance(body.get("model"), str):
+            raise BatchFileError(f"Line {number} has no request body with a model")
+        if model is None:
+            model, endpoint = body["model"], request.get("url")
+        elif (body["model"], request.get("url")) != (model, endpoint):
+            raise BatchFileError(f"Line {number} targets a different model or endpoint than line 1")
+        request_count += 1
+        if endpoint == "/v1/embeddings":
+            inputs = embedding_inputs(body)
+            input_tokens += estimate_tokens(*inputs) if inputs else len(line) // 4
+            continue
+        input_tokens += len(line) // 4
+        max_output_tokens = body.get("max_completion_tokens") or body.get("max_tokens")
+        output_tokens += max_output_tokens or settings.BUDGET_RESERVATION_OUTPUT_TOKENS
+    if not request_count:
+        raise BatchFileError("The file has no requests")
+    costs = calculate_cost("openai", model, input_tokens, output_tokens, price_ratio=settings.BATCH_PRICE_RATIO)
+    return BatchEstimate(model, endpoint or "", request_count, costs["total_cost"])
+
+
+def final_timestamp(batch: Dict[str, Any]) -> Optional[datetime]:
+    """When a batch object says it reached its final status (UTC, naive)"""
+    for name in _FINAL_TIMESTAMPS:
+        if batch.get(name):
+            return datetime.utcfromtimestamp(batch[name])
+    return None
+
+
+def batch_usage_event(job: BatchJob, line: Dict[str, Any], created_at: datetime) -> Dict[str, Any]:
+    """The usage event for one line of a batch's output or error file
+
+    Calls are billed at BATCH_PRICE_RATIO of the batch model's price in
+    effect when the batch finished, and recorded at that time.
+    """
+    response = line.get("response") or {}
+    status_code = response.get("status_code") or 500
+    usage = ((response.get("body") or {}).get("usage") or {}) if status_code == 200 else {}
+    input_tokens = usage.get("prompt_tokens", 0)
+    output_tokens = usage.get("completion_tokens", 0)
+    costs = calculate_cost(
+        "openai", job.model, input_tokens, output_tokens, at=created_at, price_ratio=settings.BATCH_PRICE_RATIO
+    )
+    return {
+        "virtual_key_id": job.virtual_key_id,
+        "user_id": None,
+        "provider": "openai",
+        "model": job.model,
+        "input_tokens": input_tokens,
+        "output_tokens": output_tokens,
+        "total_tokens": usage.get("total_tokens", input_tokens + output_tokens),
+        "input_cost": costs["input_cost"],
+        "output_cost": costs["output_cost"],
+        "total_cost": costs["total_cost"],
+        "prompt_hash": None,
+        "prompt_chars": None,
+        "prompt_preview": None,
+        "prompt_signature": None,
+        "request_id": str(line.get("custom_id") or line.get("id") or "")[:255] or None,
+        "status_code": status_code,
+        "was_blocked": False,
+        "block_reason": None,
+        "cache_hit": False,
+        "coalesced": False,
+        "saved_cost": 0.0,
+        "attempt": 1,
+        "hedge": False,
+        "served": True,
+        "batch_id": job.id,
+        "created_at": created_at
+    }
+
+
+def reserved_scopes(job: BatchJob) -> Tuple[ScopeId, ...]:
+    """The budget chain a batch's estimate is held on; just the key for batches from before chains"""
+    if job.reserved_scopes:
+        return parse_scopes(job.reserved_scopes)
+    return ((VIRTUAL_KEY_SCOPE, job.virtual_key_id),)
+
+
+def batch_target(name: str) -> Optional[UpstreamTarget]:
+    """The OpenAI upstream target a batch's files live on, if still configured"""
+    return next((target for target in get_upstream_pool("openai").targets if target.name == name), None)
+
+
+class BatchAccountant:
+    """Turn finished batches' result files into usage events
+
+    Output and error files are streamed from the upstream line by line and
+    written in chunks of BATCH_ACCOUNTING_CHUNK_SIZE events, each in one
+    transaction with the batch's line checkpoint, so memory stays flat
+    however large the files are and an interrupted run resumes where it
+    stopped without double counting. The checkpoint update only succeeds
+    if nobody else moved it, which keeps two workers from accounting the
+    same lines. Once every line is in, the estimate held against the key's
+    budget since submission is released.
+    """
+
+    def __init__(self):
+        self._tasks: Dict[str, asyncio.Task] = {}
+
+    def schedule(self, batch_id: str) -> None:
+        """Start accounting a finished batch in the background, unless already running"""
+        task = self._tasks.get(batch_id)
+        if task is not None and not task.done():
+            return
+        task = self._tasks[batch_id] = asyncio.create_task(self._run(batch_id), name=f"batch-accounting-{batch_id}")
+        task.add_done_callback(lambda _: self._tasks.pop(batch_id, None))
+
+    async def stop(self) -> None:
+        """Cancel running accounting; it resumes from its checkpoint next time"""
+        tasks = list(self._tasks.values())
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+    async def _run(self, batch_id: str) -> None:
+        try:
+            await self.account(batch_id)
+        except BatchAccountingConflict:
+            logger.info("Batch %s is being accounted by another worker", batch_id)
+        except Exception:
+            logger.exception("Failed to account batch %s; it is retried on its next status poll", batch_id)
+
+    async def account(self, batch_id: str) -> None:
+        """Account every result line of a finished batch not yet written"""
+        async with AsyncSessionLocal() as db:
+            job = await db.get(BatchJob, batch_id)
+            if job is None or job.accounted_at is not None or job.status not in FINAL_STATUSES:
+                return
+            environment = await db.scalar(select(VirtualKey.environment).where(VirtualKey.id == job.virtual_key_id))
+        target = batch_target(job.upstream)
+        if target is None:
+            raise RuntimeError(f"Upstream target {job.upstream!r} is no longer configured")
+        created_at = job.completed_at or datetime.utcnow()
+        chunk_size = settings.BATCH_ACCOUNTING_CHUNK_SIZE
+
+        events: List[Dict[str, Any]] = []
+        line_number = job.accounted_lines
+        seen = 0
+        for file_id in (job.output_file_id, job.error_file_id):
+            if not file_id:
+                continue
+            async with target.client.stream(
+                "GET", f"/v1/files/{file_id}/content", headers=target.auth_headers
+            ) as response:
+                if response.status_code != 200:
+                    raise RuntimeError(f"Upstream answered {response.status_code} for file {file_id}")
+                async for line in response.aiter_lines():
+                    if not line.strip():
+                        continue
+                    seen += 1
+                    if seen <= job.accounted_lines:
+                        continue
+                    events.append(batch_usage_event(job, loads(line), created_at))
+                    line_number = seen
+                    if len(events) >= chunk_size:
+                        await self._write(job, events, line_number, environment)
+                        events = []
+        if events:
+            await self._write(job, events, line_number, environment)
+        await self._finish(job)
+
+    async def _write(self, job: BatchJob, events: List[Dict[str, Any]], line_number: int, environment: Optional[str]):
+        """Insert one chunk of events and move the batch's checkpoint past it"""
+        cost = sum(event["total_cost"] for event in events)
+        expected = job.accounted_lines
+
+        async def checkpoint(db) -> None:
+            result = await db.execute(
+                update(BatchJob)
+                .where(BatchJob.id == job.id, BatchJob.accounted_lines == expected)
+                .values(accounted_lines=line_number, actual_cost=BatchJob.actual_cost + cost)
+            )
+            if result.rowcount != 1:
+                raise BatchAccountingConflict(job.id)
+
+        await usage_writer.write(events, checkpoint)
+        job.accounted_lines = line_number
+        job.actual_cost += cost
+        # The live budget counters see the spend as it is written; the hold is released at the end
+        await spend_ledger.settle(Reservation(reserved_scopes(job), current_period(events[0]["created_at"]), 0.0), cost)
+        for event in events:
+            BATCH_LINES_ACCOUNTED.labels("ok" if event["status_code"] == 200 else "error").inc()
+            record_usage_metrics(
+                "openai", job.model, environment, event["input_tokens"], event["output_tokens"], event["total_cost"]
+            )
+
+    async def _finish(self, job: BatchJob) -> None:
+        """Mark the batch accounted and release its budget hold, exactly once"""
+        async with AsyncSessionLocal() as db:
+            result = await db.execute(
+                update(BatchJob)
+                .where(BatchJob.id == job.id, BatchJob.accounted_at.is_(None))
+                .values(accounted_at=datetime.utcnow())
+            )
+            await db.commit()
+        if result.rowcount == 1:
+            await spend_ledger.settle(Reservation(reserved_scopes(job), job.reserved_period, job.estimated_cost), 0.0)
+            logger.info(
+                "Accounted batch %s: %d result lines, $%.6f (estimated $%.6f)",
+                job.id, job.accounted_lines, job.actual_cost, job.estimated_cost
+            )
+
+
+batch_accountant = BatchAccountant()
+
+
+async def resume_batches() -> None:
+    """Restore budget holds for batches still open and resume unfinished accounting
+
+    Called from the app lifespan. Holds live in the spend ledger, so they
+    are only restored into a per-process ledger, in the current month; a
+    Redis ledger keeps them.
+    """
+    async with AsyncSessionLocal() as db:
+        jobs = (await db.execute(select(BatchJob).where(BatchJob.accounted_at.is_(None)))).scalars().all()
+        if isinstance(spend_ledger, LocalSpendLedger):
+            for job in jobs:
+                scopes = [BudgetScope(scope_type, scope_id) for scope_type, scope_id in reserved_scopes(job)]
+                reservation = await spend_ledger.reserve(scopes, job.estimated_cost)
+                job.reserved_period = reservation.period
+            await db.commit()
+    for job in jobs:
+        if job.status in FINAL_STATUSES:
+            batch_accountant.schedule(job.id)
@@ -0,0 +1,227 @@
+import asyncio
+from collections import deque
+from dataclasses import dataclass
+from typing import Any, AsyncIterator, Awaitable, Deque, Dict, Optional, Set
+
+from prometheus_client import Counter, Gauge
+
+from app.config import settings
+from app.utils import hash_request
+
+COALESCED_REQUESTS = Counter(
+    'coalesced_requests_total',
+    'Requests by single-flight role; followers / (leaders + followers) is the coalescing ratio',
+    ['provider', 'role']
+)
+COALESCE_INFLIGHT = Gauge('coalesce_inflight_requests', 'Distinct upstream calls currently open for coalescing')
+
+SCOPES = ("virtual_key", "project", "team", "global")
+
+
+@dataclass
+class BufferedResult:
+    """A complete upstream response, shareable between coalesced requests"""
+    status_code: int
+    body: bytes
+    media_type: str
+    total_cost: float
+    headers: Optional[Dict[str, str]] = None
+
+
+class StreamBroadcast:
+    """One upstream stream fanned out to the readers attached before it starts
+
+    Readers can attach until the first chunk is published; a request
+    arriving later makes its own upstream call. Each chunk is dropped once
+    every attached reader has consumed it, and publishing waits while the
+    slowest reader is STREAM_RELAY_BUFFER_CHUNKS behind, so a stream holds
+    at most that many chunks however long the completion is. A stream whose
+    readers have all gone keeps being read (and accounted) to the end.
+    """
+
+    def __init__(self):
+        self.done = False
+        self.error: Optional[BaseException] = None
+        self.total_cost = 0.0
+        self.headers: Optional[Dict[str, str]] = None
+        self.ready: asyncio.Future = asyncio.get_running_loop().create_future()
+        self._chunks: Deque[bytes] = deque()
+        self._offset = 0  # stream position of _chunks[0]
+        self._end = 0  # stream position after the last chunk published
+        self._readers: Set["StreamReader"] = set()
+        self._changed = asyncio.Event()
+        self._drained = asyncio.Event()
+
+    @property
+    def joinable(self) -> bool:
+        """Whether a new reader would still see the stream from its start"""
+        return not self.done and self._end == 0
+
+    def attach(self) -> "StreamReader":
+        """Register a reader; it must be closed, or read to the end, to stop holding chunks"""
+        if not self.joinable:
+            raise RuntimeError("Stream already started")
+        reader = StreamReader(self)
+        self._readers.add(reader)
+        return reader
+
+    def _notify(self) -> None:
+        self._changed.set()
+        self._changed = asyncio.Event()
+
+    def _release(self) -> None:
+        """Drop chunks every reader is past and wake a waiting publisher"""
+        low = min((reader.position for reader in self._readers), default=self._end)
+        while self._offset < low:
+            self._chunks.popleft()
+            self._offset += 1
+        self._drained.set()
+        self._drained = asyncio.Event()
+
+    def start(self, status_code: int, media_type: str, headers: Optional[Dict[str, str]] = None) -> None:
+        """Publish the upstream status and content type, plus any headers to relay"""
+        self.headers = headers
+        self.ready.set_result((status_code, media_type))
+
+    async def publish(self, chunk: bytes) -> None:
+        """Append a chunk, first waiting for the slowest reader if it is too far behind"""
+        while self._end - self._offset >= settings.STREAM_RELAY_BUFFER_CHUNKS:
+            await self._drained.wait()
+        self._chunks.append(chunk)
+        self._end += 1
+        self._release()
+        self._notify()
+
+    def close(self, total_cost: float = 0.0, error: Optional[BaseException] = None) -> None:
+        """Mark the stream finished, failing readers still waiting to start"""
+        self.total_cost = total_cost
+        self.error = error
+        self.done = True
+        if not self.ready.done():
+            self.ready.set_exception(error or RuntimeError("Upstream stream closed before it started"))
+            # Readers that never awaited it must not log an unretrieved exception
+            self.ready.exception()
+        self._notify()
+
+
+class StreamReader:
+    """One reader's position in a StreamBroadcast"""
+
+    def __init__(self, broadcast: StreamBroadcast):
+        self.broadcast = broadcast
+        self.position = 0
+
+    def close(self) -> None:
+        """Detach from the broadcast, releasing the chunks held for this reader"""
+        broadcast = self.broadcast
+        if self in broadcast._readers:
+            broadcast._readers.discard(self)
+            broadcast._release()
+
+    async def aclose(self) -> None:
+        self.close()
+
+    async def iterate(self) -> AsyncIterator[bytes]:
+        """Yield every chunk from the start, waiting for new ones until done"""
+        broadcast = self.broadcast
+        try:
+            while True:
+                changed = broadcast._changed
+                if self.position < broadcast._end:
+                    chunk = broadcast._chunks[self.position - broadcast._offset]
+                    self.position += 1
+                    broadcast._release()
+                    yield chunk
+                    continue
+                if broadcast.done:
+                    if broadcast.error is not None:
+                        raise RuntimeError("Upstream stream failed") from broadcast.error
+                    return
+                await changed.wait()
+        finally:
+            self.close()
+
+    async def read_all(self) -> bytes:
+        return b"".join([chunk async for chunk in self.iterate()])
+
+
+@dataclass
+class Flight:
+    """An upstream call in progress; `stream` is set for streaming calls"""
+    task: asyncio.Task
+    stream: Optional[StreamBroadcast] = None
+
+
+def _retrieve_exception(task: asyncio.Task) -> None:
+    # Followers may all be gone; don't let the loop warn about lost errors
+    if not task.cancelled():
+        task.exception()
+
+
+class SingleFlight:
+    """Registry of in-flight upstream calls keyed by canonical request hash
+
+    The first request for a key becomes the leader and starts the upstream
+    call as a task; identical requests arriving before it completes attach
+    to that task instead of calling upstream again. Running the call as a
+    task means a leader whose client disconnects doesn't cancel it for the
+    followers. Coalescing is per worker process.
+    """
+
+    def __init__(self, enabled: bool, scope: str):
+        if scope not in SCOPES:
+            raise ValueError(f"COALESCE_SCOPE must be one of {', '.join(SCOPES)}")
+        self.enabled = enabled
+        self.scope = scope
+        self._flights: Dict[str, Flight] = {}
+        COALESCE_INFLIGHT.set_function(lambda: len(self._flights))
+
+    def key_for(self, virtual_key, provider: str, body: Dict[str, Any]) -> Optional[str]:
+        """Coalescing key for a request, or None when coalescing is off"""
+        if not self.enabled:
+            return None
+        scope_id = {
+            "virtual_key": virtual_key.id,
+            "project": virtual_key.project_id,
+            "team": virtual_key.team_id,
+            "global": "*",
+        }[self.scope]
+        # Keys without a project/team only coalesce with themselves
+        scope = f"{self.scope}:{scope_id}" if scope_id is not None else f"virtual_key:{virtual_key.id}"
+        return f"{scope}:{provider}:{hash_request(body)}"
+
+    def join(self, key: Optional[str], provider: str) -> Optional[Flight]:
+        """Return the flight already running for this key, if any"""
+        if key is None:
+            return None
+        flight = self._flights.get(key)
+        if flight is None or flight.task.done():
+            return None
+        if flight.stream is not None and not flight.stream.joinable:
+            # Its first chunks are gone; replaying it would need the whole stream kept
+            return None
+        COALESCED_REQUESTS.labels(provider=provider, role="follower").inc()
+        return flight
+
+    def lead(
+        self,
+        key: Optional[str],
+        provider: str,
+        call: Awaitable,
+        stream: Optional[StreamBroadcast] = None
+    ) -> Flight:
+        """Start an upstream call and, if keyed, let identical requests join it"""
+        flight = Flight(task=asyncio.ensure_future(call), stream=stream)
+        flight.task.add_done_callback(_retrieve_exception)
+        if key is not None:
+            COALESCED_REQUESTS.labels(provider=provider, role="leader").inc()
+            self._flights[key] = flight
+            flight.task.add_done_callback(lambda _: self._forget(key, flight))
+        return flight
+
+    def _forget(self, key: str, flight: Flight) -> None:
+        if self._flights.get(key) is flight:
+            del self._flights[key]
+
+
+single_flight = SingleFlight(enabled=settings.COALESCE_ENABLED, scope=settings.COALESCE_SCOPE)
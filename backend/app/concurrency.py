@@ -0,0 +1,243 @@
+import asyncio
+import heapq
+import itertools
+import time
+from contextlib import asynccontextmanager
+from typing import AsyncIterator, Dict, List, Optional, Tuple
+
+from prometheus_client import Counter, Gauge, Histogram
+
+from app.config import settings
+from app.instrumentation import model_label
+
+# Upstream answers that mean "slow down"; 529 is Anthropic's overloaded_error
+OVERLOAD_STATUSES = frozenset({429, 503, 529})
+
+UPSTREAM_CONCURRENCY_LIMIT = Gauge(
+    'upstream_concurrency_limit', 'Adaptive limit on concurrent upstream calls', ['provider', 'model']
+)
+UPSTREAM_INFLIGHT = Gauge('upstream_inflight_requests', 'Upstream calls in progress', ['provider', 'model'])
+UPSTREAM_QUEUE_DEPTH = Gauge(
+    'upstream_queue_depth', 'Requests waiting for an upstream concurrency slot', ['provider', 'model']
+)
+UPSTREAM_QUEUE_WAIT = Histogram(
+    'upstream_queue_wait_seconds', 'Time requests waited for an upstream concurrency slot', ['provider', 'priority'],
+    buckets=(0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+)
+UPSTREAM_SHED = Counter(
+    'upstream_shed_requests_total', 'Requests refused while waiting for an upstream slot',
+    ['provider', 'model', 'priority', 'reason']
+)
+
+
+class UpstreamOverloaded(Exception):
+    """A request was shed instead of waiting longer for an upstream slot"""
+
+    def __init__(self, provider: str, reason: str):
+        super().__init__(f"Upstream {provider} is overloaded ({reason.replace('_', ' ')}); retry later")
+        self.reason = reason
+
+
+class UpstreamSlot:
+    """How one upstream call went, reported to its limiter on release"""
+    __slots__ = ("latency", "overloaded")
+
+    def __init__(self):
+        self.latency: Optional[float] = None
+        self.overloaded = False
+
+    def record(self, latency: Optional[float], status_code: int) -> None:
+        self.latency = latency
+        self.overloaded = status_code in OVERLOAD_STATUSES
+
+
+class AdaptiveLimiter:
+    """AIMD concurrency limit with a priority queue for one provider/model
+
+    The limit grows by one per limit's worth of successful calls while it
+    is actually in use, and is cut by `backoff` when the upstream answers
+    429/503/529, fails, or its recent latency exceeds `latency_tolerance`
+    times its long-run baseline (at most once per recent round trip).
+    Calls over the limit wait in priority order, each for at most
+    `queue_timeout`; a full queue sheds its lowest-priority entry.
+    Everything runs on the event loop, so no locking is needed.
+    """
+
+    def __init__(self, provider: str, model: str):
+        self.provider = provider
+        self.model = model
+        self.limit = float(settings.CONCURRENCY_INITIAL_LIMIT)
+        self.in_flight = 0
+        self._waiters: List[list] = []  # heap of [priority, sequence, future, priority label]
+        self._queued = 0  # waiters still waiting; cancelled ones stay in the heap until popped
+        self._sequence = itertools.count()
+        # Per call kind (streaming or not): [recent EWMA, long-run baseline EWMA]
+        self._latency: Dict[bool, List[float]] = {}
+        self._last_decrease = 0.0
+        self._limit_gauge = UPSTREAM_CONCURRENCY_LIMIT.labels(provider, model)
+        self._inflight_gauge = UPSTREAM_INFLIGHT.labels(provider, model)
+        self._queue_gauge = UPSTREAM_QUEUE_DEPTH.labels(provider, model)
+        self._limit_gauge.set(self.limit)
+
+    @property
+    def queue_depth(self) -> int:
+        return self._queued
+
+    async def acquire(self, priority: int, priority_label: str) -> None:
+        """Wait for a slot, or raise UpstreamOverloaded when shed"""
+        if self.in_flight < int(self.limit) and not self._queued:
+            self._take()
+            return
+
+        start = time.perf_counter()
+        if self._queued >= settings.CONCURRENCY_MAX_QUEUE:
+            self._shed_lowest(priority, priority_label)
+        future = asyncio.get_running_loop().create_future()
+        heapq.heappush(self._waiters, [priority, next(self._sequence), future, priority_label])
+        self._set_queued(self._queued + 1)
+        try:
+            await asyncio.wait_for(future, settings.CONCURRENCY_QUEUE_TIMEOUT)
+        except asyncio.TimeoutError:
+            self._set_queued(self._queued - 1)
+            UPSTREAM_SHED.labels(self.provider, self.model, priority_label, "queue_timeout").inc()
+            raise UpstreamOverloaded(self.provider, "queue_timeout")
+        except asyncio.CancelledError:
+            if future.cancelled():
+                self._set_queued(self._queued - 1)
+            elif future.exception() is None:
+                # Granted a slot just as the client went away: hand it on
+                self.release(None, overloaded=False, streaming=False)
+            raise
+        finally:
+            UPSTREAM_QUEUE_WAIT.labels(self.provider, priority_label).observe(time.perf_counter() - start)
+
+    def release(self, latency: Optional[float], overloaded: bool, streaming: bool) -> None:
+        """Return a slot, adapting the limit from how the call went
+
+        `latency` is the upstream time to first byte for streams and the
+        full response time otherwise, so the two kinds keep separate
+        baselines; None skips the latency signal.
+        """
+        utilized = self.in_flight >= self.limit / 2
+        self.in_flight -= 1
+        self._inflight_gauge.set(self.in_flight)
+        now = time.monotonic()
+        congested = overloaded
+        ewma = self._latency.get(streaming)
+        if latency is not None:
+            if ewma is None:
+                ewma = self._latency[streaming] = [latency, latency]
+            else:
+                ewma[0] += 0.2 * (latency - ewma[0])
+                ewma[1] += 0.01 * (latency - ewma[1])
+            congested = congested or ewma[0] > ewma[1] * settings.CONCURRENCY_LATENCY_TOLERANCE
+        if congested:
+            # One cut per round trip, so a burst of 429s from one window counts once
+            if now - self._last_decrease >= (ewma[0] if ewma else 1.0):
+                self._last_decrease = now
+                self.limit = max(settings.CONCURRENCY_MIN_LIMIT, self.limit * settings.CONCURRENCY_BACKOFF)
+        elif utilized:
+            self.limit = min(settings.CONCURRENCY_MAX_LIMIT, self.limit + 1 / self.limit)
+        self._limit_gauge.set(self.limit)
+        self._grant()
+
+    def _take(self) -> None:
+        self.in_flight += 1
+        self._inflight_gauge.set(self.in_flight)
+
+    def _set_queued(self, queued: int) -> None:
+        self._queued = queued
+        self._queue_gauge.set(queued)
+        if not queued:
+            # Whatever is left are timed-out or cancelled waiters
+            self._waiters.clear()
+
+    def _grant(self) -> None:
+        """Hand free slots to the highest-priority waiters"""
+        while self._queued and self.in_flight < int(self.limit):
+            future = heapq.heappop(self._waiters)[2]
+            if future.done():
+                continue
+            self._take()
+            self._set_queued(self._queued - 1)
+            future.set_result(None)
+
+    def _shed_lowest(self, priority: int, priority_label: str) -> None:
+        """Make room in a full queue by refusing its lowest-priority, newest waiter"""
+        live = [waiter for waiter in self._waiters if not waiter[2].done()]
+        worst = max(live)
+        if worst[0] <= priority:
+            # Nothing queued is less important than the newcomer
+            UPSTREAM_SHED.labels(self.provider, self.model, priority_label, "queue_full").inc()
+            raise UpstreamOverloaded(self.provider, "queue_full")
+        live.remove(worst)
+        heapq.heapify(live)
+        self._waiters = live
+        self._set_queued(self._queued - 1)
+        worst[2].set_exception(UpstreamOverloaded(self.provider, "queue_full"))
+        UPSTREAM_SHED.labels(self.provider, self.model, worst[3], "queue_full").inc()
+
+
+class UpstreamAdmission:
+    """Adaptive limiters per provider and model, created on first use
+
+    Models without a known price share one "other" limiter per provider, so
+    arbitrary model names cannot create unbounded state. Limits are per
+    worker process.
+    """
+
+    def __init__(self, enabled: bool, priorities: str):
+        self.enabled = enabled
+        self.priorities = [environment.strip() for environment in priorities.split(",") if environment.strip()]
+        self._ranks = {environment: rank for rank, environment in enumerate(self.priorities)}
+        self._limiters: Dict[Tuple[str, str], AdaptiveLimiter] = {}
+
+    def limiter(self, provider: str, model: str) -> Optional[AdaptiveLimiter]:
+        if not self.enabled:
+            return None
+        key = (provider, model_label(provider, model))
+        limiter = self._limiters.get(key)
+        if limiter is None:
+            limiter = self._limiters[key] = AdaptiveLimiter(*key)
+        return limiter
+
+    @asynccontextmanager
+    async def slot(
+        self,
+        provider: str,
+        model: str,
+        environment: Optional[str],
+        streaming: bool
+    ) -> AsyncIterator[UpstreamSlot]:
+        """Hold an upstream concurrency slot for the duration of a call
+
+        Raises UpstreamOverloaded if the request is shed while it waits.
+        The caller records the call's latency and status on the slot; an
+        exception out of the block counts as an overload signal.
+        """
+        slot = UpstreamSlot()
+        limiter = self.limiter(provider, model)
+        if limiter is None:
+            yield slot
+            return
+        await limiter.acquire(*self.priority(environment))
+        try:
+            yield slot
+        except Exception:
+            slot.overloaded = True
+            raise
+        finally:
+            limiter.release(slot.latency, slot.overloaded, streaming)
+
+    def priority(self, environment: Optional[str]) -> Tuple[int, str]:
+        """(rank, label) for a key environment; unlisted environments come last"""
+        rank = self._ranks.get(environment)
+        if rank is None:
+            return len(self.priorities), "other"
+        return rank, environment
+
+
+upstream_admission = UpstreamAdmission(
+    enabled=settings.CONCURRENCY_ENABLED,
+    priorities=settings.CONCURRENCY_PRIORITIES,
+)
@@ -5,7 +5,13 @@ from typing import List
 class Settings(BaseSettings):
     # Default to SQLite for local dev (no PostgreSQL required on Windows)
     DATABASE_URL: str = "sqlite:///./app.db"
+    # Async driver URL for request handlers; derived from DATABASE_URL when empty
+    ASYNC_DATABASE_URL: str = ""
     REDIS_URL: str = "redis://localhost:6379/0"
+    REDIS_ENABLED: bool = False  # cross-worker features (cache invalidation, shared counters)
+    # Worker processes serving the app (uvicorn and gunicorn read it as their --workers default);
+    # more than one requires REDIS_ENABLED so budget caps hold across workers
+    WEB_CONCURRENCY: int = 1
     # Dev-only defaults; set in .env for production
     SECRET_KEY: str = "dev-secret-key-change-in-production"
     JWT_SECRET: str = "dev-jwt-secret-change-in-production"
@@ -13,14 +19,121 @@ class Settings(BaseSettings):
     JWT_EXPIRATION_HOURS: int = 24
     OPENAI_API_KEY: str = ""
     ANTHROPIC_API_KEY: str = ""
+    OPENAI_BASE_URL: str = "https://api.openai.com"
+    ANTHROPIC_BASE_URL: str = "https://api.anthropic.com"
     CORS_ORIGINS: str = "http://localhost:5173,http://localhost:3000"
     
-    # Model pricing (per 1M tokens) - defaults
+    # Upstream HTTP clients (one pooled client per provider, shared across requests)
+    UPSTREAM_MAX_CONNECTIONS: int = 200
+    UPSTREAM_MAX_KEEPALIVE_CONNECTIONS: int = 50
+    UPSTREAM_KEEPALIVE_EXPIRY: float = 30.0
+    UPSTREAM_HTTP2: bool = False  # requires the h2 package (pip install "httpx[http2]")
+    UPSTREAM_CONNECT_TIMEOUT: float = 5.0
+    UPSTREAM_READ_TIMEOUT: float = 60.0
+    UPSTREAM_WRITE_TIMEOUT: float = 10.0
+    UPSTREAM_POOL_TIMEOUT: float = 5.0
+    
+    # Upstream target pools: JSON lists of {"name", "base_url", "api_key", "weight", "path",
+    # "api_key_header", "models"}; empty means the single *_BASE_URL / *_API_KEY endpoint
+    OPENAI_UPSTREAMS: List[dict] = []
+    ANTHROPIC_UPSTREAMS: List[dict] = []
+    UPSTREAM_EJECT_FAILURES: int = 5  # failures in a row that take a target out of rotation
+    UPSTREAM_EJECT_SECONDS: float = 30.0  # first ejection; doubles on each repeat
+    UPSTREAM_EJECT_MAX_SECONDS: float = 300.0
+    UPSTREAM_HEALTH_DECAY: float = 10.0  # seconds for an idle target's latency/error stats to fade by 1/e
+    
+    # Write-behind queue for usage events
+    USAGE_WRITER_QUEUE_SIZE: int = 10000
+    USAGE_WRITER_BATCH_SIZE: int = 500
+    USAGE_WRITER_FLUSH_INTERVAL: float = 0.5  # seconds
+    
+    # Virtual key lookup cache
+    KEY_CACHE_MAX_SIZE: int = 10000
+    KEY_CACHE_TTL: float = 60.0  # seconds
+    KEY_CACHE_NEGATIVE_MAX_SIZE: int = 1000
+    KEY_CACHE_NEGATIVE_TTL: float = 5.0
+    KEY_CACHE_INVALIDATION_CHANNEL: str = "aca:virtual-key-invalidations"
+    
+    # Budget enforcement: output tokens assumed when a request sets no max_tokens
+    BUDGET_RESERVATION_OUTPUT_TOKENS: int = 1024
+    
+    # Prompt fingerprinting: request bodies at least this large are hashed off the event loop
+    FINGERPRINT_OFFLOAD_BYTES: int = 1024 * 1024
+    
+    # Near-duplicate prompt detection (MinHash signatures, LSH band index)
+    NEAR_DUPLICATE_SAMPLE_CHARS: int = 4096  # leading prompt text that is fingerprinted
+    NEAR_DUPLICATE_THRESHOLD: float = 0.7  # estimated word-bigram Jaccard similarity to join a cluster
+    NEAR_DUPLICATE_RETENTION_DAYS: int = 366  # clusters idle longer are pruned, sooner under USAGE_RETENTION_MONTHS
+    
+    # Repeated-prompt heavy hitters (Space-Saving summaries per scope and UTC day)
+    HEAVY_HITTERS_EPSILON: float = 0.001  # global count error bound, as a share of requests (1/epsilon counters)
+    HEAVY_HITTERS_SCOPE_EPSILON: float = 0.01  # the same per virtual key and per project
+    HEAVY_HITTERS_WINDOW_DAYS: int = 7
+    HEAVY_HITTERS_CHECKPOINT_INTERVAL: float = 30.0  # seconds
+    
+    # Monthly usage_events storage and retention (scripts/maintain_usage_events.py)
+    USAGE_PARTITION_MONTHS_AHEAD: int = 3  # Postgres partitions created ahead of time
+    USAGE_RETENTION_MONTHS: int = 0  # months kept in the database; older ones are archived, 0 keeps everything
+    USAGE_ARCHIVE_DIR: str = "./archive"  # Parquet archive of expired months (needs pyarrow)
+    USAGE_ARCHIVE_BATCH_SIZE: int = 50000  # rows per archive read and per delete transaction
+    
+    # Exact-match response cache (opt-in per virtual key)
+    RESPONSE_CACHE_MAX_BYTES: int = 64 * 1024 * 1024  # in-process LRU budget
+    RESPONSE_CACHE_MAX_ENTRY_BYTES: int = 1024 * 1024  # larger responses are not cached
+    RESPONSE_CACHE_DEFAULT_TTL: int = 3600  # seconds, when the key sets no TTL
+    RESPONSE_CACHE_REDIS: bool = False  # share cached responses across workers (needs REDIS_ENABLED)
+    
+    # Adaptive upstream concurrency (AIMD limit per provider/model) with a priority queue
+    CONCURRENCY_ENABLED: bool = True
+    CONCURRENCY_INITIAL_LIMIT: int = 32
+    CONCURRENCY_MIN_LIMIT: int = 2
+    CONCURRENCY_MAX_LIMIT: int = 1000
+    CONCURRENCY_BACKOFF: float = 0.75  # limit multiplier on 429/503/529, failures or rising latency
+    CONCURRENCY_LATENCY_TOLERANCE: float = 2.0  # recent / baseline upstream latency treated as congestion
+    CONCURRENCY_MAX_QUEUE: int = 1000  # waiting requests per provider/model; lowest priority shed first
+    CONCURRENCY_QUEUE_TIMEOUT: float = 10.0  # seconds a request may wait before it is shed (503)
+    CONCURRENCY_PRIORITIES: str = "prod,staging,dev"  # key environments, highest priority first
+    
+    # Upstream retries (429/5xx/connection errors), hedging and per-provider circuit breaking
+    RETRY_MAX_ATTEMPTS: int = 3  # upstream tries per request, including the first
+    RETRY_BACKOFF_BASE: float = 0.25  # seconds; full jitter up to base * 2^(retry - 1)
+    RETRY_BACKOFF_MAX: float = 4.0
+    RETRY_MAX_RETRY_AFTER: float = 10.0  # a longer Retry-After is passed to the client instead of waited out
+    HEDGE_ENABLED: bool = False  # non-streaming only; a hedge that also completes bills its tokens too
+    HEDGE_PERCENTILE: float = 95.0  # hedge once the first call is slower than this share of recent calls
+    HEDGE_MIN_SAMPLES: int = 100  # recent calls to a model needed before hedging it
+    HEDGE_MAX_RATIO: float = 0.05  # hedges as a share of requests
+    CIRCUIT_FAILURE_RATIO: float = 0.5
+    CIRCUIT_MIN_CALLS: int = 20  # calls in the window before the circuit may open
+    CIRCUIT_WINDOW: float = 30.0  # seconds
+    CIRCUIT_OPEN_SECONDS: float = 15.0  # fail fast this long, then let one probe call through
+    
+    # Single-flight: identical in-flight requests share one upstream call
+    COALESCE_ENABLED: bool = True
+    COALESCE_SCOPE: str = "virtual_key"  # virtual_key, project, team, global
+    STREAM_RELAY_BUFFER_CHUNKS: int = 64  # chunks a stream may run ahead of its slowest reader
+    
+    # Embeddings micro-batching: concurrent small requests for one model share an upstream call
+    EMBEDDINGS_BATCH_ENABLED: bool = False
+    EMBEDDINGS_BATCH_WINDOW: float = 0.005  # seconds the first request of a batch waits for company
+    EMBEDDINGS_BATCH_MAX_INPUTS: int = 2048  # inputs per upstream call (OpenAI's limit)
+    EMBEDDINGS_BATCH_MAX_TOKENS: int = 100000  # estimated tokens per upstream call
+    EMBEDDINGS_BATCH_REQUEST_INPUTS: int = 16  # requests with more inputs are sent on their own
+    
+    # OpenAI Batch API through the proxy (/proxy/openai/v1/files, /proxy/openai/v1/batches)
+    BATCH_PRICE_RATIO: float = 0.5  # batch calls are billed at this share of the model's price
+    BATCH_ACCOUNTING_CHUNK_SIZE: int = 1000  # result lines per bulk insert of usage events
+    
+    # Model pricing (per 1M tokens) - defaults; rows in model_prices take precedence
+    PRICING_REFRESH_INTERVAL: float = 60.0  # seconds between model_prices reloads in each worker
     OPENAI_PRICING: dict = {
         "gpt-4o": {"input": 2.50, "output": 10.00},
         "gpt-4o-mini": {"input": 0.15, "output": 0.60},
         "gpt-4-turbo": {"input": 10.00, "output": 30.00},
         "gpt-3.5-turbo": {"input": 0.50, "output": 1.50},
+        "text-embedding-3-small": {"input": 0.02, "output": 0.00},
+        "text-embedding-3-large": {"input": 0.13, "output": 0.00},
+        "text-embedding-ada-002": {"input": 0.10, "output": 0.00},
     }
     
     ANTHROPIC_PRICING: dict = {
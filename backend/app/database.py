@@ -1,4 +1,6 @@
-from sqlalchemy import create_engine
+from typing import Sequence
+from sqlalchemy import create_engine, event
+from sqlalchemy.ext.asyncio import AsyncSession, async_sessionmaker, create_async_engine
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import sessionmaker
 from app.config import settings
@@ -8,6 +10,7 @@ _connect_args = {}
 if _db_url.startswith("sqlite"):
     _connect_args["check_same_thread"] = False
 
+# Sync engine: scripts (seed, backfills), Alembic and table creation
 engine = create_engine(
     _db_url,
     connect_args=_connect_args,
@@ -18,6 +21,39 @@ engine = create_engine(
 
 SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
 
+def _async_url(url: str) -> str:
+    """Derive the async driver URL (asyncpg / aiosqlite) from DATABASE_URL"""
+    if settings.ASYNC_DATABASE_URL:
+        return settings.ASYNC_DATABASE_URL
+    scheme, _, rest = url.partition("://")
+    if scheme in ("postgresql", "postgres", "postgresql+psycopg2"):
+        return f"postgresql+asyncpg://{rest}"
+    if scheme in ("sqlite", "sqlite+pysqlite"):
+        return f"sqlite+aiosqlite://{rest}"
+    return url
+
+_async_db_url = _async_url(_db_url)
+_async_is_sqlite = _async_db_url.startswith("sqlite")
+
+# Async engine: every request handler. SQLite gets a few connections in WAL
+# mode so dashboard reads don't queue behind proxy writes.
+async_engine = create_async_engine(
+    _async_db_url,
+    pool_pre_ping=not _async_is_sqlite,
+    pool_size=10 if not _async_is_sqlite else 5,
+    max_overflow=20 if not _async_is_sqlite else 0,
+)
+
+if _async_is_sqlite:
+    @event.listens_for(async_engine.sync_engine, "connect")
+    def _sqlite_pragmas(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        cursor.execute("PRAGMA journal_mode=WAL")
+        cursor.execute("PRAGMA busy_timeout=5000")
+        cursor.close()
+
+AsyncSessionLocal = async_sessionmaker(async_engine, expire_on_commit=False, autoflush=False)
+
 Base = declarative_base()
 
 def get_db():
@@ -27,3 +63,33 @@ def get_db():
         yield db
     finally:
         db.close()
+
+async def get_async_db():
+    """Dependency for getting an async database session"""
+    async with AsyncSessionLocal() as db:
+        yield db
+
+def upsert_increment_stmt(
+    dialect: str,
+    table,
+    key_columns: Sequence[str],
+    increment_columns: Sequence[str]
+):
+    """Build an insert that adds counters to rows that already exist
+
+    Used for counter tables (ledgers, rollups) so concurrent writers never
+    read-modify-write. Execute it with a list of row dicts. Supports the
+    PostgreSQL and SQLite dialects.
+    """
+    if dialect == "postgresql":
+        from sqlalchemy.dialects.postgresql import insert
+    elif dialect == "sqlite":
+        from sqlalchemy.dialects.sqlite import insert
+    else:
+        raise NotImplementedError(f"upsert_increment_stmt is not supported on {dialect}")
+
+    stmt = insert(table)
+    return stmt.on_conflict_do_update(
+        index_elements=list(key_columns),
+        set_={column: table.c[column] + stmt.excluded[column] for column in increment_columns}
+    )
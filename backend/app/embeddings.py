@@ -0,0 +1,176 @@
+import asyncio
+from dataclasses import dataclass, field
+from typing import Any, Awaitable, Callable, Dict, List, Optional, Tuple
+
+from prometheus_client import Histogram
+
+from app.config import settings
+from app.utils import hash_request
+
+EMBEDDING_BATCH_SIZE = Histogram(
+    'embedding_batch_requests', 'Embedding requests merged into one upstream call',
+    buckets=(1, 2, 4, 8, 16, 32, 64, 128, 256, 512, 1024)
+)
+
+
+def embedding_inputs(body: Dict[str, Any]) -> Optional[Tuple[str, list]]:
+    """Split an embeddings request's input into ("text" or "tokens", list of inputs)
+
+    Returns None when the input is missing or not one of the shapes the
+    API accepts: a string, an array of strings, an array of token ids or
+    an array of token id arrays.
+    """
+    value = body.get("input")
+    if isinstance(value, str):
+        return "text", [value]
+    if not isinstance(value, list) or not value:
+        return None
+    if all(isinstance(item, str) for item in value):
+        return "text", value
+    if all(isinstance(item, int) for item in value):
+        return "tokens", [value]
+    if all(isinstance(item, list) and all(isinstance(token, int) for token in item) for item in value):
+        return "tokens", value
+    return None
+
+
+def estimate_tokens(kind: str, inputs: list) -> int:
+    """Rough token count of a request's inputs (1 token ≈ 4 chars of text)"""
+    if kind == "tokens":
+        return sum(len(tokens) for tokens in inputs)
+    return sum(max(1, len(text) // 4) for text in inputs)
+
+
+def split_tokens(total: int, weights: List[int]) -> List[int]:
+    """Divide a batch's billed tokens between its requests in proportion to their weights
+
+    Uses largest remainders, so the shares add up to exactly `total`.
+    """
+    weight_sum = sum(weights)
+    if not weight_sum:
+        weights, weight_sum = [1] * len(weights), len(weights)
+    exact = [total * weight / weight_sum for weight in weights]
+    shares = [int(value) for value in exact]
+    by_remainder = sorted(range(len(weights)), key=lambda index: exact[index] - shares[index], reverse=True)
+    for index in by_remainder[:total - sum(shares)]:
+        shares[index] += 1
+    return shares
+
+
+@dataclass
+class BatchEntry:
+    """One caller's request waiting in a batch
+
+    `params` are the request's fields other than model and input, which
+    every entry of a batch shares; `call` is the caller's accounting
+    context, opaque to the batcher.
+    """
+    inputs: list
+    weight: int
+    params: Dict[str, Any]
+    call: Any
+    future: Optional[asyncio.Future] = None
+
+
+@dataclass
+class _Batch:
+    entries: List[BatchEntry] = field(default_factory=list)
+    inputs: int = 0
+    weight: int = 0
+    timer: Optional[asyncio.TimerHandle] = None
+
+
+BatchSender = Callable[[List[BatchEntry]], Awaitable[list]]
+
+
+class EmbeddingBatcher:
+    """Merge concurrent small embedding requests into one upstream call per model
+
+    The first request for a model and parameter set opens a batch and
+    waits up to `window` seconds for others; the batch is sent early once
+    it reaches `max_inputs` inputs or `max_tokens` estimated tokens. The
+    send runs as a task, so a caller that disconnects doesn't cancel it
+    for the rest of the batch. Batching is per worker process.
+    """
+
+    def __init__(self, enabled: bool, window: float, max_inputs: int, max_tokens: int, request_inputs: int):
+        self.enabled = enabled
+        self.window = window
+        self.max_inputs = max_inputs
+        self.max_tokens = max_tokens
+        self.request_inputs = request_inputs
+        self._open: Dict[str, _Batch] = {}
+        self._tasks: set = set()
+
+    def accepts(self, inputs: list, weight: int) -> bool:
+        """Whether a request is small enough to be batched"""
+        return (
+            self.enabled
+            and len(inputs) <= min(self.request_inputs, self.max_inputs)
+            and weight <= self.max_tokens
+        )
+
+    def key_for(self, provider: str, model: str, kind: str, params: Dict[str, Any]) -> str:
+        """Requests only share a batch when everything but their input matches"""
+        return f"{provider}:{model}:{kind}:{hash_request(params)}"
+
+    async def submit(self, key: str, entry: BatchEntry, send: BatchSender) -> Any:
+        """Add a request to its open batch and wait for its share of the result
+
+        `send` makes the upstream call for a whole batch and returns one
+        result per entry, in order; the batch's first `send` is used.
+        """
+        entry.future = asyncio.get_running_loop().create_future()
+        batch = self._open.get(key)
+        if batch is not None and (
+            batch.inputs + len(entry.inputs) > self.max_inputs or batch.weight + entry.weight > self.max_tokens
+        ):
+            self._flush(key, send)
+            batch = None
+        if batch is None:
+            batch = self._open[key] = _Batch()
+            batch.timer = asyncio.get_running_loop().call_later(self.window, self._flush, key, send)
+        batch.entries.append(entry)
+        batch.inputs += len(entry.inputs)
+        batch.weight += entry.weight
+        if batch.inputs >= self.max_inputs or batch.weight >= self.max_tokens:
+            self._flush(key, send)
+        # Shielded: a disconnecting caller must not cancel the batch's call
+        return await asyncio.shield(entry.future)
+
+    def _flush(self, key: str, send: BatchSender) -> None:
+        batch = self._open.pop(key, None)
+        if batch is None:
+            return
+        batch.timer.cancel()
+        EMBEDDING_BATCH_SIZE.observe(len(batch.entries))
+        task = asyncio.create_task(self._send(batch.entries, send))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def _send(self, entries: List[BatchEntry], send: BatchSender) -> None:
+        try:
+            results = await send(entries)
+        except asyncio.CancelledError:
+            for entry in entries:
+                entry.future.cancel()
+            raise
+        except Exception as exc:
+            for entry in entries:
+                if not entry.future.done():
+                    entry.future.set_exception(exc)
+                    # Callers may all be gone; don't let the loop warn about lost errors
+                    entry.future.exception()
+            return
+        for entry, result in zip(entries, results):
+            if not entry.future.done():
+                entry.future.set_result(result)
+
+
+embedding_batcher = EmbeddingBatcher(
+    enabled=settings.EMBEDDINGS_BATCH_ENABLED,
+    window=settings.EMBEDDINGS_BATCH_WINDOW,
+    max_inputs=settings.EMBEDDINGS_BATCH_MAX_INPUTS,
+    max_tokens=settings.EMBEDDINGS_BATCH_MAX_TOKENS,
+    request_inputs=settings.EMBEDDINGS_BATCH_REQUEST_INPUTS,
+)
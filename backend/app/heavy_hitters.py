@@ -0,0 +1,343 @@
+import asyncio
+import heapq
+import logging
+import math
+import time
+import uuid
+from collections import defaultdict
+from datetime import datetime, timedelta
+from typing import Dict, Iterable, List, Optional, Tuple
+
+from sqlalchemy import delete, or_, select, update
+
+from app.config import settings
+from app.database import AsyncSessionLocal
+from app.json_scan import dumps, loads
+from app.models import PromptHeavyHitters
+from app.rollups import bucket_start
+
+logger = logging.getLogger(__name__)
+
+GLOBAL_SCOPE = ("global", 0)
+# Checkpoint intervals without a heartbeat after which a worker's rows are taken over
+_STALE_CHECKPOINTS = 4
+
+
+class SpaceSaving:
+    """Approximate top-k counter in bounded memory (Metwally et al., Space-Saving)
+
+    Keeps at most `capacity` counters. When a new item arrives and every
+    counter is taken, it replaces the smallest one and inherits its count
+    as `error`. Each count overestimates the true count by at most its
+    error, which is at most total / capacity, and any item seen more than
+    total / capacity times is guaranteed to be tracked.
+    """
+
+    def __init__(self, capacity: int):
+        self.capacity = capacity
+        self.total = 0
+        # item -> [count, error, cost]; cost only covers occurrences since the counter was taken
+        self.counters: Dict[str, List[float]] = {}
+        # One (count, item) entry per counter, refreshed lazily when popped stale
+        self._heap: List[Tuple[float, str]] = []
+
+    def add(self, item: str, cost: float = 0.0, count: int = 1) -> None:
+        self.total += count
+        counter = self.counters.get(item)
+        if counter is not None:
+            counter[0] += count
+            counter[2] += cost
+            return
+        if len(self.counters) < self.capacity:
+            self.counters[item] = [count, 0, cost]
+            heapq.heappush(self._heap, (count, item))
+            return
+        floor, victim = self._pop_min()
+        del self.counters[victim]
+        self.counters[item] = [floor + count, floor, cost]
+        heapq.heappush(self._heap, (floor + count, item))
+
+    def _pop_min(self) -> Tuple[float, str]:
+        while True:
+            count, item = heapq.heappop(self._heap)
+            current = self.counters[item][0]
+            if current == count:
+                return count, item
+            heapq.heappush(self._heap, (current, item))
+
+    @property
+    def floor(self) -> float:
+        """Upper bound on the count of any item not being tracked"""
+        if len(self.counters) < self.capacity:
+            return 0
+        return min(counter[0] for counter in self.counters.values())
+
+    def top(self, limit: int) -> List[Tuple[str, float, float, float]]:
+        """The `limit` largest (item, count, error, cost) entries"""
+        entries = heapq.nlargest(limit, self.counters.items(), key=lambda entry: entry[1][0])
+        return [(item, count, error, cost) for item, (count, error, cost) in entries]
+
+    def to_json(self) -> bytes:
+        return dumps({"capacity": self.capacity, "total": self.total, "counters": self.counters})
+
+    @classmethod
+    def from_json(cls, raw: bytes) -> "SpaceSaving":
+        data = loads(raw)
+        summary = cls(data["capacity"])
+        summary.total = data["total"]
+        summary.counters = data["counters"]
+        summary._heap = [(counter[0], item) for item, counter in summary.counters.items()]
+        heapq.heapify(summary._heap)
+        return summary
+
+    @classmethod
+    def merge(cls, summaries: Iterable["SpaceSaving"], capacity: int) -> "SpaceSaving":
+        """Combine summaries of disjoint streams, keeping the error bounds
+
+        An item missing from a full summary may still have occurred up to
+        that summary's floor times there, so the floor is added to both its
+        count and its error.
+        """
+        summaries = [summary for summary in summaries if summary.total]
+        merged = cls(capacity)
+        merged.total = sum(summary.total for summary in summaries)
+        floors = [summary.floor for summary in summaries]
+        # Start every item at "absent everywhere", then swap in real counters
+        absent = sum(floors)
+        counters: Dict[str, List[float]] = {}
+        for summary, floor in zip(summaries, floors):
+            for item, (count, error, cost) in summary.counters.items():
+                counter = counters.get(item)
+                if counter is None:
+                    counter = counters[item] = [absent, absent, 0.0]
+                counter[0] += count - floor
+                counter[1] += error - floor
+                counter[2] += cost
+        kept = heapq.nlargest(capacity, counters.items(), key=lambda entry: entry[1][0])
+        merged.counters = dict(kept)
+        merged._heap = [(counter[0], item) for item, counter in kept]
+        heapq.heapify(merged._heap)
+        return merged
+
+
+def estimated_repeat_cost(count: float, error: float, cost: float) -> float:
+    """Cost of every repeat after the first, from the average observed cost"""
+    observed = count - error
+    if observed <= 0:
+        return 0.0
+    return (count - 1) * (cost / observed)
+
+
+class HeavyHitters:
+    """Repeated-prompt summaries per scope (global, virtual key, project) and UTC day
+
+    Each worker feeds its own Space-Saving summaries from the ingest path
+    and periodically checkpoints them to `prompt_heavy_hitters` under its
+    own worker id, so checkpoints from different workers never conflict
+    and readers merge them. Every checkpoint also heartbeats the worker's
+    rows; rows of a worker that has stopped (each process gets a new id)
+    are folded into a live worker's summaries once their heartbeat is
+    _STALE_CHECKPOINTS intervals old. Reading the top repeated prompts
+    costs O(capacity x days x live workers), independent of the number of
+    events and of restarts.
+    """
+
+    def __init__(self, epsilon: float, scope_epsilon: float, window_days: int, checkpoint_interval: float):
+        self.global_capacity = math.ceil(1 / epsilon)
+        self.scope_capacity = math.ceil(1 / scope_epsilon)
+        self.window_days = window_days
+        self.checkpoint_interval = checkpoint_interval
+        self.worker_id = uuid.uuid4().hex
+        self._summaries: Dict[Tuple[str, int, datetime], SpaceSaving] = {}
+        self._dirty = set()
+        # Keys this worker has rows for in prompt_heavy_hitters
+        self._written = set()
+        self._task: Optional[asyncio.Task] = None
+        # Merged checkpoints from other workers: key -> (expires, summaries)
+        self._peer_cache: Dict[Tuple, Tuple[float, List[SpaceSaving]]] = {}
+
+    def capacity_for(self, scope_type: str) -> int:
+        return self.global_capacity if scope_type == "global" else self.scope_capacity
+
+    def observe(
+        self,
+        prompt_hash: Optional[str],
+        cost: float,
+        virtual_key_id: int,
+        project_id: Optional[int] = None,
+        timestamp: Optional[datetime] = None
+    ) -> None:
+        """Count one request for its prompt hash in every scope it belongs to"""
+        if not prompt_hash:
+            return
+        day = bucket_start(timestamp or datetime.utcnow(), "day")
+        scopes = [GLOBAL_SCOPE, ("virtual_key", virtual_key_id)]
+        if project_id is not None:
+            scopes.append(("project", project_id))
+        for scope_type, scope_id in scopes:
+            key = (scope_type, scope_id, day)
+            summary = self._summaries.get(key)
+            if summary is None:
+                summary = self._summaries[key] = SpaceSaving(self.capacity_for(scope_type))
+            summary.add(prompt_hash, cost)
+            self._dirty.add(key)
+
+    def _window(self, days: int) -> List[datetime]:
+        today = bucket_start(datetime.utcnow(), "day")
+        return [today - timedelta(days=offset) for offset in range(days)]
+
+    async def _peer_summaries(self, db, scope_type: str, scope_ids: Tuple[int, ...], days: List[datetime]) -> List[SpaceSaving]:
+        """Checkpointed summaries from other workers, cached for one checkpoint interval"""
+        cache_key = (scope_type, scope_ids, days[-1])
+        cached = self._peer_cache.get(cache_key)
+        if cached is not None and cached[0] > time.monotonic():
+            return cached[1]
+        rows = await db.execute(
+            select(PromptHeavyHitters.summary).where(
+                PromptHeavyHitters.worker_id != self.worker_id,
+                PromptHeavyHitters.scope_type == scope_type,
+                PromptHeavyHitters.scope_id.in_(scope_ids),
+                PromptHeavyHitters.window_start >= days[-1]
+            )
+        )
+        summaries = [SpaceSaving.from_json(raw) for raw in rows.scalars()]
+        if len(self._peer_cache) > 1000:
+            self._peer_cache.clear()
+        self._peer_cache[cache_key] = (time.monotonic() + self.checkpoint_interval, summaries)
+        return summaries
+
+    async def top(self, db, scope_type: str, scope_ids: Iterable[int], limit: int = 10, days: Optional[int] = None) -> SpaceSaving:
+        """Merged summary of the scopes over the last `days` UTC days (default: the whole window)"""
+        window = self._window(min(days or self.window_days, self.window_days))
+        scope_ids = tuple(sorted(set(scope_ids)))
+        if not scope_ids:
+            return SpaceSaving(self.capacity_for(scope_type))
+        summaries = list(await self._peer_summaries(db, scope_type, scope_ids, window))
+        summaries.extend(
+            summary for (kind, scope_id, day), summary in self._summaries.items()
+            if kind == scope_type and scope_id in scope_ids and day >= window[-1]
+        )
+        return SpaceSaving.merge(summaries, self.capacity_for(scope_type))
+
+    async def checkpoint(self) -> None:
+        """Write this worker's changed summaries, take over stopped workers' and drop ones past the window
+
+        The heartbeat runs first and returns the keys whose rows this worker
+        still holds. A row missing from it was taken over while checkpoints
+        were failing, so its counts already live on under another worker:
+        the summary is reset rather than written again, losing only what was
+        counted since its last checkpoint instead of counting the rest twice.
+        """
+        oldest = self._window(self.window_days)[-1]
+        for key in [key for key in self._summaries if key[2] < oldest]:
+            del self._summaries[key]
+            self._dirty.discard(key)
+        self._written = {key for key in self._written if key[2] >= oldest}
+        dirty, self._dirty = self._dirty, set()
+        now = datetime.utcnow()
+        stale = now - timedelta(seconds=self.checkpoint_interval * _STALE_CHECKPOINTS)
+        adopted: Dict[Tuple[str, int, datetime], List[SpaceSaving]] = defaultdict(list)
+        try:
+            async with AsyncSessionLocal() as db:
+                # Also locks the rows, so they cannot be taken over before this commits
+                held = await db.execute(
+                    update(PromptHeavyHitters)
+                    .where(PromptHeavyHitters.worker_id == self.worker_id)
+                    .values(updated_at=now)
+                    .returning(
+                        PromptHeavyHitters.scope_type, PromptHeavyHitters.scope_id, PromptHeavyHitters.window_start
+                    )
+                    .execution_options(synchronize_session=False)
+                )
+                taken = self._written - {tuple(row) for row in held}
+                # Deleting them claims the rows, so two workers never both take them over
+                rows = await db.execute(
+                    delete(PromptHeavyHitters).where(
+                        PromptHeavyHitters.worker_id != self.worker_id,
+                        PromptHeavyHitters.window_start >= oldest,
+                        or_(PromptHeavyHitters.updated_at.is_(None), PromptHeavyHitters.updated_at < stale)
+                    ).returning(
+                        PromptHeavyHitters.scope_type,
+                        PromptHeavyHitters.scope_id,
+                        PromptHeavyHitters.window_start,
+                        PromptHeavyHitters.summary
+                    )
+                )
+                for scope_type, scope_id, day, raw in rows:
+                    adopted[(scope_type, scope_id, day)].append(SpaceSaving.from_json(raw))
+                written = set()
+                for key in (dirty - taken) | adopted.keys():
+                    summaries = [summary for summary in (self._summaries.get(key),) if summary is not None]
+                    if key in taken:
+                        summaries = []
+                    summaries.extend(adopted.get(key, ()))
+                    if not summaries:
+                        continue
+                    summary = summaries[0] if len(summaries) == 1 else SpaceSaving.merge(
+                        summaries, self.capacity_for(key[0])
+                    )
+                    await db.merge(PromptHeavyHitters(
+                        worker_id=self.worker_id,
+                        scope_type=key[0],
+                        scope_id=key[1],
+                        window_start=key[2],
+                        summary=summary.to_json(),
+                        updated_at=now
+                    ))
+                    written.add(key)
+                await db.execute(delete(PromptHeavyHitters).where(PromptHeavyHitters.window_start < oldest))
+                await db.commit()
+        except Exception:
+            self._dirty |= dirty
+            raise
+        if taken:
+            logger.warning(
+                "%d repeated-prompt checkpoints were taken over by another worker; resetting them", len(taken)
+            )
+            for key in taken:
+                self._summaries.pop(key, None)
+            self._written -= taken
+        self._written |= written
+        # Merged into what was counted meanwhile; the rows written above already include them
+        for key, summaries in adopted.items():
+            own = self._summaries.get(key)
+            self._summaries[key] = SpaceSaving.merge(
+                [own, *summaries] if own is not None else summaries, self.capacity_for(key[0])
+            )
+        if adopted or taken:
+            self._peer_cache.clear()
+
+    async def start(self) -> None:
+        """Start periodic checkpoints"""
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._run(), name="heavy-hitters-checkpoint")
+
+    async def stop(self) -> None:
+        """Stop checkpointing and write a final checkpoint"""
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        try:
+            await self.checkpoint()
+        except Exception:
+            logger.exception("Failed to checkpoint repeated-prompt summaries")
+
+    async def _run(self) -> None:
+        while True:
+            await asyncio.sleep(self.checkpoint_interval)
+            try:
+                await self.checkpoint()
+            except Exception:
+                logger.exception("Failed to checkpoint repeated-prompt summaries")
+
+
+heavy_hitters = HeavyHitters(
+    epsilon=settings.HEAVY_HITTERS_EPSILON,
+    scope_epsilon=settings.HEAVY_HITTERS_SCOPE_EPSILON,
+    window_days=settings.HEAVY_HITTERS_WINDOW_DAYS,
+    checkpoint_interval=settings.HEAVY_HITTERS_CHECKPOINT_INTERVAL,
+)
@@ -0,0 +1,168 @@
+import time
+from typing import Dict, Optional, Tuple
+
+from prometheus_client import Counter, Histogram
+
+from app.pricing import price_book, settings_price
+
+# Label values are bounded: routes are path templates, models outside the
+# price table and settings are "other", environments outside ENVIRONMENTS
+# are "other" (or "none" when the key has none). Raw keys never become labels.
+ENVIRONMENTS = frozenset({"dev", "staging", "prod"})
+PROVIDERS = ("openai", "anthropic")
+METHODS = frozenset({"GET", "HEAD", "POST", "PUT", "PATCH", "DELETE", "OPTIONS"})
+STAGES = ("key_lookup", "budget_check", "prompt_hash", "cache_lookup", "rate_limit", "budget_reserve", "accounting")
+
+REQUEST_COUNT = Counter('http_requests_total', 'Total HTTP requests', ['method', 'endpoint', 'status'])
+REQUEST_DURATION = Histogram('http_request_duration_seconds', 'HTTP request duration', ['method', 'endpoint'])
+
+PROXY_STAGE_DURATION = Histogram(
+    'proxy_stage_duration_seconds', 'Time spent in each proxy stage before and after the upstream call', ['stage'],
+    buckets=(0.00001, 0.000025, 0.00005, 0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 1.0)
+)
+UPSTREAM_BUCKETS = (0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 20.0, 40.0, 60.0, 120.0)
+UPSTREAM_DURATION = Histogram(
+    'proxy_upstream_duration_seconds', 'Upstream call time until the full response was read', ['provider', 'model'],
+    buckets=UPSTREAM_BUCKETS
+)
+UPSTREAM_TTFB = Histogram(
+    'proxy_upstream_ttfb_seconds',
+    'Upstream time to first byte: response headers for buffered calls, first body chunk for streams',
+    ['provider', 'model'],
+    buckets=UPSTREAM_BUCKETS
+)
+PROXY_TOKENS = Counter('proxy_tokens_total', 'Tokens billed upstream', ['provider', 'model', 'environment', 'direction'])
+PROXY_COST = Counter('proxy_cost_usd_total', 'Upstream cost in USD', ['provider', 'model', 'environment'])
+
+# Label children resolved once; labels() takes a lock and builds a key on every call
+_stage_children = {stage: PROXY_STAGE_DURATION.labels(stage) for stage in STAGES}
+_request_children: Dict[Tuple[str, str, int], Tuple[Counter, Histogram]] = {}
+_usage_children: Dict[Tuple[str, str, str], Tuple[Counter, Counter, Counter]] = {}
+_upstream_children: Dict[Tuple[str, str], Tuple[Histogram, Histogram]] = {}
+
+
+class _StageTimer:
+    """Context manager observing the time spent in one proxy stage
+
+    Cheaper than Histogram.time(), which wraps every use in a decorator
+    capable object.
+    """
+    __slots__ = ("_histogram", "_start")
+
+    def __init__(self, histogram: Histogram):
+        self._histogram = histogram
+
+    def __enter__(self) -> None:
+        self._start = time.perf_counter()
+
+    def __exit__(self, *exc_info) -> None:
+        self._histogram.observe(time.perf_counter() - self._start)
+
+
+def stage_timer(stage: str) -> _StageTimer:
+    """Time a `with` block as one of STAGES"""
+    return _StageTimer(_stage_children[stage])
+
+
+def model_label(provider: str, model: str) -> str:
+    """The model as a label value, or "other" for models without a known price"""
+    if provider not in PROVIDERS:
+        return "other"
+    if settings_price(provider, model) is not None or price_book.periods(provider, model):
+        return model
+    return "other"
+
+
+def environment_label(environment: Optional[str]) -> str:
+    if environment is None:
+        return "none"
+    return environment if environment in ENVIRONMENTS else "other"
+
+
+def observe_upstream(provider: str, model: str, ttfb: Optional[float], duration: float) -> None:
+    """Record one upstream call's time to first byte and total time"""
+    # Keyed by label values, so arbitrary model names cannot grow the cache
+    key = (provider, model_label(provider, model))
+    children = _upstream_children.get(key)
+    if children is None:
+        children = _upstream_children[key] = (UPSTREAM_TTFB.labels(*key), UPSTREAM_DURATION.labels(*key))
+    if ttfb is not None:
+        children[0].observe(ttfb)
+    children[1].observe(duration)
+
+
+def record_usage_metrics(
+    provider: str,
+    model: str,
+    environment: Optional[str],
+    input_tokens: int,
+    output_tokens: int,
+    cost: float
+) -> None:
+    """Count tokens and cost billed by the upstream"""
+    key = (provider, model_label(provider, model), environment_label(environment))
+    children = _usage_children.get(key)
+    if children is None:
+        children = _usage_children[key] = (
+            PROXY_TOKENS.labels(*key, "input"),
+            PROXY_TOKENS.labels(*key, "output"),
+            PROXY_COST.labels(*key),
+        )
+    if input_tokens:
+        children[0].inc(input_tokens)
+    if output_tokens:
+        children[1].inc(output_tokens)
+    if cost:
+        children[2].inc(cost)
+
+
+class PrometheusMiddleware:
+    """ASGI middleware counting requests and timing them by route template
+
+    Streaming responses are timed until their last body chunk is sent.
+    Requests that match no route are labelled "unmatched" so unknown paths
+    cannot add label values; /metrics itself is not recorded.
+    """
+
+    def __init__(self, app, skip_paths: Tuple[str, ...] = ("/metrics",)):
+        self.app = app
+        self.skip_paths = skip_paths
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or scope["path"].startswith(self.skip_paths):
+            await self.app(scope, receive, send)
+            return
+
+        start = time.perf_counter()
+        status_code = 500
+        recorded = False
+
+        def record() -> None:
+            nonlocal recorded
+            if recorded:
+                return
+            recorded = True
+            route = scope.get("route")
+            endpoint = getattr(route, "path", None) or "unmatched"
+            method = scope["method"] if scope["method"] in METHODS else "OTHER"
+            key = (method, endpoint, status_code)
+            children = _request_children.get(key)
+            if children is None:
+                children = _request_children[key] = (
+                    REQUEST_COUNT.labels(method, endpoint, status_code), REQUEST_DURATION.labels(method, endpoint)
+                )
+            children[0].inc()
+            children[1].observe(time.perf_counter() - start)
+
+        async def send_wrapper(message):
+            nonlocal status_code
+            if message["type"] == "http.response.start":
+                status_code = message["status"]
+            await send(message)
+            if message["type"] == "http.response.body" and not message.get("more_body", False):
+                record()
+
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            record()
@@ -0,0 +1,92 @@
+from typing import Any, Dict, Optional
+
+import orjson
+
+# Providers put the top-level "usage" object after the (possibly huge)
+# content, so scanning backwards finds it without parsing the whole body.
+_USAGE_KEY = b'"usage"'
+_WHITESPACE = b" \t\r\n"
+
+
+def loads(data: bytes) -> Any:
+    """Parse JSON bytes"""
+    return orjson.loads(data)
+
+
+def dumps(value: Any) -> bytes:
+    """Serialize to compact JSON bytes"""
+    return orjson.dumps(value)
+
+
+def dumps_canonical(value: Any) -> bytes:
+    """Serialize with sorted keys, so equal documents produce equal bytes"""
+    return orjson.dumps(value, option=orjson.OPT_SORT_KEYS)
+
+
+def _skip_whitespace(raw: bytes, index: int) -> int:
+    while index < len(raw) and raw[index] in _WHITESPACE:
+        index += 1
+    return index
+
+
+def _object_end(raw: bytes, start: int) -> Optional[int]:
+    """Return the index just past the JSON object starting at raw[start]"""
+    depth = 0
+    in_string = False
+    index = start
+    while index < len(raw):
+        byte = raw[index]
+        if in_string:
+            if byte == 0x5C:  # backslash: skip the escaped character
+                index += 1
+            elif byte == 0x22:
+                in_string = False
+        elif byte == 0x22:
+            in_string = True
+        elif byte == 0x7B:
+            depth += 1
+        elif byte == 0x7D:
+            depth -= 1
+            if depth == 0:
+                return index + 1
+        index += 1
+    return None
+
+
+def extract_usage(raw: bytes) -> Dict[str, Any]:
+    """Pull the top-level "usage" object out of a JSON response body
+
+    Only the usage object itself is parsed. Falls back to parsing the whole
+    body if the targeted scan can't find it.
+    """
+    end = len(raw)
+    while True:
+        position = raw.rfind(_USAGE_KEY, 0, end)
+        if position == -1:
+            break
+        end = position
+        if position and raw[position - 1] == 0x5C:
+            # An escaped quote: the key appears inside a string value
+            continue
+        index = _skip_whitespace(raw, position + len(_USAGE_KEY))
+        if index >= len(raw) or raw[index] != 0x3A:  # ':'
+            continue
+        index = _skip_whitespace(raw, index + 1)
+        if index >= len(raw) or raw[index] != 0x7B:  # '{'
+            break
+        object_end = _object_end(raw, index)
+        if object_end is not None:
+            try:
+                usage = orjson.loads(raw[index:object_end])
+            except orjson.JSONDecodeError:
+                break
+            if isinstance(usage, dict):
+                return usage
+        break
+
+    try:
+        data = orjson.loads(raw)
+    except orjson.JSONDecodeError:
+        return {}
+    usage = data.get("usage") if isinstance(data, dict) else None
+    return usage if isinstance(usage, dict) else {}
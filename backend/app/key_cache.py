@@ -0,0 +1,202 @@
+import asyncio
+import logging
+import time
+from collections import OrderedDict
+from dataclasses import dataclass
+from typing import Optional, Tuple
+
+from prometheus_client import Counter
+
+from app.config import settings
+from app.ledger import BudgetScope
+from app.models import VirtualKey
+from app.redis_client import get_redis
+
+logger = logging.getLogger(__name__)
+
+KEY_CACHE_LOOKUPS = Counter('virtual_key_cache_lookups_total', 'Virtual key cache lookups', ['result'])
+
+# Published on the invalidation channel to drop every cached key, e.g. after a team's cap changes
+_INVALIDATE_ALL = "*"
+
+
+@dataclass(frozen=True)
+class CachedVirtualKey:
+    """Detached snapshot of a virtual key, its budget settings and its budget chain"""
+    id: int
+    key: str
+    name: str
+    team_id: Optional[int]
+    project_id: Optional[int]
+    user_email: Optional[str]
+    cost_centre: Optional[str]
+    environment: Optional[str]
+    agent_name: Optional[str]
+    monthly_budget_cap: Optional[float]
+    max_tokens_per_request: Optional[int]
+    max_reasoning_tokens: Optional[int]
+    is_active: bool
+    cache_responses: bool = False
+    cache_ttl_seconds: Optional[int] = None
+    requests_per_minute: Optional[int] = None
+    tokens_per_minute: Optional[int] = None
+    # The key's own scope, then its project's, team's and organization's, with their caps
+    budget_scopes: Tuple[BudgetScope, ...] = ()
+
+    @classmethod
+    def from_model(cls, virtual_key: VirtualKey, budget_scopes: Tuple[BudgetScope, ...]) -> "CachedVirtualKey":
+        return cls(
+            id=virtual_key.id,
+            key=virtual_key.key,
+            name=virtual_key.name,
+            team_id=virtual_key.team_id,
+            project_id=virtual_key.project_id,
+            user_email=virtual_key.user_email,
+            cost_centre=virtual_key.cost_centre,
+            environment=virtual_key.environment,
+            agent_name=virtual_key.agent_name,
+            monthly_budget_cap=virtual_key.monthly_budget_cap,
+            max_tokens_per_request=virtual_key.max_tokens_per_request,
+            max_reasoning_tokens=virtual_key.max_reasoning_tokens,
+            is_active=bool(virtual_key.is_active),
+            cache_responses=bool(virtual_key.cache_responses),
+            cache_ttl_seconds=virtual_key.cache_ttl_seconds,
+            requests_per_minute=virtual_key.requests_per_minute,
+            tokens_per_minute=virtual_key.tokens_per_minute,
+            budget_scopes=budget_scopes,
+        )
+
+
+class _TTLCache:
+    """Size-bounded LRU mapping whose entries expire after a TTL"""
+
+    def __init__(self, max_size: int, ttl: float):
+        self.max_size = max_size
+        self.ttl = ttl
+        self._entries: "OrderedDict[str, Tuple[float, object]]" = OrderedDict()
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def get(self, key: str) -> Tuple[bool, object]:
+        entry = self._entries.get(key)
+        if entry is None:
+            return False, None
+        expires_at, value = entry
+        if expires_at < time.monotonic():
+            del self._entries[key]
+            return False, None
+        self._entries.move_to_end(key)
+        return True, value
+
+    def set(self, key: str, value: object) -> None:
+        self._entries[key] = (time.monotonic() + self.ttl, value)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+
+    def pop(self, key: str) -> None:
+        self._entries.pop(key, None)
+
+    def clear(self) -> None:
+        self._entries.clear()
+
+
+class VirtualKeyCache:
+    """In-process cache of resolved virtual keys keyed by X-Virtual-Key
+
+    Unknown keys are remembered in a separate, much smaller LRU with a short
+    TTL, so a flood of random keys can only evict other misses and never
+    pushes real keys out of the cache.
+    """
+
+    def __init__(self, max_size: int, ttl: float, negative_max_size: int, negative_ttl: float):
+        self._positive = _TTLCache(max_size, ttl)
+        self._negative = _TTLCache(negative_max_size, negative_ttl)
+
+    def get(self, key: str) -> Tuple[bool, Optional[CachedVirtualKey]]:
+        """Return (hit, value); a hit with value None is a cached unknown key"""
+        hit, value = self._positive.get(key)
+        if hit:
+            KEY_CACHE_LOOKUPS.labels(result="hit").inc()
+            return True, value
+        hit, _ = self._negative.get(key)
+        if hit:
+            KEY_CACHE_LOOKUPS.labels(result="negative_hit").inc()
+            return True, None
+        KEY_CACHE_LOOKUPS.labels(result="miss").inc()
+        return False, None
+
+    def set(self, key: str, value: CachedVirtualKey) -> None:
+        self._negative.pop(key)
+        self._positive.set(key, value)
+
+    def set_missing(self, key: str) -> None:
+        self._negative.set(key, None)
+
+    def invalidate(self, key: str) -> None:
+        self._positive.pop(key)
+        self._negative.pop(key)
+
+    def clear(self) -> None:
+        self._positive.clear()
+        self._negative.clear()
+
+
+virtual_key_cache = VirtualKeyCache(
+    max_size=settings.KEY_CACHE_MAX_SIZE,
+    ttl=settings.KEY_CACHE_TTL,
+    negative_max_size=settings.KEY_CACHE_NEGATIVE_MAX_SIZE,
+    negative_ttl=settings.KEY_CACHE_NEGATIVE_TTL,
+)
+
+
+async def _publish_invalidation(message: str) -> None:
+    client = get_redis()
+    if client is None:
+        return
+    try:
+        await client.publish(settings.KEY_CACHE_INVALIDATION_CHANNEL, message)
+    except Exception:
+        # Other workers fall back to the TTL if the broadcast is lost
+        logger.exception("Failed to publish virtual key invalidation")
+
+
+async def invalidate_virtual_key(key: str) -> None:
+    """Drop a key from this worker's cache and tell the other workers"""
+    virtual_key_cache.invalidate(key)
+    await _publish_invalidation(key)
+
+
+async def invalidate_all_virtual_keys() -> None:
+    """Drop every key from all workers' caches, e.g. after a project's, team's or organization's cap changed"""
+    virtual_key_cache.clear()
+    await _publish_invalidation(_INVALIDATE_ALL)
+
+
+async def listen_for_invalidations() -> None:
+    """Apply invalidations published by other workers until cancelled"""
+    client = get_redis()
+    if client is None:
+        return
+    while True:
+        try:
+            pubsub = client.pubsub()
+            await pubsub.subscribe(settings.KEY_CACHE_INVALIDATION_CHANNEL)
+            try:
+                async for message in pubsub.listen():
+                    if message.get("type") != "message":
+                        continue
+                    if message["data"] == _INVALIDATE_ALL:
+                        virtual_key_cache.clear()
+                    else:
+                        virtual_key_cache.invalidate(message["data"])
+            finally:
+                await pubsub.aclose()
+        except asyncio.CancelledError:
+            raise
+        except Exception:
+            logger.exception("Virtual key invalidation listener failed; reconnecting")
+            # Entries cached while disconnected may have missed invalidations
+            virtual_key_cache.clear()
+            await asyncio.sleep(1.0)
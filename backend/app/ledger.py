@@ -0,0 +1,527 @@
+import logging
+from collections import defaultdict
+from dataclasses import dataclass
+from datetime import datetime
+from typing import Any, Collection, Dict, Iterable, List, Optional, Sequence, Tuple
+
+from sqlalchemy import func, select
+from sqlalchemy.exc import IntegrityError
+
+from app.config import settings
+from app.database import AsyncSessionLocal, upsert_increment_stmt
+from app.models import Organization, Project, SpendLedger, Team, UsageEvent, VirtualKey
+from app.redis_client import get_redis
+
+logger = logging.getLogger(__name__)
+
+VIRTUAL_KEY_SCOPE = "virtual_key"
+PROJECT_SCOPE = "project"
+TEAM_SCOPE = "team"
+ORGANIZATION_SCOPE = "organization"
+
+# (scope_type, scope_id)
+ScopeId = Tuple[str, int]
+
+
+def current_period(now: Optional[datetime] = None) -> str:
+    """Return the ledger period (UTC calendar month) for a timestamp"""
+    now = now or datetime.utcnow()
+    return f"{now.year:04d}-{now.month:02d}"
+
+
+@dataclass(frozen=True)
+class BudgetScope:
+    """One level of a key's budget chain (the key, its project, team or organization) and its monthly cap"""
+    scope_type: str
+    scope_id: int
+    cap: Optional[float] = None
+
+    @property
+    def id(self) -> ScopeId:
+        return (self.scope_type, self.scope_id)
+
+    @property
+    def qualifier(self) -> str:
+        """Names the scope in budget messages; empty for the key itself"""
+        if self.scope_type == VIRTUAL_KEY_SCOPE:
+            return ""
+        return f" for {self.scope_type} {self.scope_id}"
+
+
+class BudgetExceeded(Exception):
+    """A reservation would take one of the scopes in a key's chain over its cap"""
+
+    def __init__(self, scope: BudgetScope):
+        super().__init__(f"monthly budget cap of ${scope.cap}{scope.qualifier}")
+        self.scope = scope
+
+
+@dataclass
+class Reservation:
+    """Cost held against a key's budget chain until the request is settled"""
+    scopes: Tuple[ScopeId, ...]  # the key first, then its ancestors
+    period: str
+    amount: float
+    settled: bool = False
+
+    @property
+    def virtual_key_id(self) -> int:
+        return self.scopes[0][1]
+
+    def empty(self) -> "Reservation":
+        """A fresh hold of nothing on the same scopes; settling it only adds spend"""
+        return Reservation(self.scopes, self.period, 0.0)
+
+
+def format_scopes(scopes: Iterable[ScopeId]) -> str:
+    """Serialize scope ids as e.g. virtual_key:7,project:3,team:2"""
+    return ",".join(f"{scope_type}:{scope_id}" for scope_type, scope_id in scopes)
+
+
+def parse_scopes(text: str) -> Tuple[ScopeId, ...]:
+    """Inverse of format_scopes"""
+    scopes = []
+    for part in text.split(","):
+        if part:
+            scope_type, scope_id = part.rsplit(":", 1)
+            scopes.append((scope_type, int(scope_id)))
+    return tuple(scopes)
+
+
+class LocalSpendLedger:
+    """Per-process spend counters for every budget scope
+
+    Every method runs to completion without awaiting, so check-and-reserve is
+    atomic on the event loop. Counters are not shared between workers; use
+    the Redis ledger when running more than one.
+    """
+
+    def __init__(self):
+        self._spent: Dict[Tuple[str, int, str], float] = defaultdict(float)
+        self._reserved: Dict[Tuple[str, int, str], float] = defaultdict(float)
+        # Current ancestors of keys moved while this process runs; spend settled
+        # on holds taken before the move goes there
+        self._moved: Dict[int, Tuple[ScopeId, ...]] = {}
+
+    async def load(self, period: str, totals: Dict[ScopeId, float]) -> None:
+        for (scope_type, scope_id), spent in totals.items():
+            self._spent[(scope_type, scope_id, period)] = spent
+
+    async def exceeded(self, scopes: Sequence[BudgetScope]) -> Optional[BudgetScope]:
+        """The first capped scope whose spent plus reserved has reached its cap this period"""
+        period = current_period()
+        for scope in scopes:
+            if scope.cap is not None:
+                key = (scope.scope_type, scope.scope_id, period)
+                if self._spent.get(key, 0.0) + self._reserved.get(key, 0.0) >= scope.cap:
+                    return scope
+        return None
+
+    async def reserve(self, scopes: Sequence[BudgetScope], amount: float) -> Reservation:
+        """Hold `amount` on every scope of the chain, or raise BudgetExceeded for the first one it doesn't fit"""
+        period = current_period()
+        keys = [(scope.scope_type, scope.scope_id, period) for scope in scopes]
+        for scope, key in zip(scopes, keys):
+            if scope.cap is not None and self._spent[key] + self._reserved[key] + amount > scope.cap:
+                raise BudgetExceeded(scope)
+        for key in keys:
+            self._reserved[key] += amount
+        return Reservation(tuple(scope.id for scope in scopes), period, amount)
+
+    async def settle(self, reservation: Reservation, actual: float) -> None:
+        if reservation.settled:
+            return
+        reservation.settled = True
+        for scope_type, scope_id in reservation.scopes:
+            key = (scope_type, scope_id, reservation.period)
+            self._reserved[key] = max(0.0, self._reserved[key] - reservation.amount)
+        scopes = reservation.scopes
+        moved = self._moved.get(reservation.virtual_key_id)
+        if moved is not None:
+            scopes = scopes[:1] + moved
+        for scope_type, scope_id in scopes:
+            self._spent[(scope_type, scope_id, reservation.period)] += actual
+
+    async def adjust(self, scope_type: str, scope_id: int, period: str, amount: float) -> None:
+        """Correct recorded spend, e.g. after re-costing past events"""
+        key = (scope_type, scope_id, period)
+        if key in self._spent:
+            self._spent[key] = max(0.0, self._spent[key] + amount)
+
+    async def move(self, virtual_key_id: int, old: Sequence[ScopeId], new: Sequence[ScopeId]) -> None:
+        """Carry a key's spend this period from its old ancestors to its new ones"""
+        period = current_period()
+        spent = self._spent.get((VIRTUAL_KEY_SCOPE, virtual_key_id, period), 0.0)
+        for scope_type, scope_id in old:
+            if (scope_type, scope_id) not in new:
+                key = (scope_type, scope_id, period)
+                self._spent[key] = max(0.0, self._spent[key] - spent)
+        for scope_type, scope_id in new:
+            if (scope_type, scope_id) not in old:
+                self._spent[(scope_type, scope_id, period)] += spent
+        self._moved[virtual_key_id] = tuple(new)
+
+
+# KEYS = ledger hashes of the chain; ARGV = amount, ttl seconds, then each scope's cap ('' for none)
+# Returns 0 once reserved on every scope, or the 1-based index of the scope over its cap
+_RESERVE_SCRIPT = """
+local amount = tonumber(ARGV[1])
+for i, key in ipairs(KEYS) do
+    local cap = ARGV[i + 2]
+    if cap ~= '' then
+        local spent = tonumber(redis.call('HGET', key, 'spent') or '0')
+        local reserved = tonumber(redis.call('HGET', key, 'reserved') or '0')
+        if spent + reserved + amount > tonumber(cap) then
+            return i
+        end
+    end
+end
+for _, key in ipairs(KEYS) do
+    redis.call('HINCRBYFLOAT', key, 'reserved', amount)
+    redis.call('EXPIRE', key, ARGV[2])
+end
+return 0
+"""
+
+# KEYS[1] = the key's chain marker, KEYS[2] = the key's ledger hash, then its ancestors' hashes
+# ARGV = reserved amount, actual cost, ttl seconds, the ancestors (format_scopes), '1' to add the cost to the key
+# The hold is released on every hash. If the key was moved since, the cost only goes to
+# the key and its current ancestors are returned for the caller to add it there
+_SETTLE_SCRIPT = """
+for i = 2, #KEYS do
+    local reserved = tonumber(redis.call('HGET', KEYS[i], 'reserved') or '0')
+    redis.call('HINCRBYFLOAT', KEYS[i], 'reserved', -math.min(reserved, tonumber(ARGV[1])))
+end
+if ARGV[5] == '1' then
+    redis.call('HINCRBYFLOAT', KEYS[2], 'spent', ARGV[2])
+    redis.call('EXPIRE', KEYS[2], ARGV[3])
+end
+local chain = redis.call('GET', KEYS[1])
+if chain and chain ~= ARGV[4] then
+    return chain
+end
+for i = 3, #KEYS do
+    redis.call('HINCRBYFLOAT', KEYS[i], 'spent', ARGV[2])
+    redis.call('EXPIRE', KEYS[i], ARGV[3])
+end
+return false
+"""
+
+# KEYS[1] = the key's chain marker, KEYS[2] = the key's ledger hash, then the hashes it
+# leaves, then the ones it joins; ARGV = number it leaves, new ancestors (format_scopes), ttl seconds
+_MOVE_SCRIPT = """
+local spent = tonumber(redis.call('HGET', KEYS[2], 'spent') or '0')
+local leaving = tonumber(ARGV[1])
+for i = 3, #KEYS do
+    local delta = spent
+    if i < 3 + leaving then
+        delta = -spent
+    end
+    redis.call('HINCRBYFLOAT', KEYS[i], 'spent', delta)
+    redis.call('EXPIRE', KEYS[i], ARGV[3])
+end
+redis.call('SET', KEYS[1], ARGV[2], 'EX', ARGV[3])
+return 1
+"""
+
+# Keep a month's counters around a little longer than the month itself
+_LEDGER_TTL_SECONDS = 40 * 24 * 3600
+
+
+class RedisSpendLedger:
+    """Spend counters for every budget scope, shared by all workers through Redis hashes"""
+
+    def __init__(self, client):
+        self._client = client
+        self._reserve = client.register_script(_RESERVE_SCRIPT)
+        self._settle = client.register_script(_SETTLE_SCRIPT)
+        self._move = client.register_script(_MOVE_SCRIPT)
+
+    @staticmethod
+    def _key(scope_type: str, scope_id: int, period: str) -> str:
+        return f"aca:ledger:{scope_type}:{scope_id}:{period}"
+
+    @staticmethod
+    def _chain_key(virtual_key_id: int) -> str:
+        return f"aca:ledger:chain:{virtual_key_id}"
+
+    async def load(self, period: str, totals: Dict[ScopeId, float]) -> None:
+        # Only seed missing counters; live ones already include in-flight spend
+        pipe = self._client.pipeline(transaction=False)
+        for (scope_type, scope_id), spent in totals.items():
+            key = self._key(scope_type, scope_id, period)
+            pipe.hsetnx(key, "spent", spent)
+            pipe.expire(key, _LEDGER_TTL_SECONDS)
+        await pipe.execute()
+
+    async def exceeded(self, scopes: Sequence[BudgetScope]) -> Optional[BudgetScope]:
+        capped = [scope for scope in scopes if scope.cap is not None]
+        if not capped:
+            return None
+        period = current_period()
+        pipe = self._client.pipeline(transaction=False)
+        for scope in capped:
+            pipe.hmget(self._key(scope.scope_type, scope.scope_id, period), "spent", "reserved")
+        for scope, values in zip(capped, await pipe.execute()):
+            if sum(float(value) for value in values if value) >= scope.cap:
+                return scope
+        return None
+
+    async def reserve(self, scopes: Sequence[BudgetScope], amount: float) -> Reservation:
+        period = current_period()
+        exceeded = await self._reserve(
+            keys=[self._key(scope.scope_type, scope.scope_id, period) for scope in scopes],
+            args=[amount, _LEDGER_TTL_SECONDS, *("" if scope.cap is None else scope.cap for scope in scopes)]
+        )
+        if exceeded:
+            raise BudgetExceeded(scopes[exceeded - 1])
+        return Reservation(tuple(scope.id for scope in scopes), period, amount)
+
+    async def settle(self, reservation: Reservation, actual: float) -> None:
+        if reservation.settled:
+            return
+        reservation.settled = True
+        own, ancestors = reservation.scopes[0], reservation.scopes[1:]
+        chain_key = self._chain_key(reservation.virtual_key_id)
+        own_key = self._key(*own, reservation.period)
+        moved = await self._settle(
+            keys=[chain_key, own_key, *(self._key(*scope, reservation.period) for scope in ancestors)],
+            args=[reservation.amount, actual, _LEDGER_TTL_SECONDS, format_scopes(ancestors), "1"]
+        )
+        # Rare: the key moved after the hold was taken, so the spend follows it
+        while moved is not None and actual:
+            moved = await self._settle(
+                keys=[chain_key, own_key, *(self._key(*scope, reservation.period) for scope in parse_scopes(moved))],
+                args=[0, actual, _LEDGER_TTL_SECONDS, moved, "0"]
+            )
+
+    async def adjust(self, scope_type: str, scope_id: int, period: str, amount: float) -> None:
+        key = self._key(scope_type, scope_id, period)
+        # Missing counters are seeded from the (already corrected) durable ledger
+        if await self._client.hexists(key, "spent"):
+            await self._client.hincrbyfloat(key, "spent", amount)
+
+    async def move(self, virtual_key_id: int, old: Sequence[ScopeId], new: Sequence[ScopeId]) -> None:
+        period = current_period()
+        leaving = [scope for scope in old if scope not in new]
+        joining = [scope for scope in new if scope not in old]
+        await self._move(
+            keys=[
+                self._chain_key(virtual_key_id),
+                self._key(VIRTUAL_KEY_SCOPE, virtual_key_id, period),
+                *(self._key(*scope, period) for scope in leaving + joining)
+            ],
+            args=[len(leaving), format_scopes(new), _LEDGER_TTL_SECONDS]
+        )
+
+
+def _create_ledger():
+    client = get_redis()
+    return RedisSpendLedger(client) if client is not None else LocalSpendLedger()
+
+
+spend_ledger = _create_ledger()
+
+
+def _budget_chains_query(virtual_key_ids: Collection[int]):
+    """Each key's cap and its project's, team's and organization's ids and caps
+
+    A key's team is its project's team, or its own when the project has
+    none; its organization is its project's, or its team's.
+    """
+    team_id = func.coalesce(Project.team_id, VirtualKey.team_id)
+    organization_id = func.coalesce(Project.organization_id, Team.organization_id)
+    return (
+        select(
+            VirtualKey.id,
+            VirtualKey.monthly_budget_cap,
+            Project.id.label("project_id"),
+            Project.monthly_budget_cap.label("project_cap"),
+            Team.id.label("team_id"),
+            Team.monthly_budget_cap.label("team_cap"),
+            Organization.id.label("organization_id"),
+            Organization.monthly_budget_cap.label("organization_cap"),
+        )
+        .select_from(VirtualKey)
+        .outerjoin(Project, Project.id == VirtualKey.project_id)
+        .outerjoin(Team, Team.id == team_id)
+        .outerjoin(Organization, Organization.id == organization_id)
+        .where(VirtualKey.id.in_(list(virtual_key_ids)))
+    )
+
+
+def _budget_chain(row) -> Tuple[BudgetScope, ...]:
+    scopes = [BudgetScope(VIRTUAL_KEY_SCOPE, row.id, row.monthly_budget_cap)]
+    if row.project_id is not None:
+        scopes.append(BudgetScope(PROJECT_SCOPE, row.project_id, row.project_cap))
+    if row.team_id is not None:
+        scopes.append(BudgetScope(TEAM_SCOPE, row.team_id, row.team_cap))
+    if row.organization_id is not None:
+        scopes.append(BudgetScope(ORGANIZATION_SCOPE, row.organization_id, row.organization_cap))
+    return tuple(scopes)
+
+
+async def load_budget_chains(
+    db, virtual_key_ids: Collection[int], lock: bool = False
+) -> Dict[int, Tuple[BudgetScope, ...]]:
+    """Each key's budget chain, the key first, in one query
+
+    With `lock`, the keys' rows are share-locked until the transaction
+    ends (PostgreSQL), so a key move is ordered strictly before or after
+    the ledger increments made under that chain.
+    """
+    query = _budget_chains_query(virtual_key_ids)
+    if lock:
+        query = query.with_for_update(read=True, of=VirtualKey)
+    return {row.id: _budget_chain(row) for row in (await db.execute(query)).all()}
+
+
+def load_budget_chains_sync(conn, virtual_key_ids: Collection[int]) -> Dict[int, Tuple[BudgetScope, ...]]:
+    """load_budget_chains for a synchronous connection"""
+    return {row.id: _budget_chain(row) for row in conn.execute(_budget_chains_query(virtual_key_ids)).all()}
+
+
+def ledger_deltas(
+    events: Iterable[Dict[str, Any]], chains: Dict[int, Tuple[BudgetScope, ...]]
+) -> List[Dict[str, Any]]:
+    """Aggregate usage event rows into per-scope, per-month spend increments
+
+    Each event counts for its key and every ancestor in the key's chain.
+    Rows come sorted, so concurrent writers lock shared ancestor rows in
+    the same order.
+    """
+    totals: Dict[Tuple[str, int, str], float] = defaultdict(float)
+    for event in events:
+        if event.get("total_cost"):
+            period = current_period(event["created_at"])
+            virtual_key_id = event["virtual_key_id"]
+            for scope in chains.get(virtual_key_id) or (BudgetScope(VIRTUAL_KEY_SCOPE, virtual_key_id),):
+                totals[(scope.scope_type, scope.scope_id, period)] += event["total_cost"]
+    return [
+        {"scope_type": scope_type, "scope_id": scope_id, "period": period, "spent": spent}
+        for (scope_type, scope_id, period), spent in sorted(totals.items())
+    ]
+
+
+async def _increment_spend(db, rows: List[Dict[str, Any]]) -> None:
+    stmt = upsert_increment_stmt(
+        db.bind.dialect.name, SpendLedger.__table__,
+        key_columns=("scope_type", "scope_id", "period"),
+        increment_columns=("spent",)
+    )
+    await db.execute(stmt, rows)
+
+
+async def apply_ledger_deltas(db, events: Iterable[Dict[str, Any]]) -> None:
+    """Add a batch of events to the durable ledger (caller commits)"""
+    events = list(events)
+    virtual_key_ids = {event["virtual_key_id"] for event in events if event.get("total_cost")}
+    if not virtual_key_ids:
+        return
+    chains = await load_budget_chains(db, virtual_key_ids, lock=True)
+    await _increment_spend(db, ledger_deltas(events, chains))
+
+
+async def release_dropped_spend(events: List[Dict[str, Any]]) -> float:
+    """Take the cost of events that never reached the database back out of the live ledger
+
+    Their cost was settled into the live counters when they were recorded,
+    so without this the counters would keep spend the durable ledger lacks.
+    Returns the cost released.
+    """
+    virtual_key_ids = {event["virtual_key_id"] for event in events if event.get("total_cost")}
+    if not virtual_key_ids:
+        return 0.0
+    try:
+        async with AsyncSessionLocal() as db:
+            chains = await load_budget_chains(db, virtual_key_ids)
+    except Exception:
+        # Likely the same outage that dropped the events; ancestors keep the spend until the next reload
+        logger.warning(
+            "Could not load budget chains for %d dropped events; releasing from their keys only", len(events), exc_info=True
+        )
+        chains = {}
+    for delta in ledger_deltas(events, chains):
+        await spend_ledger.adjust(delta["scope_type"], delta["scope_id"], delta["period"], -delta["spent"])
+    return sum(event.get("total_cost") or 0.0 for event in events)
+
+
+async def move_ledger_spend(db, virtual_key_id: int, old: Sequence[ScopeId], new: Sequence[ScopeId]) -> None:
+    """Carry a key's recorded spend, every month, from its old ancestors to its new ones (caller commits)
+
+    Called in the transaction that moves the key, with its row locked, so
+    the key's ledger rows can't change underneath.
+    """
+    leaving = [scope for scope in old if scope not in new]
+    joining = [scope for scope in new if scope not in old]
+    if not leaving and not joining:
+        return
+    months = (await db.execute(
+        select(SpendLedger.period, SpendLedger.spent).where(
+            SpendLedger.scope_type == VIRTUAL_KEY_SCOPE,
+            SpendLedger.scope_id == virtual_key_id
+        )
+    )).all()
+    rows = [
+        {"scope_type": scope_type, "scope_id": scope_id, "period": month.period, "spent": sign * month.spent}
+        for sign, scopes in ((-1, leaving), (1, joining))
+        for scope_type, scope_id in scopes
+        for month in months
+        if month.spent
+    ]
+    if rows:
+        await _increment_spend(db, sorted(rows, key=lambda row: (row["scope_type"], row["scope_id"], row["period"])))
+
+
+async def _read_period_totals(period: str) -> Dict[ScopeId, float]:
+    """Read a period's totals from the ledger, rebuilding it from usage_events if empty"""
+    async with AsyncSessionLocal() as db:
+        rows = (await db.execute(
+            select(SpendLedger.scope_type, SpendLedger.scope_id, SpendLedger.spent).where(
+                SpendLedger.period == period
+            )
+        )).all()
+        if rows:
+            return {(row.scope_type, row.scope_id): row.spent for row in rows}
+
+        year, month = (int(part) for part in period.split("-"))
+        period_start = datetime(year, month, 1)
+        rebuilt = (await db.execute(
+            select(
+                UsageEvent.virtual_key_id,
+                func.sum(UsageEvent.total_cost).label("spent")
+            ).where(
+                UsageEvent.created_at >= period_start
+            ).group_by(UsageEvent.virtual_key_id)
+        )).all()
+        totals: Dict[ScopeId, float] = defaultdict(float)
+        if rebuilt:
+            chains = await load_budget_chains(db, [row.virtual_key_id for row in rebuilt])
+            for row in rebuilt:
+                for scope in chains.get(row.virtual_key_id) or (BudgetScope(VIRTUAL_KEY_SCOPE, row.virtual_key_id),):
+                    totals[scope.id] += row.spent or 0.0
+        if totals:
+            db.add_all(
+                SpendLedger(scope_type=scope_type, scope_id=scope_id, period=period, spent=spent)
+                for (scope_type, scope_id), spent in totals.items()
+            )
+            try:
+                await db.commit()
+            except IntegrityError:
+                # Another worker rebuilt the same period first
+                await db.rollback()
+                return await _read_period_totals(period)
+            logger.info("Rebuilt spend ledger for %s from usage_events (%d scopes)", period, len(totals))
+        return dict(totals)
+
+
+async def load_spend_ledger() -> None:
+    """Warm the live ledger for the current month (called from the app lifespan)"""
+    if isinstance(spend_ledger, LocalSpendLedger) and settings.WEB_CONCURRENCY > 1:
+        # Each worker's counters would admit spend up to the full cap on their own
+        raise RuntimeError(
+            f"WEB_CONCURRENCY={settings.WEB_CONCURRENCY} needs REDIS_ENABLED so budget caps are shared between workers"
+        )
+    period = current_period()
+    totals = await _read_period_totals(period)
+    await spend_ledger.load(period, totals)
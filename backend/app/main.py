@@ -1,27 +1,62 @@
+import asyncio
+from contextlib import asynccontextmanager
 from fastapi import FastAPI
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.responses import JSONResponse
-from prometheus_client import make_asgi_app, Counter, Histogram
+from prometheus_client import make_asgi_app
 import os
 from dotenv import load_dotenv
 
-from app.database import engine, Base
-from app.routers import auth, proxy, metrics, admin
+from app.database import engine, async_engine, Base
+from app.routers import auth, proxy, batches, metrics, admin
 from app.config import settings
+from app.upstream import start_upstream_clients, close_upstream_clients
+from app.usage_writer import usage_writer
+from app.key_cache import listen_for_invalidations
+from app.redis_client import close_redis
+from app.ledger import load_spend_ledger
+from app.batches import batch_accountant, resume_batches
+from app.heavy_hitters import heavy_hitters
+from app.partitions import ensure_partitions
+from app.pricing import price_book
+from app.instrumentation import PrometheusMiddleware
 
 load_dotenv()
 
 # Create database tables
 Base.metadata.create_all(bind=engine)
 
-# Prometheus metrics
-REQUEST_COUNT = Counter('http_requests_total', 'Total HTTP requests', ['method', 'endpoint', 'status'])
-REQUEST_DURATION = Histogram('http_request_duration_seconds', 'HTTP request duration', ['method', 'endpoint'])
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    """Create shared resources on startup and release them on shutdown"""
+    # Monthly usage_events partitions must exist before the writer inserts into them
+    async with async_engine.begin() as conn:
+        await conn.run_sync(ensure_partitions, settings.USAGE_PARTITION_MONTHS_AHEAD)
+    await start_upstream_clients()
+    await price_book.start()
+    await load_spend_ledger()
+    await usage_writer.start()
+    await heavy_hitters.start()
+    # Batch API budget holds and unfinished result accounting survive restarts
+    await resume_batches()
+    invalidation_listener = asyncio.create_task(listen_for_invalidations())
+    try:
+        yield
+    finally:
+        invalidation_listener.cancel()
+        await batch_accountant.stop()
+        # Drain queued usage events before the process exits
+        await usage_writer.stop()
+        await heavy_hitters.stop()
+        await price_book.stop()
+        await close_upstream_clients()
+        await close_redis()
 
 app = FastAPI(
     title="AI Cost Auditor API",
     description="LLM proxy with cost tracking and waste detection",
-    version="1.0.0"
+    version="1.0.0",
+    lifespan=lifespan
 )
 
 # CORS middleware
@@ -31,11 +66,16 @@ app.add_middleware(
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
+    expose_headers=["X-Next-Cursor"],
 )
 
+# Request count and duration by route template (app/instrumentation.py)
+app.add_middleware(PrometheusMiddleware)
+
 # Include routers
 app.include_router(auth.router, prefix="/api/auth", tags=["auth"])
 app.include_router(proxy.router, prefix="/proxy", tags=["proxy"])
+app.include_router(batches.router, prefix="/proxy", tags=["batches"])
 app.include_router(metrics.router, prefix="/api/metrics", tags=["metrics"])
 app.include_router(admin.router, prefix="/api/admin", tags=["admin"])
 
@@ -1,4 +1,4 @@
-from sqlalchemy import Column, Integer, String, Float, DateTime, Boolean, ForeignKey, Text, Index
+from sqlalchemy import Column, Integer, BigInteger, SmallInteger, String, Float, DateTime, Boolean, ForeignKey, Text, LargeBinary, Index
 from sqlalchemy.orm import relationship
 from sqlalchemy.sql import func
 from app.database import Base
@@ -9,6 +9,7 @@ class Organization(Base):
     
     id = Column(Integer, primary_key=True, index=True)
     name = Column(String(255), nullable=False, unique=True)
+    monthly_budget_cap = Column(Float, nullable=True)  # in USD, across all its keys
     created_at = Column(DateTime(timezone=True), server_default=func.now())
     
     teams = relationship("Team", back_populates="organization")
@@ -20,6 +21,7 @@ class Team(Base):
     id = Column(Integer, primary_key=True, index=True)
     name = Column(String(255), nullable=False)
     organization_id = Column(Integer, ForeignKey("organizations.id"), nullable=False)
+    monthly_budget_cap = Column(Float, nullable=True)  # in USD, across all its keys
     created_at = Column(DateTime(timezone=True), server_default=func.now())
     
     organization = relationship("Organization", back_populates="teams")
@@ -33,6 +35,7 @@ class Project(Base):
     name = Column(String(255), nullable=False)
     organization_id = Column(Integer, ForeignKey("organizations.id"), nullable=False)
     team_id = Column(Integer, ForeignKey("teams.id"), nullable=True)
+    monthly_budget_cap = Column(Float, nullable=True)  # in USD, across all its keys
     created_at = Column(DateTime(timezone=True), server_default=func.now())
     
     organization = relationship("Organization", back_populates="projects")
@@ -71,6 +74,14 @@ class VirtualKey(Base):
     max_reasoning_tokens = Column(Integer, nullable=True)
     is_active = Column(Boolean, default=True)
     
+    # Rate limits (token buckets holding one minute's allowance)
+    requests_per_minute = Column(Integer, nullable=True)
+    tokens_per_minute = Column(Integer, nullable=True)
+    
+    # Response cache (deterministic requests only)
+    cache_responses = Column(Boolean, default=False)
+    cache_ttl_seconds = Column(Integer, nullable=True)  # falls back to RESPONSE_CACHE_DEFAULT_TTL
+    
     created_at = Column(DateTime(timezone=True), server_default=func.now())
     created_by = Column(Integer, ForeignKey("users.id"), nullable=True)
     
@@ -103,6 +114,8 @@ class UsageEvent(Base):
     prompt_hash = Column(String(64), nullable=True, index=True)
     prompt_chars = Column(Integer, nullable=True)
     prompt_preview = Column(Text, nullable=True)  # First 200 chars, configurable
+    prompt_minhash = Column(LargeBinary, nullable=True)  # near-duplicate fingerprint, 64 bytes
+    prompt_cluster_id = Column(Integer, nullable=True)
     
     # Request metadata
     request_id = Column(String(255), nullable=True)
@@ -110,13 +123,157 @@ class UsageEvent(Base):
     was_blocked = Column(Boolean, default=False)
     block_reason = Column(String(255), nullable=True)
     
+    # Served from the response cache or coalesced onto an identical in-flight
+    # request: total_cost is 0, saved_cost is what the upstream call would have cost
+    cache_hit = Column(Boolean, default=False)
+    coalesced = Column(Boolean, default=False)
+    saved_cost = Column(Float, nullable=False, default=0.0)
+    
+    # Upstream attempt within the request (retries and hedges share request_id);
+    # served is False for attempts whose response was not returned, whose tokens
+    # were still billed
+    attempt = Column(Integer, nullable=False, default=1)
+    hedge = Column(Boolean, default=False)
+    served = Column(Boolean, default=True)
+    
+    # Set for calls made through the Batch API, which are billed at BATCH_PRICE_RATIO
+    batch_id = Column(String(255), nullable=True)
+    
     # Timestamps
     created_at = Column(DateTime(timezone=True), server_default=func.now(), index=True)
     
     virtual_key = relationship("VirtualKey", back_populates="usage_events")
     user = relationship("User", back_populates="usage_events")
 
+class SpendLedger(Base):
+    """Running spend per budget scope and calendar month (UTC)"""
+    __tablename__ = "spend_ledger"
+    
+    scope_type = Column(String(20), primary_key=True)  # virtual_key, project, team, organization
+    scope_id = Column(Integer, primary_key=True)
+    period = Column(String(7), primary_key=True)  # YYYY-MM
+    spent = Column(Float, nullable=False, default=0.0)
+
+class UsageRollup(Base):
+    """Usage pre-aggregated per time bucket, virtual key, provider and model"""
+    __tablename__ = "usage_rollups"
+    
+    granularity = Column(String(5), primary_key=True)  # hour, day
+    bucket_start = Column(DateTime, primary_key=True)  # UTC, naive
+    virtual_key_id = Column(Integer, primary_key=True)
+    provider = Column(String(50), primary_key=True)
+    model = Column(String(100), primary_key=True)
+    
+    request_count = Column(Integer, nullable=False, default=0)
+    input_tokens = Column(Integer, nullable=False, default=0)
+    output_tokens = Column(Integer, nullable=False, default=0)
+    total_tokens = Column(Integer, nullable=False, default=0)
+    total_cost = Column(Float, nullable=False, default=0.0)
+    cache_hits = Column(Integer, nullable=False, default=0)
+    coalesced_requests = Column(Integer, nullable=False, default=0)
+    saved_cost = Column(Float, nullable=False, default=0.0)  # avoided by cache hits and coalescing
+
+class PromptCluster(Base):
+    """Near-duplicate prompts: every prompt similar enough to the first one"""
+    __tablename__ = "prompt_clusters"
+    
+    id = Column(Integer, primary_key=True)
+    model = Column(String(100), nullable=False)
+    signature = Column(LargeBinary, nullable=False)  # full MinHash of the first prompt
+    prompt_hash = Column(String(64), nullable=True)  # exact hash of the first prompt
+    created_at = Column(DateTime(timezone=True), server_default=func.now())
+
+class PromptClusterBand(Base):
+    """LSH index: a key per band of each cluster's MinHash signature"""
+    __tablename__ = "prompt_cluster_bands"
+    
+    band = Column(SmallInteger, primary_key=True)
+    key = Column(BigInteger, primary_key=True)
+    cluster_id = Column(Integer, primary_key=True)
+
+class PromptClusterRollup(Base):
+    """Requests and cost per near-duplicate cluster, day and virtual key"""
+    __tablename__ = "prompt_cluster_rollups"
+    
+    cluster_id = Column(Integer, primary_key=True)
+    bucket_start = Column(DateTime, primary_key=True)  # UTC day, naive
+    virtual_key_id = Column(Integer, primary_key=True)
+    
+    request_count = Column(Integer, nullable=False, default=0)
+    total_cost = Column(Float, nullable=False, default=0.0)
+
+class PromptHeavyHitters(Base):
+    """Checkpointed Space-Saving summary of repeated prompts for one worker, scope and day"""
+    __tablename__ = "prompt_heavy_hitters"
+    
+    worker_id = Column(String(32), primary_key=True)
+    scope_type = Column(String(20), primary_key=True)  # global, virtual_key, project
+    scope_id = Column(Integer, primary_key=True)  # 0 for global
+    window_start = Column(DateTime, primary_key=True)  # UTC day, naive
+    summary = Column(LargeBinary, nullable=False)  # JSON counters
+    updated_at = Column(DateTime, nullable=True)  # UTC, naive; the worker's last checkpoint
+
+class ModelPrice(Base):
+    """Per-1M-token prices for a provider's model from effective_from until effective_to"""
+    __tablename__ = "model_prices"
+    
+    id = Column(Integer, primary_key=True)
+    provider = Column(String(50), nullable=False)
+    model = Column(String(100), nullable=False)
+    input_price = Column(Float, nullable=False)
+    output_price = Column(Float, nullable=False)
+    effective_from = Column(DateTime, nullable=False)  # UTC, naive
+    effective_to = Column(DateTime, nullable=True)  # exclusive; open-ended when null
+    created_at = Column(DateTime(timezone=True), server_default=func.now())
+
+class BatchFile(Base):
+    """A Batch API input file uploaded through the proxy, with its estimated cost"""
+    __tablename__ = "batch_files"
+    
+    id = Column(String(255), primary_key=True)  # upstream file id
+    virtual_key_id = Column(Integer, ForeignKey("virtual_keys.id"), nullable=False, index=True)
+    upstream = Column(String(100), nullable=False)  # target the file was uploaded to
+    model = Column(String(100), nullable=False)
+    endpoint = Column(String(100), nullable=False)  # e.g. /v1/chat/completions
+    filename = Column(String(255), nullable=True)
+    bytes = Column(BigInteger, nullable=False, default=0)
+    request_count = Column(Integer, nullable=False, default=0)
+    estimated_cost = Column(Float, nullable=False, default=0.0)  # at batch prices
+    created_at = Column(DateTime(timezone=True), server_default=func.now())
+
+class BatchJob(Base):
+    """A Batch API batch submitted through the proxy and how far its results are accounted"""
+    __tablename__ = "batch_jobs"
+    
+    id = Column(String(255), primary_key=True)  # upstream batch id
+    virtual_key_id = Column(Integer, ForeignKey("virtual_keys.id"), nullable=False, index=True)
+    input_file_id = Column(String(255), ForeignKey("batch_files.id"), nullable=False)
+    upstream = Column(String(100), nullable=False)
+    model = Column(String(100), nullable=False)
+    status = Column(String(20), nullable=False)
+    output_file_id = Column(String(255), nullable=True, index=True)
+    error_file_id = Column(String(255), nullable=True, index=True)
+    
+    # The estimated cost held against the key's budget from submission until accounted
+    estimated_cost = Column(Float, nullable=False, default=0.0)
+    reserved_period = Column(String(7), nullable=False)  # YYYY-MM
+    reserved_scopes = Column(String(255), nullable=True)  # budget chain holding the estimate (ledger.format_scopes)
+    
+    # Result lines (output file, then error file) already written as usage events
+    accounted_lines = Column(Integer, nullable=False, default=0)
+    actual_cost = Column(Float, nullable=False, default=0.0)
+    accounted_at = Column(DateTime, nullable=True)  # UTC, naive; set once every line is accounted
+    
+    created_at = Column(DateTime(timezone=True), server_default=func.now())
+    completed_at = Column(DateTime, nullable=True)  # UTC, naive; when the batch reached a final status
+
 # Indexes for performance
 Index('idx_usage_events_created_at', UsageEvent.created_at)
 Index('idx_usage_events_virtual_key_created', UsageEvent.virtual_key_id, UsageEvent.created_at)
 Index('idx_usage_events_prompt_hash', UsageEvent.prompt_hash)
+Index('idx_usage_rollups_bucket', UsageRollup.granularity, UsageRollup.bucket_start)
+Index('idx_usage_events_prompt_cluster', UsageEvent.prompt_cluster_id)
+Index('idx_prompt_cluster_rollups_bucket', PromptClusterRollup.bucket_start)
+Index('idx_prompt_cluster_bands_cluster', PromptClusterBand.cluster_id)
+Index('idx_prompt_heavy_hitters_scope', PromptHeavyHitters.scope_type, PromptHeavyHitters.window_start)
+Index('idx_model_prices_model', ModelPrice.provider, ModelPrice.model, ModelPrice.effective_from, unique=True)
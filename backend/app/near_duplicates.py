@@ -0,0 +1,251 @@
+import hashlib
+import re
+from collections import defaultdict
+from datetime import datetime
+from typing import Any, Dict, Iterable, List, Optional, Set, Tuple
+
+import numpy as np
+from sqlalchemy import delete, exists, insert, select
+
+from app.config import settings
+from app.database import upsert_increment_stmt
+from app.models import PromptCluster, PromptClusterBand, PromptClusterRollup
+from app.rollups import bucket_start
+
+# MinHash over word bigrams of the normalized prompt text estimates the
+# Jaccard similarity of two prompts. The signature is split into bands;
+# prompts similar enough to matter almost always share at least one band
+# exactly, so candidate clusters are found by indexed band lookups instead
+# of comparing pairs, then confirmed against the cluster's first member.
+NUM_PERM = 64
+BANDS = 16
+ROWS = NUM_PERM // BANDS
+_DIGITS = re.compile(r"\d+")
+_WORDS = re.compile(r"\w+")
+_BIGRAM_MULTIPLIER = np.uint64(0x9E3779B97F4A7C15)
+
+_ROLLUP_KEY_COLUMNS = ("cluster_id", "bucket_start", "virtual_key_id")
+_ROLLUP_COUNTER_COLUMNS = ("request_count", "total_cost")
+
+
+def _mix(values: np.ndarray) -> np.ndarray:
+    """splitmix64 finalizer: a cheap, well-distributed 64-bit hash"""
+    values = values ^ (values >> np.uint64(30))
+    values = values * np.uint64(0xBF58476D1CE4E5B9)
+    values = values ^ (values >> np.uint64(27))
+    values = values * np.uint64(0x94D049BB133111EB)
+    return values ^ (values >> np.uint64(31))
+
+
+# One seed per permutation; derived, not random, so every worker agrees
+_SEEDS = _mix(np.arange(1, NUM_PERM + 1, dtype=np.uint64) * _BIGRAM_MULTIPLIER)
+
+
+def _shingles(text: str) -> Optional[np.ndarray]:
+    """Distinct 64-bit hashes of the word bigrams (or the single word)"""
+    words = _WORDS.findall(_DIGITS.sub("0", text.lower()))
+    if not words:
+        return None
+    # Hash each distinct word once, then combine neighbours vectorized
+    vocabulary = {word: index for index, word in enumerate(dict.fromkeys(words))}
+    word_hashes = np.frombuffer(
+        b"".join(hashlib.blake2b(word.encode(), digest_size=8).digest() for word in vocabulary),
+        dtype=np.uint64
+    )[np.fromiter((vocabulary[word] for word in words), dtype=np.intp, count=len(words))]
+    if len(word_hashes) == 1:
+        return word_hashes
+    return np.unique(_mix(word_hashes[:-1] * _BIGRAM_MULTIPLIER ^ word_hashes[1:]))
+
+
+def minhash(text: str) -> Optional[bytes]:
+    """MinHash signature of a prompt: NUM_PERM little-endian uint32s
+
+    Text is lowercased and digit runs collapse to "0", so timestamps, IDs
+    and counters don't change the signature.
+    """
+    shingles = _shingles(text)
+    if shingles is None:
+        return None
+    hashed = _mix(shingles[:, None] ^ _SEEDS[None, :])
+    return (hashed.min(axis=0) >> np.uint64(32)).astype("<u4").tobytes()
+
+
+def compact_signature(signature: bytes) -> bytes:
+    """The stored form of a signature: the low byte of each value (b-bit MinHash)"""
+    return np.frombuffer(signature, dtype="<u4").astype(np.uint8).tobytes()
+
+
+def similarity(a: bytes, b: bytes) -> float:
+    """Estimated Jaccard similarity of two full signatures"""
+    return float(np.mean(np.frombuffer(a, dtype="<u4") == np.frombuffer(b, dtype="<u4")))
+
+
+def band_keys(signature: bytes) -> List[int]:
+    """One signed 64-bit key per band of the signature"""
+    width = ROWS * 4
+    return [
+        int.from_bytes(
+            hashlib.blake2b(signature[band * width:(band + 1) * width], digest_size=8).digest(),
+            "big", signed=True
+        )
+        for band in range(BANDS)
+    ]
+
+
+class _Candidate:
+    __slots__ = ("cluster", "model", "signature")
+
+    def __init__(self, cluster: Dict[str, Any], model: str, signature: bytes):
+        # The cluster's row; "id" is filled in once a new cluster is inserted
+        self.cluster = cluster
+        self.model = model
+        self.signature = signature
+
+
+async def assign_prompt_clusters(db, events: List[Dict[str, Any]]) -> None:
+    """Cluster each event's prompt signature, creating clusters as needed
+
+    Sets prompt_cluster_id and the compact prompt_minhash on every row; the
+    full `prompt_signature` is left in place (it isn't a column) so a retried
+    batch clusters the same way. Cache hits and coalesced requests cost
+    nothing and are skipped. Band lookups are one indexed query per band for
+    the whole batch, and prompts first seen in the batch can seed clusters
+    for later ones in it. Caller inserts the events and commits.
+    """
+    threshold = settings.NEAR_DUPLICATE_THRESHOLD
+    eligible = []
+    for event in events:
+        signature = event.get("prompt_signature")
+        event["prompt_minhash"] = compact_signature(signature) if signature else None
+        event["prompt_cluster_id"] = None
+        if signature and not event.get("cache_hit") and not event.get("coalesced"):
+            eligible.append((event, band_keys(signature)))
+    if not eligible:
+        return
+
+    # band -> key -> candidate clusters
+    index: Dict[int, Dict[int, List[_Candidate]]] = defaultdict(lambda: defaultdict(list))
+    wanted: Dict[int, Set[int]] = defaultdict(set)
+    for _, keys in eligible:
+        for band, key in enumerate(keys):
+            wanted[band].add(key)
+
+    cluster_bands: Dict[int, List[Tuple[int, int]]] = defaultdict(list)
+    for band, keys in wanted.items():
+        rows = await db.execute(
+            select(PromptClusterBand.key, PromptClusterBand.cluster_id).where(
+                PromptClusterBand.band == band,
+                PromptClusterBand.key.in_(keys)
+            )
+        )
+        for key, cluster_id in rows:
+            cluster_bands[cluster_id].append((band, key))
+    if cluster_bands:
+        rows = await db.execute(
+            select(PromptCluster.id, PromptCluster.model, PromptCluster.signature).where(
+                PromptCluster.id.in_(cluster_bands)
+            )
+        )
+        for cluster_id, model, signature in rows:
+            candidate = _Candidate({"id": cluster_id}, model, signature)
+            for band, key in cluster_bands[cluster_id]:
+                index[band][key].append(candidate)
+
+    assigned = []
+    new_clusters = []
+    for event, keys in eligible:
+        signature = event["prompt_signature"]
+        match = None
+        for band, key in enumerate(keys):
+            for candidate in index[band].get(key, ()):
+                if candidate.model == event["model"] and similarity(candidate.signature, signature) >= threshold:
+                    match = candidate
+                    break
+            if match is not None:
+                break
+        if match is None:
+            cluster = {
+                "model": event["model"],
+                "signature": signature,
+                "prompt_hash": event.get("prompt_hash"),
+                "created_at": event.get("created_at"),
+            }
+            new_clusters.append((cluster, keys))
+            match = _Candidate(cluster, event["model"], signature)
+            for band, key in enumerate(keys):
+                index[band][key].append(match)
+        assigned.append((event, match))
+
+    new_bands = []
+    if new_clusters:
+        # One multi-row INSERT ... RETURNING for every new cluster in the batch
+        result = await db.execute(
+            insert(PromptCluster).returning(PromptCluster.id, sort_by_parameter_order=True),
+            [cluster for cluster, _ in new_clusters]
+        )
+        for (cluster, keys), cluster_id in zip(new_clusters, result.scalars()):
+            cluster["id"] = cluster_id
+            new_bands.extend(
+                {"band": band, "key": key, "cluster_id": cluster_id}
+                for band, key in enumerate(keys)
+            )
+    for event, match in assigned:
+        event["prompt_cluster_id"] = match.cluster["id"]
+
+    if new_bands:
+        await db.execute(insert(PromptClusterBand), new_bands)
+
+
+def cluster_rollup_deltas(events: Iterable[Dict[str, Any]]) -> List[Dict[str, Any]]:
+    """Aggregate clustered events into per-day, per-key counter increments"""
+    totals: Dict[Tuple, List[float]] = defaultdict(lambda: [0, 0.0])
+    for event in events:
+        if event.get("prompt_cluster_id") is None:
+            continue
+        key = (event["prompt_cluster_id"], bucket_start(event["created_at"], "day"), event["virtual_key_id"])
+        counters = totals[key]
+        counters[0] += 1
+        counters[1] += event.get("total_cost") or 0.0
+    return [
+        {**dict(zip(_ROLLUP_KEY_COLUMNS, key)), **dict(zip(_ROLLUP_COUNTER_COLUMNS, counters))}
+        for key, counters in totals.items()
+    ]
+
+
+async def apply_cluster_rollup_deltas(db, events: Iterable[Dict[str, Any]]) -> None:
+    """Add a batch of clustered events to the cluster rollups (caller commits)"""
+    rows = cluster_rollup_deltas(events)
+    if rows:
+        stmt = upsert_increment_stmt(
+            db.bind.dialect.name, PromptClusterRollup.__table__,
+            key_columns=_ROLLUP_KEY_COLUMNS,
+            increment_columns=_ROLLUP_COUNTER_COLUMNS
+        )
+        await db.execute(stmt, rows)
+
+
+def prune_prompt_clusters(engine, before: datetime, batch_size: int) -> int:
+    """Delete clusters last seen before `before`, with their bands and rollups
+
+    A cluster's last sighting is its newest daily rollup, as reported by
+    the near-duplicates endpoint. Clusters are removed in batches of short
+    transactions, bands first so writers stop matching them. Returns the
+    number of clusters deleted.
+    """
+    clusters = PromptCluster.__table__
+    bands = PromptClusterBand.__table__
+    rollups = PromptClusterRollup.__table__
+    recent = exists().where(rollups.c.cluster_id == clusters.c.id, rollups.c.bucket_start >= before)
+    deleted = 0
+    while True:
+        with engine.begin() as conn:
+            ids = conn.execute(
+                select(clusters.c.id).where(clusters.c.created_at < before, ~recent)
+                .order_by(clusters.c.id).limit(batch_size)
+            ).scalars().all()
+            if not ids:
+                return deleted
+            conn.execute(delete(bands).where(bands.c.cluster_id.in_(ids)))
+            conn.execute(delete(rollups).where(rollups.c.cluster_id.in_(ids)))
+            conn.execute(delete(clusters).where(clusters.c.id.in_(ids)))
+        deleted += len(ids)
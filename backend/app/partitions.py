@@ -0,0 +1,259 @@
+import logging
+import re
+from dataclasses import dataclass
+from datetime import datetime, timezone
+from typing import List, Optional
+
+from sqlalchemy import Column, MetaData, Table, delete, func, insert, inspect, select, text
+
+from app.models import UsageEvent
+
+logger = logging.getLogger(__name__)
+
+# Monthly storage for usage_events.
+#
+# Postgres: usage_events is range-partitioned on created_at (migration 008)
+# with one partition per month, usage_events_YYYY_MM, created ahead of time.
+# Rows from before the migration live in the usage_events_history partition.
+#
+# SQLite has no partitioning, so closed months are rolled out of the hot
+# usage_events table into per-month tables of the same name. The current
+# and previous month always stay in usage_events, which is all the request
+# path and the dashboard read.
+
+_PARTITION_NAME = re.compile(r"^usage_events_(\d{4})_(\d{2})$")
+_UPPER_BOUND = re.compile(r"TO \('([^']+)'\)")
+
+
+@dataclass
+class Partition:
+    """Where one month of usage events is stored"""
+    period: str  # YYYY-MM
+    table: str
+    whole_table: bool  # the table holds only this month, so it can be dropped
+
+
+def period_of(timestamp: datetime) -> str:
+    return timestamp.strftime("%Y-%m")
+
+
+def month_start(period: str) -> datetime:
+    """First instant of a YYYY-MM period (naive UTC)"""
+    return datetime.strptime(period, "%Y-%m")
+
+
+def add_months(period: str, months: int) -> str:
+    start = month_start(period)
+    index = start.year * 12 + start.month - 1 + months
+    return f"{index // 12:04d}-{index % 12 + 1:02d}"
+
+
+def current_period() -> str:
+    return period_of(datetime.utcnow())
+
+
+def partition_name(period: str) -> str:
+    return "usage_events_" + period.replace("-", "_")
+
+
+def is_partitioned(conn) -> bool:
+    """True when usage_events is a partitioned Postgres table"""
+    if conn.dialect.name != "postgresql":
+        return False
+    return conn.execute(text(
+        "SELECT 1 FROM pg_partitioned_table p JOIN pg_class c ON c.oid = p.partrelid "
+        "WHERE c.relname = 'usage_events' AND pg_table_is_visible(c.oid)"
+    )).first() is not None
+
+
+def _postgres_partitions(conn) -> List[tuple]:
+    """(name, bound expression) for every partition of usage_events"""
+    return conn.execute(text(
+        "SELECT child.relname, pg_get_expr(child.relpartbound, child.oid) "
+        "FROM pg_inherits i "
+        "JOIN pg_class parent ON parent.oid = i.inhparent "
+        "JOIN pg_class child ON child.oid = i.inhrelid "
+        "WHERE parent.relname = 'usage_events' AND pg_table_is_visible(parent.oid)"
+    )).all()
+
+
+def ensure_partitions(conn, months_ahead: int) -> List[str]:
+    """Create monthly Postgres partitions through `months_ahead` months from now
+
+    Starts after the highest existing partition bound, so it never overlaps
+    the history partition. Returns the partitions created; a no-op unless
+    usage_events is partitioned.
+    """
+    if not is_partitioned(conn):
+        return []
+    highest = None
+    for _, bound in _postgres_partitions(conn):
+        match = _UPPER_BOUND.search(bound or "")
+        if match:
+            upper = period_of(datetime.fromisoformat(match.group(1)).astimezone(timezone.utc))
+            highest = upper if highest is None or upper > highest else highest
+    period = max(highest or current_period(), current_period())
+    last = add_months(current_period(), months_ahead)
+    created = []
+    while period <= last:
+        name = partition_name(period)
+        conn.execute(text(
+            f"CREATE TABLE IF NOT EXISTS {name} PARTITION OF usage_events "
+            f"FOR VALUES FROM ('{month_start(period).isoformat()}+00') "
+            f"TO ('{month_start(add_months(period, 1)).isoformat()}+00')"
+        ))
+        created.append(name)
+        period = add_months(period, 1)
+    return created
+
+
+def _month_table(name: str) -> Table:
+    """A lightweight Table for a per-month copy of usage_events"""
+    return Table(name, MetaData(), *[Column(column.name, column.type) for column in UsageEvent.__table__.columns])
+
+
+def sqlite_month_tables(conn) -> List[str]:
+    return sorted(name for name in inspect(conn).get_table_names() if _PARTITION_NAME.match(name))
+
+
+def _naive_utc(timestamp: datetime) -> datetime:
+    return timestamp.astimezone(timezone.utc).replace(tzinfo=None) if timestamp.tzinfo else timestamp
+
+
+def stored_tables(conn, since: Optional[datetime] = None, until: Optional[datetime] = None) -> List[Table]:
+    """Every table holding usage events: usage_events plus the SQLite month tables overlapping [since, until)"""
+    tables = [UsageEvent.__table__]
+    if conn.dialect.name == "sqlite":
+        for name in sqlite_month_tables(conn):
+            match = _PARTITION_NAME.match(name)
+            period = f"{match.group(1)}-{match.group(2)}"
+            if since and month_start(add_months(period, 1)) <= _naive_utc(since):
+                continue
+            if until and month_start(period) >= _naive_utc(until):
+                continue
+            tables.append(_month_table(name))
+    return tables
+
+
+def partitions(conn) -> List[Partition]:
+    """Every stored month older than the current one, oldest first"""
+    table = UsageEvent.__table__
+    if is_partitioned(conn):
+        names = [name for name, _ in _postgres_partitions(conn)]
+    elif conn.dialect.name == "sqlite":
+        names = sqlite_month_tables(conn)
+    else:
+        names = []
+    found = {}
+    for name in names:
+        match = _PARTITION_NAME.match(name)
+        if match:
+            period = f"{match.group(1)}-{match.group(2)}"
+            found[period] = Partition(period, name, True)
+
+    # Months still mixed into a shared table (hot table, history or default partition)
+    oldest = conn.execute(select(func.min(table.c.created_at))).scalar()
+    if oldest is not None:
+        if isinstance(oldest, str):
+            oldest = datetime.fromisoformat(oldest)
+        period = period_of(oldest)
+        while period < current_period():
+            if period not in found and _has_rows(conn, table, period):
+                found[period] = Partition(period, "usage_events", False)
+            period = add_months(period, 1)
+    return [found[period] for period in sorted(found) if period < current_period()]
+
+
+def _has_rows(conn, table, period: str) -> bool:
+    return conn.execute(select(table.c.id).where(
+        table.c.created_at >= month_start(period),
+        table.c.created_at < month_start(add_months(period, 1))
+    ).limit(1)).first() is not None
+
+
+def month_source(partition: Partition) -> Table:
+    """Table to read a month's rows from, filtered to the month by the caller"""
+    if partition.table == "usage_events":
+        return UsageEvent.__table__
+    return _month_table(partition.table)
+
+
+def period_source(conn, period: str) -> Table:
+    """Table holding a month's rows: its SQLite month table once rolled over, else usage_events"""
+    name = partition_name(period)
+    if conn.dialect.name == "sqlite" and inspect(conn).has_table(name):
+        return _month_table(name)
+    return UsageEvent.__table__
+
+
+def delete_month_rows(engine, partition: Partition, batch_size: int) -> int:
+    """Remove a month from the database in short transactions
+
+    Whole-month tables are detached and dropped. Months that share a table
+    are deleted by primary key in batches, so no statement holds locks on
+    many rows for long. Returns the rows deleted batch-wise.
+    """
+    if partition.whole_table:
+        if engine.dialect.name == "postgresql":
+            # DETACH ... CONCURRENTLY can't run inside a transaction block
+            with engine.connect().execution_options(isolation_level="AUTOCOMMIT") as conn:
+                conn.execute(text(f"ALTER TABLE usage_events DETACH PARTITION {partition.table} CONCURRENTLY"))
+                conn.execute(text(f"DROP TABLE {partition.table}"))
+        else:
+            with engine.begin() as conn:
+                conn.execute(text(f"DROP TABLE {partition.table}"))
+        return 0
+
+    table = UsageEvent.__table__
+    start, end = month_start(partition.period), month_start(add_months(partition.period, 1))
+    deleted = 0
+    while True:
+        with engine.begin() as conn:
+            ids = conn.execute(select(table.c.id).where(
+                table.c.created_at >= start, table.c.created_at < end
+            ).order_by(table.c.id).limit(batch_size)).scalars().all()
+            if not ids:
+                return deleted
+            conn.execute(delete(table).where(table.c.id.in_(ids)))
+        deleted += len(ids)
+
+
+def roll_over_sqlite(engine, batch_size: int, keep_months: int = 2) -> List[str]:
+    """Move closed months out of the SQLite hot table into per-month tables
+
+    The newest `keep_months` months (current one included) stay in
+    usage_events. Each batch copies and deletes up to `batch_size` rows in
+    one short transaction, so the proxy's writer is never blocked for long.
+    Returns the months rolled over.
+    """
+    if engine.dialect.name != "sqlite":
+        return []
+    table = UsageEvent.__table__
+    cutoff = add_months(current_period(), 1 - keep_months)
+    rolled = []
+    with engine.connect() as conn:
+        months = [partition.period for partition in partitions(conn) if not partition.whole_table]
+    for period in months:
+        if period >= cutoff:
+            continue
+        name = partition_name(period)
+        start, end = month_start(period), month_start(add_months(period, 1))
+        with engine.begin() as conn:
+            conn.execute(text(f"CREATE TABLE IF NOT EXISTS {name} AS SELECT * FROM usage_events WHERE 0"))
+            conn.execute(text(f"CREATE INDEX IF NOT EXISTS idx_{name}_key_created ON {name} (virtual_key_id, created_at)"))
+        target = _month_table(name)
+        columns = [column.name for column in table.columns]
+        while True:
+            with engine.begin() as conn:
+                ids = conn.execute(select(table.c.id).where(
+                    table.c.created_at >= start, table.c.created_at < end
+                ).order_by(table.c.id).limit(batch_size)).scalars().all()
+                if not ids:
+                    break
+                conn.execute(insert(target).from_select(
+                    columns, select(*table.columns).where(table.c.id.in_(ids))
+                ))
+                conn.execute(delete(table).where(table.c.id.in_(ids)))
+        logger.info("Rolled %s out of usage_events into %s", period, name)
+        rolled.append(period)
+    return rolled
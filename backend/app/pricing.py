@@ -0,0 +1,114 @@
+import asyncio
+import bisect
+import logging
+from dataclasses import dataclass
+from datetime import datetime, timezone
+from typing import Dict, Iterable, List, Optional, Tuple
+
+from sqlalchemy import select
+
+from app.config import settings
+from app.database import AsyncSessionLocal
+from app.models import ModelPrice
+
+logger = logging.getLogger(__name__)
+
+# Per 1M tokens, for models in neither the price table nor settings
+DEFAULT_PRICE = (1.0, 3.0)
+
+
+@dataclass(frozen=True)
+class PricePeriod:
+    """Prices for one model over [effective_from, effective_to)"""
+    input_price: float
+    output_price: float
+    effective_from: datetime
+    effective_to: Optional[datetime]
+
+
+def settings_price(provider: str, model: str) -> Optional[Tuple[float, float]]:
+    """(input, output) per 1M tokens from OPENAI_PRICING / ANTHROPIC_PRICING"""
+    pricing = settings.OPENAI_PRICING if provider == "openai" else settings.ANTHROPIC_PRICING
+    entry = pricing.get(model)
+    if entry is None:
+        return None
+    return entry["input"], entry["output"]
+
+
+def _naive_utc(timestamp: datetime) -> datetime:
+    if timestamp.tzinfo is not None:
+        return timestamp.astimezone(timezone.utc).replace(tzinfo=None)
+    return timestamp
+
+
+class PriceBook:
+    """Model prices from the model_prices table, falling back to settings
+
+    Lookups are in memory, so the request path never queries for prices.
+    Each worker reloads the table every `refresh_interval` seconds, so a
+    price added on one worker reaches the others within that interval.
+    """
+
+    def __init__(self, refresh_interval: float):
+        self.refresh_interval = refresh_interval
+        self._periods: Dict[Tuple[str, str], List[PricePeriod]] = {}
+        self._starts: Dict[Tuple[str, str], List[datetime]] = {}
+        self._task: Optional[asyncio.Task] = None
+
+    def replace(self, rows: Iterable[ModelPrice]) -> None:
+        """Swap in a full set of price rows"""
+        periods: Dict[Tuple[str, str], List[PricePeriod]] = {}
+        for row in rows:
+            periods.setdefault((row.provider, row.model), []).append(PricePeriod(
+                row.input_price, row.output_price, row.effective_from, row.effective_to
+            ))
+        for entries in periods.values():
+            entries.sort(key=lambda period: period.effective_from)
+        self._periods = periods
+        self._starts = {key: [period.effective_from for period in entries] for key, entries in periods.items()}
+
+    def periods(self, provider: str, model: str) -> List[PricePeriod]:
+        return self._periods.get((provider, model), [])
+
+    def models(self) -> List[Tuple[str, str]]:
+        return list(self._periods)
+
+    def lookup(self, provider: str, model: str, at: Optional[datetime] = None) -> Tuple[float, float]:
+        """(input, output) per 1M tokens in effect at `at` (default: now)"""
+        periods = self._periods.get((provider, model))
+        if periods:
+            at = _naive_utc(at) if at else datetime.utcnow()
+            index = bisect.bisect_right(self._starts[(provider, model)], at) - 1
+            if index >= 0 and (periods[index].effective_to is None or at < periods[index].effective_to):
+                return periods[index].input_price, periods[index].output_price
+        return settings_price(provider, model) or DEFAULT_PRICE
+
+    async def reload(self) -> None:
+        async with AsyncSessionLocal() as db:
+            self.replace((await db.execute(select(ModelPrice))).scalars().all())
+
+    async def start(self) -> None:
+        """Load prices and keep reloading them in the background"""
+        await self.reload()
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._run(), name="price-book-refresh")
+
+    async def stop(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    async def _run(self) -> None:
+        while True:
+            await asyncio.sleep(self.refresh_interval)
+            try:
+                await self.reload()
+            except Exception:
+                logger.exception("Failed to reload model prices")
+
+
+price_book = PriceBook(refresh_interval=settings.PRICING_REFRESH_INTERVAL)
@@ -0,0 +1,224 @@
+import logging
+import math
+import time
+from dataclasses import dataclass
+from typing import Dict, Optional
+
+from prometheus_client import Counter
+
+from app.redis_client import get_redis
+
+logger = logging.getLogger(__name__)
+
+RATE_LIMITED_REQUESTS = Counter('rate_limited_requests_total', 'Requests refused by a rate limit', ['limit'])
+RATE_LIMIT_FALLBACKS = Counter(
+    'rate_limit_fallbacks_total', 'Rate limit checks answered in-process because Redis failed'
+)
+
+
+class RateLimitExceeded(Exception):
+    """A request does not fit a key's requests- or tokens-per-minute limit"""
+
+    def __init__(self, limit: str, per_minute: int, retry_after: float):
+        super().__init__(f"Rate limit of {per_minute} {limit} per minute exceeded")
+        self.limit = limit
+        self.per_minute = per_minute
+        self.retry_after = retry_after
+
+    @property
+    def retry_after_header(self) -> str:
+        """Whole seconds for the Retry-After header, at least 1"""
+        return str(max(1, math.ceil(self.retry_after)))
+
+
+@dataclass
+class RatePermit:
+    """Tokens taken from a key's TPM bucket until the request is settled"""
+    virtual_key_id: int
+    tokens_per_minute: Optional[int]
+    tokens: int
+    settled: bool = False
+
+
+def _refused(limit: str, per_minute: int, retry_after: float) -> RateLimitExceeded:
+    RATE_LIMITED_REQUESTS.labels(limit=limit).inc()
+    return RateLimitExceeded(limit, per_minute, retry_after)
+
+
+class LocalRateLimiter:
+    """Per-process token buckets for requests and tokens per minute
+
+    Each bucket holds up to a minute's allowance and refills continuously,
+    so a key can burst to its full limit and then runs at the steady rate.
+    Every method runs without awaiting, so check-and-take is atomic on the
+    event loop. Buckets are not shared between workers; use the Redis
+    limiter when running more than one.
+    """
+
+    def __init__(self):
+        # virtual key id -> [requests, tokens, updated (monotonic)]
+        self._buckets: Dict[int, list] = {}
+
+    async def acquire(
+        self,
+        virtual_key_id: int,
+        requests_per_minute: Optional[int],
+        tokens_per_minute: Optional[int],
+        tokens: int
+    ) -> RatePermit:
+        """Take one request and `tokens` estimated tokens, or raise RateLimitExceeded"""
+        now = time.monotonic()
+        bucket = self._buckets.get(virtual_key_id)
+        if bucket is None:
+            bucket = self._buckets[virtual_key_id] = [requests_per_minute or 0, tokens_per_minute or 0, now]
+        elapsed = now - bucket[2]
+        bucket[2] = now
+
+        request_wait = token_wait = 0.0
+        if requests_per_minute:
+            bucket[0] = min(requests_per_minute, bucket[0] + elapsed * requests_per_minute / 60)
+            if bucket[0] < 1:
+                request_wait = (1 - bucket[0]) * 60 / requests_per_minute
+        if tokens_per_minute:
+            # A request larger than the whole allowance waits for a full bucket
+            tokens = min(tokens, tokens_per_minute)
+            bucket[1] = min(tokens_per_minute, bucket[1] + elapsed * tokens_per_minute / 60)
+            if bucket[1] < tokens:
+                token_wait = (tokens - bucket[1]) * 60 / tokens_per_minute
+
+        if request_wait or token_wait:
+            if request_wait >= token_wait:
+                raise _refused("requests", requests_per_minute, request_wait)
+            raise _refused("tokens", tokens_per_minute, token_wait)
+        if requests_per_minute:
+            bucket[0] -= 1
+        if tokens_per_minute:
+            bucket[1] -= tokens
+        return RatePermit(virtual_key_id, tokens_per_minute, tokens if tokens_per_minute else 0)
+
+    async def settle(self, permit: RatePermit, actual_tokens: int) -> None:
+        """Replace the estimate with the tokens actually used
+
+        Unused tokens go back into the bucket; an underestimate leaves it in
+        debt, which later requests wait out.
+        """
+        if permit.settled:
+            return
+        permit.settled = True
+        bucket = self._buckets.get(permit.virtual_key_id)
+        if bucket is not None and permit.tokens_per_minute and actual_tokens != permit.tokens:
+            bucket[1] = min(permit.tokens_per_minute, bucket[1] + permit.tokens - actual_tokens)
+
+
+# KEYS[1] = bucket hash; ARGV = rpm ('' for none), tpm ('' for none), tokens.
+# Returns {1} or {0, wait seconds as a string, limit}; the clock is Redis's,
+# so workers on different hosts agree on refill times.
+_ACQUIRE_SCRIPT = """
+local clock = redis.call('TIME')
+local now = tonumber(clock[1]) + tonumber(clock[2]) / 1000000
+local state = redis.call('HMGET', KEYS[1], 'r', 't', 'ts')
+local elapsed = math.max(0, now - (tonumber(state[3]) or now))
+local wait, limit = 0, ''
+local r, t, need
+if ARGV[1] ~= '' then
+    local rpm = tonumber(ARGV[1])
+    r = math.min(rpm, (tonumber(state[1]) or rpm) + elapsed * rpm / 60)
+    if r < 1 then
+        wait, limit = (1 - r) * 60 / rpm, 'requests'
+    end
+end
+if ARGV[2] ~= '' then
+    local tpm = tonumber(ARGV[2])
+    need = math.min(tonumber(ARGV[3]), tpm)
+    t = math.min(tpm, (tonumber(state[2]) or tpm) + elapsed * tpm / 60)
+    if t < need and (need - t) * 60 / tpm > wait then
+        wait, limit = (need - t) * 60 / tpm, 'tokens'
+    end
+end
+if wait > 0 then
+    return {0, tostring(wait), limit}
+end
+redis.call('HSET', KEYS[1], 'ts', tostring(now))
+if r then
+    redis.call('HSET', KEYS[1], 'r', tostring(r - 1))
+end
+if t then
+    redis.call('HSET', KEYS[1], 't', tostring(t - need))
+end
+redis.call('EXPIRE', KEYS[1], 120)
+return {1}
+"""
+
+# KEYS[1] = bucket hash; ARGV = tpm, tokens to return (negative for debt)
+_SETTLE_SCRIPT = """
+local t = tonumber(redis.call('HGET', KEYS[1], 't'))
+if t then
+    redis.call('HSET', KEYS[1], 't', tostring(math.min(tonumber(ARGV[1]), t + tonumber(ARGV[2]))))
+end
+return 1
+"""
+
+
+class RedisRateLimiter:
+    """Token buckets shared by all workers through Redis hashes
+
+    Each check is one script call. If Redis fails, the check falls back to
+    this worker's in-process buckets rather than failing the request.
+    """
+
+    def __init__(self, client):
+        self._client = client
+        self._acquire = client.register_script(_ACQUIRE_SCRIPT)
+        self._settle = client.register_script(_SETTLE_SCRIPT)
+        self._fallback = LocalRateLimiter()
+
+    @staticmethod
+    def _key(virtual_key_id: int) -> str:
+        return f"aca:ratelimit:virtual_key:{virtual_key_id}"
+
+    async def acquire(
+        self,
+        virtual_key_id: int,
+        requests_per_minute: Optional[int],
+        tokens_per_minute: Optional[int],
+        tokens: int
+    ) -> RatePermit:
+        try:
+            result = await self._acquire(
+                keys=[self._key(virtual_key_id)],
+                args=[requests_per_minute or "", tokens_per_minute or "", tokens]
+            )
+        except Exception:
+            logger.exception("Redis rate limit check failed; using the in-process limiter")
+            RATE_LIMIT_FALLBACKS.inc()
+            return await self._fallback.acquire(virtual_key_id, requests_per_minute, tokens_per_minute, tokens)
+        if int(result[0]) == 0:
+            limit = result[2]
+            raise _refused(
+                limit, requests_per_minute if limit == "requests" else tokens_per_minute, float(result[1])
+            )
+        if tokens_per_minute:
+            return RatePermit(virtual_key_id, tokens_per_minute, min(tokens, tokens_per_minute))
+        return RatePermit(virtual_key_id, None, 0)
+
+    async def settle(self, permit: RatePermit, actual_tokens: int) -> None:
+        if permit.settled:
+            return
+        permit.settled = True
+        if not permit.tokens_per_minute or actual_tokens == permit.tokens:
+            return
+        try:
+            await self._settle(
+                keys=[self._key(permit.virtual_key_id)],
+                args=[permit.tokens_per_minute, permit.tokens - actual_tokens]
+            )
+        except Exception:
+            logger.exception("Failed to settle rate limit tokens")
+
+
+def _create_limiter():
+    client = get_redis()
+    return RedisRateLimiter(client) if client is not None else LocalRateLimiter()
+
+
+rate_limiter = _create_limiter()
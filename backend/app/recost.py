@@ -0,0 +1,443 @@
+import logging
+from collections import defaultdict
+from dataclasses import dataclass, field
+from datetime import datetime, timedelta, timezone
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+from sqlalchemy import (
+    Column, DateTime, Float, Integer, MetaData, String, Table, and_, bindparam, delete, insert, or_, select, tuple_,
+    type_coerce, update
+)
+
+from app.config import settings
+from app.ledger import VIRTUAL_KEY_SCOPE, BudgetScope, load_budget_chains_sync
+from app.models import PromptClusterRollup, SpendLedger, UsageRollup
+from app.partitions import stored_tables
+from app.pricing import PriceBook, PricePeriod, settings_price
+
+logger = logging.getLogger(__name__)
+
+# Re-costing recomputes every matching event's cost from the price book
+# (model_prices over the settings defaults) and writes back only the events
+# whose cost changed. Each chunk runs in one transaction that updates the
+# events and applies the cost differences to usage_rollups,
+# prompt_cluster_rollups and spend_ledger (the key's rows and its current
+# project's, team's and organization's), so the aggregates always match
+# the events. Cache hits and coalesced requests carry no tokens of their
+# own and are left as recorded. Batch API events keep their discount
+# (BATCH_PRICE_RATIO).
+
+_EPOCH = datetime(1970, 1, 1)
+_MICROS_PER_HOUR = 3_600_000_000
+_MICROS_PER_DAY = 24 * _MICROS_PER_HOUR
+_TOLERANCE = 1e-9
+
+_EVENT_COLUMNS = (
+    "id", "created_at", "virtual_key_id", "provider", "model", "input_tokens", "output_tokens",
+    "input_cost", "output_cost", "total_cost", "prompt_cluster_id", "batch_id",
+)
+
+
+def _micros(timestamp: datetime) -> int:
+    if timestamp.tzinfo is not None:
+        timestamp = timestamp.astimezone(timezone.utc).replace(tzinfo=None)
+    return (timestamp - _EPOCH) // timedelta(microseconds=1)
+
+
+def _micros_array(timestamps: list) -> np.ndarray:
+    if isinstance(timestamps[0], str):
+        # SQLite's stored ISO text, parsed in bulk
+        return np.array(timestamps, dtype="datetime64[us]").astype(np.int64)
+    if timestamps[0].tzinfo is None:
+        # NumPy converts naive datetimes without a Python-level loop
+        return np.array(timestamps, dtype="datetime64[us]").astype(np.int64)
+    return np.fromiter((_micros(value) for value in timestamps), np.int64, len(timestamps))
+
+
+def _from_micros(micros: int) -> datetime:
+    return _EPOCH + timedelta(microseconds=int(micros))
+
+
+def _round6(values: np.ndarray) -> np.ndarray:
+    """round(value, 6) for every element, matching Python's rounding exactly
+
+    np.round scales and rounds half to even, which disagrees with Python's
+    correctly rounded result when the scaled value sits on a half; those
+    few elements are rounded in Python.
+    """
+    rounded = np.round(values, 6)
+    scaled = values * 1e6
+    near_half = np.abs(np.abs(scaled - np.trunc(scaled)) - 0.5) < 1e-6
+    if near_half.any():
+        rounded[near_half] = [round(value, 6) for value in values[near_half].tolist()]
+    return rounded
+
+
+class PriceSchedule:
+    """One model's prices as a step function of time, for vectorized lookup
+
+    Segment i covers [starts[i], starts[i + 1]) in microseconds since the
+    epoch. Outside the price table's periods the settings price applies;
+    NaN marks times with no known price, whose events are left alone.
+    """
+
+    def __init__(self, periods: List[PricePeriod], fallback: Optional[Tuple[float, float]]):
+        base = fallback or (np.nan, np.nan)
+        starts = [np.iinfo(np.int64).min]
+        prices = [base]
+        for period in periods:
+            starts.append(_micros(period.effective_from))
+            prices.append((period.input_price, period.output_price))
+            if period.effective_to is not None:
+                starts.append(_micros(period.effective_to))
+                prices.append(base)
+        self.starts = np.array(starts, dtype=np.int64)
+        self.input_prices = np.array([price[0] for price in prices], dtype=np.float64)
+        self.output_prices = np.array([price[1] for price in prices], dtype=np.float64)
+
+    def lookup(self, micros: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+        # Equal starts (a period ending where the next begins) resolve to the later segment
+        index = np.searchsorted(self.starts, micros, side="right") - 1
+        return self.input_prices[index], self.output_prices[index]
+
+
+@dataclass
+class RecostReport:
+    """What a re-costing run changed (or would change, in a dry run)"""
+    dry_run: bool
+    scanned: int = 0
+    changed: int = 0
+    unpriced: int = 0
+    # (provider, model) -> [events changed, old cost, new cost]
+    models: Dict[Tuple[str, str], List[float]] = field(default_factory=dict)
+    # (scope type, scope id, YYYY-MM) -> cost difference
+    ledger: Dict[Tuple[str, int, str], float] = field(default_factory=lambda: defaultdict(float))
+
+    @property
+    def old_cost(self) -> float:
+        return sum(entry[1] for entry in self.models.values())
+
+    @property
+    def new_cost(self) -> float:
+        return sum(entry[2] for entry in self.models.values())
+
+    def to_dict(self) -> dict:
+        return {
+            "dry_run": self.dry_run,
+            "scanned": self.scanned,
+            "changed": self.changed,
+            "unpriced": self.unpriced,
+            "old_cost": round(self.old_cost, 6),
+            "new_cost": round(self.new_cost, 6),
+            "models": [
+                {
+                    "provider": provider,
+                    "model": model,
+                    "changed": int(changed),
+                    "old_cost": round(old_cost, 6),
+                    "new_cost": round(new_cost, 6),
+                    "difference": round(new_cost - old_cost, 6),
+                }
+                for (provider, model), (changed, old_cost, new_cost) in sorted(
+                    self.models.items(), key=lambda item: abs(item[1][2] - item[1][1]), reverse=True
+                )
+            ],
+        }
+
+
+@dataclass
+class _Chunk:
+    """Columns of one chunk of events, as arrays"""
+    ids: np.ndarray
+    created_at: list
+    micros: np.ndarray
+    virtual_key_ids: np.ndarray
+    codes: np.ndarray
+    cluster_ids: np.ndarray
+    input_tokens: np.ndarray
+    output_tokens: np.ndarray
+    input_costs: np.ndarray
+    output_costs: np.ndarray
+    total_costs: np.ndarray
+    price_ratios: np.ndarray
+
+
+class Recoster:
+    """Re-cost usage events chunk by chunk against a price book"""
+
+    def __init__(self, price_book: PriceBook):
+        self.price_book = price_book
+        self._codes: Dict[Tuple[str, str], int] = {}
+        self._models: List[Tuple[str, str]] = []
+        self._schedules: List[PriceSchedule] = []
+
+    def _code(self, key: Tuple[str, str]) -> int:
+        code = self._codes.get(key)
+        if code is None:
+            code = self._codes[key] = len(self._models)
+            self._models.append(key)
+            self._schedules.append(PriceSchedule(self.price_book.periods(*key), settings_price(*key)))
+        return code
+
+    def _chunk(self, rows) -> _Chunk:
+        columns = list(zip(*rows))
+        created_at = list(columns[1])
+        return _Chunk(
+            ids=np.array(columns[0], dtype=np.int64),
+            created_at=created_at,
+            micros=_micros_array(created_at),
+            virtual_key_ids=np.array(columns[2], dtype=np.int64),
+            codes=np.fromiter((self._code(key) for key in zip(columns[3], columns[4])), np.int64, len(rows)),
+            cluster_ids=np.array([-1 if value is None else value for value in columns[10]], dtype=np.int64),
+            input_tokens=np.array(columns[5], dtype=np.float64),
+            output_tokens=np.array(columns[6], dtype=np.float64),
+            input_costs=np.array(columns[7], dtype=np.float64),
+            output_costs=np.array(columns[8], dtype=np.float64),
+            total_costs=np.array(columns[9], dtype=np.float64),
+            price_ratios=np.array(
+                [1.0 if value is None else settings.BATCH_PRICE_RATIO for value in columns[11]], dtype=np.float64
+            ),
+        )
+
+    def recost(self, rows) -> Tuple[_Chunk, np.ndarray, np.ndarray, np.ndarray, np.ndarray, int]:
+        """(chunk, changed mask, new input, output and total costs, unpriced count) for a chunk of rows"""
+        chunk = self._chunk(rows)
+        input_prices = np.full(len(rows), np.nan)
+        output_prices = np.full(len(rows), np.nan)
+        for code in np.unique(chunk.codes):
+            mask = chunk.codes == code
+            input_prices[mask], output_prices[mask] = self._schedules[code].lookup(chunk.micros[mask])
+        priced = ~np.isnan(input_prices)
+        input_prices *= chunk.price_ratios
+        output_prices *= chunk.price_ratios
+
+        # Same arithmetic and rounding as calculate_cost
+        input_raw = chunk.input_tokens / 1_000_000 * input_prices
+        output_raw = chunk.output_tokens / 1_000_000 * output_prices
+        input_costs = _round6(input_raw)
+        output_costs = _round6(output_raw)
+        total_costs = _round6(input_raw + output_raw)
+        changed = priced & (
+            (np.abs(total_costs - chunk.total_costs) > _TOLERANCE)
+            | (np.abs(input_costs - chunk.input_costs) > _TOLERANCE)
+            | (np.abs(output_costs - chunk.output_costs) > _TOLERANCE)
+        )
+        return chunk, changed, input_costs, output_costs, total_costs, int((~priced).sum())
+
+    def model(self, code: int) -> Tuple[str, str]:
+        return self._models[code]
+
+
+def _group_sums(keys: List[np.ndarray], weights: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+    """Unique key rows and the sum of weights for each"""
+    order = np.lexsort(keys[::-1])
+    ordered = [key[order] for key in keys]
+    boundary = np.ones(len(order), dtype=bool)
+    boundary[1:] = np.any([key[1:] != key[:-1] for key in ordered], axis=0)
+    starts = np.flatnonzero(boundary)
+    return np.stack([key[starts] for key in ordered], axis=1), np.add.reduceat(weights[order], starts)
+
+
+_rollups = UsageRollup.__table__
+_ROLLUP_ADJUST = update(_rollups).where(
+    _rollups.c.granularity == bindparam("b_granularity"),
+    _rollups.c.bucket_start == bindparam("b_bucket_start"),
+    _rollups.c.virtual_key_id == bindparam("b_virtual_key_id"),
+    _rollups.c.provider == bindparam("b_provider"),
+    _rollups.c.model == bindparam("b_model"),
+).values(total_cost=_rollups.c.total_cost + bindparam("b_delta"))
+
+_cluster_rollups = PromptClusterRollup.__table__
+_CLUSTER_ROLLUP_ADJUST = update(_cluster_rollups).where(
+    _cluster_rollups.c.cluster_id == bindparam("b_cluster_id"),
+    _cluster_rollups.c.bucket_start == bindparam("b_bucket_start"),
+    _cluster_rollups.c.virtual_key_id == bindparam("b_virtual_key_id"),
+).values(total_cost=_cluster_rollups.c.total_cost + bindparam("b_delta"))
+
+_ledger = SpendLedger.__table__
+_LEDGER_ADJUST = update(_ledger).where(
+    _ledger.c.scope_type == bindparam("b_scope_type"),
+    _ledger.c.scope_id == bindparam("b_scope_id"),
+    _ledger.c.period == bindparam("b_period"),
+).values(spent=_ledger.c.spent + bindparam("b_delta"))
+
+
+def _aggregate_deltas(recoster: Recoster, chunk: _Chunk, changed: np.ndarray, delta: np.ndarray):
+    """Cost differences per rollup bucket, cluster rollup bucket and ledger month
+
+    Only rows that already exist are adjusted: buckets missing from the
+    rollups are rebuilt from the (corrected) events by backfill_rollups.
+    """
+    micros = chunk.micros[changed]
+    virtual_key_ids = chunk.virtual_key_ids[changed]
+    codes = chunk.codes[changed]
+    delta = delta[changed]
+
+    rollups = []
+    days: Dict[Tuple[int, int, int], float] = defaultdict(float)
+    ledger: Dict[Tuple[int, str], float] = defaultdict(float)
+    groups, sums = _group_sums([micros // _MICROS_PER_HOUR, virtual_key_ids, codes], delta)
+    for (hour, virtual_key_id, code), amount in zip(groups.tolist(), sums.tolist()):
+        provider, model = recoster.model(code)
+        start = _from_micros(hour * _MICROS_PER_HOUR)
+        rollups.append({
+            "b_granularity": "hour", "b_bucket_start": start, "b_virtual_key_id": virtual_key_id,
+            "b_provider": provider, "b_model": model, "b_delta": amount
+        })
+        days[(hour * _MICROS_PER_HOUR // _MICROS_PER_DAY, virtual_key_id, code)] += amount
+        ledger[(virtual_key_id, start.strftime("%Y-%m"))] += amount
+    for (day, virtual_key_id, code), amount in days.items():
+        provider, model = recoster.model(code)
+        rollups.append({
+            "b_granularity": "day", "b_bucket_start": _from_micros(day * _MICROS_PER_DAY),
+            "b_virtual_key_id": virtual_key_id, "b_provider": provider, "b_model": model, "b_delta": amount
+        })
+
+    clustered = chunk.cluster_ids[changed] >= 0
+    cluster_rollups = []
+    if clustered.any():
+        groups, sums = _group_sums(
+            [chunk.cluster_ids[changed][clustered], micros[clustered] // _MICROS_PER_DAY, virtual_key_ids[clustered]],
+            delta[clustered]
+        )
+        cluster_rollups = [
+            {
+                "b_cluster_id": cluster_id, "b_bucket_start": _from_micros(day * _MICROS_PER_DAY),
+                "b_virtual_key_id": virtual_key_id, "b_delta": amount
+            }
+            for (cluster_id, day, virtual_key_id), amount in zip(groups.tolist(), sums.tolist())
+        ]
+    return rollups, cluster_rollups, ledger
+
+
+def _batch_table() -> Table:
+    """Session-local staging table for one chunk's new costs"""
+    return Table(
+        "recost_batch", MetaData(),
+        Column("id", Integer, primary_key=True),
+        Column("created_at", DateTime(timezone=True)),
+        Column("input_cost", Float),
+        Column("output_cost", Float),
+        Column("total_cost", Float),
+        prefixes=["TEMPORARY"],
+    )
+
+
+def recost_usage_events(
+    engine,
+    price_book: PriceBook,
+    since: Optional[datetime] = None,
+    until: Optional[datetime] = None,
+    provider: Optional[str] = None,
+    model: Optional[str] = None,
+    dry_run: bool = True,
+    chunk_size: int = 100_000
+) -> RecostReport:
+    """Recompute the cost of usage events in [since, until) from the price book
+
+    Events are read in keyset order on (created_at, id), `chunk_size` at a
+    time. Changed costs go to a temporary table and are applied with a
+    single UPDATE ... FROM per chunk, alongside the rollup and ledger
+    adjustments. A dry run computes the same report without writing.
+    """
+    report = RecostReport(dry_run=dry_run)
+    recoster = Recoster(price_book)
+    chains: Dict[int, Tuple[BudgetScope, ...]] = {}
+    batch = _batch_table()
+    with engine.connect() as conn:
+        postgres = conn.dialect.name == "postgresql"
+        tables = stored_tables(conn)
+        conn.commit()
+        if not dry_run:
+            with conn.begin():
+                batch.create(conn)
+        for table in tables:
+            created_at = table.c.created_at
+            if conn.dialect.name == "sqlite":
+                # Read the stored text as is; parsing it into datetimes row by row dominates otherwise
+                created_at = type_coerce(created_at, String)
+            columns = [created_at.label("created_at") if name == "created_at" else table.c[name] for name in _EVENT_COLUMNS]
+            filters = [
+                table.c.created_at.isnot(None),
+                or_(table.c.cache_hit.is_(None), table.c.cache_hit.is_(False)),
+                or_(table.c.coalesced.is_(None), table.c.coalesced.is_(False)),
+            ]
+            if since:
+                filters.append(table.c.created_at >= since)
+            if until:
+                filters.append(table.c.created_at < until)
+            if provider:
+                filters.append(table.c.provider == provider)
+            if model:
+                filters.append(table.c.model == model)
+            position = None
+            while True:
+                with conn.begin():
+                    query = select(*columns).where(*filters)
+                    if position is not None:
+                        query = query.where(tuple_(created_at, table.c.id) > tuple_(*position))
+                    rows = conn.execute(query.order_by(table.c.created_at, table.c.id).limit(chunk_size)).all()
+                    if not rows:
+                        break
+                    position = (rows[-1][1], rows[-1][0])
+                    report.scanned += len(rows)
+
+                    chunk, changed, input_costs, output_costs, total_costs, unpriced = recoster.recost(rows)
+                    report.unpriced += unpriced
+                    if not changed.any():
+                        continue
+                    delta = total_costs - chunk.total_costs
+                    report.changed += int(changed.sum())
+                    groups, changed_counts = _group_sums([chunk.codes[changed]], np.ones(int(changed.sum())))
+                    _, old_sums = _group_sums([chunk.codes[changed]], chunk.total_costs[changed])
+                    _, new_sums = _group_sums([chunk.codes[changed]], total_costs[changed])
+                    for (code,), count, old_cost, new_cost in zip(groups.tolist(), changed_counts, old_sums, new_sums):
+                        entry = report.models.setdefault(recoster.model(code), [0, 0.0, 0.0])
+                        entry[0] += int(count)
+                        entry[1] += float(old_cost)
+                        entry[2] += float(new_cost)
+
+                    rollups, cluster_rollups, key_ledger = _aggregate_deltas(recoster, chunk, changed, delta)
+                    missing = {virtual_key_id for virtual_key_id, _ in key_ledger} - chains.keys()
+                    if missing:
+                        chains.update(load_budget_chains_sync(conn, missing))
+                    ledger: Dict[Tuple[str, int, str], float] = defaultdict(float)
+                    for (virtual_key_id, period), amount in key_ledger.items():
+                        for scope in chains.get(virtual_key_id) or (BudgetScope(VIRTUAL_KEY_SCOPE, virtual_key_id),):
+                            ledger[(scope.scope_type, scope.scope_id, period)] += amount
+                    for key, amount in ledger.items():
+                        report.ledger[key] += amount
+                    if dry_run:
+                        continue
+
+                    indexes = np.flatnonzero(changed)
+                    conn.execute(delete(batch))
+                    conn.execute(insert(batch), [
+                        {
+                            "id": int(chunk.ids[index]),
+                            "created_at": chunk.created_at[index] if postgres else None,
+                            "input_cost": float(input_costs[index]),
+                            "output_cost": float(output_costs[index]),
+                            "total_cost": float(total_costs[index]),
+                        }
+                        for index in indexes.tolist()
+                    ])
+                    match = table.c.id == batch.c.id
+                    if postgres:
+                        # Lets each partition's (id, created_at) key serve the join
+                        match = and_(match, table.c.created_at == batch.c.created_at)
+                    conn.execute(update(table).values(
+                        input_cost=batch.c.input_cost,
+                        output_cost=batch.c.output_cost,
+                        total_cost=batch.c.total_cost
+                    ).where(match))
+                    conn.execute(_ROLLUP_ADJUST, rollups)
+                    if cluster_rollups:
+                        conn.execute(_CLUSTER_ROLLUP_ADJUST, cluster_rollups)
+                    conn.execute(_LEDGER_ADJUST, [
+                        {"b_scope_type": scope_type, "b_scope_id": scope_id, "b_period": period, "b_delta": amount}
+                        for (scope_type, scope_id, period), amount in sorted(ledger.items())
+                    ])
+            logger.info("Re-costed %s: %d scanned, %d changed", table.name, report.scanned, report.changed)
+    return report
@@ -0,0 +1,25 @@
+from typing import Optional
+
+import redis.asyncio as redis
+
+from app.config import settings
+
+_client: Optional[redis.Redis] = None
+
+
+def get_redis() -> Optional[redis.Redis]:
+    """Get the shared async Redis client, or None when Redis is disabled"""
+    global _client
+    if not settings.REDIS_ENABLED:
+        return None
+    if _client is None:
+        _client = redis.from_url(settings.REDIS_URL, decode_responses=True)
+    return _client
+
+
+async def close_redis() -> None:
+    """Close the shared Redis client"""
+    global _client
+    if _client is not None:
+        await _client.aclose()
+        _client = None
@@ -0,0 +1,422 @@
+import asyncio
+import math
+import random
+import time
+from collections import deque
+from typing import Awaitable, Callable, Deque, Dict, List, Optional, Set, Tuple
+
+import httpx
+from prometheus_client import Counter, Gauge
+
+from app.concurrency import UpstreamOverloaded
+from app.config import settings
+from app.instrumentation import model_label
+
+# Answers worth another try; everything else (including other 4xx) is final
+RETRY_STATUSES = frozenset({429, 500, 502, 503, 504, 529})
+# Answers that count against the provider's circuit; 429 is a quota signal instead
+FAILURE_STATUSES = frozenset({500, 502, 503, 504, 529})
+
+CLOSED, HALF_OPEN, OPEN = 0, 1, 2
+
+UPSTREAM_ATTEMPTS = Counter(
+    'upstream_attempts_total', 'Upstream calls by kind (first, retry, hedge)', ['provider', 'kind']
+)
+UPSTREAM_HEDGE_WINS = Counter(
+    'upstream_hedge_wins_total', 'Hedged requests answered by the hedge rather than the first call', ['provider']
+)
+UPSTREAM_CIRCUIT_STATE = Gauge(
+    'upstream_circuit_state', 'Provider circuit breaker: 0 closed, 1 half-open, 2 open', ['provider']
+)
+UPSTREAM_CIRCUIT_REJECTIONS = Counter(
+    'upstream_circuit_rejections_total', 'Requests failed fast by an open circuit', ['provider']
+)
+
+
+class CircuitOpen(Exception):
+    """A provider's circuit is open, so the call is not attempted"""
+
+    def __init__(self, provider: str, retry_after: float):
+        super().__init__(f"Upstream {provider} is failing; requests are paused")
+        self.retry_after = retry_after
+
+    @property
+    def retry_after_header(self) -> str:
+        return str(max(1, math.ceil(self.retry_after)))
+
+
+class Attempt:
+    """One upstream try of a request; `response` is read in full unless streaming"""
+    __slots__ = ("number", "hedge", "response", "error", "latency")
+
+    def __init__(self, number: int, hedge: bool = False):
+        self.number = number
+        self.hedge = hedge
+        self.response: Optional[httpx.Response] = None
+        self.error: Optional[Exception] = None
+        self.latency: Optional[float] = None
+
+    @property
+    def status_code(self) -> Optional[int]:
+        return None if self.response is None else self.response.status_code
+
+    @property
+    def retryable(self) -> bool:
+        return self.response is None or self.response.status_code in RETRY_STATUSES
+
+    @property
+    def failed(self) -> bool:
+        return self.response is None or self.response.status_code in FAILURE_STATUSES
+
+
+class CircuitPermit:
+    """Leave for one upstream call from a circuit breaker
+
+    Its outcome only counts in the circuit state it was handed out in, so
+    a call started before the circuit opened can't decide the probe.
+    """
+    __slots__ = ("probe", "generation", "settled")
+
+    def __init__(self, probe: bool, generation: int):
+        self.probe = probe
+        self.generation = generation
+        self.settled = False
+
+
+class CircuitBreaker:
+    """Failure-ratio breaker over a sliding window of one provider's calls
+
+    Closed: calls flow and outcomes are counted in one-second buckets. Once
+    the last CIRCUIT_WINDOW seconds hold at least CIRCUIT_MIN_CALLS calls
+    and CIRCUIT_FAILURE_RATIO of them failed, the circuit opens and every
+    call fails fast for CIRCUIT_OPEN_SECONDS. Then a single probe call is
+    let through (half-open): success closes the circuit, failure opens it
+    again, and a probe that is shed or cancelled hands its turn to the
+    next call.
+    """
+
+    def __init__(self, provider: str):
+        self.provider = provider
+        self.state = CLOSED
+        self._generation = 0  # bumped on every state change
+        self._buckets: Deque[List[int]] = deque()  # [second, calls, failures]
+        self._calls = 0
+        self._failures = 0
+        self._opened_at = 0.0
+        self._probing = False
+        self._gauge = UPSTREAM_CIRCUIT_STATE.labels(provider)
+        self._rejections = UPSTREAM_CIRCUIT_REJECTIONS.labels(provider)
+        self._gauge.set(CLOSED)
+
+    def allow(self) -> Optional[CircuitPermit]:
+        """A permit for one call, or None while the circuit is open or already probing"""
+        if self.state == OPEN and self._opened_at + settings.CIRCUIT_OPEN_SECONDS <= time.monotonic():
+            self._set_state(HALF_OPEN)
+        if self.state == CLOSED:
+            return CircuitPermit(False, self._generation)
+        if self.state == HALF_OPEN and not self._probing:
+            self._probing = True
+            return CircuitPermit(True, self._generation)
+        return None
+
+    def check(self) -> CircuitPermit:
+        """A permit for one call; raises CircuitOpen unless the call may go ahead"""
+        permit = self.allow()
+        if permit is None:
+            self._rejections.inc()
+            remaining = self._opened_at + settings.CIRCUIT_OPEN_SECONDS - time.monotonic()
+            raise CircuitOpen(self.provider, max(remaining, 1.0))
+        return permit
+
+    def record(self, permit: CircuitPermit, failed: bool) -> None:
+        """Count the outcome of a permitted call, once"""
+        if permit.settled:
+            return
+        permit.settled = True
+        if permit.generation != self._generation:
+            # Admitted before the circuit last changed state
+            return
+        if permit.probe:
+            self._probing = False
+            if failed:
+                self._open()
+            else:
+                self._close()
+            return
+        now = int(time.monotonic())
+        self._expire(now)
+        if not self._buckets or self._buckets[-1][0] != now:
+            self._buckets.append([now, 0, 0])
+        bucket = self._buckets[-1]
+        bucket[1] += 1
+        self._calls += 1
+        if failed:
+            bucket[2] += 1
+            self._failures += 1
+            if (self._calls >= settings.CIRCUIT_MIN_CALLS
+                    and self._failures >= self._calls * settings.CIRCUIT_FAILURE_RATIO):
+                self._open()
+
+    def release(self, permit: CircuitPermit) -> None:
+        """Hand back a permit whose call was shed or cancelled, without counting it"""
+        if permit.settled:
+            return
+        permit.settled = True
+        if permit.probe and permit.generation == self._generation:
+            self._probing = False
+
+    def _expire(self, now: int) -> None:
+        while self._buckets and self._buckets[0][0] <= now - settings.CIRCUIT_WINDOW:
+            _, calls, failures = self._buckets.popleft()
+            self._calls -= calls
+            self._failures -= failures
+
+    def _open(self) -> None:
+        self._opened_at = time.monotonic()
+        self._set_state(OPEN)
+
+    def _close(self) -> None:
+        self._buckets.clear()
+        self._calls = self._failures = 0
+        self._set_state(CLOSED)
+
+    def _set_state(self, state: int) -> None:
+        self.state = state
+        self._generation += 1
+        self._gauge.set(state)
+
+
+class LatencyWindow:
+    """The last `size` successful latencies, with a cached percentile"""
+
+    def __init__(self, size: int = 512):
+        self._samples: Deque[float] = deque(maxlen=size)
+        self._added = 0
+        self._cached: Optional[float] = None
+
+    def add(self, latency: float) -> None:
+        self._samples.append(latency)
+        self._added += 1
+        # Re-sorting a few hundred floats is cheap, but not on every request
+        if self._added % 32 == 0:
+            self._cached = None
+
+    def percentile(self, pct: float) -> Optional[float]:
+        if len(self._samples) < settings.HEDGE_MIN_SAMPLES:
+            return None
+        if self._cached is None:
+            ordered = sorted(self._samples)
+            self._cached = ordered[min(len(ordered) - 1, int(len(ordered) * pct / 100))]
+        return self._cached
+
+
+class UpstreamResilience:
+    """Retries, hedging and circuit breaking around upstream calls
+
+    Retries use full-jitter exponential backoff, or the upstream's
+    Retry-After when it sends one (a longer wait than
+    RETRY_MAX_RETRY_AFTER is not waited out). Hedging applies to buffered
+    calls only: if the first call has not answered after the p95 latency
+    of recent calls to the same model, a second one is sent, preferably to
+    another target, and the first good answer wins. The loser is left to
+    finish so the tokens it bills can be recorded. Hedges are capped at
+    HEDGE_MAX_RATIO of requests so a slow upstream does not double its own
+    load.
+    """
+
+    def __init__(self):
+        self._breakers: Dict[str, CircuitBreaker] = {}
+        self._latencies: Dict[Tuple[str, str], LatencyWindow] = {}
+        self._hedge_tokens = 0.0
+        self._random = random.Random()
+        self._background: Set[asyncio.Task] = set()
+
+    def breaker(self, provider: str) -> CircuitBreaker:
+        breaker = self._breakers.get(provider)
+        if breaker is None:
+            breaker = self._breakers[provider] = CircuitBreaker(provider)
+        return breaker
+
+    def retry_delay(self, attempt: Attempt) -> Optional[float]:
+        """Seconds to wait before retrying a failed attempt, or None to give up"""
+        if attempt.number >= settings.RETRY_MAX_ATTEMPTS or not attempt.retryable:
+            return None
+        backoff = self._random.uniform(
+            0, min(settings.RETRY_BACKOFF_MAX, settings.RETRY_BACKOFF_BASE * 2 ** (attempt.number - 1))
+        )
+        retry_after = _retry_after(attempt.response)
+        if retry_after is None:
+            return backoff
+        if retry_after > settings.RETRY_MAX_RETRY_AFTER:
+            return None
+        # Jitter on top, so callers told the same Retry-After don't return in lockstep
+        return retry_after + backoff
+
+    def observe(self, provider: str, model: str, latency: float) -> None:
+        """Add a successful buffered call's latency to its model's hedge window"""
+        key = (provider, model_label(provider, model))
+        window = self._latencies.get(key)
+        if window is None:
+            window = self._latencies[key] = LatencyWindow()
+        window.add(latency)
+
+    def hedge_delay(self, provider: str, model: str) -> Optional[float]:
+        """Seconds to wait before hedging, or None while too little is known"""
+        window = self._latencies.get((provider, model_label(provider, model)))
+        return None if window is None else window.percentile(settings.HEDGE_PERCENTILE)
+
+    async def call(
+        self,
+        provider: str,
+        model: str,
+        send: Callable[[Attempt], Awaitable[None]],
+        unserved: Callable[[Attempt], Awaitable[None]],
+        hedge: bool = False
+    ) -> Attempt:
+        """Run a buffered upstream call with retries and optional hedging
+
+        `send` performs one attempt, filling in its response and latency;
+        an exception it raises is kept on the attempt (UpstreamOverloaded,
+        a shed by admission control, propagates instead). Every attempt
+        that is not the answer, including a hedge that loses the race, is
+        passed to `unserved` once it has finished. Raises CircuitOpen when
+        the provider's circuit is open.
+        """
+        breaker = self.breaker(provider)
+        permit = breaker.check()
+        number = 1
+        while True:
+            attempt = await self._race(
+                provider, model, breaker, permit, send, unserved, number, hedge and number == 1
+            )
+            delay = self.retry_delay(attempt)
+            if delay is None:
+                return attempt
+            try:
+                permit = breaker.check()
+            except CircuitOpen:
+                # The circuit opened while retrying: answer with what we have
+                return attempt
+            try:
+                await unserved(attempt)
+                await asyncio.sleep(delay)
+            except BaseException:
+                breaker.release(permit)
+                raise
+            number += 1
+
+    async def _race(
+        self,
+        provider: str,
+        model: str,
+        breaker: CircuitBreaker,
+        permit: CircuitPermit,
+        send: Callable[[Attempt], Awaitable[None]],
+        unserved: Callable[[Attempt], Awaitable[None]],
+        number: int,
+        hedge: bool
+    ) -> Attempt:
+        """One attempt, plus a hedge if it is slow; returns the attempt to use"""
+        primary = self._start(provider, model, breaker, permit, send, Attempt(number))
+        delay = self.hedge_delay(provider, model) if hedge and settings.HEDGE_ENABLED else None
+        if delay is None:
+            return await primary
+        self._hedge_tokens = min(10.0, self._hedge_tokens + settings.HEDGE_MAX_RATIO)
+        done, _ = await asyncio.wait({primary}, timeout=delay)
+        if done or self._hedge_tokens < 1:
+            return await primary
+        # The hedge needs its own permit; a half-open circuit's single probe is already out
+        hedge_permit = breaker.allow()
+        if hedge_permit is None:
+            return await primary
+        self._hedge_tokens -= 1
+
+        second = self._start(provider, model, breaker, hedge_permit, send, Attempt(number, hedge=True))
+        pending = {primary, second}
+        finished: List[Attempt] = []
+        winner = None
+        while pending and winner is None:
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                # A call shed by admission control simply drops out of the race
+                if task.exception() is None:
+                    finished.append(task.result())
+            winner = next((attempt for attempt in finished if not attempt.retryable), None)
+        if winner is None:
+            if not finished:
+                raise primary.exception()
+            # Both failed: the later failure goes on to be retried or returned
+            winner = finished[-1]
+        for attempt in finished:
+            if attempt is not winner:
+                await unserved(attempt)
+        for task in pending:
+            self._finish_later(task, unserved)
+        if winner.hedge:
+            UPSTREAM_HEDGE_WINS.labels(provider).inc()
+        return winner
+
+    def _start(
+        self,
+        provider: str,
+        model: str,
+        breaker: CircuitBreaker,
+        permit: CircuitPermit,
+        send: Callable[[Attempt], Awaitable[None]],
+        attempt: Attempt
+    ) -> asyncio.Task:
+        """Run one attempt as a task; its permit goes back if it ends without an outcome"""
+        task = asyncio.ensure_future(self._run(provider, model, breaker, permit, send, attempt))
+        # A done callback, so a task cancelled before it ever ran gives it back too
+        task.add_done_callback(lambda _: breaker.release(permit))
+        return task
+
+    async def _run(
+        self,
+        provider: str,
+        model: str,
+        breaker: CircuitBreaker,
+        permit: CircuitPermit,
+        send: Callable[[Attempt], Awaitable[None]],
+        attempt: Attempt
+    ) -> Attempt:
+        kind = "hedge" if attempt.hedge else "first" if attempt.number == 1 else "retry"
+        UPSTREAM_ATTEMPTS.labels(provider, kind).inc()
+        try:
+            await send(attempt)
+        except UpstreamOverloaded:
+            raise
+        except Exception as exc:
+            attempt.error = exc
+        breaker.record(permit, attempt.failed)
+        if attempt.status_code == 200 and attempt.latency is not None:
+            self.observe(provider, model, attempt.latency)
+        return attempt
+
+    def _finish_later(self, task: asyncio.Future, unserved: Callable[[Attempt], Awaitable[None]]) -> None:
+        """Let a losing attempt finish in the background and account it"""
+        async def finish():
+            try:
+                attempt = await task
+            except UpstreamOverloaded:
+                return
+            await unserved(attempt)
+
+        background = asyncio.ensure_future(finish())
+        self._background.add(background)
+        background.add_done_callback(self._background.discard)
+
+
+def _retry_after(response: Optional[httpx.Response]) -> Optional[float]:
+    if response is None:
+        return None
+    value = response.headers.get("retry-after")
+    if value is None:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        return None
+
+
+upstream_resilience = UpstreamResilience()
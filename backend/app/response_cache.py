@@ -0,0 +1,161 @@
+import json
+import logging
+import time
+from collections import OrderedDict
+from dataclasses import asdict, dataclass
+from typing import Any, Dict, Optional, Tuple
+
+from prometheus_client import Counter, Gauge
+
+from app.config import settings
+from app.redis_client import get_redis
+from app.utils import hash_request
+
+logger = logging.getLogger(__name__)
+
+RESPONSE_CACHE_LOOKUPS = Counter('response_cache_lookups_total', 'Response cache lookups', ['tier', 'result'])
+RESPONSE_CACHE_BYTES = Gauge('response_cache_bytes', 'Bytes held by the in-process response cache')
+
+
+@dataclass(frozen=True)
+class CachedResponse:
+    """A successful upstream response body and what it cost"""
+    body: bytes
+    media_type: str
+    input_tokens: int
+    output_tokens: int
+    total_cost: float
+
+    def to_json(self) -> str:
+        data = asdict(self)
+        data["body"] = self.body.decode("utf-8")
+        return json.dumps(data)
+
+    @classmethod
+    def from_json(cls, raw: str) -> "CachedResponse":
+        data = json.loads(raw)
+        data["body"] = data["body"].encode("utf-8")
+        return cls(**data)
+
+
+def is_cacheable(body: Dict[str, Any]) -> bool:
+    """Only deterministic, buffered, single-choice requests are cached"""
+    return (
+        not body.get("stream")
+        and body.get("temperature") == 0
+        and body.get("n", 1) == 1
+    )
+
+
+def cache_directives(header: Optional[str]) -> Tuple[bool, bool]:
+    """Parse a request Cache-Control header into (skip lookup, skip store)"""
+    directives = {part.strip().lower() for part in (header or "").split(",")}
+    no_store = "no-store" in directives
+    return no_store or "no-cache" in directives, no_store
+
+
+def response_cache_key(virtual_key_id: int, provider: str, body: Dict[str, Any]) -> str:
+    """Canonical hash of the full request body, scoped to one virtual key"""
+    return f"aca:response:{virtual_key_id}:{provider}:{hash_request(body)}"
+
+
+class _ByteLRU:
+    """LRU of cached responses bounded by total body bytes, with per-entry expiry"""
+
+    def __init__(self, max_bytes: int):
+        self.max_bytes = max_bytes
+        self.size = 0
+        self._entries: "OrderedDict[str, Tuple[float, CachedResponse]]" = OrderedDict()
+
+    def get(self, key: str) -> Optional[CachedResponse]:
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        expires_at, value = entry
+        if expires_at < time.monotonic():
+            self.pop(key)
+            return None
+        self._entries.move_to_end(key)
+        return value
+
+    def set(self, key: str, value: CachedResponse, ttl: float) -> None:
+        self.pop(key)
+        self._entries[key] = (time.monotonic() + ttl, value)
+        self.size += len(value.body)
+        while self.size > self.max_bytes and self._entries:
+            _, (_, evicted) = self._entries.popitem(last=False)
+            self.size -= len(evicted.body)
+
+    def pop(self, key: str) -> None:
+        entry = self._entries.pop(key, None)
+        if entry is not None:
+            self.size -= len(entry[1].body)
+
+    def clear(self) -> None:
+        self._entries.clear()
+        self.size = 0
+
+
+class ResponseCache:
+    """Two-tier exact-match cache: in-process LRU in front of optional Redis
+
+    Memory hits never leave the event loop. Redis hits are copied into the
+    local tier so repeated requests on the same worker stay in memory.
+    """
+
+    def __init__(self, max_bytes: int, max_entry_bytes: int, default_ttl: int, use_redis: bool):
+        self.max_entry_bytes = max_entry_bytes
+        self.default_ttl = default_ttl
+        self.use_redis = use_redis
+        self._local = _ByteLRU(max_bytes)
+        RESPONSE_CACHE_BYTES.set_function(lambda: self._local.size)
+
+    def _redis(self):
+        return get_redis() if self.use_redis else None
+
+    async def get(self, key: str) -> Optional[CachedResponse]:
+        value = self._local.get(key)
+        if value is not None:
+            RESPONSE_CACHE_LOOKUPS.labels(tier="memory", result="hit").inc()
+            return value
+        client = self._redis()
+        if client is None:
+            RESPONSE_CACHE_LOOKUPS.labels(tier="memory", result="miss").inc()
+            return None
+        try:
+            raw, ttl = await client.get(key), await client.ttl(key)
+        except Exception:
+            logger.exception("Response cache lookup in Redis failed")
+            raw = None
+        if raw is None:
+            RESPONSE_CACHE_LOOKUPS.labels(tier="redis", result="miss").inc()
+            return None
+        RESPONSE_CACHE_LOOKUPS.labels(tier="redis", result="hit").inc()
+        value = CachedResponse.from_json(raw)
+        if ttl and ttl > 0:
+            self._local.set(key, value, ttl)
+        return value
+
+    async def set(self, key: str, value: CachedResponse, ttl: Optional[int] = None) -> None:
+        if len(value.body) > self.max_entry_bytes:
+            return
+        ttl = ttl or self.default_ttl
+        self._local.set(key, value, ttl)
+        client = self._redis()
+        if client is None:
+            return
+        try:
+            await client.set(key, value.to_json(), ex=ttl)
+        except Exception:
+            logger.exception("Failed to store response in Redis cache")
+
+    def clear(self) -> None:
+        self._local.clear()
+
+
+response_cache = ResponseCache(
+    max_bytes=settings.RESPONSE_CACHE_MAX_BYTES,
+    max_entry_bytes=settings.RESPONSE_CACHE_MAX_ENTRY_BYTES,
+    default_ttl=settings.RESPONSE_CACHE_DEFAULT_TTL,
+    use_redis=settings.RESPONSE_CACHE_REDIS,
+)
@@ -0,0 +1,140 @@
+from collections import defaultdict
+from datetime import datetime, timedelta, timezone
+from typing import Any, Dict, Iterable, List, Optional, Tuple
+
+from sqlalchemy import insert, select
+
+from app.archive import archived_periods
+from app.database import upsert_increment_stmt
+from app.models import UsageRollup
+from app.partitions import add_months, month_start, stored_tables
+
+GRANULARITIES = ("hour", "day")
+
+_KEY_COLUMNS = ("granularity", "bucket_start", "virtual_key_id", "provider", "model")
+# Event columns the rollups are built from
+_EVENT_COLUMNS = (
+    "created_at", "virtual_key_id", "provider", "model", "input_tokens", "output_tokens", "total_tokens",
+    "total_cost", "served", "cache_hit", "coalesced", "saved_cost"
+)
+_COUNTER_COLUMNS = (
+    "request_count", "input_tokens", "output_tokens", "total_tokens", "total_cost",
+    "cache_hits", "coalesced_requests", "saved_cost"
+)
+
+
+def bucket_start(timestamp: datetime, granularity: str) -> datetime:
+    """Truncate a timestamp to the start of its hour or day bucket (naive UTC)"""
+    if timestamp.tzinfo is not None:
+        timestamp = timestamp.astimezone(timezone.utc).replace(tzinfo=None)
+    if granularity == "hour":
+        return timestamp.replace(minute=0, second=0, microsecond=0)
+    if granularity == "day":
+        return timestamp.replace(hour=0, minute=0, second=0, microsecond=0)
+    raise ValueError(f"Unknown granularity: {granularity}")
+
+
+def rollup_deltas(events: Iterable[Dict[str, Any]]) -> List[Dict[str, Any]]:
+    """Aggregate usage event rows into per-bucket counter increments"""
+    totals: Dict[Tuple, List[float]] = defaultdict(lambda: [0, 0, 0, 0, 0.0, 0, 0, 0.0])
+    for event in events:
+        for granularity in GRANULARITIES:
+            key = (
+                granularity,
+                bucket_start(event["created_at"], granularity),
+                event["virtual_key_id"],
+                event["provider"],
+                event["model"],
+            )
+            counters = totals[key]
+            # Retried or out-raced upstream attempts bill tokens but aren't requests
+            if event.get("served") is not False:
+                counters[0] += 1
+            counters[1] += event.get("input_tokens") or 0
+            counters[2] += event.get("output_tokens") or 0
+            counters[3] += event.get("total_tokens") or 0
+            counters[4] += event.get("total_cost") or 0.0
+            if event.get("cache_hit"):
+                counters[5] += 1
+            if event.get("coalesced"):
+                counters[6] += 1
+            counters[7] += event.get("saved_cost") or 0.0
+    return [
+        {**dict(zip(_KEY_COLUMNS, key)), **dict(zip(_COUNTER_COLUMNS, counters))}
+        for key, counters in totals.items()
+    ]
+
+
+async def apply_rollup_deltas(db, events: Iterable[Dict[str, Any]]) -> None:
+    """Add a batch of events to the rollup tables (caller commits)"""
+    rows = rollup_deltas(events)
+    if rows:
+        stmt = upsert_increment_stmt(
+            db.bind.dialect.name, UsageRollup.__table__,
+            key_columns=_KEY_COLUMNS,
+            increment_columns=_COUNTER_COLUMNS
+        )
+        await db.execute(stmt, rows)
+
+
+def backfill_rollups(
+    db,
+    since: Optional[datetime] = None,
+    until: Optional[datetime] = None,
+    chunk_size: int = 10000
+) -> int:
+    """Rebuild rollups for [since, until) from raw usage events
+
+    `since`/`until` are rounded out to whole days so every rebuilt bucket is
+    complete. Events are read from every table that stores them, SQLite
+    month tables included. Archived months have no raw events left, so the
+    range is clamped to start after the newest archive and their rollups
+    are kept. Raw events are streamed in chunks and only the aggregates are
+    held in memory. Returns the number of events read; the caller commits.
+    """
+    since = bucket_start(since, "day") if since else None
+    if until:
+        day = bucket_start(until, "day")
+        until = day if day == until else day + timedelta(days=1)
+    archived = archived_periods()
+    if archived:
+        kept = month_start(add_months(archived[-1], 1))
+        since = max(since, kept) if since else kept
+    if since and until and since >= until:
+        return 0
+
+    delete = db.query(UsageRollup)
+    if since:
+        delete = delete.filter(UsageRollup.bucket_start >= since)
+    if until:
+        delete = delete.filter(UsageRollup.bucket_start < until)
+    delete.delete(synchronize_session=False)
+
+    totals: Dict[Tuple, Dict[str, Any]] = {}
+
+    def merge(chunk):
+        for delta in rollup_deltas(chunk):
+            key = tuple(delta[column] for column in _KEY_COLUMNS)
+            existing = totals.get(key)
+            if existing is None:
+                totals[key] = delta
+            else:
+                for column in _COUNTER_COLUMNS:
+                    existing[column] += delta[column]
+
+    count = 0
+    for table in stored_tables(db.connection()):
+        events = select(*(table.c[column] for column in _EVENT_COLUMNS)).where(table.c.created_at.isnot(None))
+        if since:
+            events = events.where(table.c.created_at >= since)
+        if until:
+            events = events.where(table.c.created_at < until)
+        result = db.execute(events.execution_options(yield_per=chunk_size))
+        for chunk in result.mappings().partitions():
+            merge(chunk)
+            count += len(chunk)
+
+    rows = list(totals.values())
+    for start in range(0, len(rows), chunk_size):
+        db.execute(insert(UsageRollup), rows[start:start + chunk_size])
+    return count
@@ -1,14 +1,31 @@
-from fastapi import APIRouter, Depends, HTTPException
-from sqlalchemy.orm import Session
-from typing import List
+from fastapi import APIRouter, Depends, HTTPException, Query, Response
+from fastapi.responses import StreamingResponse
+from sqlalchemy import select, tuple_, union_all
+from sqlalchemy.ext.asyncio import AsyncSession
+from datetime import datetime, timezone
+from typing import List, Optional
+import base64
+import binascii
+import csv
+import io
 import secrets
 import string
 
-from app.database import get_db
-from app.models import VirtualKey, UsageEvent
-from app.schemas import VirtualKeyCreate, VirtualKeyResponse, UsageEventResponse
+from app.archive import archived_periods
+from app.database import AsyncSessionLocal, get_async_db
+from app.json_scan import dumps, loads
+from app.models import VirtualKey, UsageEvent, ModelPrice, Organization, Team, Project
+from app.schemas import (
+    VirtualKeyCreate, VirtualKeyUpdate, VirtualKeyResponse, UsageEventResponse, ModelPriceCreate, ModelPriceResponse,
+    OrganizationCreate, OrganizationUpdate, OrganizationResponse, TeamCreate, TeamUpdate, TeamResponse,
+    ProjectCreate, ProjectUpdate, ProjectResponse
+)
 from app.auth import get_current_admin_user, get_current_active_user, get_current_user
 from app.models import User
+from app.key_cache import invalidate_all_virtual_keys, invalidate_virtual_key
+from app.ledger import load_budget_chains, move_ledger_spend, spend_ledger
+from app.partitions import period_of, stored_tables
+from app.pricing import price_book
 
 router = APIRouter()
 
@@ -20,13 +37,13 @@ def generate_virtual_key() -> str:
 @router.post("/virtual-keys", response_model=VirtualKeyResponse)
 async def create_virtual_key(
     vk_data: VirtualKeyCreate,
-    db: Session = Depends(get_db),
+    db: AsyncSession = Depends(get_async_db),
     current_user: User = Depends(get_current_admin_user)
 ):
     """Create a new virtual key"""
     # Generate unique key
     key = generate_virtual_key()
-    while db.query(VirtualKey).filter(VirtualKey.key == key).first():
+    while await db.scalar(select(VirtualKey).where(VirtualKey.key == key)):
         key = generate_virtual_key()
     
     virtual_key = VirtualKey(
@@ -41,38 +58,45 @@ async def create_virtual_key(
         monthly_budget_cap=vk_data.monthly_budget_cap,
         max_tokens_per_request=vk_data.max_tokens_per_request,
         max_reasoning_tokens=vk_data.max_reasoning_tokens,
+        requests_per_minute=vk_data.requests_per_minute,
+        tokens_per_minute=vk_data.tokens_per_minute,
+        cache_responses=vk_data.cache_responses,
+        cache_ttl_seconds=vk_data.cache_ttl_seconds,
         created_by=current_user.id
     )
     
     db.add(virtual_key)
-    db.commit()
-    db.refresh(virtual_key)
+    await db.commit()
+    await db.refresh(virtual_key)
+    
+    # Clear any cached "unknown key" entry for the new key
+    await invalidate_virtual_key(virtual_key.key)
     
     return virtual_key
 
 @router.get("/virtual-keys", response_model=List[VirtualKeyResponse])
 async def list_virtual_keys(
-    db: Session = Depends(get_db),
+    db: AsyncSession = Depends(get_async_db),
     current_user: User = Depends(get_current_active_user)
 ):
     """List all virtual keys (admin sees all, regular users see their own)"""
     if current_user.is_admin:
-        virtual_keys = db.query(VirtualKey).all()
+        query = select(VirtualKey)
     else:
-        virtual_keys = db.query(VirtualKey).filter(
+        query = select(VirtualKey).where(
             VirtualKey.user_email == current_user.email
-        ).all()
+        )
     
-    return virtual_keys
+    return (await db.scalars(query)).all()
 
 @router.get("/virtual-keys/{key_id}", response_model=VirtualKeyResponse)
 async def get_virtual_key(
     key_id: int,
-    db: Session = Depends(get_db),
+    db: AsyncSession = Depends(get_async_db),
     current_user: User = Depends(get_current_active_user)
 ):
     """Get a specific virtual key"""
-    virtual_key = db.query(VirtualKey).filter(VirtualKey.id == key_id).first()
+    virtual_key = await db.get(VirtualKey, key_id)
     if not virtual_key:
         raise HTTPException(status_code=404, detail="Virtual key not found")
     
@@ -82,29 +106,418 @@ async def get_virtual_key(
     
     return virtual_key
 
-@router.get("/usage-events", response_model=List[UsageEventResponse])
-async def list_usage_events(
-    limit: int = 100,
-    virtual_key_id: int = None,
-    db: Session = Depends(get_db),
+@router.patch("/virtual-keys/{key_id}", response_model=VirtualKeyResponse)
+async def update_virtual_key(
+    key_id: int,
+    vk_data: VirtualKeyUpdate,
+    db: AsyncSession = Depends(get_async_db),
+    current_user: User = Depends(get_current_admin_user)
+):
+    """Update a virtual key's attribution, budget or active flag
+    
+    Moving a key to another project or team carries its recorded spend
+    from its old project's, team's and organization's budgets to the new
+    ones, so each of them keeps counting exactly what its current keys
+    spent.
+    """
+    # Locked, so the usage writer's ledger increments for the key land wholly before or after a move
+    virtual_key = await db.get(VirtualKey, key_id, with_for_update=True)
+    if not virtual_key:
+        raise HTTPException(status_code=404, detail="Virtual key not found")
+    
+    changes = vk_data.model_dump(exclude_unset=True)
+    moved = any(
+        field in changes and changes[field] != getattr(virtual_key, field) for field in ("project_id", "team_id")
+    )
+    if moved:
+        old_chain = (await load_budget_chains(db, [key_id]))[key_id]
+    for field, value in changes.items():
+        setattr(virtual_key, field, value)
+    if moved:
+        await db.flush()
+        new_chain = (await load_budget_chains(db, [key_id]))[key_id]
+        old_ancestors = [scope.id for scope in old_chain[1:]]
+        new_ancestors = [scope.id for scope in new_chain[1:]]
+        await move_ledger_spend(db, key_id, old_ancestors, new_ancestors)
+    
+    await db.commit()
+    await db.refresh(virtual_key)
+    
+    if moved:
+        await spend_ledger.move(key_id, old_ancestors, new_ancestors)
+    # Proxy workers must not keep serving the old limits
+    await invalidate_virtual_key(virtual_key.key)
+    
+    return virtual_key
+
+async def _get_or_404(db: AsyncSession, model, object_id: int, label: str):
+    instance = await db.get(model, object_id)
+    if instance is None:
+        raise HTTPException(status_code=404, detail=f"{label} not found")
+    return instance
+
+async def _update_budget_owner(db: AsyncSession, instance, changes: dict):
+    """Apply an organization, team or project update; a new cap reaches every worker's cached keys"""
+    for field, value in changes.items():
+        setattr(instance, field, value)
+    await db.commit()
+    await db.refresh(instance)
+    if "monthly_budget_cap" in changes:
+        await invalidate_all_virtual_keys()
+    return instance
+
+@router.get("/organizations", response_model=List[OrganizationResponse])
+async def list_organizations(
+    db: AsyncSession = Depends(get_async_db),
     current_user: User = Depends(get_current_active_user)
 ):
-    """List recent usage events"""
-    query = db.query(UsageEvent)
+    """List organizations"""
+    return (await db.scalars(select(Organization).order_by(Organization.id))).all()
+
+@router.post("/organizations", response_model=OrganizationResponse)
+async def create_organization(
+    data: OrganizationCreate,
+    db: AsyncSession = Depends(get_async_db),
+    current_user: User = Depends(get_current_admin_user)
+):
+    """Create an organization"""
+    organization = Organization(name=data.name, monthly_budget_cap=data.monthly_budget_cap)
+    db.add(organization)
+    await db.commit()
+    await db.refresh(organization)
+    return organization
+
+@router.patch("/organizations/{organization_id}", response_model=OrganizationResponse)
+async def update_organization(
+    organization_id: int,
+    data: OrganizationUpdate,
+    db: AsyncSession = Depends(get_async_db),
+    current_user: User = Depends(get_current_admin_user)
+):
+    """Rename an organization or change its monthly budget cap"""
+    organization = await _get_or_404(db, Organization, organization_id, "Organization")
+    return await _update_budget_owner(db, organization, data.model_dump(exclude_unset=True))
+
+@router.get("/teams", response_model=List[TeamResponse])
+async def list_teams(
+    organization_id: Optional[int] = None,
+    db: AsyncSession = Depends(get_async_db),
+    current_user: User = Depends(get_current_active_user)
+):
+    """List teams, optionally of one organization"""
+    query = select(Team)
+    if organization_id is not None:
+        query = query.where(Team.organization_id == organization_id)
+    return (await db.scalars(query.order_by(Team.id))).all()
+
+@router.post("/teams", response_model=TeamResponse)
+async def create_team(
+    data: TeamCreate,
+    db: AsyncSession = Depends(get_async_db),
+    current_user: User = Depends(get_current_admin_user)
+):
+    """Create a team in an organization"""
+    await _get_or_404(db, Organization, data.organization_id, "Organization")
+    team = Team(name=data.name, organization_id=data.organization_id, monthly_budget_cap=data.monthly_budget_cap)
+    db.add(team)
+    await db.commit()
+    await db.refresh(team)
+    return team
+
+@router.patch("/teams/{team_id}", response_model=TeamResponse)
+async def update_team(
+    team_id: int,
+    data: TeamUpdate,
+    db: AsyncSession = Depends(get_async_db),
+    current_user: User = Depends(get_current_admin_user)
+):
+    """Rename a team or change its monthly budget cap"""
+    team = await _get_or_404(db, Team, team_id, "Team")
+    return await _update_budget_owner(db, team, data.model_dump(exclude_unset=True))
+
+@router.get("/projects", response_model=List[ProjectResponse])
+async def list_projects(
+    organization_id: Optional[int] = None,
+    team_id: Optional[int] = None,
+    db: AsyncSession = Depends(get_async_db),
+    current_user: User = Depends(get_current_active_user)
+):
+    """List projects, optionally of one organization or team"""
+    query = select(Project)
+    if organization_id is not None:
+        query = query.where(Project.organization_id == organization_id)
+    if team_id is not None:
+        query = query.where(Project.team_id == team_id)
+    return (await db.scalars(query.order_by(Project.id))).all()
+
+@router.post("/projects", response_model=ProjectResponse)
+async def create_project(
+    data: ProjectCreate,
+    db: AsyncSession = Depends(get_async_db),
+    current_user: User = Depends(get_current_admin_user)
+):
+    """Create a project in an organization, optionally under one of its teams"""
+    await _get_or_404(db, Organization, data.organization_id, "Organization")
+    if data.team_id is not None:
+        team = await _get_or_404(db, Team, data.team_id, "Team")
+        if team.organization_id != data.organization_id:
+            raise HTTPException(status_code=400, detail="Team belongs to a different organization")
+    project = Project(
+        name=data.name,
+        organization_id=data.organization_id,
+        team_id=data.team_id,
+        monthly_budget_cap=data.monthly_budget_cap
+    )
+    db.add(project)
+    await db.commit()
+    await db.refresh(project)
+    return project
+
+@router.patch("/projects/{project_id}", response_model=ProjectResponse)
+async def update_project(
+    project_id: int,
+    data: ProjectUpdate,
+    db: AsyncSession = Depends(get_async_db),
+    current_user: User = Depends(get_current_admin_user)
+):
+    """Rename a project or change its monthly budget cap"""
+    project = await _get_or_404(db, Project, project_id, "Project")
+    return await _update_budget_owner(db, project, data.model_dump(exclude_unset=True))
+
+def _naive_utc(timestamp: Optional[datetime]) -> Optional[datetime]:
+    if timestamp is not None and timestamp.tzinfo is not None:
+        return timestamp.astimezone(timezone.utc).replace(tzinfo=None)
+    return timestamp
+
+@router.get("/model-prices", response_model=List[ModelPriceResponse])
+async def list_model_prices(
+    provider: Optional[str] = None,
+    model: Optional[str] = None,
+    db: AsyncSession = Depends(get_async_db),
+    current_user: User = Depends(get_current_active_user)
+):
+    """List model price periods (models without any fall back to the configured defaults)"""
+    query = select(ModelPrice)
+    if provider:
+        query = query.where(ModelPrice.provider == provider)
+    if model:
+        query = query.where(ModelPrice.model == model)
+    return (await db.scalars(query.order_by(ModelPrice.provider, ModelPrice.model, ModelPrice.effective_from))).all()
+
+@router.post("/model-prices", response_model=ModelPriceResponse)
+async def create_model_price(
+    price_data: ModelPriceCreate,
+    db: AsyncSession = Depends(get_async_db),
+    current_user: User = Depends(get_current_admin_user)
+):
+    """Add a price period for a model
+
+    An open-ended period that starts earlier is closed where the new one
+    begins; any other overlap is rejected. Past events keep their recorded
+    cost until scripts/recost_usage.py is run over them.
+    """
+    effective_from = _naive_utc(price_data.effective_from)
+    effective_to = _naive_utc(price_data.effective_to)
+    if effective_to is not None and effective_to <= effective_from:
+        raise HTTPException(status_code=400, detail="effective_to must be after effective_from")
+    
+    existing = (await db.scalars(select(ModelPrice).where(
+        ModelPrice.provider == price_data.provider,
+        ModelPrice.model == price_data.model
+    ))).all()
+    for period in existing:
+        if period.effective_to is None and period.effective_from < effective_from:
+            period.effective_to = effective_from
+        ends_after_start = period.effective_to is None or period.effective_to > effective_from
+        starts_before_end = effective_to is None or period.effective_from < effective_to
+        if ends_after_start and starts_before_end:
+            raise HTTPException(
+                status_code=409,
+                detail=f"Overlaps the period starting {period.effective_from.isoformat()}"
+            )
+    
+    price = ModelPrice(
+        provider=price_data.provider,
+        model=price_data.model,
+        input_price=price_data.input_price,
+        output_price=price_data.output_price,
+        effective_from=effective_from,
+        effective_to=effective_to
+    )
+    db.add(price)
+    await db.commit()
+    await db.refresh(price)
+    
+    # Other workers pick the change up on their next reload
+    await price_book.reload()
     
-    # Filter by virtual key if specified
-    if virtual_key_id:
-        query = query.filter(UsageEvent.virtual_key_id == virtual_key_id)
+    return price
+
+# Columns returned by the usage event list and export, in UsageEventResponse order
+USAGE_EVENT_COLUMNS = [UsageEvent.__table__.c[name] for name in UsageEventResponse.model_fields]
+EXPORT_BATCH_SIZE = 5000
+
+def _encode_cursor(created_at: datetime, event_id: int) -> str:
+    raw = dumps([created_at.isoformat(), event_id])
+    return base64.urlsafe_b64encode(raw).decode().rstrip("=")
+
+def _decode_cursor(cursor: str):
+    """(created_at, id) of the last event on the previous page"""
+    try:
+        created_at, event_id = loads(base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4)))
+        return datetime.fromisoformat(created_at), int(event_id)
+    except (binascii.Error, ValueError, TypeError):
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+
+class UsageEventFilters:
+    """Query parameters shared by the usage event list and export"""
+
+    def __init__(
+        self,
+        virtual_key_id: Optional[int] = None,
+        project_id: Optional[int] = None,
+        provider: Optional[str] = None,
+        model: Optional[str] = None,
+        since: Optional[datetime] = Query(None, description="Inclusive lower bound on created_at"),
+        until: Optional[datetime] = Query(None, description="Exclusive upper bound on created_at")
+    ):
+        self.virtual_key_id = virtual_key_id
+        self.project_id = project_id
+        self.provider = provider
+        self.model = model
+        self.since = since
+        self.until = until
+
+async def _usage_events_queries(db: AsyncSession, filters: UsageEventFilters, current_user: User):
+    """One select per table storing events that match the filters, limited to the user's own keys unless admin"""
+    # Archived months have left the database; reading past them would silently come back short
+    archived = archived_periods()
+    if filters.since and archived and period_of(filters.since) <= archived[-1]:
+        raise HTTPException(
+            status_code=410,
+            detail=f"Usage up to {archived[-1]} is archived; read those months from /api/metrics/periods/{{period}}"
+        )
+    if filters.virtual_key_id:
         # Check permissions
-        vk = db.query(VirtualKey).filter(VirtualKey.id == virtual_key_id).first()
+        vk = await db.get(VirtualKey, filters.virtual_key_id)
         if vk and not current_user.is_admin and vk.user_email != current_user.email:
             raise HTTPException(status_code=403, detail="Not authorized")
+
+    tables = await db.run_sync(lambda session: stored_tables(session.connection(), filters.since, filters.until))
+    queries = []
+    for table in tables:
+        query = select(*(table.c[column.name] for column in USAGE_EVENT_COLUMNS))
+        if filters.virtual_key_id:
+            query = query.where(table.c.virtual_key_id == filters.virtual_key_id)
+        if filters.provider:
+            query = query.where(table.c.provider == filters.provider)
+        if filters.model:
+            query = query.where(table.c.model == filters.model)
+        if filters.since:
+            query = query.where(table.c.created_at >= filters.since)
+        if filters.until:
+            query = query.where(table.c.created_at < filters.until)
+
+        # Non-admins only see their own events
+        if filters.project_id or not current_user.is_admin:
+            query = query.join(VirtualKey, VirtualKey.id == table.c.virtual_key_id)
+            if filters.project_id:
+                query = query.where(VirtualKey.project_id == filters.project_id)
+            if not current_user.is_admin:
+                query = query.where(VirtualKey.user_email == current_user.email)
+        queries.append(query)
+    return queries
+
+def _ordered(queries, descending: bool = False, limit: Optional[int] = None):
+    """Combine the per-table queries into one ordered on (created_at, id)
+
+    With SQLite month tables each table is ordered and limited on its own
+    first, so a page still reads at most `limit` rows from each.
+    """
+    def order(columns):
+        if descending:
+            return columns.created_at.desc(), columns.id.desc()
+        return columns.created_at, columns.id
+
+    if len(queries) == 1:
+        query = queries[0]
+        columns = query.selected_columns
+        query = query.order_by(*order(columns))
+        return query.limit(limit) if limit else query
+    arms = []
+    for query in queries:
+        if limit:
+            query = query.order_by(*order(query.selected_columns)).limit(limit)
+        arms.append(select(query.subquery()))
+    events = union_all(*arms).subquery()
+    query = select(events).order_by(*order(events.c))
+    return query.limit(limit) if limit else query
+
+@router.get("/usage-events", response_model=List[UsageEventResponse])
+async def list_usage_events(
+    limit: int = Query(100, ge=1, le=1000),
+    cursor: Optional[str] = Query(None, description="X-Next-Cursor from the previous page"),
+    filters: UsageEventFilters = Depends(),
+    db: AsyncSession = Depends(get_async_db),
+    current_user: User = Depends(get_current_active_user)
+):
+    """List usage events, newest first, one keyset page at a time
+
+    Pages are ordered on (created_at, id), so each one is an index range
+    scan no matter how deep into the history it is. When more events
+    follow, the X-Next-Cursor header holds the cursor for the next page.
+    """
+    queries = await _usage_events_queries(db, filters, current_user)
+    if cursor:
+        created_at, event_id = _decode_cursor(cursor)
+        after = tuple_(created_at, event_id)
+        queries = [
+            query.where(tuple_(query.selected_columns.created_at, query.selected_columns.id) < after)
+            for query in queries
+        ]
     
-    # Non-admins only see their own events
-    if not current_user.is_admin:
-        query = query.join(VirtualKey).filter(
-            VirtualKey.user_email == current_user.email
-        )
+    result = await db.execute(_ordered(queries, descending=True, limit=limit + 1))
+    names = [column.name for column in USAGE_EVENT_COLUMNS]
+    rows = [dict(zip(names, row)) for row in result]
     
-    events = query.order_by(UsageEvent.created_at.desc()).limit(limit).all()
-    return events
+    headers = {}
+    if len(rows) > limit:
+        rows = rows[:limit]
+        headers["X-Next-Cursor"] = _encode_cursor(rows[-1]["created_at"], rows[-1]["id"])
+    # Rows go straight to JSON; the columns already match UsageEventResponse
+    return Response(content=dumps(rows), media_type="application/json", headers=headers)
+
+async def _export_rows(query, format: str):
+    """Yield the export body in chunks, reading rows through a server-side cursor"""
+    async with AsyncSessionLocal() as db:
+        result = await db.stream(query.execution_options(yield_per=EXPORT_BATCH_SIZE))
+        names = [column.name for column in USAGE_EVENT_COLUMNS]
+        if format == "csv":
+            buffer = io.StringIO()
+            writer = csv.writer(buffer)
+            writer.writerow(names)
+            async for rows in result.partitions():
+                writer.writerows(rows)
+                yield buffer.getvalue()
+                buffer.seek(0)
+                buffer.truncate()
+            yield buffer.getvalue()
+        else:
+            async for rows in result.partitions():
+                yield b"".join(dumps(dict(zip(names, row))) + b"\n" for row in rows)
+
+@router.get("/usage-events/export")
+async def export_usage_events(
+    format: str = Query("ndjson", pattern="^(ndjson|csv)$"),
+    filters: UsageEventFilters = Depends(),
+    db: AsyncSession = Depends(get_async_db),
+    current_user: User = Depends(get_current_active_user)
+):
+    """Stream every matching usage event as NDJSON or CSV, oldest first"""
+    query = _ordered(await _usage_events_queries(db, filters, current_user))
+    media_type = "text/csv" if format == "csv" else "application/x-ndjson"
+    return StreamingResponse(
+        _export_rows(query, format),
+        media_type=media_type,
+        headers={"Content-Disposition": f'attachment; filename="usage-events.{format}"'}
+    )
@@ -0,0 +1,246 @@
+from fastapi import APIRouter, HTTPException, Request, Depends
+from fastapi.responses import Response, StreamingResponse
+from starlette.background import BackgroundTask
+from starlette.datastructures import UploadFile
+from sqlalchemy import or_, select
+from datetime import datetime
+import asyncio
+import random
+import time
+
+import httpx
+
+from app.database import AsyncSessionLocal
+from app.models import BatchFile, BatchJob
+from app.key_cache import CachedVirtualKey
+from app.ledger import BudgetExceeded, format_scopes, spend_ledger
+from app.upstream import UpstreamTarget, get_upstream_pool
+from app.json_scan import loads
+from app.batches import (
+    FINAL_STATUSES, BatchFileError, batch_accountant, batch_target, estimate_batch_file, final_timestamp
+)
+from app.routers.proxy import _read_body, get_virtual_key
+
+router = APIRouter()
+
+def _upload_target(model: str) -> UpstreamTarget:
+    """Pick the target a new batch file goes to; its batch and results stay there
+    
+    Targets with a per-model `path` (e.g. Azure deployments) don't expose
+    the plain files and batches endpoints, so they are left out.
+    """
+    candidates = [target for target in get_upstream_pool("openai").targets if not target.path and target.serves(model)]
+    if not candidates:
+        raise HTTPException(status_code=400, detail=f"No upstream target accepts batches for model {model}")
+    now = time.monotonic()
+    live = [target for target in candidates if target.available(now)] or candidates
+    return random.choices(live, weights=[target.weight for target in live])[0]
+
+def _pinned_target(name: str) -> UpstreamTarget:
+    target = batch_target(name)
+    if target is None:
+        raise HTTPException(status_code=502, detail=f"Upstream target {name} is no longer configured")
+    return target
+
+def _relay(response: httpx.Response) -> Response:
+    return Response(
+        content=response.content,
+        status_code=response.status_code,
+        media_type=response.headers.get("content-type", "application/json")
+    )
+
+async def _upstream(target: UpstreamTarget, method: str, path: str, **kwargs) -> httpx.Response:
+    """Make one Batch API call to a target; connection errors become 502"""
+    try:
+        return await target.client.request(
+            method, path, headers={**kwargs.pop("headers", {}), **target.auth_headers}, **kwargs
+        )
+    except httpx.HTTPError as exc:
+        raise HTTPException(status_code=502, detail=f"Upstream request failed ({type(exc).__name__})")
+
+async def _owned_file(virtual_key: CachedVirtualKey, file_id: str) -> str:
+    """The upstream target of a file the key uploaded or a result file of its batches; 404 otherwise"""
+    async with AsyncSessionLocal() as db:
+        upstream = await db.scalar(
+            select(BatchFile.upstream).where(BatchFile.id == file_id, BatchFile.virtual_key_id == virtual_key.id)
+        )
+        if upstream is None:
+            upstream = await db.scalar(
+                select(BatchJob.upstream).where(
+                    BatchJob.virtual_key_id == virtual_key.id,
+                    or_(BatchJob.output_file_id == file_id, BatchJob.error_file_id == file_id)
+                ).limit(1)
+            )
+    if upstream is None:
+        raise HTTPException(status_code=404, detail="File not found")
+    return upstream
+
+async def _owned_batch(virtual_key: CachedVirtualKey, batch_id: str) -> BatchJob:
+    async with AsyncSessionLocal() as db:
+        job = await db.get(BatchJob, batch_id)
+    if job is None or job.virtual_key_id != virtual_key.id:
+        raise HTTPException(status_code=404, detail="Batch not found")
+    return job
+
+async def _refresh_job(batch_id: str, response: httpx.Response) -> BatchJob:
+    """Store the batch object from an upstream answer; returns the updated job"""
+    async with AsyncSessionLocal() as db:
+        job = await db.get(BatchJob, batch_id)
+        if response.status_code == 200:
+            _update_job(job, loads(response.content))
+            await db.commit()
+    return job
+
+def _update_job(job: BatchJob, batch: dict) -> None:
+    """Copy an upstream batch object's status and result files onto the job"""
+    job.status = batch.get("status") or job.status
+    job.output_file_id = batch.get("output_file_id") or job.output_file_id
+    job.error_file_id = batch.get("error_file_id") or job.error_file_id
+    if job.status in FINAL_STATUSES and job.completed_at is None:
+        job.completed_at = final_timestamp(batch) or datetime.utcnow()
+
+@router.post("/openai/v1/files")
+async def upload_batch_file(
+    request: Request,
+    virtual_key: CachedVirtualKey = Depends(get_virtual_key)
+):
+    """Upload a Batch API input file, estimating what its requests will cost"""
+    form = await request.form()
+    upload = form.get("file")
+    if form.get("purpose") != "batch" or not isinstance(upload, UploadFile):
+        raise HTTPException(status_code=400, detail="Only files with purpose=batch can be uploaded through the proxy")
+    
+    # Read line by line from the spooled upload, off the event loop
+    try:
+        estimate = await asyncio.to_thread(estimate_batch_file, upload.file)
+    except BatchFileError as e:
+        raise HTTPException(status_code=400, detail=f"Invalid batch file: {e}")
+    
+    target = _upload_target(estimate.model)
+    await upload.seek(0)
+    response = await _upstream(
+        target, "POST", "/v1/files",
+        data={"purpose": "batch"},
+        files={"file": (upload.filename or "batch.jsonl", upload.file, upload.content_type or "application/jsonl")}
+    )
+    if response.status_code == 200:
+        uploaded = loads(response.content)
+        async with AsyncSessionLocal() as db:
+            db.add(BatchFile(
+                id=uploaded["id"],
+                virtual_key_id=virtual_key.id,
+                upstream=target.name,
+                model=estimate.model,
+                endpoint=estimate.endpoint,
+                filename=upload.filename,
+                bytes=uploaded.get("bytes") or upload.size or 0,
+                request_count=estimate.request_count,
+                estimated_cost=estimate.estimated_cost
+            ))
+            await db.commit()
+    return _relay(response)
+
+@router.get("/openai/v1/files/{file_id}")
+async def get_batch_file(
+    file_id: str,
+    virtual_key: CachedVirtualKey = Depends(get_virtual_key)
+):
+    """Get a batch file's metadata"""
+    target = _pinned_target(await _owned_file(virtual_key, file_id))
+    return _relay(await _upstream(target, "GET", f"/v1/files/{file_id}"))
+
+@router.get("/openai/v1/files/{file_id}/content")
+async def get_batch_file_content(
+    file_id: str,
+    virtual_key: CachedVirtualKey = Depends(get_virtual_key)
+):
+    """Stream a batch input, output or error file back to the client"""
+    target = _pinned_target(await _owned_file(virtual_key, file_id))
+    upstream_request = target.client.build_request(
+        "GET", f"/v1/files/{file_id}/content", headers=target.auth_headers
+    )
+    try:
+        response = await target.client.send(upstream_request, stream=True)
+    except httpx.HTTPError as e:
+        raise HTTPException(status_code=502, detail=f"Upstream request failed ({type(e).__name__})")
+    if response.status_code != 200:
+        try:
+            await response.aread()
+        finally:
+            await response.aclose()
+        return _relay(response)
+    # Relayed chunk by chunk, so result files of any size pass through in constant memory
+    return StreamingResponse(
+        response.aiter_raw(),
+        media_type=response.headers.get("content-type", "application/octet-stream"),
+        background=BackgroundTask(response.aclose)
+    )
+
+@router.post("/openai/v1/batches")
+async def create_batch(
+    request: Request,
+    virtual_key: CachedVirtualKey = Depends(get_virtual_key)
+):
+    """Submit a batch, holding its input file's estimated cost against the key's budget"""
+    content, body = await _read_body(request)
+    async with AsyncSessionLocal() as db:
+        batch_file = await db.get(BatchFile, body.get("input_file_id") or "")
+    if batch_file is None or batch_file.virtual_key_id != virtual_key.id:
+        raise HTTPException(status_code=404, detail="Input file not found")
+    target = _pinned_target(batch_file.upstream)
+    
+    try:
+        reservation = await spend_ledger.reserve(virtual_key.budget_scopes, batch_file.estimated_cost)
+    except BudgetExceeded as exc:
+        raise HTTPException(status_code=403, detail=f"Batch would exceed {exc}")
+    try:
+        response = await _upstream(
+            target, "POST", "/v1/batches", content=content, headers={"Content-Type": "application/json"}
+        )
+        if response.status_code != 200:
+            await spend_ledger.settle(reservation, 0.0)
+            return _relay(response)
+        batch = loads(response.content)
+        job = BatchJob(
+            id=batch["id"],
+            virtual_key_id=virtual_key.id,
+            input_file_id=batch_file.id,
+            upstream=batch_file.upstream,
+            model=batch_file.model,
+            status=batch.get("status") or "validating",
+            estimated_cost=batch_file.estimated_cost,
+            reserved_period=reservation.period,
+            reserved_scopes=format_scopes(reservation.scopes)
+        )
+        _update_job(job, batch)
+        async with AsyncSessionLocal() as db:
+            db.add(job)
+            await db.commit()
+    except BaseException:
+        await spend_ledger.settle(reservation, 0.0)
+        raise
+    return _relay(response)
+
+@router.get("/openai/v1/batches/{batch_id}")
+async def get_batch(
+    batch_id: str,
+    virtual_key: CachedVirtualKey = Depends(get_virtual_key)
+):
+    """Get a batch's status; a batch seen finished for the first time is accounted in the background"""
+    job = await _owned_batch(virtual_key, batch_id)
+    response = await _upstream(_pinned_target(job.upstream), "GET", f"/v1/batches/{batch_id}")
+    job = await _refresh_job(batch_id, response)
+    if job.status in FINAL_STATUSES and job.accounted_at is None:
+        batch_accountant.schedule(batch_id)
+    return _relay(response)
+
+@router.post("/openai/v1/batches/{batch_id}/cancel")
+async def cancel_batch(
+    batch_id: str,
+    virtual_key: CachedVirtualKey = Depends(get_virtual_key)
+):
+    """Cancel a batch; requests it already ran are still accounted once it stops"""
+    job = await _owned_batch(virtual_key, batch_id)
+    response = await _upstream(_pinned_target(job.upstream), "POST", f"/v1/batches/{batch_id}/cancel")
+    await _refresh_job(batch_id, response)
+    return _relay(response)
@@ -1,19 +1,39 @@
-from fastapi import APIRouter, Depends
-from sqlalchemy.orm import Session
-from sqlalchemy import func, and_
+import asyncio
+import calendar
+from fastapi import APIRouter, Depends, HTTPException, Path, Query
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy import func, case, select
 from datetime import datetime, timedelta
 from typing import List
 
-from app.database import get_db
-from app.models import UsageEvent, VirtualKey, User
-from app.schemas import MetricsOverview, CostOverview, TopUser, TopProject, WasteMetrics
+from app.database import get_async_db
+from app.models import UsageRollup, VirtualKey, User, Project, PromptCluster, PromptClusterRollup
+from app.schemas import (
+    MetricsOverview, CostOverview, TopUser, TopProject, WasteMetrics, TimeSeriesPoint, NearDuplicateCluster,
+    StoredPeriod, PeriodUsage, ModelUsage
+)
 from app.auth import get_current_active_user
+from app.heavy_hitters import estimated_repeat_cost, heavy_hitters
+from app.partitions import add_months, current_period, month_start as period_start, partitions, period_source
+from app.archive import archived_periods, archived_usage
+from app.rollups import bucket_start
 
 router = APIRouter()
 
+def _rollup_query(current_user: User, *columns):
+    """Select from day/hour rollups, limited to the user's own keys unless admin"""
+    query = select(*columns).select_from(UsageRollup)
+    if not current_user.is_admin:
+        query = query.join(
+            VirtualKey, VirtualKey.id == UsageRollup.virtual_key_id
+        ).where(
+            VirtualKey.user_email == current_user.email
+        )
+    return query
+
 @router.get("/overview", response_model=MetricsOverview)
 async def get_metrics_overview(
-    db: Session = Depends(get_db),
+    db: AsyncSession = Depends(get_async_db),
     current_user: User = Depends(get_current_active_user)
 ):
     """Get comprehensive metrics overview"""
@@ -22,69 +42,58 @@ async def get_metrics_overview(
     month_start = datetime(now.year, now.month, 1)
     year_start = datetime(now.year, 1, 1)
     
-    # Base query - filter by user if not admin
-    base_query = db.query(UsageEvent)
-    if not current_user.is_admin:
-        base_query = base_query.join(VirtualKey).filter(
-            VirtualKey.user_email == current_user.email
-        )
-    
-    # Cost overview
-    spend_today = base_query.filter(
-        UsageEvent.created_at >= today_start
-    ).with_entities(func.sum(UsageEvent.total_cost)).scalar() or 0.0
-    
-    spend_mtd = base_query.filter(
-        UsageEvent.created_at >= month_start
-    ).with_entities(func.sum(UsageEvent.total_cost)).scalar() or 0.0
+    # Cost overview from daily rollups: one pass over at most a year of buckets
+    in_month = UsageRollup.bucket_start >= month_start
+    totals = (await db.execute(_rollup_query(
+        current_user,
+        func.sum(case((UsageRollup.bucket_start >= today_start, UsageRollup.total_cost), else_=0.0)).label('spend_today'),
+        func.sum(case((in_month, UsageRollup.total_cost), else_=0.0)).label('spend_mtd'),
+        func.sum(UsageRollup.total_cost).label('spend_ytd'),
+        func.sum(case((in_month, UsageRollup.request_count), else_=0)).label('total_requests'),
+        func.sum(case((in_month, UsageRollup.total_tokens), else_=0)).label('total_tokens')
+    ).where(
+        UsageRollup.granularity == "day",
+        UsageRollup.bucket_start >= year_start
+    ))).one()
     
-    spend_ytd = base_query.filter(
-        UsageEvent.created_at >= year_start
-    ).with_entities(func.sum(UsageEvent.total_cost)).scalar() or 0.0
+    spend_today = totals.spend_today or 0.0
+    spend_mtd = totals.spend_mtd or 0.0
+    spend_ytd = totals.spend_ytd or 0.0
     
     # Forecast month-end (simple: average daily spend * days remaining)
     days_elapsed = (now - month_start).days + 1
-    days_in_month = (datetime(now.year, now.month + 1, 1) - timedelta(days=1)).day
+    days_in_month = calendar.monthrange(now.year, now.month)[1]
     avg_daily = spend_mtd / days_elapsed if days_elapsed > 0 else 0
     forecasted_month_end = avg_daily * days_in_month
     
-    # Request and token counts
-    total_requests = base_query.filter(
-        UsageEvent.created_at >= month_start
-    ).count()
-    
-    total_tokens = base_query.filter(
-        UsageEvent.created_at >= month_start
-    ).with_entities(func.sum(UsageEvent.total_tokens)).scalar() or 0
-    
     cost_overview = CostOverview(
         spend_today=round(spend_today, 2),
         spend_mtd=round(spend_mtd, 2),
         spend_ytd=round(spend_ytd, 2),
         forecasted_month_end=round(forecasted_month_end, 2),
-        total_requests=total_requests,
-        total_tokens=total_tokens
+        total_requests=totals.total_requests or 0,
+        total_tokens=totals.total_tokens or 0
     )
     
     # Top users (last 30 days)
-    thirty_days_ago = now - timedelta(days=30)
-    user_query = base_query.filter(UsageEvent.created_at >= thirty_days_ago)
+    thirty_days_ago = today_start - timedelta(days=30)
     
     if current_user.is_admin:
-        top_users_data = db.query(
+        top_users_data = (await db.execute(select(
             VirtualKey.user_email,
-            func.sum(UsageEvent.total_cost).label('total_cost'),
-            func.count(UsageEvent.id).label('request_count')
+            func.sum(UsageRollup.total_cost).label('total_cost'),
+            func.sum(UsageRollup.request_count).label('request_count')
         ).join(
-            UsageEvent, VirtualKey.id == UsageEvent.virtual_key_id
-        ).filter(
-            UsageEvent.created_at >= thirty_days_ago,
+            UsageRollup, VirtualKey.id == UsageRollup.virtual_key_id
+        ).where(
+            UsageRollup.granularity == "day",
+            UsageRollup.bucket_start >= thirty_days_ago,
             VirtualKey.user_email.isnot(None)
         ).group_by(
             VirtualKey.user_email
         ).order_by(
-            func.sum(UsageEvent.total_cost).desc()
-        ).limit(10).all()
+            func.sum(UsageRollup.total_cost).desc()
+        ).limit(10))).all()
         
         top_users = [
             TopUser(
@@ -98,27 +107,27 @@ async def get_metrics_overview(
         top_users = []
     
     # Top projects (last 30 days)
-    from app.models import Project
-    project_query = db.query(
+    project_query = select(
         Project.name,
-        func.sum(UsageEvent.total_cost).label('total_cost'),
-        func.count(UsageEvent.id).label('request_count')
+        func.sum(UsageRollup.total_cost).label('total_cost'),
+        func.sum(UsageRollup.request_count).label('request_count')
     ).join(
         VirtualKey, Project.id == VirtualKey.project_id
     ).join(
-        UsageEvent, VirtualKey.id == UsageEvent.virtual_key_id
-    ).filter(
-        UsageEvent.created_at >= thirty_days_ago
+        UsageRollup, VirtualKey.id == UsageRollup.virtual_key_id
+    ).where(
+        UsageRollup.granularity == "day",
+        UsageRollup.bucket_start >= thirty_days_ago
     )
     
     if not current_user.is_admin:
-        project_query = project_query.filter(VirtualKey.user_email == current_user.email)
+        project_query = project_query.where(VirtualKey.user_email == current_user.email)
     
-    top_projects_data = project_query.group_by(
+    top_projects_data = (await db.execute(project_query.group_by(
         Project.name
     ).order_by(
-        func.sum(UsageEvent.total_cost).desc()
-    ).limit(10).all()
+        func.sum(UsageRollup.total_cost).desc()
+    ).limit(10))).all()
     
     top_projects = [
         TopProject(
@@ -129,52 +138,51 @@ async def get_metrics_overview(
         for row in top_projects_data
     ]
     
-    # Waste detection (repeated prompts in last 7 days)
+    # Waste detection (repeated prompts in last 7 days), from the in-memory
+    # heavy-hitter summaries: cost doesn't grow with the number of events
     seven_days_ago = now - timedelta(days=7)
-    waste_query = base_query.filter(
-        UsageEvent.created_at >= seven_days_ago,
-        UsageEvent.prompt_hash.isnot(None)
-    )
-    
-    # Find repeated prompt hashes
-    repeated_hashes = db.query(
-        UsageEvent.prompt_hash,
-        func.count(UsageEvent.id).label('count'),
-        func.sum(UsageEvent.total_cost).label('total_cost')
-    ).filter(
-        UsageEvent.created_at >= seven_days_ago,
-        UsageEvent.prompt_hash.isnot(None)
-    )
     
-    if not current_user.is_admin:
-        repeated_hashes = repeated_hashes.join(VirtualKey).filter(
+    if current_user.is_admin:
+        summary = await heavy_hitters.top(db, "global", [0], days=7)
+    else:
+        key_ids = (await db.execute(select(VirtualKey.id).where(
             VirtualKey.user_email == current_user.email
-        )
+        ))).scalars().all()
+        summary = await heavy_hitters.top(db, "virtual_key", key_ids, days=7)
     
-    repeated_hashes = repeated_hashes.group_by(
-        UsageEvent.prompt_hash
-    ).having(
-        func.count(UsageEvent.id) > 1
-    ).order_by(
-        func.count(UsageEvent.id).desc()
-    ).limit(10).all()
+    repeated_hashes = [entry for entry in summary.top(10) if entry[1] > 1]
     
-    repeated_prompts_count = sum(row.count - 1 for row in repeated_hashes)  # Subtract 1 for first occurrence
-    estimated_waste = sum((row.count - 1) * (row.total_cost / row.count) for row in repeated_hashes)
+    repeated_prompts_count = int(sum(count - 1 for _, count, _, _ in repeated_hashes))  # Subtract 1 for first occurrence
+    estimated_waste = sum(estimated_repeat_cost(count, error, cost) for _, count, error, cost in repeated_hashes)
     
     top_repeated_hashes = [
         {
-            "hash": row.prompt_hash[:16] + "...",
-            "count": row.count,
-            "estimated_waste": round((row.count - 1) * (row.total_cost / row.count), 2)
+            "hash": prompt_hash[:16] + "...",
+            "count": int(count),
+            "estimated_waste": round(estimated_repeat_cost(count, error, cost), 2)
         }
-        for row in repeated_hashes
+        for prompt_hash, count, error, cost in repeated_hashes
     ]
     
+    # Realized savings: repeats answered from the response cache or coalesced
+    # onto an identical in-flight request, from the hourly rollups
+    savings = (await db.execute(_rollup_query(
+        current_user,
+        func.sum(UsageRollup.cache_hits).label('cache_hits'),
+        func.sum(UsageRollup.coalesced_requests).label('coalesced_requests'),
+        func.sum(UsageRollup.saved_cost).label('realized_savings')
+    ).where(
+        UsageRollup.granularity == "hour",
+        UsageRollup.bucket_start >= bucket_start(seven_days_ago, "hour")
+    ))).one()
+    
     waste_metrics = WasteMetrics(
         repeated_prompts_count=repeated_prompts_count,
         estimated_waste=round(estimated_waste, 2),
-        top_repeated_hashes=top_repeated_hashes
+        top_repeated_hashes=top_repeated_hashes,
+        cache_hits=savings.cache_hits or 0,
+        coalesced_requests=savings.coalesced_requests or 0,
+        realized_savings=round(savings.realized_savings or 0.0, 6)
     )
     
     return MetricsOverview(
@@ -183,3 +191,176 @@ async def get_metrics_overview(
         top_projects=top_projects,
         waste=waste_metrics
     )
+
+
+@router.get("/timeseries", response_model=List[TimeSeriesPoint])
+async def get_metrics_timeseries(
+    granularity: str = Query("day", pattern="^(hour|day)$"),
+    days: int = Query(30, ge=1, le=366),
+    db: AsyncSession = Depends(get_async_db),
+    current_user: User = Depends(get_current_active_user)
+):
+    """Get spend, requests and tokens per hour or day bucket"""
+    now = datetime.utcnow()
+    since = datetime(now.year, now.month, now.day) - timedelta(days=days - 1)
+    
+    rows = (await db.execute(_rollup_query(
+        current_user,
+        UsageRollup.bucket_start,
+        func.sum(UsageRollup.total_cost).label('total_cost'),
+        func.sum(UsageRollup.request_count).label('request_count'),
+        func.sum(UsageRollup.total_tokens).label('total_tokens')
+    ).where(
+        UsageRollup.granularity == granularity,
+        UsageRollup.bucket_start >= since
+    ).group_by(
+        UsageRollup.bucket_start
+    ).order_by(
+        UsageRollup.bucket_start
+    ))).all()
+    
+    return [
+        TimeSeriesPoint(
+            bucket_start=row.bucket_start,
+            total_cost=round(row.total_cost or 0.0, 6),
+            request_count=row.request_count or 0,
+            total_tokens=row.total_tokens or 0
+        )
+        for row in rows
+    ]
+
+
+@router.get("/waste/near-duplicates", response_model=List[NearDuplicateCluster])
+async def get_near_duplicate_prompts(
+    days: int = Query(7, ge=1, le=366),
+    limit: int = Query(20, ge=1, le=200),
+    db: AsyncSession = Depends(get_async_db),
+    current_user: User = Depends(get_current_active_user)
+):
+    """Get clusters of near-identical prompts ranked by estimated redundant cost"""
+    now = datetime.utcnow()
+    since = datetime(now.year, now.month, now.day) - timedelta(days=days - 1)
+    
+    request_count = func.sum(PromptClusterRollup.request_count)
+    total_cost = func.sum(PromptClusterRollup.total_cost)
+    # Every request after the first in a cluster is counted as redundant
+    estimated_waste = total_cost - total_cost / request_count
+    
+    query = select(
+        PromptClusterRollup.cluster_id,
+        request_count.label('request_count'),
+        func.count(func.distinct(PromptClusterRollup.virtual_key_id)).label('virtual_keys'),
+        total_cost.label('total_cost'),
+        estimated_waste.label('estimated_waste'),
+        func.min(PromptClusterRollup.bucket_start).label('first_seen'),
+        func.max(PromptClusterRollup.bucket_start).label('last_seen')
+    ).where(
+        PromptClusterRollup.bucket_start >= since
+    )
+    
+    if not current_user.is_admin:
+        query = query.join(
+            VirtualKey, VirtualKey.id == PromptClusterRollup.virtual_key_id
+        ).where(
+            VirtualKey.user_email == current_user.email
+        )
+    
+    rows = (await db.execute(query.group_by(
+        PromptClusterRollup.cluster_id
+    ).having(
+        request_count > 1
+    ).order_by(
+        estimated_waste.desc()
+    ).limit(limit))).all()
+    
+    clusters = {}
+    if rows:
+        clusters = {
+            cluster.id: cluster
+            for cluster in (await db.execute(
+                select(PromptCluster).where(PromptCluster.id.in_([row.cluster_id for row in rows]))
+            )).scalars()
+        }
+    
+    return [
+        NearDuplicateCluster(
+            cluster_id=row.cluster_id,
+            model=clusters[row.cluster_id].model,
+            sample_hash=(clusters[row.cluster_id].prompt_hash or "")[:16] + "...",
+            request_count=row.request_count,
+            virtual_keys=row.virtual_keys,
+            total_cost=round(row.total_cost or 0.0, 6),
+            estimated_waste=round(row.estimated_waste or 0.0, 6),
+            first_seen=row.first_seen,
+            last_seen=row.last_seen
+        )
+        for row in rows
+        if row.cluster_id in clusters
+    ]
+
+
+@router.get("/periods", response_model=List[StoredPeriod])
+async def list_usage_periods(
+    db: AsyncSession = Depends(get_async_db),
+    current_user: User = Depends(get_current_active_user)
+):
+    """List the months of usage on record and whether each is in the database or the archive"""
+    stored = await db.run_sync(lambda session: [partition.period for partition in partitions(session.connection())])
+    tiers = {period: "database" for period in stored + [current_period()]}
+    # A month is served from the archive as soon as it has one, even while
+    # the archive job is still deleting its rows
+    tiers.update((period, "archive") for period in archived_periods())
+    return [StoredPeriod(period=period, tier=tier) for period, tier in sorted(tiers.items())]
+
+
+@router.get("/periods/{period}", response_model=PeriodUsage)
+async def get_period_usage(
+    period: str = Path(..., pattern=r"^\d{4}-(0[1-9]|1[0-2])$"),
+    db: AsyncSession = Depends(get_async_db),
+    current_user: User = Depends(get_current_active_user)
+):
+    """Get one month's usage per provider and model, reading archived months from Parquet"""
+    key_ids = None
+    if not current_user.is_admin:
+        key_ids = (await db.execute(
+            select(VirtualKey.id).where(VirtualKey.user_email == current_user.email)
+        )).scalars().all()
+    
+    if period in archived_periods():
+        tier = "archive"
+        try:
+            models = await asyncio.to_thread(archived_usage, period, key_ids)
+        except RuntimeError as exc:
+            raise HTTPException(status_code=503, detail=str(exc))
+    else:
+        tier = "database"
+        source = await db.run_sync(lambda session: period_source(session.connection(), period))
+        query = select(
+            source.c.provider,
+            source.c.model,
+            func.count(case((source.c.served.isnot(False), source.c.id))).label('request_count'),
+            func.sum(source.c.input_tokens).label('input_tokens'),
+            func.sum(source.c.output_tokens).label('output_tokens'),
+            func.sum(source.c.total_tokens).label('total_tokens'),
+            func.sum(source.c.total_cost).label('total_cost')
+        ).where(
+            source.c.created_at >= period_start(period),
+            source.c.created_at < period_start(add_months(period, 1))
+        )
+        if key_ids is not None:
+            query = query.where(source.c.virtual_key_id.in_(key_ids))
+        rows = (await db.execute(query.group_by(source.c.provider, source.c.model))).all()
+        models = [row._asdict() for row in rows]
+    
+    models = [
+        ModelUsage(**{**model, "total_cost": round(model["total_cost"] or 0.0, 6)})
+        for model in sorted(models, key=lambda model: model["total_cost"] or 0.0, reverse=True)
+    ]
+    return PeriodUsage(
+        period=period,
+        tier=tier,
+        request_count=sum(model.request_count for model in models),
+        total_tokens=sum(model.total_tokens for model in models),
+        total_cost=round(sum(model.total_cost for model in models), 6),
+        models=models
+    )
@@ -1,286 +1,814 @@
-import httpx
 from fastapi import APIRouter, Header, HTTPException, Request, Depends
-from fastapi.responses import JSONResponse
-from sqlalchemy.orm import Session
-from typing import Optional, Dict, Any
+from fastapi.responses import Response, StreamingResponse
+from starlette.background import BackgroundTask
+from sqlalchemy import select
+from typing import Optional, Dict, Any, Tuple, Callable, Awaitable, Set, List
+from dataclasses import dataclass
+import asyncio
+import time
 import uuid
 from datetime import datetime
 
-from app.database import get_db
+from app.database import AsyncSessionLocal
 from app.models import VirtualKey, UsageEvent, User
-from app.utils import calculate_cost, hash_prompt, extract_prompt_preview, check_budget_limits, detect_repeated_prompts
+from app.utils import calculate_cost, fingerprint_prompt_async, check_budget_limits, detect_repeated_prompts, estimate_request_cost
 from app.config import settings
+from app.upstream import get_upstream_pool
+from app.streaming import SSEUsageParser
+from app.usage_writer import usage_writer
+from app.heavy_hitters import heavy_hitters
+from app.key_cache import CachedVirtualKey, virtual_key_cache
+from app.ledger import BudgetExceeded, Reservation, load_budget_chains, spend_ledger
+from app.rate_limit import RateLimitExceeded, RatePermit, rate_limiter
+from app.response_cache import CachedResponse, cache_directives, is_cacheable, response_cache, response_cache_key
+from app.coalescing import BufferedResult, Flight, StreamBroadcast, StreamReader, single_flight
+from app.json_scan import dumps, extract_usage, loads
+from app.instrumentation import observe_upstream, record_usage_metrics, stage_timer
+from app.concurrency import UpstreamOverloaded, upstream_admission
+from app.resilience import Attempt, CircuitOpen, CircuitPermit, upstream_resilience
+from app.embeddings import BatchEntry, embedding_batcher, embedding_inputs, estimate_tokens, split_tokens
 
 router = APIRouter()
 
+# Sent with the 503 for a request shed by upstream admission control
+_SHED_HEADERS = {"Retry-After": "1"}
+
 async def get_virtual_key(
-    x_virtual_key: Optional[str] = Header(None, alias="X-Virtual-Key"),
-    db: Session = Depends(get_db)
-) -> VirtualKey:
+    x_virtual_key: Optional[str] = Header(None, alias="X-Virtual-Key")
+) -> CachedVirtualKey:
     """Get and validate virtual key from header"""
     if not x_virtual_key:
         raise HTTPException(status_code=401, detail="X-Virtual-Key header required")
     
-    virtual_key = db.query(VirtualKey).filter(VirtualKey.key == x_virtual_key).first()
+    with stage_timer("key_lookup"):
+        hit, virtual_key = virtual_key_cache.get(x_virtual_key)
+        if not hit:
+            # Only a cache miss touches the database, and the connection goes back
+            # to the pool before the upstream call
+            async with AsyncSessionLocal() as db:
+                db_key = await db.scalar(select(VirtualKey).where(VirtualKey.key == x_virtual_key))
+                if db_key:
+                    chains = await load_budget_chains(db, [db_key.id])
+            if db_key:
+                virtual_key = CachedVirtualKey.from_model(db_key, chains[db_key.id])
+                virtual_key_cache.set(x_virtual_key, virtual_key)
+            else:
+                virtual_key_cache.set_missing(x_virtual_key)
     if not virtual_key:
         raise HTTPException(status_code=401, detail="Invalid virtual key")
     
     # Check budget limits
-    allowed, reason = check_budget_limits(db, virtual_key)
+    with stage_timer("budget_check"):
+        allowed, reason = await check_budget_limits(virtual_key)
     if not allowed:
         raise HTTPException(status_code=403, detail=reason)
     
     return virtual_key
 
+async def _reserve_budget(
+    virtual_key: CachedVirtualKey,
+    provider: str,
+    model: str,
+    prompt_chars: int,
+    max_output_tokens: Optional[int]
+) -> Reservation:
+    """Hold the request's estimated cost against the monthly budgets of the key and its ancestors"""
+    with stage_timer("budget_reserve"):
+        estimated_cost = estimate_request_cost(provider, model, prompt_chars, max_output_tokens)
+        try:
+            return await spend_ledger.reserve(virtual_key.budget_scopes, estimated_cost)
+        except BudgetExceeded as exc:
+            raise HTTPException(status_code=403, detail=f"Request would exceed {exc}")
+
+async def _acquire_rate(
+    virtual_key: CachedVirtualKey,
+    prompt_chars: int,
+    max_output_tokens: Optional[int]
+) -> Optional[RatePermit]:
+    """Take the request and its estimated tokens from the key's per-minute limits"""
+    if not virtual_key.requests_per_minute and not virtual_key.tokens_per_minute:
+        return None
+    with stage_timer("rate_limit"):
+        output_tokens = settings.BUDGET_RESERVATION_OUTPUT_TOKENS if max_output_tokens is None else max_output_tokens
+        estimated_tokens = prompt_chars // 4 + output_tokens
+        try:
+            return await rate_limiter.acquire(
+                virtual_key.id, virtual_key.requests_per_minute, virtual_key.tokens_per_minute, estimated_tokens
+            )
+        except RateLimitExceeded as exc:
+            raise HTTPException(status_code=429, detail=str(exc), headers={"Retry-After": exc.retry_after_header})
+
+async def _read_body(request: Request) -> Tuple[bytes, Dict[str, Any]]:
+    """Return the raw request body and its parsed JSON object"""
+    content = await request.body()
+    try:
+        body = loads(content)
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Request body must be valid JSON")
+    if not isinstance(body, dict):
+        raise HTTPException(status_code=400, detail="Request body must be a JSON object")
+    return content, body
+
+@dataclass
+class ProxyCall:
+    """What the auditor records about one proxied request"""
+    virtual_key: CachedVirtualKey
+    provider: str
+    model: str
+    prompt_hash: str
+    prompt_chars: int
+    prompt_preview: str
+    prompt_signature: Optional[bytes]
+    request_id: str
+    reservation: Optional[Reservation] = None
+    rate_permit: Optional[RatePermit] = None
+
+async def _admit(call: ProxyCall, max_output_tokens: Optional[int]) -> None:
+    """Apply the key's rate limits, then hold the estimated cost against its budget"""
+    call.rate_permit = await _acquire_rate(call.virtual_key, call.prompt_chars, max_output_tokens)
+    try:
+        call.reservation = await _reserve_budget(
+            call.virtual_key, call.provider, call.model, call.prompt_chars, max_output_tokens
+        )
+    except HTTPException:
+        if call.rate_permit is not None:
+            await rate_limiter.settle(call.rate_permit, 0)
+        raise
+
+async def _record_usage(
+    call: ProxyCall,
+    input_tokens: int,
+    output_tokens: int,
+    status_code: int,
+    total_tokens: Optional[int] = None,
+    cache_hit: bool = False,
+    coalesced: bool = False,
+    saved_cost: float = 0.0,
+    attempt: int = 1,
+    hedge: bool = False,
+    served: bool = True
+) -> float:
+    """Calculate costs, settle the budget reservation and queue a usage event
+    
+    Cache hits and coalesced followers are recorded at zero cost with the
+    cost they avoided in `saved_cost`. Attempts whose response was not
+    served (a retried failure, a losing hedge) leave the reservation to the
+    served one; whatever they billed is charged on top. Returns the event's
+    cost.
+    """
+    with stage_timer("accounting"):
+        costs = calculate_cost(call.provider, call.model, input_tokens, output_tokens)
+        reservation, rate_permit = call.reservation, call.rate_permit
+        if not served:
+            # Settling a fresh, empty hold only adds the attempt's own usage
+            if reservation is not None:
+                reservation = reservation.empty()
+            if rate_permit is not None:
+                rate_permit = RatePermit(rate_permit.virtual_key_id, rate_permit.tokens_per_minute, 0)
+        if reservation is not None and (served or costs["total_cost"]):
+            await spend_ledger.settle(reservation, costs["total_cost"])
+        if rate_permit is not None and (served or input_tokens + output_tokens):
+            await rate_limiter.settle(rate_permit, input_tokens + output_tokens)
+        await usage_writer.enqueue({
+            "virtual_key_id": call.virtual_key.id,
+            "user_id": None,
+            "provider": call.provider,
+            "model": call.model,
+            "input_tokens": input_tokens,
+            "output_tokens": output_tokens,
+            "total_tokens": input_tokens + output_tokens if total_tokens is None else total_tokens,
+            "input_cost": costs["input_cost"],
+            "output_cost": costs["output_cost"],
+            "total_cost": costs["total_cost"],
+            "prompt_hash": call.prompt_hash,
+            "prompt_chars": call.prompt_chars,
+            "prompt_preview": call.prompt_preview[:200],
+            "prompt_signature": call.prompt_signature,
+            "request_id": call.request_id,
+            "status_code": status_code,
+            "was_blocked": False,
+            "block_reason": None,
+            "cache_hit": cache_hit,
+            "coalesced": coalesced,
+            "saved_cost": saved_cost,
+            "attempt": attempt,
+            "hedge": hedge,
+            "served": served,
+            "created_at": datetime.utcnow()
+        })
+        if not cache_hit and not coalesced:
+            if served:
+                heavy_hitters.observe(
+                    call.prompt_hash, costs["total_cost"], call.virtual_key.id, call.virtual_key.project_id
+                )
+            record_usage_metrics(
+                call.provider, call.model, call.virtual_key.environment, input_tokens, output_tokens, costs["total_cost"]
+            )
+    return costs["total_cost"]
+
+def _usage_counts(provider: str, usage: Dict[str, Any]) -> Tuple[int, int, Optional[int]]:
+    """Read (input, output, total) tokens from a provider's usage object"""
+    if provider == "openai":
+        return usage.get("prompt_tokens", 0), usage.get("completion_tokens", 0), usage.get("total_tokens", 0)
+    return usage.get("input_tokens", 0), usage.get("output_tokens", 0), None
+
+async def _lookup_cache(
+    request: Request,
+    virtual_key: CachedVirtualKey,
+    provider: str,
+    body: Dict[str, Any]
+) -> Tuple[Optional[str], Optional[CachedResponse]]:
+    """Return (key to store the response under, cached response if any)"""
+    if not virtual_key.cache_responses or not is_cacheable(body):
+        return None, None
+    skip_lookup, skip_store = cache_directives(request.headers.get("cache-control"))
+    key = None if skip_store else response_cache_key(virtual_key.id, provider, body)
+    if skip_lookup:
+        return key, None
+    return key, await response_cache.get(key)
+
+async def _serve_cached(cached: CachedResponse, call: ProxyCall) -> Response:
+    """Replay a cached body and record a zero-cost usage event"""
+    await _record_usage(call, 0, 0, 200, cache_hit=True, saved_cost=cached.total_cost)
+    return Response(content=cached.body, media_type=cached.media_type, headers={"X-Cache": "HIT"})
+
+async def _send_buffered(
+    call: ProxyCall,
+    url: str,
+    content: bytes,
+    headers: Dict[str, str],
+    tried: Set[str],
+    attempt: Attempt
+) -> None:
+    """Make one buffered upstream try through admission control and target routing"""
+    pool = get_upstream_pool(call.provider)
+    async with upstream_admission.slot(
+        call.provider, call.model, call.virtual_key.environment, streaming=False
+    ) as slot:
+        with pool.route(call.model, streaming=False, tried=tried) as route:
+            client = route.target.client
+            start = time.perf_counter()
+            upstream_request = client.build_request(
+                "POST", route.target.url(url, call.model), content=content,
+                headers={**headers, **route.target.auth_headers}
+            )
+            response = await client.send(upstream_request, stream=True)
+            ttfb = time.perf_counter() - start
+            try:
+                await response.aread()
+            finally:
+                await response.aclose()
+            attempt.latency = time.perf_counter() - start
+            route.record(attempt.latency, response)
+        slot.record(attempt.latency, response.status_code)
+    attempt.response = response
+    observe_upstream(call.provider, call.model, ttfb, attempt.latency)
+
+async def _record_attempt(call: ProxyCall, attempt: Attempt) -> None:
+    """Record an attempt whose response was not served, with any tokens it billed"""
+    input_tokens = output_tokens = 0
+    total_tokens = None
+    if attempt.status_code == 200:
+        input_tokens, output_tokens, total_tokens = _usage_counts(
+            call.provider, extract_usage(attempt.response.content)
+        )
+    await _record_usage(
+        call, input_tokens, output_tokens, attempt.status_code or 502, total_tokens=total_tokens,
+        attempt=attempt.number, hedge=attempt.hedge, served=False
+    )
+
+def _failure_body(error: Optional[Exception]) -> bytes:
+    return dumps({"detail": f"Upstream request failed ({type(error).__name__})"})
+
+def _relayed_headers(response: Any) -> Optional[Dict[str, str]]:
+    """Headers worth passing on with an upstream error, i.e. Retry-After"""
+    retry_after = response.headers.get("retry-after")
+    return {"Retry-After": retry_after} if retry_after is not None else None
+
+def _unavailable(exc: Exception) -> BufferedResult:
+    """The 503 for a call shed by admission control or refused by an open circuit"""
+    headers = {"Retry-After": exc.retry_after_header} if isinstance(exc, CircuitOpen) else _SHED_HEADERS
+    return BufferedResult(503, dumps({"detail": str(exc)}), "application/json", 0.0, headers=headers)
+
+def _upstream_error(attempt: Attempt) -> Optional[BufferedResult]:
+    """What to relay for a final attempt that got no 200, or None if it did"""
+    response = attempt.response
+    if response is None:
+        return BufferedResult(502, _failure_body(attempt.error), "application/json", 0.0)
+    if response.status_code != 200:
+        return BufferedResult(
+            response.status_code, response.content, response.headers.get("content-type", "application/json"), 0.0,
+            headers=_relayed_headers(response)
+        )
+    return None
+
+async def _call_upstream(
+    call: ProxyCall,
+    url: str,
+    content: bytes,
+    headers: Dict[str, str],
+    cache_key: Optional[str]
+) -> BufferedResult:
+    """Make one buffered upstream call, account it and cache it if allowed
+    
+    Transient failures are retried and slow calls may be hedged; every
+    attempt is recorded as its own usage event.
+    """
+    tried: Set[str] = set()
+    
+    async def send(attempt: Attempt) -> None:
+        await _send_buffered(call, url, content, headers, tried, attempt)
+    
+    async def unserved(attempt: Attempt) -> None:
+        await _record_attempt(call, attempt)
+    
+    try:
+        attempt = await upstream_resilience.call(call.provider, call.model, send, unserved, hedge=True)
+    except (UpstreamOverloaded, CircuitOpen) as exc:
+        await _record_usage(call, 0, 0, 503)
+        return _unavailable(exc)
+    
+    failure = _upstream_error(attempt)
+    if failure is not None:
+        # Log failed request
+        await _record_usage(call, 0, 0, failure.status_code, attempt=attempt.number, hedge=attempt.hedge)
+        return failure
+    
+    # The body is relayed as-is; only the usage object is parsed
+    response = attempt.response
+    media_type = response.headers.get("content-type", "application/json")
+    input_tokens, output_tokens, total_tokens = _usage_counts(call.provider, extract_usage(response.content))
+    total_cost = await _record_usage(
+        call, input_tokens, output_tokens, 200, total_tokens=total_tokens, attempt=attempt.number, hedge=attempt.hedge
+    )
+    if cache_key is not None:
+        await response_cache.set(
+            cache_key,
+            CachedResponse(response.content, media_type, input_tokens, output_tokens, total_cost),
+            ttl=call.virtual_key.cache_ttl_seconds
+        )
+    return BufferedResult(200, response.content, media_type, total_cost)
+
+async def _call_embedding_batch(entries: List[BatchEntry], url: str, headers: Dict[str, str]) -> List[BufferedResult]:
+    """Send a batch of embedding requests upstream as one call and split the answer per request
+    
+    Each request gets its own inputs' embeddings, re-indexed from 0, and is
+    billed a share of the batch's tokens in proportion to its estimated
+    size. The call runs at the priority of the batch's most important key
+    and is retried like any buffered call, but never hedged.
+    """
+    lead = min(entries, key=lambda entry: upstream_admission.priority(entry.call.virtual_key.environment)[0]).call
+    inputs = [item for entry in entries for item in entry.inputs]
+    content = dumps({**entries[0].params, "model": lead.model, "input": inputs})
+    tried: Set[str] = set()
+    
+    async def send(attempt: Attempt) -> None:
+        await _send_buffered(lead, url, content, headers, tried, attempt)
+    
+    async def unserved(attempt: Attempt) -> None:
+        for entry in entries:
+            await _record_attempt(entry.call, attempt)
+    
+    try:
+        attempt = await upstream_resilience.call(lead.provider, lead.model, send, unserved)
+    except (UpstreamOverloaded, CircuitOpen) as exc:
+        for entry in entries:
+            await _record_usage(entry.call, 0, 0, 503)
+        return [_unavailable(exc)] * len(entries)
+    
+    failure = _upstream_error(attempt)
+    if failure is None:
+        try:
+            answer = loads(attempt.response.content)
+        except ValueError:
+            answer = None
+        data = answer.get("data") if isinstance(answer, dict) else None
+        returned = sum(isinstance(item, dict) for item in data) if isinstance(data, list) else 0
+        if not isinstance(data, list) or len(data) != len(inputs) or returned != len(inputs):
+            failure = BufferedResult(
+                502, dumps({"detail": f"Upstream returned {returned} embeddings for {len(inputs)} inputs"}),
+                "application/json", 0.0
+            )
+    if failure is not None:
+        for entry in entries:
+            await _record_usage(entry.call, 0, 0, failure.status_code, attempt=attempt.number)
+        return [failure] * len(entries)
+    
+    data.sort(key=lambda item: item.get("index", 0))
+    usage = answer.get("usage")
+    prompt_tokens = usage.get("prompt_tokens") if isinstance(usage, dict) else None
+    shares = split_tokens(prompt_tokens if isinstance(prompt_tokens, int) else 0, [entry.weight for entry in entries])
+    media_type = attempt.response.headers.get("content-type", "application/json")
+    results = []
+    offset = 0
+    for entry, tokens in zip(entries, shares):
+        items = data[offset:offset + len(entry.inputs)]
+        offset += len(entry.inputs)
+        for index, item in enumerate(items):
+            item["index"] = index
+        body = dumps({**answer, "data": items, "usage": {"prompt_tokens": tokens, "total_tokens": tokens}})
+        total_cost = await _record_usage(entry.call, tokens, 0, 200, total_tokens=tokens, attempt=attempt.number)
+        results.append(BufferedResult(200, body, media_type, total_cost))
+    return results
+
+async def _stream_attempt(
+    broadcast: StreamBroadcast,
+    parser: SSEUsageParser,
+    call: ProxyCall,
+    url: str,
+    content: bytes,
+    headers: Dict[str, str],
+    tried: Set[str],
+    attempt: Attempt
+) -> None:
+    """Make one streaming upstream try, relaying it into the broadcast if it answers 200
+    
+    A non-200 answer is read in full and, like an error before the stream
+    started, left on the attempt for the caller to retry or relay. Errors
+    once chunks have been relayed propagate.
+    """
+    pool = get_upstream_pool(call.provider)
+    async with upstream_admission.slot(
+        call.provider, call.model, call.virtual_key.environment, streaming=True
+    ) as slot:
+        with pool.route(call.model, streaming=True, tried=tried) as route:
+            client = route.target.client
+            start = time.perf_counter()
+            ttfb: Optional[float] = None
+            try:
+                upstream_request = client.build_request(
+                    "POST", route.target.url(url, call.model), content=content,
+                    headers={**headers, **route.target.auth_headers}
+                )
+                response = await client.send(upstream_request, stream=True)
+                try:
+                    if response.status_code != 200:
+                        await response.aread()
+                        ttfb = time.perf_counter() - start
+                    else:
+                        broadcast.start(200, response.headers.get("content-type", "text/event-stream"))
+                        async for chunk in response.aiter_bytes():
+                            if ttfb is None:
+                                ttfb = time.perf_counter() - start
+                                slot.record(ttfb, 200)
+                            parser.feed(chunk)
+                            await broadcast.publish(chunk)
+                finally:
+                    await response.aclose()
+            except Exception as exc:
+                if broadcast.ready.done():
+                    raise
+                # Nothing relayed yet, so the call can still be retried; the
+                # route and slot see a call without a response as failed
+                attempt.error = exc
+                slot.overloaded = True
+                return
+            attempt.response = response
+            attempt.latency = ttfb
+            route.record(ttfb, response)
+        slot.record(ttfb, response.status_code)
+    observe_upstream(call.provider, call.model, ttfb, time.perf_counter() - start)
+
+async def _pump_stream(
+    broadcast: StreamBroadcast,
+    call: ProxyCall,
+    url: str,
+    content: bytes,
+    headers: Dict[str, str]
+) -> None:
+    """Read one upstream event stream into a broadcast and account usage once it ends
+    
+    Failures before the first chunk is relayed are retried like buffered
+    calls; once the stream has started it is not. Streams are never hedged.
+    """
+    breaker = upstream_resilience.breaker(call.provider)
+    parser = SSEUsageParser(call.provider)
+    tried: Set[str] = set()
+    attempt = Attempt(1)
+    status_code = 500
+    error: Optional[BaseException] = None
+    total_cost = 0.0
+    permit: Optional[CircuitPermit] = None
+    try:
+        try:
+            permit = breaker.check()
+            while True:
+                await _stream_attempt(broadcast, parser, call, url, content, headers, tried, attempt)
+                breaker.record(permit, attempt.failed)
+                delay = upstream_resilience.retry_delay(attempt)
+                if delay is None:
+                    break
+                try:
+                    permit = breaker.check()
+                except CircuitOpen:
+                    break
+                await _record_attempt(call, attempt)
+                await asyncio.sleep(delay)
+                attempt = Attempt(attempt.number + 1)
+            
+            response = attempt.response
+            if response is None:
+                status_code = 502
+                broadcast.start(status_code, "application/json")
+                await broadcast.publish(_failure_body(attempt.error))
+            else:
+                status_code = response.status_code
+                if status_code != 200:
+                    broadcast.start(
+                        status_code, response.headers.get("content-type", "application/json"),
+                        _relayed_headers(response)
+                    )
+                    await broadcast.publish(response.content)
+        except UpstreamOverloaded as exc:
+            status_code = 503
+            broadcast.start(status_code, "application/json", _SHED_HEADERS)
+            await broadcast.publish(dumps({"detail": str(exc)}))
+        except CircuitOpen as exc:
+            status_code = 503
+            broadcast.start(status_code, "application/json", {"Retry-After": exc.retry_after_header})
+            await broadcast.publish(dumps({"detail": str(exc)}))
+        except Exception as exc:
+            # The stream broke after it started
+            if permit is not None:
+                breaker.record(permit, True)
+            error = exc
+            status_code = 500
+        parser.close()
+        total_cost = await _record_usage(
+            call, parser.input_tokens, parser.output_tokens, status_code, attempt=attempt.number
+        )
+    finally:
+        if permit is not None:
+            # A no-op once recorded; frees the permit of an attempt that was shed or cancelled
+            breaker.release(permit)
+        broadcast.close(total_cost, error)
+
+async def _stream_response(
+    reader: StreamReader,
+    on_done: Optional[Callable[[int], Awaitable[None]]] = None
+) -> Response:
+    """Relay a broadcast stream to one client; on_done(status) runs once it ends"""
+    broadcast = reader.broadcast
+    try:
+        status_code, media_type = await broadcast.ready
+        if status_code != 200:
+            content = await reader.read_all()
+    except BaseException:
+        reader.close()
+        if on_done is not None:
+            await on_done(500)
+        raise
+    
+    if status_code != 200:
+        if on_done is not None:
+            await on_done(status_code)
+        return Response(content=content, status_code=status_code, media_type=media_type, headers=broadcast.headers)
+    
+    async def relay():
+        relay_status = 200
+        try:
+            async for chunk in reader.iterate():
+                yield chunk
+        except Exception:
+            relay_status = 500
+            raise
+        finally:
+            if on_done is not None:
+                await on_done(relay_status)
+    
+    # A client gone before the relay starts never runs it; the reader is closed after the response either way
+    return StreamingResponse(
+        relay(),
+        status_code=200,
+        media_type=media_type,
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+        background=BackgroundTask(reader.aclose)
+    )
+
+async def _follow(flight: Flight, call: ProxyCall) -> Response:
+    """Answer a request from an identical one already in flight"""
+    if flight.stream is not None:
+        broadcast = flight.stream
+        reader = broadcast.attach()
+        
+        async def on_done(status_code: int) -> None:
+            await _record_usage(call, 0, 0, status_code, coalesced=True, saved_cost=broadcast.total_cost)
+        
+        return await _stream_response(reader, on_done)
+    
+    status_code, saved_cost = 500, 0.0
+    try:
+        result = await asyncio.shield(flight.task)
+        status_code, saved_cost = result.status_code, result.total_cost
+    finally:
+        await _record_usage(call, 0, 0, status_code, coalesced=True, saved_cost=saved_cost)
+    return Response(
+        content=result.body, status_code=result.status_code, media_type=result.media_type, headers=result.headers
+    )
+
+async def _forward(
+    request: Request,
+    call: ProxyCall,
+    url: str,
+    body: Dict[str, Any],
+    content: bytes,
+    headers: Dict[str, str],
+    cache_key: Optional[str]
+) -> Response:
+    """Send a request upstream, or join an identical one already in flight"""
+    # Cache-Control: no-store also opts out of sharing another caller's response
+    _, no_store = cache_directives(request.headers.get("cache-control"))
+    flight_key = None if no_store else single_flight.key_for(call.virtual_key, call.provider, body)
+    
+    flight = single_flight.join(flight_key, call.provider)
+    if flight is not None:
+        return await _follow(flight, call)
+    
+    if body.get("stream"):
+        broadcast = StreamBroadcast()
+        reader = broadcast.attach()
+        single_flight.lead(flight_key, call.provider, _pump_stream(broadcast, call, url, content, headers), broadcast)
+        return await _stream_response(reader)
+    
+    flight = single_flight.lead(flight_key, call.provider, _call_upstream(call, url, content, headers, cache_key))
+    # Shielded: a disconnecting leader must not cancel the call for its followers
+    result = await asyncio.shield(flight.task)
+    return Response(
+        content=result.body, status_code=result.status_code, media_type=result.media_type, headers=result.headers
+    )
+
 @router.post("/openai/v1/chat/completions")
 async def proxy_openai(
     request: Request,
-    virtual_key: VirtualKey = Depends(get_virtual_key),
-    db: Session = Depends(get_db)
+    virtual_key: CachedVirtualKey = Depends(get_virtual_key)
 ):
     """Proxy OpenAI chat completions endpoint"""
-    body = await request.json()
+    content, body = await _read_body(request)
     model = body.get("model", "gpt-4o-mini")
     messages = body.get("messages", [])
     
+    # Hash prompt for waste detection (hash, size and preview in one pass)
+    with stage_timer("prompt_hash"):
+        fingerprint = await fingerprint_prompt_async(messages, model, len(content))
+    
     # Check token limits
     if virtual_key.max_tokens_per_request:
-        # Estimate tokens (rough: 1 token ≈ 4 chars)
-        estimated_tokens = sum(len(str(msg.get("content", ""))) for msg in messages) // 4
+        # Estimate tokens (rough: 1 token ≈ 4 chars of text)
+        estimated_tokens = fingerprint.chars // 4
         if estimated_tokens > virtual_key.max_tokens_per_request:
             raise HTTPException(
                 status_code=400,
                 detail=f"Request exceeds max tokens limit of {virtual_key.max_tokens_per_request}"
             )
+    # Checked before admission, which holds budget and rate permits until the call is logged
+    if not isinstance(body.get("stream_options") or {}, dict):
+        raise HTTPException(status_code=400, detail="stream_options must be an object")
     
-    # Hash prompt for waste detection
-    prompt_hash = hash_prompt(messages=messages, model=model)
-    prompt_preview, prompt_chars = extract_prompt_preview(messages=messages)
+    call = ProxyCall(
+        virtual_key, "openai", model,
+        fingerprint.hash, fingerprint.chars, fingerprint.preview, fingerprint.signature, str(uuid.uuid4())
+    )
     
-    # Forward to OpenAI
-    openai_url = "https://api.openai.com/v1/chat/completions"
+    # Deterministic requests may be answered from the key's response cache
+    with stage_timer("cache_lookup"):
+        cache_key, cached = await _lookup_cache(request, virtual_key, "openai", body)
+    if cached is not None:
+        return await _serve_cached(cached, call)
+    
+    # Forward to OpenAI; credentials come from the upstream target the call is routed to
+    openai_url = "/v1/chat/completions"
     headers = {
-        "Authorization": f"Bearer {settings.OPENAI_API_KEY}",
         "Content-Type": "application/json"
     }
     
-    request_id = str(uuid.uuid4())
-    was_blocked = False
-    block_reason = None
-    status_code = 200
-    input_tokens = 0
-    output_tokens = 0
-    total_tokens = 0
+    max_output_tokens = body.get("max_completion_tokens") or body.get("max_tokens")
+    await _admit(call, max_output_tokens)
     
-    try:
-        async with httpx.AsyncClient(timeout=60.0) as client:
-            response = await client.post(openai_url, json=body, headers=headers)
-            status_code = response.status_code
-            
-            if response.status_code == 200:
-                data = response.json()
-                usage = data.get("usage", {})
-                input_tokens = usage.get("prompt_tokens", 0)
-                output_tokens = usage.get("completion_tokens", 0)
-                total_tokens = usage.get("total_tokens", 0)
-                
-                # Check reasoning tokens if limit set
-                if virtual_key.max_reasoning_tokens and output_tokens > virtual_key.max_reasoning_tokens:
-                    # This is a soft check - we log it but don't block
-                    pass
-                
-                # Calculate costs
-                costs = calculate_cost("openai", model, input_tokens, output_tokens)
-                
-                # Log usage event
-                usage_event = UsageEvent(
-                    virtual_key_id=virtual_key.id,
-                    provider="openai",
-                    model=model,
-                    input_tokens=input_tokens,
-                    output_tokens=output_tokens,
-                    total_tokens=total_tokens,
-                    input_cost=costs["input_cost"],
-                    output_cost=costs["output_cost"],
-                    total_cost=costs["total_cost"],
-                    prompt_hash=prompt_hash,
-                    prompt_chars=prompt_chars,
-                    prompt_preview=prompt_preview[:200],
-                    request_id=request_id,
-                    status_code=status_code,
-                    was_blocked=was_blocked,
-                    block_reason=block_reason
-                )
-                db.add(usage_event)
-                db.commit()
-                
-                return JSONResponse(content=data, status_code=200)
-            else:
-                # Log failed request
-                usage_event = UsageEvent(
-                    virtual_key_id=virtual_key.id,
-                    provider="openai",
-                    model=model,
-                    input_tokens=0,
-                    output_tokens=0,
-                    total_tokens=0,
-                    input_cost=0.0,
-                    output_cost=0.0,
-                    total_cost=0.0,
-                    prompt_hash=prompt_hash,
-                    prompt_chars=prompt_chars,
-                    prompt_preview=prompt_preview[:200],
-                    request_id=request_id,
-                    status_code=status_code,
-                    was_blocked=False
-                )
-                db.add(usage_event)
-                db.commit()
-                
-                return JSONResponse(content=response.json(), status_code=status_code)
+    stream_options = body.get("stream_options") or {}
+    if body.get("stream") and not stream_options.get("include_usage"):
+        # Ask OpenAI to append a final usage chunk so streamed calls are billed;
+        # the only case where the request is re-serialized instead of relayed
+        body["stream_options"] = {**stream_options, "include_usage": True}
+        content = dumps(body)
     
+    try:
+        return await _forward(request, call, openai_url, body, content, headers, cache_key)
     except Exception as e:
-        # Log error
-        usage_event = UsageEvent(
-            virtual_key_id=virtual_key.id,
-            provider="openai",
-            model=model,
-            input_tokens=0,
-            output_tokens=0,
-            total_tokens=0,
-            input_cost=0.0,
-            output_cost=0.0,
-            total_cost=0.0,
-            prompt_hash=prompt_hash,
-            prompt_chars=prompt_chars,
-            prompt_preview=prompt_preview[:200],
-            request_id=request_id,
-            status_code=500,
-            was_blocked=False
-        )
-        db.add(usage_event)
-        db.commit()
-        
+        # Usage for the failed call has already been logged
         raise HTTPException(status_code=500, detail=str(e))
 
 @router.post("/anthropic/v1/messages")
 async def proxy_anthropic(
     request: Request,
-    virtual_key: VirtualKey = Depends(get_virtual_key),
-    db: Session = Depends(get_db)
+    virtual_key: CachedVirtualKey = Depends(get_virtual_key)
 ):
     """Proxy Anthropic messages endpoint"""
-    body = await request.json()
+    content, body = await _read_body(request)
     model = body.get("model", "claude-3-5-sonnet-20241022")
     messages = body.get("messages", [])
     
+    # Hash prompt for waste detection (hash, size and preview in one pass)
+    with stage_timer("prompt_hash"):
+        fingerprint = await fingerprint_prompt_async(messages, model, len(content))
+    
     # Check token limits
     if virtual_key.max_tokens_per_request:
-        estimated_tokens = sum(len(str(msg.get("content", ""))) for msg in messages) // 4
+        # Estimate tokens (rough: 1 token ≈ 4 chars of text)
+        estimated_tokens = fingerprint.chars // 4
         if estimated_tokens > virtual_key.max_tokens_per_request:
             raise HTTPException(
                 status_code=400,
                 detail=f"Request exceeds max tokens limit of {virtual_key.max_tokens_per_request}"
             )
     
-    # Hash prompt for waste detection
-    prompt_hash = hash_prompt(messages=messages, model=model)
-    prompt_preview, prompt_chars = extract_prompt_preview(messages=messages)
+    call = ProxyCall(
+        virtual_key, "anthropic", model,
+        fingerprint.hash, fingerprint.chars, fingerprint.preview, fingerprint.signature, str(uuid.uuid4())
+    )
+    
+    # Deterministic requests may be answered from the key's response cache
+    with stage_timer("cache_lookup"):
+        cache_key, cached = await _lookup_cache(request, virtual_key, "anthropic", body)
+    if cached is not None:
+        return await _serve_cached(cached, call)
     
-    # Forward to Anthropic
-    anthropic_url = "https://api.anthropic.com/v1/messages"
+    # Forward to Anthropic; credentials come from the upstream target the call is routed to
+    anthropic_url = "/v1/messages"
     headers = {
-        "x-api-key": settings.ANTHROPIC_API_KEY,
         "anthropic-version": "2023-06-01",
         "Content-Type": "application/json"
     }
     
-    request_id = str(uuid.uuid4())
-    status_code = 200
-    input_tokens = 0
-    output_tokens = 0
+    await _admit(call, body.get("max_tokens"))
     
     try:
-        async with httpx.AsyncClient(timeout=60.0) as client:
-            response = await client.post(anthropic_url, json=body, headers=headers)
-            status_code = response.status_code
-            
-            if response.status_code == 200:
-                data = response.json()
-                usage = data.get("usage", {})
-                input_tokens = usage.get("input_tokens", 0)
-                output_tokens = usage.get("output_tokens", 0)
-                total_tokens = input_tokens + output_tokens
-                
-                # Calculate costs
-                costs = calculate_cost("anthropic", model, input_tokens, output_tokens)
-                
-                # Log usage event
-                usage_event = UsageEvent(
-                    virtual_key_id=virtual_key.id,
-                    provider="anthropic",
-                    model=model,
-                    input_tokens=input_tokens,
-                    output_tokens=output_tokens,
-                    total_tokens=total_tokens,
-                    input_cost=costs["input_cost"],
-                    output_cost=costs["output_cost"],
-                    total_cost=costs["total_cost"],
-                    prompt_hash=prompt_hash,
-                    prompt_chars=prompt_chars,
-                    prompt_preview=prompt_preview[:200],
-                    request_id=request_id,
-                    status_code=status_code,
-                    was_blocked=False
-                )
-                db.add(usage_event)
-                db.commit()
-                
-                return JSONResponse(content=data, status_code=200)
-            else:
-                # Log failed request
-                usage_event = UsageEvent(
-                    virtual_key_id=virtual_key.id,
-                    provider="anthropic",
-                    model=model,
-                    input_tokens=0,
-                    output_tokens=0,
-                    total_tokens=0,
-                    input_cost=0.0,
-                    output_cost=0.0,
-                    total_cost=0.0,
-                    prompt_hash=prompt_hash,
-                    prompt_chars=prompt_chars,
-                    prompt_preview=prompt_preview[:200],
-                    request_id=request_id,
-                    status_code=status_code,
-                    was_blocked=False
-                )
-                db.add(usage_event)
-                db.commit()
-                
-                return JSONResponse(content=response.json(), status_code=status_code)
-    
+        return await _forward(request, call, anthropic_url, body, content, headers, cache_key)
     except Exception as e:
-        # Log error
-        usage_event = UsageEvent(
-            virtual_key_id=virtual_key.id,
-            provider="anthropic",
-            model=model,
-            input_tokens=0,
-            output_tokens=0,
-            total_tokens=0,
-            input_cost=0.0,
-            output_cost=0.0,
-            total_cost=0.0,
-            prompt_hash=prompt_hash,
-            prompt_chars=prompt_chars,
-            prompt_preview=prompt_preview[:200],
-            request_id=request_id,
-            status_code=500,
-            was_blocked=False
+        # Usage for the failed call has already been logged
+        raise HTTPException(status_code=500, detail=str(e))
+
+@router.post("/openai/v1/embeddings")
+async def proxy_openai_embeddings(
+    request: Request,
+    virtual_key: CachedVirtualKey = Depends(get_virtual_key)
+):
+    """Proxy OpenAI embeddings endpoint"""
+    content, body = await _read_body(request)
+    model = body.get("model", "text-embedding-3-small")
+    parsed = embedding_inputs(body)
+    if parsed is None:
+        raise HTTPException(
+            status_code=400,
+            detail="input must be a string, an array of strings or an array of token arrays"
         )
-        db.add(usage_event)
-        db.commit()
-        
+    kind, inputs = parsed
+    
+    # Hash the inputs for waste detection like a prompt; token arrays hash as their ids
+    texts = inputs if kind == "text" else [" ".join(map(str, tokens)) for tokens in inputs]
+    with stage_timer("prompt_hash"):
+        fingerprint = await fingerprint_prompt_async(
+            [{"role": "user", "content": text} for text in texts], model, len(content)
+        )
+    
+    # Check token limits
+    estimated_tokens = estimate_tokens(kind, inputs)
+    if virtual_key.max_tokens_per_request and estimated_tokens > virtual_key.max_tokens_per_request:
+        raise HTTPException(
+            status_code=400,
+            detail=f"Request exceeds max tokens limit of {virtual_key.max_tokens_per_request}"
+        )
+    
+    call = ProxyCall(
+        virtual_key, "openai", model,
+        fingerprint.hash, fingerprint.chars, fingerprint.preview, fingerprint.signature, str(uuid.uuid4())
+    )
+    
+    # Forward to OpenAI; credentials come from the upstream target the call is routed to
+    openai_url = "/v1/embeddings"
+    headers = {
+        "Content-Type": "application/json"
+    }
+    
+    # Embeddings produce no output tokens
+    await _admit(call, 0)
+    
+    try:
+        if embedding_batcher.accepts(inputs, estimated_tokens):
+            # Small requests may share one upstream call with concurrent ones
+            params = {name: value for name, value in body.items() if name not in ("model", "input")}
+            entry = BatchEntry(inputs, estimated_tokens, params, call)
+            
+            async def send(entries: List[BatchEntry]) -> List[BufferedResult]:
+                return await _call_embedding_batch(entries, openai_url, headers)
+            
+            result = await embedding_batcher.submit(
+                embedding_batcher.key_for("openai", model, kind, params), entry, send
+            )
+            return Response(
+                content=result.body, status_code=result.status_code, media_type=result.media_type,
+                headers=result.headers
+            )
+        return await _forward(request, call, openai_url, body, content, headers, None)
+    except Exception as e:
+        # Usage for the failed call has already been logged
         raise HTTPException(status_code=500, detail=str(e))
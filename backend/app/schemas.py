@@ -1,4 +1,4 @@
-from pydantic import BaseModel, EmailStr
+from pydantic import BaseModel, EmailStr, Field
 from typing import Optional, List
 from datetime import datetime
 
@@ -35,6 +35,27 @@ class VirtualKeyCreate(BaseModel):
     monthly_budget_cap: Optional[float] = None
     max_tokens_per_request: Optional[int] = None
     max_reasoning_tokens: Optional[int] = None
+    requests_per_minute: Optional[int] = Field(None, gt=0)
+    tokens_per_minute: Optional[int] = Field(None, gt=0)
+    cache_responses: bool = False
+    cache_ttl_seconds: Optional[int] = None
+
+class VirtualKeyUpdate(BaseModel):
+    name: Optional[str] = None
+    team_id: Optional[int] = None
+    project_id: Optional[int] = None
+    user_email: Optional[str] = None
+    cost_centre: Optional[str] = None
+    environment: Optional[str] = None
+    agent_name: Optional[str] = None
+    monthly_budget_cap: Optional[float] = None
+    max_tokens_per_request: Optional[int] = None
+    max_reasoning_tokens: Optional[int] = None
+    is_active: Optional[bool] = None
+    requests_per_minute: Optional[int] = Field(None, gt=0)
+    tokens_per_minute: Optional[int] = Field(None, gt=0)
+    cache_responses: Optional[bool] = None
+    cache_ttl_seconds: Optional[int] = None
 
 class VirtualKeyResponse(BaseModel):
     id: int
@@ -50,11 +71,94 @@ class VirtualKeyResponse(BaseModel):
     max_tokens_per_request: Optional[int]
     max_reasoning_tokens: Optional[int]
     is_active: bool
+    requests_per_minute: Optional[int] = None
+    tokens_per_minute: Optional[int] = None
+    cache_responses: Optional[bool] = False
+    cache_ttl_seconds: Optional[int] = None
     created_at: datetime
     
     class Config:
         from_attributes = True
 
+# Organization, team and project schemas (budget caps cover all their keys)
+class OrganizationCreate(BaseModel):
+    name: str
+    monthly_budget_cap: Optional[float] = Field(None, ge=0)
+
+class OrganizationUpdate(BaseModel):
+    name: Optional[str] = None
+    monthly_budget_cap: Optional[float] = Field(None, ge=0)
+
+class OrganizationResponse(BaseModel):
+    id: int
+    name: str
+    monthly_budget_cap: Optional[float]
+    created_at: datetime
+    
+    class Config:
+        from_attributes = True
+
+class TeamCreate(BaseModel):
+    name: str
+    organization_id: int
+    monthly_budget_cap: Optional[float] = Field(None, ge=0)
+
+class TeamUpdate(BaseModel):
+    name: Optional[str] = None
+    monthly_budget_cap: Optional[float] = Field(None, ge=0)
+
+class TeamResponse(BaseModel):
+    id: int
+    name: str
+    organization_id: int
+    monthly_budget_cap: Optional[float]
+    created_at: datetime
+    
+    class Config:
+        from_attributes = True
+
+class ProjectCreate(BaseModel):
+    name: str
+    organization_id: int
+    team_id: Optional[int] = None
+    monthly_budget_cap: Optional[float] = Field(None, ge=0)
+
+class ProjectUpdate(BaseModel):
+    name: Optional[str] = None
+    monthly_budget_cap: Optional[float] = Field(None, ge=0)
+
+class ProjectResponse(BaseModel):
+    id: int
+    name: str
+    organization_id: int
+    team_id: Optional[int]
+    monthly_budget_cap: Optional[float]
+    created_at: datetime
+    
+    class Config:
+        from_attributes = True
+
+# Model price schemas (per 1M tokens)
+class ModelPriceCreate(BaseModel):
+    provider: str
+    model: str
+    input_price: float = Field(..., ge=0)
+    output_price: float = Field(..., ge=0)
+    effective_from: datetime
+    effective_to: Optional[datetime] = None  # exclusive; open-ended when omitted
+
+class ModelPriceResponse(BaseModel):
+    id: int
+    provider: str
+    model: str
+    input_price: float
+    output_price: float
+    effective_from: datetime
+    effective_to: Optional[datetime]
+    
+    class Config:
+        from_attributes = True
+
 # Usage Event schemas
 class UsageEventResponse(BaseModel):
     id: int
@@ -72,6 +176,13 @@ class UsageEventResponse(BaseModel):
     status_code: Optional[int]
     was_blocked: bool
     block_reason: Optional[str]
+    cache_hit: Optional[bool] = False
+    coalesced: Optional[bool] = False
+    saved_cost: Optional[float] = 0.0
+    attempt: Optional[int] = 1
+    hedge: Optional[bool] = False
+    served: Optional[bool] = True
+    batch_id: Optional[str] = None
     created_at: datetime
     
     class Config:
@@ -100,6 +211,47 @@ class WasteMetrics(BaseModel):
     repeated_prompts_count: int
     estimated_waste: float
     top_repeated_hashes: List[dict]
+    cache_hits: int = 0
+    coalesced_requests: int = 0
+    realized_savings: float = 0.0
+
+class NearDuplicateCluster(BaseModel):
+    cluster_id: int
+    model: str
+    sample_hash: str  # prompt hash of the cluster's first member
+    request_count: int
+    virtual_keys: int
+    total_cost: float
+    estimated_waste: float
+    first_seen: datetime
+    last_seen: datetime
+
+class StoredPeriod(BaseModel):
+    period: str  # YYYY-MM
+    tier: str  # database, archive
+
+class ModelUsage(BaseModel):
+    provider: str
+    model: str
+    request_count: int
+    input_tokens: int
+    output_tokens: int
+    total_tokens: int
+    total_cost: float
+
+class PeriodUsage(BaseModel):
+    period: str
+    tier: str
+    request_count: int
+    total_tokens: int
+    total_cost: float
+    models: List[ModelUsage]
+
+class TimeSeriesPoint(BaseModel):
+    bucket_start: datetime
+    total_cost: float
+    request_count: int
+    total_tokens: int
 
 class MetricsOverview(BaseModel):
     cost: CostOverview
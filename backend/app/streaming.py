@@ -0,0 +1,87 @@
+from typing import Optional
+
+import orjson
+
+# Upper bound on a single buffered SSE line. Usage-bearing events are tiny, so
+# anything larger is content we never need to parse and can safely drop.
+MAX_SSE_LINE_BYTES = 1_048_576
+
+
+class SSEUsageParser:
+    """Incrementally extract token usage from an OpenAI or Anthropic SSE stream
+
+    Chunks are fed as they are relayed to the client. Only the trailing
+    partial line is buffered, so memory stays constant regardless of how
+    long the completion is.
+    """
+
+    def __init__(self, provider: str):
+        self.provider = provider
+        self.input_tokens = 0
+        self.output_tokens = 0
+        self._buffer = b""
+
+    @property
+    def total_tokens(self) -> int:
+        return self.input_tokens + self.output_tokens
+
+    def feed(self, chunk: bytes) -> None:
+        """Consume a raw chunk of the event stream"""
+        data = self._buffer + chunk if self._buffer else chunk
+        start = 0
+        while True:
+            end = data.find(b"\n", start)
+            if end == -1:
+                break
+            self._parse_line(data[start:end])
+            start = end + 1
+        remainder = data[start:]
+        self._buffer = remainder if len(remainder) <= MAX_SSE_LINE_BYTES else b""
+
+    def close(self) -> None:
+        """Parse whatever is left once the stream has ended"""
+        if self._buffer:
+            self._parse_line(self._buffer)
+            self._buffer = b""
+
+    def _parse_line(self, line: bytes) -> None:
+        """Parse a single `data:` line if it can carry usage"""
+        if not line.startswith(b"data:") or b'"usage"' not in line:
+            return
+        if b'"usage":null' in line:
+            # OpenAI sends an empty usage field on every content chunk
+            return
+        payload = line[5:].strip()
+        if payload == b"[DONE]":
+            return
+        try:
+            event = orjson.loads(payload)
+        except orjson.JSONDecodeError:
+            return
+        if not isinstance(event, dict):
+            return
+        if self.provider == "anthropic":
+            self._apply_anthropic(event)
+        else:
+            self._apply_openai(event)
+
+    def _apply_openai(self, event: dict) -> None:
+        """Read the final `stream_options.include_usage` chunk"""
+        usage = event.get("usage")
+        if isinstance(usage, dict):
+            self.input_tokens = usage.get("prompt_tokens", 0) or 0
+            self.output_tokens = usage.get("completion_tokens", 0) or 0
+
+    def _apply_anthropic(self, event: dict) -> None:
+        """Read usage from `message_start` and the cumulative `message_delta`"""
+        usage: Optional[dict] = None
+        if event.get("type") == "message_start":
+            usage = (event.get("message") or {}).get("usage")
+        elif event.get("type") == "message_delta":
+            usage = event.get("usage")
+        if not isinstance(usage, dict):
+            return
+        if usage.get("input_tokens"):
+            self.input_tokens = usage["input_tokens"]
+        if "output_tokens" in usage:
+            self.output_tokens = usage.get("output_tokens") or 0
@@ -0,0 +1,374 @@
+import math
+import random
+import time
+from contextlib import contextmanager
+from typing import Dict, Iterator, List, Optional, Set
+
+import httpx
+from prometheus_client import Counter, Gauge
+
+from app.config import settings
+
+PROVIDERS = ("openai", "anthropic")
+
+# Statuses that count against a target's health; 429 is a quota signal instead
+_FAILURE_STATUSES = frozenset({500, 502, 503, 504, 529})
+# (remaining, limit) header pairs each provider reports its rate limits in
+_QUOTA_HEADERS = {
+    "openai": (
+        ("x-ratelimit-remaining-requests", "x-ratelimit-limit-requests"),
+        ("x-ratelimit-remaining-tokens", "x-ratelimit-limit-tokens"),
+    ),
+    "anthropic": (
+        ("anthropic-ratelimit-requests-remaining", "anthropic-ratelimit-requests-limit"),
+        ("anthropic-ratelimit-tokens-remaining", "anthropic-ratelimit-tokens-limit"),
+    ),
+}
+_DEFAULT_LATENCY = 1.0  # seconds assumed for a target before its first response
+_ERROR_PENALTY = 10.0  # routing cost multiplier per unit of error rate
+_MIN_QUOTA = 0.05  # floor on the remaining-quota share when weighting by it
+
+UPSTREAM_TARGET_ROUTED = Counter(
+    'upstream_target_routed_total', 'Upstream calls routed to each target', ['provider', 'target']
+)
+UPSTREAM_TARGET_EJECTIONS = Counter(
+    'upstream_target_ejections_total', 'Times a target was taken out of rotation after failures', ['provider', 'target']
+)
+UPSTREAM_TARGET_LATENCY = Gauge(
+    'upstream_target_latency_seconds', 'Decayed EWMA upstream latency of each target', ['provider', 'target', 'kind']
+)
+UPSTREAM_TARGET_ERROR_RATE = Gauge(
+    'upstream_target_error_rate', 'Decayed EWMA share of failed calls to each target', ['provider', 'target']
+)
+UPSTREAM_TARGET_QUOTA = Gauge(
+    'upstream_target_quota_remaining_ratio', 'Share of its rate limit a target last reported left', ['provider', 'target']
+)
+UPSTREAM_TARGET_AVAILABLE = Gauge(
+    'upstream_target_available', '1 while a target is in rotation, 0 while ejected or out of quota',
+    ['provider', 'target']
+)
+
+
+class UpstreamTarget:
+    """One upstream endpoint with its own credentials, client and health state
+
+    Latency (kept separately for streaming and buffered calls), error rate
+    and remaining quota decay towards "unknown" while a target is idle, so
+    a target that looked bad a while ago is tried again instead of being
+    starved forever.
+    """
+
+    def __init__(
+        self,
+        provider: str,
+        name: str,
+        base_url: str,
+        api_key: str,
+        weight: float = 1.0,
+        path: Optional[str] = None,
+        api_key_header: Optional[str] = None,
+        models: Optional[List[str]] = None
+    ):
+        self.provider = provider
+        self.name = name
+        self.base_url = base_url
+        self.weight = weight
+        self.path = path
+        self.models = frozenset(models) if models else None
+        if api_key_header:
+            self.auth_headers = {api_key_header: api_key}
+        elif provider == "anthropic":
+            self.auth_headers = {"x-api-key": api_key}
+        else:
+            self.auth_headers = {"Authorization": f"Bearer {api_key}"}
+        self.client = build_upstream_client(base_url)
+        self.in_flight = 0
+        # streaming -> [EWMA latency, time of last update]
+        self._latency: Dict[bool, List[float]] = {}
+        self._error_rate = 0.0
+        self._quota: Optional[float] = None
+        self._updated = 0.0
+        self._failures = 0
+        self._ejections = 0
+        self.ejected_until = 0.0
+        self.exhausted_until = 0.0
+        self._routed = UPSTREAM_TARGET_ROUTED.labels(provider, name)
+        UPSTREAM_TARGET_ERROR_RATE.labels(provider, name).set_function(lambda: self._decayed(self._error_rate))
+        UPSTREAM_TARGET_QUOTA.labels(provider, name).set_function(
+            lambda: 1.0 if self._quota is None else 1 - self._decayed(1 - self._quota)
+        )
+        UPSTREAM_TARGET_AVAILABLE.labels(provider, name).set_function(lambda: float(self.available(time.monotonic())))
+        for streaming, kind in ((False, "buffered"), (True, "streaming")):
+            UPSTREAM_TARGET_LATENCY.labels(provider, name, kind).set_function(
+                lambda streaming=streaming: self.latency(streaming) or 0.0
+            )
+
+    @classmethod
+    def from_config(cls, provider: str, index: int, config: dict) -> "UpstreamTarget":
+        """Build a target from one entry of OPENAI_UPSTREAMS / ANTHROPIC_UPSTREAMS"""
+        unknown = set(config) - {"name", "base_url", "api_key", "weight", "path", "api_key_header", "models"}
+        if unknown or "base_url" not in config or float(config.get("weight", 1.0)) <= 0:
+            raise ValueError(
+                f"Invalid {provider} upstream #{index}: needs base_url and a positive weight"
+                + (f", unknown keys {sorted(unknown)}" if unknown else "")
+            )
+        default_key = settings.OPENAI_API_KEY if provider == "openai" else settings.ANTHROPIC_API_KEY
+        return cls(
+            provider,
+            str(config.get("name", index)),
+            config["base_url"],
+            config.get("api_key", default_key),
+            weight=float(config.get("weight", 1.0)),
+            path=config.get("path"),
+            api_key_header=config.get("api_key_header"),
+            models=config.get("models"),
+        )
+
+    def url(self, path: str, model: str) -> str:
+        """Request path on this target; `path` may name a per-model deployment"""
+        return self.path.format(model=model) if self.path else path
+
+    def serves(self, model: str) -> bool:
+        return self.models is None or model in self.models
+
+    def available(self, now: float) -> bool:
+        return now >= self.ejected_until and now >= self.exhausted_until
+
+    def latency(self, streaming: bool) -> Optional[float]:
+        ewma = self._latency.get(streaming)
+        if ewma is None:
+            return None
+        return ewma[0] * self._decay(ewma[1])
+
+    def cost(self, streaming: bool, fallback_latency: float) -> float:
+        """Expected cost of sending one more call here; lower is better"""
+        latency = self.latency(streaming)
+        if latency is None:
+            latency = fallback_latency
+        cost = latency * (self.in_flight + 1) / self.weight
+        cost *= 1 + _ERROR_PENALTY * self._decayed(self._error_rate)
+        if self._quota is not None:
+            cost /= max(_MIN_QUOTA, 1 - self._decayed(1 - self._quota))
+        return cost
+
+    def record(
+        self,
+        latency: Optional[float],
+        status_code: Optional[int],
+        headers: Optional[httpx.Headers],
+        streaming: bool
+    ) -> None:
+        """Fold one finished call into the target's health
+
+        A None status is a connection error or timeout. Failures in a row
+        eject the target for UPSTREAM_EJECT_SECONDS, doubling on each
+        repeated ejection up to UPSTREAM_EJECT_MAX_SECONDS; 429 only takes
+        it out of rotation until its Retry-After.
+        """
+        now = time.monotonic()
+        failed = status_code is None or status_code in _FAILURE_STATUSES
+        error_rate = self._decayed(self._error_rate, now)
+        self._error_rate = error_rate + 0.1 * ((1.0 if failed else 0.0) - error_rate)
+        self._updated = now
+        if latency is not None and not failed:
+            ewma = self._latency.get(streaming)
+            if ewma is None:
+                self._latency[streaming] = [latency, now]
+            else:
+                ewma[0] = ewma[0] * self._decay(ewma[1], now) * 0.8 + 0.2 * latency
+                ewma[1] = now
+        if headers is not None:
+            self._read_quota(headers)
+            if status_code == 429:
+                self.exhausted_until = now + _retry_after(headers)
+        if not failed:
+            self._failures = 0
+            if status_code != 429:
+                self._ejections = 0
+            return
+        self._failures += 1
+        if self._failures >= settings.UPSTREAM_EJECT_FAILURES:
+            self._failures = 0
+            self._ejections += 1
+            seconds = settings.UPSTREAM_EJECT_SECONDS * 2 ** (self._ejections - 1)
+            self.ejected_until = now + min(settings.UPSTREAM_EJECT_MAX_SECONDS, seconds)
+            UPSTREAM_TARGET_EJECTIONS.labels(self.provider, self.name).inc()
+
+    def _read_quota(self, headers: httpx.Headers) -> None:
+        shares = []
+        for remaining, limit in _QUOTA_HEADERS.get(self.provider, ()):
+            try:
+                shares.append(float(headers[remaining]) / float(headers[limit]))
+            except (KeyError, ValueError, ZeroDivisionError):
+                continue
+        if shares:
+            self._quota = max(0.0, min(1.0, min(shares)))
+
+    def _decay(self, updated: float, now: Optional[float] = None) -> float:
+        """Weight left on a value last updated at `updated`"""
+        idle = (now if now is not None else time.monotonic()) - updated
+        return math.exp(-idle / settings.UPSTREAM_HEALTH_DECAY) if idle > 0 else 1.0
+
+    def _decayed(self, value: float, now: Optional[float] = None) -> float:
+        return value * self._decay(self._updated, now)
+
+
+class UpstreamRoute:
+    """The target chosen for one call; the caller records how the call went"""
+    __slots__ = ("target", "latency", "status_code", "headers")
+
+    def __init__(self, target: UpstreamTarget):
+        self.target = target
+        self.latency: Optional[float] = None
+        self.status_code: Optional[int] = None
+        self.headers: Optional[httpx.Headers] = None
+
+    def record(self, latency: Optional[float], response: httpx.Response) -> None:
+        self.latency = latency
+        self.status_code = response.status_code
+        self.headers = response.headers
+
+
+class UpstreamPool:
+    """Targets for one provider, picked by power of two choices on expected cost
+
+    Two random targets among those that serve the model and are in
+    rotation are compared, and the cheaper one gets the call. The random
+    pair spreads load instead of herding every request onto the single
+    best target between updates. If every target is out of rotation the
+    pool routes across all of them rather than failing.
+    """
+
+    def __init__(self, provider: str, targets: List[UpstreamTarget]):
+        self.provider = provider
+        self.targets = targets
+        self._random = random.Random()
+
+    def choose(self, model: str, streaming: bool, tried: Set[str] = frozenset()) -> UpstreamTarget:
+        """Pick a target, avoiding those in `tried` (earlier attempts) while others are available"""
+        if len(self.targets) == 1:
+            return self.targets[0]
+        candidates = [target for target in self.targets if target.serves(model)] or self.targets
+        now = time.monotonic()
+        available = [target for target in candidates if target.available(now)] or candidates
+        if tried:
+            available = [target for target in available if target.name not in tried] or available
+        if len(available) == 1:
+            return available[0]
+        known = [latency for latency in (target.latency(streaming) for target in available) if latency is not None]
+        fallback = min(known) if known else _DEFAULT_LATENCY
+        first, second = self._random.sample(available, 2)
+        if second.cost(streaming, fallback) < first.cost(streaming, fallback):
+            return second
+        return first
+
+    @contextmanager
+    def route(self, model: str, streaming: bool, tried: Optional[Set[str]] = None) -> Iterator[UpstreamRoute]:
+        """Pick a target and hold it for the duration of one call
+
+        The chosen target is added to `tried`, so a retry or hedge passing
+        the same set goes elsewhere if it can. An exception out of the
+        block counts as a failed call.
+        """
+        target = self.choose(model, streaming, tried or frozenset())
+        if tried is not None:
+            tried.add(target.name)
+        target._routed.inc()
+        target.in_flight += 1
+        route = UpstreamRoute(target)
+        try:
+            yield route
+        except Exception:
+            # A connection error or timeout: recorded as a call without a response
+            target.record(route.latency, None, None, streaming)
+            raise
+        except BaseException:
+            # Cancelled: says nothing about the target's health
+            raise
+        else:
+            target.record(route.latency, route.status_code, route.headers, streaming)
+        finally:
+            target.in_flight -= 1
+
+    async def aclose(self) -> None:
+        for target in self.targets:
+            await target.client.aclose()
+
+
+# One pool per provider; each target keeps a long-lived client so proxied
+# calls reuse pooled keep-alive connections instead of paying a new
+# TCP+TLS handshake each time.
+_pools: Dict[str, UpstreamPool] = {}
+
+
+def _retry_after(headers: httpx.Headers) -> float:
+    try:
+        return max(0.0, float(headers.get("retry-after", 1)))
+    except ValueError:
+        return 1.0
+
+
+def _target_configs(provider: str) -> List[dict]:
+    """Configured targets for a provider, or the single default endpoint"""
+    if provider == "openai":
+        return settings.OPENAI_UPSTREAMS or [{"name": "default", "base_url": settings.OPENAI_BASE_URL}]
+    if provider == "anthropic":
+        return settings.ANTHROPIC_UPSTREAMS or [{"name": "default", "base_url": settings.ANTHROPIC_BASE_URL}]
+    raise ValueError(f"Unknown provider: {provider}")
+
+
+def build_upstream_client(base_url: str) -> httpx.AsyncClient:
+    """Build a pooled HTTP client for one upstream endpoint from settings"""
+    limits = httpx.Limits(
+        max_connections=settings.UPSTREAM_MAX_CONNECTIONS,
+        max_keepalive_connections=settings.UPSTREAM_MAX_KEEPALIVE_CONNECTIONS,
+        keepalive_expiry=settings.UPSTREAM_KEEPALIVE_EXPIRY,
+    )
+    timeout = httpx.Timeout(
+        connect=settings.UPSTREAM_CONNECT_TIMEOUT,
+        read=settings.UPSTREAM_READ_TIMEOUT,
+        write=settings.UPSTREAM_WRITE_TIMEOUT,
+        pool=settings.UPSTREAM_POOL_TIMEOUT,
+    )
+    return httpx.AsyncClient(
+        base_url=base_url,
+        limits=limits,
+        timeout=timeout,
+        http2=settings.UPSTREAM_HTTP2,
+    )
+
+
+def build_upstream_pool(provider: str) -> UpstreamPool:
+    """Build a provider's target pool from settings"""
+    targets = [
+        UpstreamTarget.from_config(provider, index, config)
+        for index, config in enumerate(_target_configs(provider))
+    ]
+    names = [target.name for target in targets]
+    if len(set(names)) != len(names):
+        raise ValueError(f"Duplicate {provider} upstream names: {names}")
+    return UpstreamPool(provider, targets)
+
+
+async def start_upstream_clients() -> None:
+    """Create the shared upstream pools (called from the app lifespan)"""
+    for provider in PROVIDERS:
+        if provider not in _pools:
+            _pools[provider] = build_upstream_pool(provider)
+
+
+async def close_upstream_clients() -> None:
+    """Close the shared upstream pools and their pooled connections"""
+    pools = list(_pools.values())
+    _pools.clear()
+    for pool in pools:
+        await pool.aclose()
+
+
+def get_upstream_pool(provider: str) -> UpstreamPool:
+    """Get the shared pool for a provider, creating it lazily if needed"""
+    pool = _pools.get(provider)
+    if pool is None or any(target.client.is_closed for target in pool.targets):
+        pool = build_upstream_pool(provider)
+        _pools[provider] = pool
+    return pool
@@ -0,0 +1,183 @@
+import asyncio
+import logging
+import time
+from typing import Any, Awaitable, Callable, Dict, List, Optional
+
+from prometheus_client import Counter, Gauge, Histogram
+from sqlalchemy import insert
+
+from app.config import settings
+from app.database import AsyncSessionLocal
+from app.models import UsageEvent
+from app.ledger import apply_ledger_deltas, release_dropped_spend
+from app.rollups import apply_rollup_deltas
+from app.near_duplicates import apply_cluster_rollup_deltas, assign_prompt_clusters
+
+logger = logging.getLogger(__name__)
+
+USAGE_QUEUE_DEPTH = Gauge('usage_writer_queue_depth', 'Usage events waiting to be written')
+USAGE_FLUSH_DURATION = Histogram('usage_writer_flush_seconds', 'Time to write one batch of usage events')
+USAGE_FLUSH_BATCH_SIZE = Histogram(
+    'usage_writer_batch_size', 'Usage events per flushed batch',
+    buckets=(1, 5, 10, 25, 50, 100, 250, 500, 1000, 2500)
+)
+USAGE_EVENTS_WRITTEN = Counter('usage_writer_events_written_total', 'Usage events written to the database')
+USAGE_EVENTS_DROPPED = Counter('usage_writer_events_dropped_total', 'Usage events dropped after repeated write failures')
+USAGE_COST_DROPPED = Counter('usage_writer_dropped_cost_usd_total', 'Cost in USD of usage events dropped unwritten')
+USAGE_ENQUEUE_WAIT = Histogram('usage_writer_enqueue_wait_seconds', 'Time producers waited for queue space')
+
+
+class UsageWriter:
+    """Bounded write-behind queue for UsageEvent rows
+
+    Proxy handlers enqueue plain column dicts and return immediately; a
+    background task drains the queue and writes multi-row inserts whenever
+    a batch fills up or the flush interval elapses. A full queue makes
+    producers wait (backpressure) instead of growing without bound.
+    """
+
+    def __init__(self, max_queue_size: int, batch_size: int, flush_interval: float, max_retries: int = 3):
+        self.max_queue_size = max_queue_size
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.max_retries = max_retries
+        self._queue: Optional[asyncio.Queue] = None
+        self._task: Optional[asyncio.Task] = None
+
+    @property
+    def running(self) -> bool:
+        return self._task is not None and not self._task.done()
+
+    async def start(self) -> None:
+        """Start the background flusher"""
+        if self.running:
+            return
+        self._queue = asyncio.Queue(maxsize=self.max_queue_size)
+        USAGE_QUEUE_DEPTH.set_function(lambda: self._queue.qsize() if self._queue else 0)
+        self._task = asyncio.create_task(self._run(), name="usage-writer")
+
+    async def stop(self) -> None:
+        """Drain everything still queued, then stop the flusher"""
+        if not self.running:
+            return
+        await self._queue.put(None)
+        await self._task
+        self._task = None
+
+    async def enqueue(self, row: Dict[str, Any]) -> None:
+        """Queue one usage event, waiting for space if the queue is full"""
+        if not self.running:
+            # No flusher (e.g. scripts or shutdown): write through directly
+            await self._write([row])
+            return
+        try:
+            self._queue.put_nowait(row)
+        except asyncio.QueueFull:
+            start = time.perf_counter()
+            await self._queue.put(row)
+            USAGE_ENQUEUE_WAIT.observe(time.perf_counter() - start)
+
+    async def _run(self) -> None:
+        """Collect rows into batches by size or time and flush them"""
+        loop = asyncio.get_running_loop()
+        stopping = False
+        while not stopping:
+            batch: List[Dict[str, Any]] = []
+            row = await self._queue.get()
+            if row is None:
+                break
+            batch.append(row)
+            deadline = loop.time() + self.flush_interval
+            while len(batch) < self.batch_size:
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    row = await asyncio.wait_for(self._queue.get(), timeout)
+                except asyncio.TimeoutError:
+                    break
+                if row is None:
+                    stopping = True
+                    break
+                batch.append(row)
+            await self._flush(batch)
+
+        # Anything enqueued after the stop sentinel still gets written
+        remaining = []
+        while not self._queue.empty():
+            row = self._queue.get_nowait()
+            if row is not None:
+                remaining.append(row)
+        for start in range(0, len(remaining), self.batch_size):
+            await self._flush(remaining[start:start + self.batch_size])
+
+    async def _flush(self, batch: List[Dict[str, Any]]) -> None:
+        """Write a batch, retrying transient failures"""
+        for attempt in range(1, self.max_retries + 1):
+            start = time.perf_counter()
+            try:
+                await self._write(batch)
+            except Exception:
+                logger.exception("Failed to write %d usage events (attempt %d)", len(batch), attempt)
+                if attempt == self.max_retries:
+                    USAGE_EVENTS_DROPPED.inc(len(batch))
+                    await self._release_spend(batch)
+                    return
+                await asyncio.sleep(0.1 * 2 ** attempt)
+                continue
+            USAGE_FLUSH_DURATION.observe(time.perf_counter() - start)
+            USAGE_FLUSH_BATCH_SIZE.observe(len(batch))
+            USAGE_EVENTS_WRITTEN.inc(len(batch))
+            return
+
+    async def _release_spend(self, batch: List[Dict[str, Any]]) -> None:
+        """Take a dropped batch's cost back out of the live budget counters"""
+        try:
+            cost = await release_dropped_spend(batch)
+        except Exception:
+            logger.exception("Failed to release the spend of %d dropped usage events", len(batch))
+            return
+        USAGE_COST_DROPPED.inc(cost)
+        logger.error("Dropped %d usage events costing $%.6f; released from the live budget counters", len(batch), cost)
+
+    async def write(
+        self,
+        batch: List[Dict[str, Any]],
+        before_commit: Optional[Callable[[Any], Awaitable[None]]] = None
+    ) -> None:
+        """Write a batch now, bypassing the queue; errors propagate
+        
+        For bulk producers that need to know their rows are durable.
+        `before_commit(db)` runs in the same transaction, e.g. to advance
+        a checkpoint, and can raise to roll the whole batch back.
+        """
+        await self._write(batch, before_commit)
+        USAGE_FLUSH_BATCH_SIZE.observe(len(batch))
+        USAGE_EVENTS_WRITTEN.inc(len(batch))
+
+    async def _write(
+        self,
+        batch: List[Dict[str, Any]],
+        before_commit: Optional[Callable[[Any], Awaitable[None]]] = None
+    ) -> None:
+        """Insert a batch of usage events with their ledger, rollup and cluster updates in one transaction"""
+        async with AsyncSessionLocal() as db:
+            try:
+                await assign_prompt_clusters(db, batch)
+                await db.execute(insert(UsageEvent), batch)
+                await apply_ledger_deltas(db, batch)
+                await apply_rollup_deltas(db, batch)
+                await apply_cluster_rollup_deltas(db, batch)
+                if before_commit is not None:
+                    await before_commit(db)
+                await db.commit()
+            except Exception:
+                await db.rollback()
+                raise
+
+
+usage_writer = UsageWriter(
+    max_queue_size=settings.USAGE_WRITER_QUEUE_SIZE,
+    batch_size=settings.USAGE_WRITER_BATCH_SIZE,
+    flush_interval=settings.USAGE_WRITER_FLUSH_INTERVAL,
+)
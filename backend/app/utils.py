@@ -1,25 +1,33 @@
+import asyncio
 import hashlib
-from typing import Optional, Dict, Any
+from typing import Optional, Dict, Any, Iterator, NamedTuple, Tuple
 from datetime import datetime, timedelta
-from sqlalchemy.orm import Session
-from sqlalchemy import func
+from sqlalchemy import func, select
+from sqlalchemy.ext.asyncio import AsyncSession
 from app.models import UsageEvent, VirtualKey
 from app.config import settings
+from app.ledger import spend_ledger
+from app.json_scan import dumps_canonical
+from app.near_duplicates import minhash
+from app.pricing import price_book
 
-def calculate_cost(provider: str, model: str, input_tokens: int, output_tokens: int) -> Dict[str, float]:
-    """Calculate cost based on provider, model, and token usage"""
-    pricing = settings.OPENAI_PRICING if provider == "openai" else settings.ANTHROPIC_PRICING
+def calculate_cost(
+    provider: str,
+    model: str,
+    input_tokens: int,
+    output_tokens: int,
+    at: Optional[datetime] = None,
+    price_ratio: float = 1.0
+) -> Dict[str, float]:
+    """Calculate cost from the prices in effect at `at` (default: now)
     
-    if model not in pricing:
-        # Default pricing if model not found
-        default_input = 1.0
-        default_output = 3.0
-    else:
-        default_input = pricing[model]["input"]
-        default_output = pricing[model]["output"]
+    `price_ratio` scales both prices, e.g. BATCH_PRICE_RATIO for Batch API calls.
+    """
+    input_price, output_price = price_book.lookup(provider, model, at)
+    input_price, output_price = input_price * price_ratio, output_price * price_ratio
     
-    input_cost = (input_tokens / 1_000_000) * default_input
-    output_cost = (output_tokens / 1_000_000) * default_output
+    input_cost = (input_tokens / 1_000_000) * input_price
+    output_cost = (output_tokens / 1_000_000) * output_price
     total_cost = input_cost + output_cost
     
     return {
@@ -28,58 +36,161 @@ def calculate_cost(provider: str, model: str, input_tokens: int, output_tokens:
         "total_cost": round(total_cost, 6)
     }
 
-def hash_prompt(messages: Optional[list] = None, prompt: Optional[str] = None, model: str = "") -> str:
-    """Create a hash of the prompt for duplicate detection"""
-    content = ""
+class PromptFingerprint(NamedTuple):
+    hash: str
+    chars: int
+    preview: str
+    signature: Optional[bytes] = None  # MinHash of the leading text, for near-duplicate detection
+
+# Long strings are encoded for hashing a slice at a time, so a huge prompt
+# never needs a second full-size copy in memory
+_HASH_CHUNK_CHARS = 1 << 20
+
+def _hash_text(hasher, text: str) -> None:
+    """Feed a string into a hash incrementally"""
+    if len(text) <= _HASH_CHUNK_CHARS:
+        hasher.update(text.encode())
+        return
+    for start in range(0, len(text), _HASH_CHUNK_CHARS):
+        hasher.update(text[start:start + _HASH_CHUNK_CHARS].encode())
+
+def _digest(text: str) -> str:
+    hasher = hashlib.sha256()
+    _hash_text(hasher, text)
+    return hasher.hexdigest()
+
+def _content_segments(content: Any) -> Iterator[Tuple[bool, str]]:
+    """Yield (is_text, segment) for one message's content
+    
+    Text parts are yielded as-is. Images and other non-text parts are
+    reduced to a short marker holding the digest of their data, so base64
+    blobs never enter the prompt hash, size or preview.
+    """
+    if content is None:
+        yield True, ""
+    elif isinstance(content, str):
+        yield True, content
+    elif isinstance(content, list):
+        for part in content:
+            if isinstance(part, str):
+                yield True, part
+            elif not isinstance(part, dict):
+                continue
+            elif part.get("type") == "text":
+                yield True, part.get("text") or ""
+            elif part.get("type") == "image_url":
+                image = part.get("image_url")
+                url = image.get("url", "") if isinstance(image, dict) else str(image or "")
+                yield False, f"[image_url:{_digest(url)}]"
+            elif part.get("type") == "image" and isinstance(part.get("source"), dict):
+                source = part["source"]
+                yield False, f"[image:{_digest(source.get('data') or source.get('url') or '')}]"
+            else:
+                yield False, f"[{part.get('type', 'part')}:{hashlib.sha256(dumps_canonical(part)).hexdigest()}]"
+    else:
+        yield True, str(content)
+
+def fingerprint_prompt(
+    messages: Optional[list] = None,
+    prompt: Optional[str] = None,
+    model: str = "",
+    max_preview_chars: int = 200
+) -> PromptFingerprint:
+    """Hash, measure and preview a prompt in a single pass over its parts
+    
+    Text is fed into an incremental SHA-256 instead of being joined into one
+    string first. For plain string contents the result matches hashing
+    `f"{model}:{' '.join(contents)}"`, so existing prompt hashes still match.
+    """
     if messages:
-        # Extract content from messages
-        content = " ".join([msg.get("content", "") for msg in messages if isinstance(msg, dict)])
+        segments = (
+            segment
+            for msg in messages if isinstance(msg, dict)
+            for segment in _content_segments(msg.get("content", ""))
+        )
     elif prompt:
-        content = prompt
+        segments = iter([(True, prompt)])
+    else:
+        segments = iter([])
     
     # Include model in hash for better detection
-    content_with_model = f"{model}:{content}"
-    return hashlib.sha256(content_with_model.encode()).hexdigest()
+    hasher = hashlib.sha256(f"{model}:".encode())
+    chars = 0
+    # The preview and the MinHash both come from the same leading sample
+    sample_parts = []
+    sample_room = max(max_preview_chars, settings.NEAR_DUPLICATE_SAMPLE_CHARS)
+    
+    def take(text: str) -> None:
+        nonlocal chars, sample_room
+        _hash_text(hasher, text)
+        chars += len(text)
+        if sample_room > 0:
+            piece = text[:sample_room]
+            sample_parts.append(piece)
+            sample_room -= len(piece)
+    
+    first = True
+    for is_text, segment in segments:
+        if not is_text:
+            hasher.update(segment.encode())
+            continue
+        if not first:
+            take(" ")
+        first = False
+        take(segment)
+    
+    sample = "".join(sample_parts)
+    return PromptFingerprint(hasher.hexdigest(), chars, sample[:max_preview_chars], minhash(sample))
+
+async def fingerprint_prompt_async(messages: Optional[list], model: str, size_hint: int) -> PromptFingerprint:
+    """Fingerprint a prompt, hashing very large requests in a worker thread
+    
+    `size_hint` is the request body size in bytes. hashlib releases the GIL
+    while hashing, so the event loop keeps serving other requests.
+    """
+    if size_hint >= settings.FINGERPRINT_OFFLOAD_BYTES:
+        return await asyncio.to_thread(fingerprint_prompt, messages, model=model)
+    return fingerprint_prompt(messages, model=model)
+
+def hash_prompt(messages: Optional[list] = None, prompt: Optional[str] = None, model: str = "") -> str:
+    """Create a hash of the prompt for duplicate detection"""
+    return fingerprint_prompt(messages, prompt, model).hash
+
+def hash_request(body: Dict[str, Any]) -> str:
+    """Create a hash of the full request body, independent of key order"""
+    return hashlib.sha256(dumps_canonical(body)).hexdigest()
 
 def extract_prompt_preview(messages: Optional[list] = None, prompt: Optional[str] = None, max_chars: int = 200) -> tuple[str, int]:
     """Extract a preview of the prompt and its character count"""
-    content = ""
-    if messages:
-        content = " ".join([msg.get("content", "") for msg in messages if isinstance(msg, dict)])
-    elif prompt:
-        content = prompt
-    
-    char_count = len(content)
-    preview = content[:max_chars] if len(content) > max_chars else content
-    return preview, char_count
+    fingerprint = fingerprint_prompt(messages, prompt, max_preview_chars=max_chars)
+    return fingerprint.preview, fingerprint.chars
+
+def estimate_request_cost(provider: str, model: str, prompt_chars: int, max_output_tokens: Optional[int] = None) -> float:
+    """Estimate the worst-case cost of a request before it is sent upstream"""
+    # Rough: 1 token ≈ 4 chars; output is bounded by the request's max_tokens
+    input_tokens = prompt_chars // 4
+    output_tokens = settings.BUDGET_RESERVATION_OUTPUT_TOKENS if max_output_tokens is None else max_output_tokens
+    return calculate_cost(provider, model, input_tokens, output_tokens)["total_cost"]
 
-def check_budget_limits(db: Session, virtual_key: VirtualKey) -> tuple[bool, Optional[str]]:
+async def check_budget_limits(virtual_key) -> tuple[bool, Optional[str]]:
     """Check if virtual key has exceeded budget limits"""
     if not virtual_key.is_active:
         return False, "Virtual key is inactive"
     
-    # Check monthly budget cap
-    if virtual_key.monthly_budget_cap:
-        now = datetime.utcnow()
-        month_start = datetime(now.year, now.month, 1)
-        
-        monthly_spend = db.query(
-            func.sum(UsageEvent.total_cost)
-        ).filter(
-            UsageEvent.virtual_key_id == virtual_key.id,
-            UsageEvent.created_at >= month_start
-        ).scalar() or 0.0
-        
-        if monthly_spend >= virtual_key.monthly_budget_cap:
-            return False, f"Monthly budget cap of ${virtual_key.monthly_budget_cap} exceeded"
+    # Check the monthly caps of the key, its project, team and organization against the running spend ledger
+    exceeded = await spend_ledger.exceeded(virtual_key.budget_scopes)
+    if exceeded is not None:
+        return False, f"Monthly budget cap of ${exceeded.cap}{exceeded.qualifier} exceeded"
     
     return True, None
 
-def detect_repeated_prompts(db: Session, prompt_hash: str, hours: int = 24) -> int:
+async def detect_repeated_prompts(db: AsyncSession, prompt_hash: str, hours: int = 24) -> int:
     """Detect how many times this prompt hash has been used recently"""
     cutoff = datetime.utcnow() - timedelta(hours=hours)
-    count = db.query(UsageEvent).filter(
-        UsageEvent.prompt_hash == prompt_hash,
-        UsageEvent.created_at >= cutoff
-    ).count()
-    return count
+    count = await db.scalar(
+        select(func.count(UsageEvent.id)).where(
+            UsageEvent.prompt_hash == prompt_hash,
+            UsageEvent.created_at >= cutoff
+        )
+    )
+    return count or 0
@@ -0,0 +1,159 @@
+"""Measure Batch API result accounting throughput and memory by file size
+
+Usage: python benchmarks/bench_batch_accounting.py [--lines 10000,100000,300000] [--chunk-size 1000]
+
+Starts the mock upstream (a separate process), then for each size uploads
+an input file of that many chat requests through the proxy, submits it as
+a batch and accounts its result files, which the mock generates as they
+are streamed. For each size it prints result lines per second, the peak
+Python memory allocated while accounting (tracemalloc, which also slows
+it down) and whether the recorded events and cost match the batch. The
+peak should stay flat as files grow.
+"""
+import sys
+import os
+import argparse
+import asyncio
+import json
+import subprocess
+import tempfile
+import time
+import tracemalloc
+sys.path.insert(0, os.path.dirname(os.path.dirname(__file__)))
+
+import httpx
+
+BACKEND_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+VIRTUAL_KEY = "vk_bench_batches"
+
+
+def start_mock(port: int) -> subprocess.Popen:
+    process = subprocess.Popen(
+        [sys.executable, "benchmarks/mock_upstream.py", "--port", str(port), "--error-rate", "0.01"],
+        cwd=BACKEND_DIR
+    )
+    deadline = time.time() + 15
+    while time.time() < deadline:
+        try:
+            httpx.get(f"http://127.0.0.1:{port}/docs", timeout=0.5)
+            return process
+        except httpx.HTTPError:
+            time.sleep(0.1)
+    process.terminate()
+    raise RuntimeError("Mock upstream did not start")
+
+
+def create_key() -> None:
+    from app.database import Base, SessionLocal, engine
+    from app.models import VirtualKey
+
+    Base.metadata.create_all(bind=engine)
+    db = SessionLocal()
+    try:
+        db.add(VirtualKey(key=VIRTUAL_KEY, name="Batch API benchmark"))
+        db.commit()
+    finally:
+        db.close()
+
+
+def input_file(lines: int) -> bytes:
+    return b"".join(
+        json.dumps({
+            "custom_id": f"request-{index}",
+            "method": "POST",
+            "url": "/v1/chat/completions",
+            "body": {
+                "model": "gpt-4o-mini",
+                "messages": [{"role": "user", "content": f"Summarize document number {index}"}],
+                "max_tokens": 200
+            }
+        }).encode() + b"\n"
+        for index in range(lines)
+    )
+
+
+async def submit(client: httpx.AsyncClient, lines: int) -> str:
+    """Upload an input file and create a batch for it; returns the batch id"""
+    headers = {"X-Virtual-Key": VIRTUAL_KEY}
+    response = await client.post(
+        "/proxy/openai/v1/files", headers=headers, data={"purpose": "batch"},
+        files={"file": ("input.jsonl", input_file(lines), "application/jsonl")}
+    )
+    response.raise_for_status()
+    response = await client.post("/proxy/openai/v1/batches", headers=headers, json={
+        "input_file_id": response.json()["id"], "endpoint": "/v1/chat/completions", "completion_window": "24h"
+    })
+    response.raise_for_status()
+    return response.json()["id"]
+
+
+async def totals(batch_id: str):
+    from sqlalchemy import func, select
+    from app.database import AsyncSessionLocal
+    from app.models import BatchJob, UsageEvent
+
+    async with AsyncSessionLocal() as db:
+        events, cost = (await db.execute(
+            select(func.count(), func.sum(UsageEvent.total_cost)).where(UsageEvent.batch_id == batch_id)
+        )).one()
+        job = await db.get(BatchJob, batch_id)
+    return events, cost or 0.0, job
+
+
+async def run(args):
+    create_key()
+
+    from app.main import app
+    from app.batches import batch_accountant
+    from app.config import settings
+
+    settings.BATCH_ACCOUNTING_CHUNK_SIZE = args.chunk_size
+    transport = httpx.ASGITransport(app=app)
+    async with app.router.lifespan_context(app):
+        async with httpx.AsyncClient(transport=transport, base_url="http://proxy", timeout=600) as client:
+            print(f"{'lines':>9} {'lines/s':>9} {'peak MB':>8} {'events':>9} {'cost $':>10} {'matches':>8}")
+            for lines in args.lines:
+                batch_id = await submit(client, lines)
+                tracemalloc.start()
+                start = time.perf_counter()
+                # The mock completes the batch on this poll, which starts accounting in the background
+                response = await client.get(
+                    f"/proxy/openai/v1/batches/{batch_id}", headers={"X-Virtual-Key": VIRTUAL_KEY}
+                )
+                response.raise_for_status()
+                task = batch_accountant._tasks.get(batch_id)
+                if task is not None:
+                    await task
+                seconds = time.perf_counter() - start
+                _, peak = tracemalloc.get_traced_memory()
+                tracemalloc.stop()
+                events, cost, job = await totals(batch_id)
+                matches = events == lines == job.accounted_lines and abs(cost - job.actual_cost) < 1e-6
+                print(f"{lines:>9} {lines / seconds:>9.0f} {peak / 2**20:>8.1f} {events:>9} {cost:>10.4f} "
+                      f"{'yes' if matches else 'NO':>8}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--lines", type=lambda value: [int(item) for item in value.split(",")],
+                        default=[10000, 100000, 300000], help="Comma-separated result file sizes")
+    parser.add_argument("--chunk-size", type=int, default=1000, help="BATCH_ACCOUNTING_CHUNK_SIZE")
+    parser.add_argument("--port", type=int, default=9610, help="Mock upstream port")
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp(prefix="aca-bench-")
+    os.environ["DATABASE_URL"] = f"sqlite:///{os.path.join(workdir, 'bench.db')}"
+    os.environ["OPENAI_BASE_URL"] = f"http://127.0.0.1:{args.port}"
+    os.environ["OPENAI_API_KEY"] = "sk-bench"
+    os.chdir(BACKEND_DIR)
+
+    mock = start_mock(args.port)
+    try:
+        asyncio.run(run(args))
+    finally:
+        mock.terminate()
+        mock.wait()
+
+
+if __name__ == "__main__":
+    main()
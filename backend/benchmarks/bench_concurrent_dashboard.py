@@ -0,0 +1,186 @@
+"""Measure proxy throughput with and without concurrent dashboard queries
+
+Usage: python benchmarks/bench_concurrent_dashboard.py [--events 200000] [--seconds 10]
+
+Starts a mock upstream and the API server in subprocesses against a fresh
+SQLite database (or --database-url), seeds it with synthetic usage events,
+then drives /proxy/openai/v1/chat/completions alone and again while other
+clients hammer the dashboard endpoints. If database calls block the event
+loop, proxy throughput collapses in the second phase.
+"""
+import sys
+import os
+import argparse
+import asyncio
+import random
+import subprocess
+import tempfile
+import time
+from datetime import datetime, timedelta
+sys.path.insert(0, os.path.dirname(os.path.dirname(__file__)))
+
+import httpx
+
+BACKEND_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+VIRTUAL_KEY = "vk_demo_key_for_testing_only"
+
+
+def percentile(samples, pct):
+    """Return the pct-th percentile of a list of samples"""
+    ordered = sorted(samples)
+    index = min(len(ordered) - 1, int(round(pct / 100 * (len(ordered) - 1))))
+    return ordered[index]
+
+
+def seed(database_url: str, events: int) -> None:
+    """Create the demo data plus `events` synthetic usage events"""
+    os.environ["DATABASE_URL"] = database_url
+    from sqlalchemy import insert
+    from scripts.seed import seed_data
+    from app.database import SessionLocal
+    from app.models import UsageEvent
+
+    seed_data()
+    db = SessionLocal()
+    try:
+        now = datetime.utcnow()
+        models = ["gpt-4o", "gpt-4o-mini", "claude-3-haiku-20240307"]
+        batch = []
+        for i in range(events):
+            batch.append({
+                "virtual_key_id": 1,
+                "provider": "openai",
+                "model": random.choice(models),
+                "input_tokens": 100,
+                "output_tokens": 200,
+                "total_tokens": 300,
+                "input_cost": 0.0001,
+                "output_cost": 0.0002,
+                "total_cost": 0.0003,
+                "prompt_hash": f"{random.randrange(events // 10 + 1):064x}",
+                "prompt_chars": 400,
+                "prompt_preview": "benchmark prompt",
+                "status_code": 200,
+                "was_blocked": False,
+                "created_at": now - timedelta(seconds=random.randrange(30 * 86400)),
+            })
+            if len(batch) == 10000:
+                db.execute(insert(UsageEvent), batch)
+                batch = []
+        if batch:
+            db.execute(insert(UsageEvent), batch)
+        db.commit()
+    finally:
+        db.close()
+
+
+def start_process(args, env):
+    """Start a subprocess in the backend directory"""
+    return subprocess.Popen(args, cwd=BACKEND_DIR, env=env,
+                            stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+
+async def wait_until_up(url: str) -> None:
+    async with httpx.AsyncClient() as client:
+        for _ in range(200):
+            try:
+                await client.get(url)
+                return
+            except httpx.TransportError:
+                await asyncio.sleep(0.05)
+    raise RuntimeError(f"{url} did not start")
+
+
+async def drive(api_url: str, seconds: float, proxy_clients: int, dashboard_clients: int):
+    """Run proxy (and optionally dashboard) clients for a fixed duration"""
+    limits = httpx.Limits(max_connections=proxy_clients + dashboard_clients + 4)
+    async with httpx.AsyncClient(base_url=api_url, timeout=10.0, limits=limits) as client:
+        token = (await client.post(
+            "/api/auth/token", data={"username": "admin@local", "password": "admin123"}
+        )).json()["access_token"]
+        auth = {"Authorization": f"Bearer {token}"}
+        deadline = time.perf_counter() + seconds
+        latencies = []
+        errors = 0
+        dashboard_calls = 0
+
+        async def proxy_worker():
+            nonlocal errors
+            body = {"model": "gpt-4o-mini", "messages": [{"role": "user", "content": "Hello"}]}
+            while time.perf_counter() < deadline:
+                start = time.perf_counter()
+                try:
+                    response = await client.post(
+                        "/proxy/openai/v1/chat/completions", json=body, headers={"X-Virtual-Key": VIRTUAL_KEY}
+                    )
+                    response.raise_for_status()
+                except httpx.HTTPError:
+                    errors += 1
+                    continue
+                latencies.append(time.perf_counter() - start)
+
+        async def dashboard_worker():
+            nonlocal dashboard_calls
+            paths = ["/api/metrics/overview", "/api/admin/usage-events?limit=1000"]
+            while time.perf_counter() < deadline:
+                try:
+                    await client.get(random.choice(paths), headers=auth)
+                except httpx.HTTPError:
+                    continue
+                dashboard_calls += 1
+
+        await asyncio.gather(
+            *(proxy_worker() for _ in range(proxy_clients)),
+            *(dashboard_worker() for _ in range(dashboard_clients))
+        )
+        return latencies, errors, dashboard_calls
+
+
+def report(name, latencies, errors, dashboard_calls, seconds):
+    ms = [s * 1000 for s in latencies] or [float("nan")]
+    print(f"{name:<20} proxy rps={len(latencies) / seconds:8.1f}  p50={percentile(ms, 50):7.2f}ms  "
+          f"p99={percentile(ms, 99):8.2f}ms  errors={errors}  dashboard calls={dashboard_calls}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--events", type=int, default=200000)
+    parser.add_argument("--seconds", type=float, default=10.0)
+    parser.add_argument("--proxy-clients", type=int, default=16)
+    parser.add_argument("--dashboard-clients", type=int, default=4)
+    parser.add_argument("--database-url", default=None)
+    parser.add_argument("--api-port", type=int, default=9200)
+    parser.add_argument("--mock-port", type=int, default=9201)
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp(prefix="aca-bench-")
+    database_url = args.database_url or f"sqlite:///{os.path.join(workdir, 'bench.db')}"
+    seed(database_url, args.events)
+
+    env = {
+        **os.environ,
+        "DATABASE_URL": database_url,
+        "OPENAI_API_KEY": "sk-bench",
+        "OPENAI_BASE_URL": f"http://127.0.0.1:{args.mock_port}",
+    }
+    mock = start_process([sys.executable, "benchmarks/mock_upstream.py", "--port", str(args.mock_port)], env)
+    api = start_process([sys.executable, "-m", "uvicorn", "app.main:app", "--port", str(args.api_port),
+                         "--log-level", "warning", "--no-access-log"], env)
+    api_url = f"http://127.0.0.1:{args.api_port}"
+    try:
+        asyncio.run(wait_until_up(f"http://127.0.0.1:{args.mock_port}/docs"))
+        asyncio.run(wait_until_up(f"{api_url}/healthz"))
+        alone = asyncio.run(drive(api_url, args.seconds, args.proxy_clients, 0))
+        mixed = asyncio.run(drive(api_url, args.seconds, args.proxy_clients, args.dashboard_clients))
+    finally:
+        api.terminate()
+        mock.terminate()
+        api.wait()
+        mock.wait()
+
+    report("proxy only", *alone, args.seconds)
+    report("proxy + dashboard", *mixed, args.seconds)
+
+
+if __name__ == "__main__":
+    main()
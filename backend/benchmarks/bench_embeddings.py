@@ -0,0 +1,141 @@
+"""Compare embeddings throughput with and without micro-batching
+
+Usage: python benchmarks/bench_embeddings.py [--requests 5000] [--concurrency 256] [--latency-ms 20]
+                                             [--window-ms 5]
+
+Starts the mock upstream (a separate process) with the given latency and
+drives the API over ASGI in this process with single-input embedding
+requests, once sending each upstream on its own and once with batching on.
+For each run it prints requests per second, client latency percentiles,
+the number of upstream calls and the tokens billed to the callers, which
+should match the upstream's total in both runs. Adaptive concurrency is
+off so the second run doesn't inherit a limit learned by the first.
+"""
+import sys
+import os
+import argparse
+import asyncio
+import subprocess
+import tempfile
+import time
+sys.path.insert(0, os.path.dirname(os.path.dirname(__file__)))
+
+import httpx
+
+BACKEND_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+VIRTUAL_KEY = "vk_bench_embeddings"
+
+
+def percentile(samples, pct):
+    """Return the pct-th percentile of a list of samples"""
+    ordered = sorted(samples)
+    index = min(len(ordered) - 1, int(round(pct / 100 * (len(ordered) - 1))))
+    return ordered[index]
+
+
+def start_mock(port: int, latency_ms: float) -> subprocess.Popen:
+    process = subprocess.Popen(
+        [sys.executable, "benchmarks/mock_upstream.py", "--port", str(port), "--latency-ms", str(latency_ms)],
+        cwd=BACKEND_DIR
+    )
+    deadline = time.time() + 15
+    while time.time() < deadline:
+        try:
+            httpx.get(f"http://127.0.0.1:{port}/docs", timeout=0.5)
+            return process
+        except httpx.HTTPError:
+            time.sleep(0.1)
+    process.terminate()
+    raise RuntimeError("Mock upstream did not start")
+
+
+def create_key() -> None:
+    from app.database import Base, SessionLocal, engine
+    from app.models import VirtualKey
+
+    Base.metadata.create_all(bind=engine)
+    db = SessionLocal()
+    try:
+        db.add(VirtualKey(key=VIRTUAL_KEY, name="Embeddings benchmark"))
+        db.commit()
+    finally:
+        db.close()
+
+
+def upstream_calls() -> float:
+    from prometheus_client import REGISTRY
+
+    return REGISTRY.get_sample_value("upstream_attempts_total", {"provider": "openai", "kind": "first"}) or 0.0
+
+
+async def drive(client: httpx.AsyncClient, requests: int, concurrency: int):
+    """Send the requests; return (latencies in ms, tokens billed, failures, seconds)"""
+    headers = {"X-Virtual-Key": VIRTUAL_KEY}
+    latencies = []
+    tokens = failures = 0
+    counter = iter(range(requests))
+
+    async def worker():
+        nonlocal tokens, failures
+        for index in counter:
+            body = {"model": "text-embedding-3-small", "input": f"Embedding benchmark document number {index}"}
+            start = time.perf_counter()
+            response = await client.post("/proxy/openai/v1/embeddings", json=body, headers=headers)
+            latencies.append((time.perf_counter() - start) * 1000)
+            if response.status_code == 200:
+                tokens += response.json()["usage"]["prompt_tokens"]
+            else:
+                failures += 1
+
+    start = time.perf_counter()
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+    return latencies, tokens, failures, time.perf_counter() - start
+
+
+async def run(args):
+    create_key()
+
+    from app.main import app
+    from app.embeddings import embedding_batcher
+
+    embedding_batcher.window = args.window_ms / 1000
+    transport = httpx.ASGITransport(app=app)
+    async with app.router.lifespan_context(app):
+        async with httpx.AsyncClient(transport=transport, base_url="http://proxy", timeout=120) as client:
+            print(f"{'mode':<10} {'req/s':>8} {'p50 ms':>8} {'p99 ms':>8} {'upstream':>9} {'tokens':>8} {'failed':>7}")
+            for batching in (False, True):
+                embedding_batcher.enabled = batching
+                calls_before = upstream_calls()
+                latencies, tokens, failures, seconds = await drive(client, args.requests, args.concurrency)
+                print(f"{'batched' if batching else 'unbatched':<10} {args.requests / seconds:>8.0f} "
+                      f"{percentile(latencies, 50):>8.1f} {percentile(latencies, 99):>8.1f} "
+                      f"{upstream_calls() - calls_before:>9.0f} {tokens:>8} {failures:>7}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--requests", type=int, default=5000)
+    parser.add_argument("--concurrency", type=int, default=256)
+    parser.add_argument("--latency-ms", type=float, default=20.0, help="Mock upstream latency per call")
+    parser.add_argument("--window-ms", type=float, default=5.0, help="EMBEDDINGS_BATCH_WINDOW in ms")
+    parser.add_argument("--port", type=int, default=9600, help="Mock upstream port")
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp(prefix="aca-bench-")
+    os.environ["DATABASE_URL"] = f"sqlite:///{os.path.join(workdir, 'bench.db')}"
+    os.environ["OPENAI_BASE_URL"] = f"http://127.0.0.1:{args.port}"
+    os.environ["OPENAI_API_KEY"] = "sk-bench"
+    os.environ["CONCURRENCY_ENABLED"] = "false"
+    os.environ["KEY_CACHE_TTL"] = "3600"
+    os.chdir(BACKEND_DIR)
+
+    mock = start_mock(args.port, args.latency_ms)
+    try:
+        asyncio.run(run(args))
+    finally:
+        mock.terminate()
+        mock.wait()
+
+
+if __name__ == "__main__":
+    main()
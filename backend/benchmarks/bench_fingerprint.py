@@ -0,0 +1,106 @@
+"""Microbenchmark prompt fingerprinting: joined strings vs a single incremental pass
+
+Usage: python benchmarks/bench_fingerprint.py [--sizes 1KB,10KB,100KB,1MB,10MB,20MB] [--repeat 5]
+
+"joined" is the previous implementation: hash_prompt and
+extract_prompt_preview each join every message content into one string.
+"single-pass" is utils.fingerprint_prompt. Peak memory is the extra
+allocation measured by tracemalloc. The multimodal case adds a base64 image
+part of the same size, which the joined version cannot handle.
+"""
+import sys
+import os
+import argparse
+import hashlib
+import statistics
+import time
+import tracemalloc
+sys.path.insert(0, os.path.dirname(os.path.dirname(__file__)))
+
+from app.utils import fingerprint_prompt
+
+UNITS = {"KB": 1024, "MB": 1024 * 1024}
+
+
+def parse_size(text: str) -> int:
+    """Parse sizes such as 512, 10KB or 1MB"""
+    text = text.strip().upper()
+    for unit, factor in UNITS.items():
+        if text.endswith(unit):
+            return int(float(text[:-len(unit)]) * factor)
+    return int(text)
+
+
+def joined_fingerprint(messages, model):
+    """The old hash_prompt + extract_prompt_preview pair"""
+    content = " ".join([msg.get("content", "") for msg in messages if isinstance(msg, dict)])
+    prompt_hash = hashlib.sha256(f"{model}:{content}".encode()).hexdigest()
+    content = " ".join([msg.get("content", "") for msg in messages if isinstance(msg, dict)])
+    return prompt_hash, len(content), content[:200]
+
+
+def single_pass_fingerprint(messages, model):
+    return fingerprint_prompt(messages, model=model)
+
+
+def text_messages(size: int):
+    """A ten-turn conversation whose contents add up to `size` characters"""
+    turns = 10
+    return [
+        {"role": "user" if i % 2 == 0 else "assistant", "content": "x" * max(1, size // turns)}
+        for i in range(turns)
+    ]
+
+
+def multimodal_messages(size: int):
+    """One user turn with a short text part and a base64 image of `size` bytes"""
+    return [{
+        "role": "user",
+        "content": [
+            {"type": "text", "text": "What is in this image?"},
+            {"type": "image_url", "image_url": {"url": "data:image/png;base64," + "A" * size}},
+        ]
+    }]
+
+
+def measure(function, messages, repeat: int):
+    """Return (median ms, peak extra MB), or None if the function can't handle the input"""
+    try:
+        function(messages, "gpt-4o")
+    except TypeError:
+        return None
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        function(messages, "gpt-4o")
+        timings.append((time.perf_counter() - start) * 1000)
+    tracemalloc.start()
+    function(messages, "gpt-4o")
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return statistics.median(timings), peak / 1024 / 1024
+
+
+def format_result(result):
+    if result is None:
+        return f"{'n/a':>10}  {'n/a':>9}"
+    return f"{result[0]:>10.3f}  {result[1]:>9.2f}"
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--sizes", default="1KB,10KB,100KB,1MB,10MB,20MB")
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+
+    print(f"{'case':<11} {'size':>10}  {'joined ms':>10}  {'joined MB':>9}  {'1-pass ms':>10}  {'1-pass MB':>9}")
+    for name, build in (("text", text_messages), ("multimodal", multimodal_messages)):
+        for size in (parse_size(size) for size in args.sizes.split(",")):
+            messages = build(size)
+            joined = measure(joined_fingerprint, messages, args.repeat)
+            single = measure(single_pass_fingerprint, messages, args.repeat)
+            print(f"{name:<11} {size:>10}  {format_result(joined)}  {format_result(single)}")
+
+
+if __name__ == "__main__":
+    main()
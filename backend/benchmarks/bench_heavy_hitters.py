@@ -0,0 +1,197 @@
+"""Compare the heavy-hitter summaries against the exact repeated-prompt query
+
+Usage: python benchmarks/bench_heavy_hitters.py [--events 1000000] [--prompts 200000] [--epsilons 0.01,0.001,0.0001]
+
+Generates a week of usage events whose prompt hashes follow a Zipf
+distribution, spread over a number of virtual keys, and stores them in a
+fresh SQLite database. The previous overview query (GROUP BY prompt_hash
+over seven days of raw events) gives the exact top 10. For each epsilon
+the same stream is fed through app.heavy_hitters, and the script reports
+how many of the exact top 10 it found, the count and waste errors on
+those, the summaries' memory, ingest cost per event and read latency,
+for the global scope and for the busiest virtual key.
+"""
+import sys
+import os
+import argparse
+import asyncio
+import bisect
+import hashlib
+import random
+import statistics
+import tempfile
+import time
+import tracemalloc
+from datetime import datetime, timedelta
+sys.path.insert(0, os.path.dirname(os.path.dirname(__file__)))
+
+
+def zipf_sampler(rng: random.Random, items: int, exponent: float):
+    """Draw item ranks with probability proportional to 1 / rank ** exponent"""
+    cumulative = []
+    total = 0.0
+    for rank in range(1, items + 1):
+        total += 1 / rank ** exponent
+        cumulative.append(total)
+    return lambda: bisect.bisect_left(cumulative, rng.random() * total)
+
+
+def generate_events(args):
+    rng = random.Random(args.seed)
+    draw = zipf_sampler(rng, args.prompts, args.exponent)
+    hashes = [hashlib.sha256(str(index).encode()).hexdigest() for index in range(args.prompts)]
+    costs = [rng.uniform(0.0005, 0.05) for _ in range(args.prompts)]
+    now = datetime.utcnow()
+    events = []
+    for _ in range(args.events):
+        prompt = draw()
+        events.append({
+            "virtual_key_id": 1 + min(int(rng.expovariate(0.3)), args.keys - 1),
+            "provider": "openai",
+            "model": "gpt-4o-mini",
+            "prompt_hash": hashes[prompt],
+            "total_cost": costs[prompt],
+            "created_at": now - timedelta(seconds=rng.uniform(0, 6.5 * 86400)),
+        })
+    return events
+
+
+def store_events(events) -> None:
+    from sqlalchemy import insert
+    from app.database import Base, SessionLocal, engine
+    from app.models import UsageEvent
+
+    Base.metadata.create_all(bind=engine)
+    db = SessionLocal()
+    try:
+        for start in range(0, len(events), 20000):
+            db.execute(insert(UsageEvent), events[start:start + 20000])
+        db.commit()
+    finally:
+        db.close()
+
+
+def exact_top(virtual_key_id=None):
+    """The overview's previous query, returning (rows, seconds)"""
+    from sqlalchemy import func
+    from app.database import SessionLocal
+    from app.models import UsageEvent
+
+    db = SessionLocal()
+    try:
+        start = time.perf_counter()
+        query = db.query(
+            UsageEvent.prompt_hash,
+            func.count(UsageEvent.id).label('count'),
+            func.sum(UsageEvent.total_cost).label('total_cost')
+        ).filter(
+            UsageEvent.created_at >= datetime.utcnow() - timedelta(days=7),
+            UsageEvent.prompt_hash.isnot(None)
+        )
+        if virtual_key_id is not None:
+            query = query.filter(UsageEvent.virtual_key_id == virtual_key_id)
+        rows = query.group_by(UsageEvent.prompt_hash).having(
+            func.count(UsageEvent.id) > 1
+        ).order_by(func.count(UsageEvent.id).desc()).limit(10).all()
+        return rows, time.perf_counter() - start
+    finally:
+        db.close()
+
+
+async def sketch_top(hitters, scope_type, scope_id):
+    from app.database import AsyncSessionLocal
+
+    async with AsyncSessionLocal() as db:
+        timings = []
+        for _ in range(20):
+            start = time.perf_counter()
+            summary = await hitters.top(db, scope_type, [scope_id], days=7)
+            entries = summary.top(10)
+            timings.append(time.perf_counter() - start)
+    return entries, statistics.median(timings)
+
+
+def compare(exact_rows, entries):
+    """(top-10 found, median and max relative count error, relative waste error) on the exact top 10"""
+    from app.heavy_hitters import estimated_repeat_cost
+
+    found = {item: (count, error, cost) for item, count, error, cost in entries}
+    count_errors = []
+    exact_waste = sketch_waste = 0.0
+    for row in exact_rows:
+        exact_waste += (row.count - 1) * (row.total_cost / row.count)
+        if row.prompt_hash in found:
+            count, error, cost = found[row.prompt_hash]
+            count_errors.append(abs(count - row.count) / row.count)
+    for count, error, cost in found.values():
+        sketch_waste += estimated_repeat_cost(count, error, cost)
+    waste_error = abs(sketch_waste - exact_waste) / exact_waste if exact_waste else 0.0
+    return (
+        len(count_errors),
+        statistics.median(count_errors) if count_errors else float("nan"),
+        max(count_errors) if count_errors else float("nan"),
+        waste_error,
+    )
+
+
+async def run(args):
+    from app.heavy_hitters import HeavyHitters
+
+    print(f"generating {args.events} events over {args.prompts} prompts (zipf s={args.exponent})")
+    events = generate_events(args)
+    store_events(events)
+    busiest_key = statistics.mode(event["virtual_key_id"] for event in events)
+    exact_global, exact_global_seconds = exact_top()
+    exact_key, exact_key_seconds = exact_top(busiest_key)
+    print(f"exact query: global {exact_global_seconds * 1000:.1f} ms, key {exact_key_seconds * 1000:.1f} ms")
+    print()
+    print(f"{'epsilon':>8}  {'scope':<6}  {'top10':>5}  {'cnt err p50':>11}  {'cnt err max':>11}  "
+          f"{'waste err':>9}  {'memory MB':>9}  {'us/event':>8}  {'read ms':>7}")
+
+    for epsilon in (float(value) for value in args.epsilons.split(",")):
+        def feed():
+            hitters = HeavyHitters(
+                epsilon=epsilon, scope_epsilon=epsilon * 10, window_days=7, checkpoint_interval=3600
+            )
+            for event in events:
+                hitters.observe(event["prompt_hash"], event["total_cost"], event["virtual_key_id"], None, event["created_at"])
+            return hitters
+
+        # Timed without tracemalloc, which slows allocation down
+        start = time.perf_counter()
+        hitters = feed()
+        feed_seconds = time.perf_counter() - start
+        tracemalloc.start()
+        feed()
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+
+        for scope, scope_type, scope_id, exact_rows in (
+            ("global", "global", 0, exact_global),
+            ("key", "virtual_key", busiest_key, exact_key),
+        ):
+            entries, read_seconds = await sketch_top(hitters, scope_type, scope_id)
+            found, error_p50, error_max, waste_error = compare(exact_rows, entries)
+            print(f"{epsilon:>8g}  {scope:<6}  {found:>5}  {error_p50:>11.2%}  {error_max:>11.2%}  "
+                  f"{waste_error:>9.2%}  {peak / 1024 / 1024:>9.1f}  "
+                  f"{feed_seconds / len(events) * 1e6:>8.2f}  {read_seconds * 1000:>7.2f}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--events", type=int, default=1000000)
+    parser.add_argument("--prompts", type=int, default=200000, help="Distinct prompt hashes")
+    parser.add_argument("--exponent", type=float, default=1.1, help="Zipf exponent of prompt popularity")
+    parser.add_argument("--keys", type=int, default=50, help="Virtual keys the events are spread over")
+    parser.add_argument("--epsilons", default="0.01,0.001,0.0001")
+    parser.add_argument("--seed", type=int, default=11)
+    parser.add_argument("--database-url", default=None, help="Defaults to a fresh SQLite file")
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp(prefix="aca-bench-")
+    os.environ["DATABASE_URL"] = args.database_url or f"sqlite:///{os.path.join(workdir, 'bench.db')}"
+    asyncio.run(run(args))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,152 @@
+"""Measure near-duplicate clustering throughput and quality as the index grows
+
+Usage: python benchmarks/bench_near_duplicates.py [--events 200000] [--batch-size 500] [--templates 200]
+
+Generates prompts from a set of templates with varying names, numbers and
+dates, mixed with unique one-off prompts, and clusters them batch by batch
+the way the usage writer does. Per-batch latency should stay flat as the
+LSH index grows, since each batch costs a few indexed band lookups rather
+than a comparison against every stored prompt. Quality is reported as the
+share of each template's prompts that land in its largest cluster, and the
+number of one-off prompts wrongly merged into a template's cluster.
+"""
+import sys
+import os
+import argparse
+import asyncio
+import random
+import statistics
+import tempfile
+import time
+from collections import Counter, defaultdict
+from datetime import datetime
+sys.path.insert(0, os.path.dirname(os.path.dirname(__file__)))
+
+WORDS = (
+    "account order invoice refund shipping delay customer ticket error page login password reset "
+    "summarize explain translate draft reply email report product feature request bug crash payment "
+    "subscription plan upgrade cancel warehouse inventory forecast quarterly revenue region manager "
+    "policy contract clause review risk compliance audit schedule meeting notes action items"
+).split()
+NAMES = ["alice", "bob", "carol", "dave", "erin", "frank", "grace", "heidi", "ivan", "judy"]
+
+
+def percentile(values, pct):
+    values = sorted(values)
+    index = min(len(values) - 1, int(len(values) * pct / 100))
+    return values[index]
+
+
+def random_sentence(rng: random.Random, words: int) -> str:
+    return " ".join(rng.choice(WORDS) for _ in range(words))
+
+
+def build_templates(rng: random.Random, count: int):
+    """Templates of a few sentences with slots for a name, a number and a date"""
+    return [
+        f"{random_sentence(rng, 25)} for {{name}} regarding #{{number}} on {{date}}. {random_sentence(rng, 40)}"
+        for _ in range(count)
+    ]
+
+
+def generate(rng: random.Random, templates, unique_share: float):
+    """Yield (template index or None, prompt text)"""
+    while True:
+        if rng.random() < unique_share:
+            yield None, random_sentence(rng, 60)
+            continue
+        index = rng.randrange(len(templates))
+        yield index, templates[index].format(
+            name=rng.choice(NAMES),
+            number=rng.randrange(1, 10 ** 6),
+            date=f"2026-{rng.randrange(1, 13):02d}-{rng.randrange(1, 29):02d}"
+        )
+
+
+async def run(args):
+    from app.database import AsyncSessionLocal, Base, engine
+    from app.near_duplicates import apply_cluster_rollup_deltas, assign_prompt_clusters, minhash
+
+    Base.metadata.create_all(bind=engine)
+    rng = random.Random(args.seed)
+    templates = build_templates(rng, args.templates)
+    prompts = generate(rng, templates, args.unique_share)
+
+    assignments = []  # (template index or None, cluster id)
+    latencies = []
+    fingerprint_seconds = 0.0
+    print(f"{'events':>10}  {'batch p50 ms':>12}  {'batch p95 ms':>12}  {'events/s':>9}")
+    window_start = time.perf_counter()
+    window_latencies = []
+    window_events = 0
+    for batch_start in range(0, args.events, args.batch_size):
+        batch = []
+        sources = []
+        for _ in range(min(args.batch_size, args.events - batch_start)):
+            source, text = next(prompts)
+            start = time.perf_counter()
+            signature = minhash(text)
+            fingerprint_seconds += time.perf_counter() - start
+            sources.append(source)
+            batch.append({
+                "virtual_key_id": 1, "model": "gpt-4o-mini", "prompt_hash": None,
+                "prompt_signature": signature, "total_cost": 0.001, "created_at": datetime.utcnow()
+            })
+        start = time.perf_counter()
+        async with AsyncSessionLocal() as db:
+            await assign_prompt_clusters(db, batch)
+            await apply_cluster_rollup_deltas(db, batch)
+            await db.commit()
+        elapsed = (time.perf_counter() - start) * 1000
+        latencies.append(elapsed)
+        window_latencies.append(elapsed)
+        window_events += len(batch)
+        assignments.extend(zip(sources, (event["prompt_cluster_id"] for event in batch)))
+
+        done = batch_start + len(batch)
+        if done % args.report_every < args.batch_size or done == args.events:
+            rate = window_events / (time.perf_counter() - window_start)
+            print(f"{done:>10}  {statistics.median(window_latencies):>12.2f}  "
+                  f"{percentile(window_latencies, 95):>12.2f}  {rate:>9.0f}")
+            window_start = time.perf_counter()
+            window_latencies = []
+            window_events = 0
+
+    by_template = defaultdict(Counter)
+    for source, cluster_id in assignments:
+        if source is not None:
+            by_template[source][cluster_id] += 1
+    template_clusters = {index: clusters.most_common(1)[0][0] for index, clusters in by_template.items()}
+    recall = sum(clusters.most_common(1)[0][1] for clusters in by_template.values()) / max(
+        1, sum(sum(clusters.values()) for clusters in by_template.values())
+    )
+    merged = sum(
+        1 for source, cluster_id in assignments
+        if source is None and cluster_id in set(template_clusters.values())
+    )
+    unique = sum(1 for source, _ in assignments if source is None)
+
+    print()
+    print(f"fingerprint: {fingerprint_seconds / args.events * 1e6:.1f} us/prompt")
+    print(f"templated prompts in their template's main cluster: {recall:.2%}")
+    print(f"one-off prompts merged into a template cluster: {merged} of {unique}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--events", type=int, default=200000)
+    parser.add_argument("--batch-size", type=int, default=500)
+    parser.add_argument("--templates", type=int, default=200)
+    parser.add_argument("--unique-share", type=float, default=0.3, help="Share of one-off prompts")
+    parser.add_argument("--report-every", type=int, default=50000)
+    parser.add_argument("--seed", type=int, default=7)
+    parser.add_argument("--database-url", default=None, help="Defaults to a fresh SQLite file")
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp(prefix="aca-bench-")
+    os.environ["DATABASE_URL"] = args.database_url or f"sqlite:///{os.path.join(workdir, 'bench.db')}"
+    asyncio.run(run(args))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,147 @@
+"""Measure proxy CPU time per request across payload sizes
+
+Usage: python benchmarks/bench_proxy_cpu.py [--requests 20] [--sizes 1KB,10KB,100KB,1MB,10MB]
+
+For each size the request carries a multi-turn conversation of that many
+bytes and the mock upstream (a separate process) answers with a completion
+of about the same size. The API runs in this process and is driven over
+ASGI, so process CPU time per request is the proxy's own work: reading,
+hashing, forwarding and accounting the payloads.
+"""
+import sys
+import os
+import argparse
+import asyncio
+import json
+import subprocess
+import tempfile
+import time
+sys.path.insert(0, os.path.dirname(os.path.dirname(__file__)))
+
+import httpx
+
+BACKEND_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+VIRTUAL_KEY = "vk_bench_proxy_cpu"
+UNITS = {"KB": 1024, "MB": 1024 * 1024}
+
+
+def parse_size(text: str) -> int:
+    """Parse sizes such as 512, 10KB or 1MB"""
+    text = text.strip().upper()
+    for unit, factor in UNITS.items():
+        if text.endswith(unit):
+            return int(float(text[:-len(unit)]) * factor)
+    return int(text)
+
+
+def build_body(size: int) -> dict:
+    """A ten-turn conversation whose message contents add up to `size` bytes"""
+    turns = 10
+    chunk = "x" * max(1, size // turns)
+    messages = [
+        {"role": "user" if i % 2 == 0 else "assistant", "content": chunk}
+        for i in range(turns)
+    ]
+    return {"model": "gpt-4o-mini", "messages": messages}
+
+
+def start_mock(port: int, output_tokens: int) -> subprocess.Popen:
+    """Run the mock upstream in its own process so its CPU isn't counted"""
+    process = subprocess.Popen(
+        [sys.executable, "benchmarks/mock_upstream.py", "--port", str(port),
+         "--output-tokens", str(output_tokens)],
+        cwd=BACKEND_DIR
+    )
+    deadline = time.time() + 15
+    while time.time() < deadline:
+        try:
+            httpx.get(f"http://127.0.0.1:{port}/docs", timeout=0.5)
+            return process
+        except httpx.HTTPError:
+            time.sleep(0.1)
+    process.terminate()
+    raise RuntimeError("Mock upstream did not start")
+
+
+async def measure(app, size: int, requests: int, port: int):
+    """Return (CPU ms per request, wall ms per request) for one payload size"""
+    from app.config import settings
+    from app.upstream import close_upstream_clients, start_upstream_clients
+
+    # "ok " is three bytes per output token
+    mock = start_mock(port, max(1, size // 3))
+    try:
+        settings.OPENAI_BASE_URL = f"http://127.0.0.1:{port}"
+        await close_upstream_clients()
+        await start_upstream_clients()
+
+        content = json.dumps(build_body(size)).encode()
+        headers = {"X-Virtual-Key": VIRTUAL_KEY, "Content-Type": "application/json"}
+        transport = httpx.ASGITransport(app=app)
+        async with httpx.AsyncClient(transport=transport, base_url="http://proxy", timeout=120) as client:
+            async def one():
+                response = await client.post("/proxy/openai/v1/chat/completions", content=content, headers=headers)
+                if response.status_code != 200:
+                    raise RuntimeError(f"Proxy returned {response.status_code}: {response.text[:200]}")
+
+            for _ in range(3):
+                await one()
+            cpu_start, wall_start = time.process_time(), time.perf_counter()
+            for _ in range(requests):
+                await one()
+            cpu = time.process_time() - cpu_start
+            wall = time.perf_counter() - wall_start
+        return cpu / requests * 1000, wall / requests * 1000
+    finally:
+        mock.terminate()
+        mock.wait()
+
+
+def create_key() -> None:
+    """A key without the demo key's per-request token limit"""
+    from app.database import Base, SessionLocal, engine
+    from app.models import VirtualKey
+
+    Base.metadata.create_all(bind=engine)
+    db = SessionLocal()
+    try:
+        db.add(VirtualKey(key=VIRTUAL_KEY, name="Proxy CPU benchmark"))
+        db.commit()
+    finally:
+        db.close()
+
+
+async def run(sizes, requests: int, port: int):
+    create_key()
+
+    from app.main import app
+
+    print(f"{'payload':>10}  {'cpu ms/req':>11}  {'wall ms/req':>11}  {'cpu MB/s':>9}")
+    async with app.router.lifespan_context(app):
+        for index, size in enumerate(sizes):
+            cpu_ms, wall_ms = await measure(app, size, requests, port + index)
+            # Request and response are both about `size` bytes
+            throughput = (2 * size / 1024 / 1024) / (cpu_ms / 1000) if cpu_ms else float("inf")
+            print(f"{size:>10}  {cpu_ms:>11.3f}  {wall_ms:>11.3f}  {throughput:>9.1f}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--requests", type=int, default=20, help="Measured requests per payload size")
+    parser.add_argument("--sizes", default="1KB,10KB,100KB,1MB,10MB")
+    parser.add_argument("--port", type=int, default=9300, help="First mock upstream port")
+    parser.add_argument("--database-url", default=None, help="Defaults to a fresh SQLite file")
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp(prefix="aca-bench-")
+    os.environ["DATABASE_URL"] = args.database_url or f"sqlite:///{os.path.join(workdir, 'bench.db')}"
+    os.environ.setdefault("OPENAI_API_KEY", "sk-bench")
+    os.environ["KEY_CACHE_TTL"] = "3600"
+    os.chdir(BACKEND_DIR)
+
+    sizes = [parse_size(size) for size in args.sizes.split(",")]
+    asyncio.run(run(sizes, args.requests, args.port))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,68 @@
+"""Measure the latency a rate limit check adds to a proxied request
+
+Usage: python benchmarks/bench_rate_limit.py [--checks 20000] [--keys 100] [--redis-url redis://localhost:6379/0]
+
+Times acquire() plus settle() for keys with both an RPM and a TPM limit,
+high enough that every check is admitted, on the in-process limiter and,
+with --redis-url, on the Redis limiter (one script call per check, plus one
+per settle whose actual tokens differ from the estimate).
+"""
+import sys
+import os
+import argparse
+import asyncio
+import random
+import time
+sys.path.insert(0, os.path.dirname(os.path.dirname(__file__)))
+
+from app.rate_limit import LocalRateLimiter, RedisRateLimiter
+
+
+def percentile(samples, pct):
+    """Return the pct-th percentile of a list of samples"""
+    ordered = sorted(samples)
+    index = min(len(ordered) - 1, int(round(pct / 100 * (len(ordered) - 1))))
+    return ordered[index]
+
+
+async def measure(limiter, checks: int, keys: int):
+    rng = random.Random(7)
+    samples = []
+    for _ in range(checks):
+        key = rng.randint(1, keys)
+        start = time.perf_counter()
+        permit = await limiter.acquire(key, 10 ** 9, 10 ** 12, 1200)
+        await limiter.settle(permit, 300)
+        samples.append((time.perf_counter() - start) * 1e6)
+    return samples
+
+
+def report(name, samples):
+    print(f"{name:<10} p50={percentile(samples, 50):8.1f}µs  p99={percentile(samples, 99):8.1f}µs  "
+          f"max={max(samples):8.1f}µs")
+
+
+async def run(args):
+    report("local", await measure(LocalRateLimiter(), args.checks, args.keys))
+    if args.redis_url:
+        import redis.asyncio as redis
+
+        client = redis.from_url(args.redis_url, decode_responses=True)
+        try:
+            await measure(RedisRateLimiter(client), 100, args.keys)
+            report("redis", await measure(RedisRateLimiter(client), args.checks, args.keys))
+        finally:
+            await client.aclose()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--checks", type=int, default=20000)
+    parser.add_argument("--keys", type=int, default=100)
+    parser.add_argument("--redis-url", default=None, help="Also measure the Redis limiter")
+    args = parser.parse_args()
+    asyncio.run(run(args))
+
+
+if __name__ == "__main__":
+    main()
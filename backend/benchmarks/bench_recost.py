@@ -0,0 +1,120 @@
+"""Measure re-costing throughput after a price change
+
+Usage: python benchmarks/bench_recost.py [--events 1000000] [--changed-share 0.5] [--chunk-size 100000]
+
+Generates usage events over 60 days for a few models, with rollups and a
+spend ledger built from them, then adds a price period covering the last
+`--changed-share` of the range for one model. It times a dry run and an
+applied run of app.recost, reports events per second and the projected
+time for 100M events, and checks that events, hourly and daily rollups
+and the ledger still sum to the same total afterwards.
+"""
+import sys
+import os
+import argparse
+import random
+import tempfile
+import time
+from datetime import datetime, timedelta
+sys.path.insert(0, os.path.dirname(os.path.dirname(__file__)))
+
+MODELS = ["gpt-4o-mini", "gpt-4o", "gpt-4-turbo", "gpt-3.5-turbo"]
+
+
+def populate(args):
+    from sqlalchemy import func, insert
+    from app.database import Base, SessionLocal, engine
+    from app.ledger import VIRTUAL_KEY_SCOPE
+    from app.models import SpendLedger, UsageEvent
+    from app.rollups import backfill_rollups
+    from app.utils import calculate_cost
+
+    Base.metadata.create_all(bind=engine)
+    rng = random.Random(args.seed)
+    now = datetime.utcnow()
+    db = SessionLocal()
+    try:
+        for start in range(0, args.events, 50000):
+            rows = []
+            for _ in range(min(50000, args.events - start)):
+                model = rng.choice(MODELS)
+                input_tokens, output_tokens = rng.randint(10, 8000), rng.randint(1, 1500)
+                rows.append({
+                    "virtual_key_id": rng.randint(1, args.keys),
+                    "provider": "openai",
+                    "model": model,
+                    "input_tokens": input_tokens,
+                    "output_tokens": output_tokens,
+                    "total_tokens": input_tokens + output_tokens,
+                    "created_at": now - timedelta(seconds=rng.uniform(0, 60 * 86400)),
+                    **calculate_cost("openai", model, input_tokens, output_tokens),
+                })
+            db.execute(insert(UsageEvent), rows)
+        backfill_rollups(db)
+        period = func.strftime("%Y-%m", UsageEvent.created_at)
+        for virtual_key_id, month, spent in db.query(
+            UsageEvent.virtual_key_id, period, func.sum(UsageEvent.total_cost)
+        ).group_by(UsageEvent.virtual_key_id, period):
+            db.add(SpendLedger(scope_type=VIRTUAL_KEY_SCOPE, scope_id=virtual_key_id, period=month, spent=spent))
+        db.commit()
+    finally:
+        db.close()
+    return now - timedelta(days=60 * args.changed_share)
+
+
+def totals():
+    from sqlalchemy import text
+    from app.database import engine
+
+    with engine.connect() as conn:
+        return [
+            conn.execute(text(query)).scalar()
+            for query in (
+                "SELECT sum(total_cost) FROM usage_events",
+                "SELECT sum(total_cost) FROM usage_rollups WHERE granularity = 'hour'",
+                "SELECT sum(total_cost) FROM usage_rollups WHERE granularity = 'day'",
+                "SELECT sum(spent) FROM spend_ledger WHERE scope_type = 'virtual_key'",
+            )
+        ]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--events", type=int, default=1000000)
+    parser.add_argument("--keys", type=int, default=200)
+    parser.add_argument("--changed-share", type=float, default=0.5, help="Share of the range the new price covers")
+    parser.add_argument("--chunk-size", type=int, default=100000)
+    parser.add_argument("--seed", type=int, default=5)
+    parser.add_argument("--database-url", default=None, help="Defaults to a fresh SQLite file")
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp(prefix="aca-bench-")
+    os.environ["DATABASE_URL"] = args.database_url or f"sqlite:///{os.path.join(workdir, 'bench.db')}"
+    from app.database import engine
+    from app.models import ModelPrice
+    from app.pricing import PriceBook
+    from app.recost import recost_usage_events
+
+    print(f"generating {args.events} events")
+    effective_from = populate(args)
+    prices = PriceBook(refresh_interval=0)
+    prices.replace([ModelPrice(
+        provider="openai", model="gpt-4o-mini", input_price=0.12, output_price=0.5, effective_from=effective_from
+    )])
+    before = totals()
+
+    for dry_run in (True, False):
+        start = time.perf_counter()
+        report = recost_usage_events(engine, prices, dry_run=dry_run, chunk_size=args.chunk_size)
+        seconds = time.perf_counter() - start
+        rate = report.scanned / seconds
+        print(f"{'dry run' if dry_run else 'apply':<8} {report.scanned} scanned, {report.changed} changed "
+              f"in {seconds:.1f} s: {rate:,.0f} events/s, 100M in {1e8 / rate / 60:.1f} min")
+
+    after = totals()
+    print(f"difference: {after[0] - before[0]:+.6f}")
+    print("events / hourly rollups / daily rollups / ledger: " + " / ".join(f"{value:.6f}" for value in after))
+
+
+if __name__ == "__main__":
+    main()
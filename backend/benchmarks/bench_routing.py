@@ -0,0 +1,142 @@
+"""Route proxied requests across several mock upstreams and report the split
+
+Usage: python benchmarks/bench_routing.py [--requests 2000] [--concurrency 16]
+                                          [--targets 20,50,200,20:0.5]
+
+Each entry of --targets starts a mock upstream (a separate process) with
+that latency in ms and, after a colon, the share of requests it fails with
+a 500. The API runs in this process with OPENAI_UPSTREAMS pointing at the
+mocks and is driven over ASGI. Afterwards the script prints, per target,
+the share of calls routed to it, its EWMA latency, error rate, ejections
+and whether it is still in rotation. The expected picture: most traffic on
+the fastest healthy targets, little on the slow one and the failing one
+ejected.
+"""
+import sys
+import os
+import argparse
+import asyncio
+import subprocess
+import tempfile
+import time
+sys.path.insert(0, os.path.dirname(os.path.dirname(__file__)))
+
+import httpx
+
+BACKEND_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+VIRTUAL_KEY = "vk_bench_routing"
+
+
+def parse_targets(text: str):
+    """[(latency ms, error rate)] from "20,50,200:0.5" """
+    targets = []
+    for entry in text.split(","):
+        latency, _, error_rate = entry.strip().partition(":")
+        targets.append((float(latency), float(error_rate or 0)))
+    return targets
+
+
+def start_mock(port: int, latency_ms: float, error_rate: float) -> subprocess.Popen:
+    process = subprocess.Popen(
+        [sys.executable, "benchmarks/mock_upstream.py", "--port", str(port), "--latency-ms", str(latency_ms),
+         "--error-rate", str(error_rate), "--seed", str(port)],
+        cwd=BACKEND_DIR
+    )
+    deadline = time.time() + 15
+    while time.time() < deadline:
+        try:
+            httpx.get(f"http://127.0.0.1:{port}/docs", timeout=0.5)
+            return process
+        except httpx.HTTPError:
+            time.sleep(0.1)
+    process.terminate()
+    raise RuntimeError("Mock upstream did not start")
+
+
+def create_key() -> None:
+    from app.database import Base, SessionLocal, engine
+    from app.models import VirtualKey
+
+    Base.metadata.create_all(bind=engine)
+    db = SessionLocal()
+    try:
+        db.add(VirtualKey(key=VIRTUAL_KEY, name="Routing benchmark"))
+        db.commit()
+    finally:
+        db.close()
+
+
+def sample(name: str, **labels) -> float:
+    from prometheus_client import REGISTRY
+
+    return REGISTRY.get_sample_value(name, labels) or 0.0
+
+
+async def drive(app, requests: int, concurrency: int):
+    """Send the requests; return (status counts, seconds)"""
+    headers = {"X-Virtual-Key": VIRTUAL_KEY}
+    statuses = {}
+    counter = iter(range(requests))
+    transport = httpx.ASGITransport(app=app)
+    async with httpx.AsyncClient(transport=transport, base_url="http://proxy", timeout=120) as client:
+        async def worker():
+            for index in counter:
+                body = {"model": "gpt-4o-mini", "messages": [{"role": "user", "content": f"Routing request {index}"}]}
+                response = await client.post("/proxy/openai/v1/chat/completions", json=body, headers=headers)
+                statuses[response.status_code] = statuses.get(response.status_code, 0) + 1
+
+        start = time.perf_counter()
+        await asyncio.gather(*(worker() for _ in range(concurrency)))
+    return statuses, time.perf_counter() - start
+
+
+async def run(args, targets):
+    create_key()
+
+    from app.main import app
+
+    async with app.router.lifespan_context(app):
+        statuses, seconds = await drive(app, args.requests, args.concurrency)
+
+    print(f"{args.requests} requests in {seconds:.1f} s, statuses {statuses}")
+    print(f"{'target':<8} {'latency':>8} {'errors':>7} {'share':>7} {'ewma ms':>8} {'err rate':>9} "
+          f"{'ejections':>10} {'available':>10}")
+    for index, (latency_ms, error_rate) in enumerate(targets):
+        name = f"t{index}"
+        routed = sample("upstream_target_routed_total", provider="openai", target=name)
+        print(f"{name:<8} {latency_ms:>6.0f}ms {error_rate:>7.0%} {routed / args.requests:>7.1%} "
+              f"{sample('upstream_target_latency_seconds', provider='openai', target=name, kind='buffered') * 1000:>8.1f} "
+              f"{sample('upstream_target_error_rate', provider='openai', target=name):>9.3f} "
+              f"{sample('upstream_target_ejections_total', provider='openai', target=name):>10.0f} "
+              f"{sample('upstream_target_available', provider='openai', target=name):>10.0f}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--requests", type=int, default=2000)
+    parser.add_argument("--concurrency", type=int, default=16)
+    parser.add_argument("--targets", default="20,50,200,20:0.5", help="latency_ms[:error_rate] per mock upstream")
+    parser.add_argument("--port", type=int, default=9500, help="First mock upstream port")
+    args = parser.parse_args()
+    targets = parse_targets(args.targets)
+
+    workdir = tempfile.mkdtemp(prefix="aca-bench-")
+    os.environ["DATABASE_URL"] = f"sqlite:///{os.path.join(workdir, 'bench.db')}"
+    os.environ["OPENAI_UPSTREAMS"] = "[" + ",".join(
+        f'{{"name": "t{index}", "base_url": "http://127.0.0.1:{args.port + index}", "api_key": "sk-bench-{index}"}}'
+        for index in range(len(targets))
+    ) + "]"
+    os.environ["KEY_CACHE_TTL"] = "3600"
+    os.chdir(BACKEND_DIR)
+
+    mocks = [start_mock(args.port + index, *target) for index, target in enumerate(targets)]
+    try:
+        asyncio.run(run(args, targets))
+    finally:
+        for mock in mocks:
+            mock.terminate()
+            mock.wait()
+
+
+if __name__ == "__main__":
+    main()
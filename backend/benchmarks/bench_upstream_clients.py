@@ -0,0 +1,95 @@
+"""Benchmark per-request vs shared pooled upstream clients against a local mock
+
+Usage: python benchmarks/bench_upstream_clients.py [--requests 500] [--concurrency 8]
+
+The mock upstream answers instantly, so the measured latency is the
+overhead the proxy adds around the upstream call (client setup, connection
+establishment and request/response handling).
+"""
+import sys
+import os
+import argparse
+import asyncio
+import statistics
+import time
+sys.path.insert(0, os.path.dirname(os.path.dirname(__file__)))
+
+import httpx
+
+from benchmarks.mock_upstream import create_mock_app, MockUpstreamServer
+
+BODY = {"model": "gpt-4o-mini", "messages": [{"role": "user", "content": "Hello"}]}
+
+
+def percentile(samples, pct):
+    """Return the pct-th percentile of a list of samples"""
+    ordered = sorted(samples)
+    index = min(len(ordered) - 1, int(round(pct / 100 * (len(ordered) - 1))))
+    return ordered[index]
+
+
+async def run_per_request(url: str, requests: int, concurrency: int):
+    """Old behaviour: a fresh AsyncClient (and connection) per proxied call"""
+    semaphore = asyncio.Semaphore(concurrency)
+    samples = []
+
+    async def one():
+        async with semaphore:
+            start = time.perf_counter()
+            async with httpx.AsyncClient(timeout=60.0) as client:
+                response = await client.post(f"{url}/v1/chat/completions", json=BODY)
+                response.json()
+            samples.append(time.perf_counter() - start)
+
+    await asyncio.gather(*(one() for _ in range(requests)))
+    return samples
+
+
+async def run_shared(url: str, requests: int, concurrency: int):
+    """New behaviour: one long-lived pooled client shared by all calls"""
+    from app.upstream import build_upstream_client
+
+    client = build_upstream_client(url)
+    semaphore = asyncio.Semaphore(concurrency)
+    samples = []
+
+    async def one():
+        async with semaphore:
+            start = time.perf_counter()
+            response = await client.post("/v1/chat/completions", json=BODY)
+            response.json()
+            samples.append(time.perf_counter() - start)
+
+    try:
+        await asyncio.gather(*(one() for _ in range(requests)))
+    finally:
+        await client.aclose()
+    return samples
+
+
+def report(name, samples):
+    """Print p50/p99 latency in milliseconds"""
+    ms = [s * 1000 for s in samples]
+    print(f"{name:<14} n={len(ms):<6} p50={percentile(ms, 50):7.3f}ms  "
+          f"p99={percentile(ms, 99):7.3f}ms  mean={statistics.mean(ms):7.3f}ms")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--requests", type=int, default=500)
+    parser.add_argument("--concurrency", type=int, default=8)
+    parser.add_argument("--port", type=int, default=9100)
+    args = parser.parse_args()
+
+    with MockUpstreamServer(create_mock_app(), port=args.port) as mock:
+        # Warm up the mock server before measuring
+        asyncio.run(run_shared(mock.url, 50, args.concurrency))
+        before = asyncio.run(run_per_request(mock.url, args.requests, args.concurrency))
+        after = asyncio.run(run_shared(mock.url, args.requests, args.concurrency))
+
+    report("per-request", before)
+    report("shared-pool", after)
+
+
+if __name__ == "__main__":
+    main()
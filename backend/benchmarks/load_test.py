@@ -0,0 +1,326 @@
+"""Load-test the proxy and dashboard endpoints against local mock upstreams
+
+Usage: python benchmarks/load_test.py [--requests 2000] [--concurrency 32]
+                                      [--database-url URL ...] [--latency-ms 50]
+                                      [--chunk-delay-ms 1] [--error-rate 0]
+                                      [--output results.json] [--compare baseline.json]
+
+The mock upstream (benchmarks/mock_upstream.py) and the API (uvicorn) run
+as separate processes, the API pointed at the mock through
+OPENAI_BASE_URL / ANTHROPIC_BASE_URL. For every database (a fresh SQLite
+file unless --database-url is given, repeatable, e.g. a throwaway
+postgresql:// database) each scenario is driven at a fixed concurrency:
+
+  openai, openai-stream        POST /proxy/openai/v1/chat/completions
+  anthropic, anthropic-stream  POST /proxy/anthropic/v1/messages
+  overview                     GET /api/metrics/overview
+
+Proxy scenarios are also run straight against the mock; overhead at each
+percentile is proxied latency minus direct latency. Every request body is
+unique, so neither the response cache nor coalescing short-circuits the
+upstream. The DB write rate is usage events written (from
+usage_writer_events_written_total) per second from the start of a scenario
+until the write-behind queue has drained; memory comes from the API
+process's /proc status (Linux).
+
+Results go to a JSON file (default benchmarks/results/<commit>.json);
+--compare prints the change against an earlier results file.
+"""
+import sys
+import os
+import argparse
+import asyncio
+import json
+import subprocess
+import tempfile
+import time
+from datetime import datetime, timezone
+sys.path.insert(0, os.path.dirname(os.path.dirname(__file__)))
+
+import httpx
+
+BACKEND_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+VIRTUAL_KEY = "vk_load_test"
+SCENARIOS = {
+    # name: (proxy path, upstream path, provider, stream)
+    "openai": ("/proxy/openai/v1/chat/completions", "/v1/chat/completions", "openai", False),
+    "openai-stream": ("/proxy/openai/v1/chat/completions", "/v1/chat/completions", "openai", True),
+    "anthropic": ("/proxy/anthropic/v1/messages", "/v1/messages", "anthropic", False),
+    "anthropic-stream": ("/proxy/anthropic/v1/messages", "/v1/messages", "anthropic", True),
+    "overview": ("/api/metrics/overview", None, None, False),
+}
+SETUP = f"""
+from scripts.seed import seed_data
+from app.database import SessionLocal
+from app.models import VirtualKey
+seed_data()
+db = SessionLocal()
+if not db.query(VirtualKey).filter(VirtualKey.key == {VIRTUAL_KEY!r}).first():
+    db.add(VirtualKey(key={VIRTUAL_KEY!r}, name="Load test", environment="prod"))
+    db.commit()
+db.close()
+"""
+
+
+def percentile(samples, pct):
+    """Return the pct-th percentile of a list of samples"""
+    ordered = sorted(samples)
+    index = min(len(ordered) - 1, int(round(pct / 100 * (len(ordered) - 1))))
+    return ordered[index]
+
+
+def git_commit() -> str:
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short=12", "HEAD"], cwd=BACKEND_DIR, capture_output=True, text=True, check=True
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+
+
+def wait_until_up(url: str, process: subprocess.Popen, timeout: float = 30.0) -> None:
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError(f"{url} exited with code {process.returncode}")
+        try:
+            httpx.get(url, timeout=0.5)
+            return
+        except httpx.HTTPError:
+            time.sleep(0.1)
+    raise RuntimeError(f"{url} did not start within {timeout:.0f} s")
+
+
+def memory_mb(pid: int):
+    """(current RSS, peak RSS) of a process in MB, or (None, None) without /proc"""
+    try:
+        with open(f"/proc/{pid}/status") as status:
+            fields = dict(line.split(":", 1) for line in status if ":" in line)
+    except OSError:
+        return None, None
+    return tuple(int(fields[name].split()[0]) / 1024 for name in ("VmRSS", "VmHWM"))
+
+
+def events_written(client: httpx.Client) -> float:
+    for line in client.get("/metrics/").text.splitlines():
+        if line.startswith("usage_writer_events_written_total "):
+            return float(line.split()[1])
+    return 0.0
+
+
+def wait_for_writes(client: httpx.Client, expected: float, timeout: float = 120.0) -> float:
+    """Wait until the usage writer has written `expected` events in total; return the count"""
+    deadline = time.time() + timeout
+    written = events_written(client)
+    while written < expected and time.time() < deadline:
+        time.sleep(0.05)
+        written = events_written(client)
+    return written
+
+
+def request_body(provider: str, stream: bool, index: int) -> dict:
+    content = f"Load test request {index}: summarize the quarterly cost report in three bullet points."
+    body = {"messages": [{"role": "user", "content": content}], "stream": stream}
+    if provider == "openai":
+        body["model"] = "gpt-4o-mini"
+    else:
+        body.update(model="claude-3-haiku-20240307", max_tokens=256)
+    return body
+
+
+async def drive(base_url: str, path: str, provider, stream: bool, headers: dict, requests: int, concurrency: int):
+    """Send `requests` requests with `concurrency` in flight; return (latencies, errors, seconds)"""
+    samples, errors = [], 0
+    counter = iter(range(requests))
+    limits = httpx.Limits(max_connections=concurrency, max_keepalive_connections=concurrency)
+
+    async with httpx.AsyncClient(base_url=base_url, headers=headers, limits=limits, timeout=120) as client:
+        async def worker():
+            nonlocal errors
+            for index in counter:
+                start = time.perf_counter()
+                try:
+                    if provider is None:
+                        response = await client.get(path)
+                    else:
+                        request = client.build_request("POST", path, json=request_body(provider, stream, index))
+                        response = await client.send(request, stream=True)
+                        async for _ in response.aiter_raw():
+                            pass
+                        await response.aclose()
+                except httpx.HTTPError:
+                    errors += 1
+                    continue
+                samples.append(time.perf_counter() - start)
+                if response.status_code >= 400:
+                    errors += 1
+
+        start = time.perf_counter()
+        await asyncio.gather(*(worker() for _ in range(concurrency)))
+        seconds = time.perf_counter() - start
+    return samples, errors, seconds
+
+
+def latency_summary(samples) -> dict:
+    if not samples:
+        return {}
+    ms = [sample * 1000 for sample in samples]
+    return {f"p{pct}_ms": round(percentile(ms, pct), 3) for pct in (50, 95, 99)}
+
+
+def run_database(database_url: str, args) -> dict:
+    """Start the API on one database and run every scenario against it"""
+    env = {
+        **os.environ,
+        "DATABASE_URL": database_url,
+        "OPENAI_BASE_URL": args.mock_url,
+        "ANTHROPIC_BASE_URL": args.mock_url,
+        "OPENAI_API_KEY": "sk-load-test",
+        "ANTHROPIC_API_KEY": "sk-ant-load-test",
+        "KEY_CACHE_TTL": "3600",
+    }
+    subprocess.run([sys.executable, "-c", SETUP], cwd=BACKEND_DIR, env=env, check=True, capture_output=True)
+    api_url = f"http://127.0.0.1:{args.api_port}"
+    api = subprocess.Popen(
+        [sys.executable, "-m", "uvicorn", "app.main:app", "--host", "127.0.0.1", "--port", str(args.api_port),
+         "--log-level", "warning", "--no-access-log"],
+        cwd=BACKEND_DIR, env=env
+    )
+    results = {}
+    try:
+        wait_until_up(f"{api_url}/healthz", api)
+        with httpx.Client(base_url=api_url, timeout=30) as client:
+            token = client.post(
+                "/api/auth/token", data={"username": "admin@local", "password": "admin123"}
+            ).json()["access_token"]
+            # Every proxied request, failed or not, is written as one usage event
+            expected = events_written(client)
+            for name in args.scenarios:
+                path, upstream_path, provider, stream = SCENARIOS[name]
+                headers = {"Authorization": f"Bearer {token}"} if provider is None else {"X-Virtual-Key": VIRTUAL_KEY}
+                asyncio.run(drive(api_url, path, provider, stream, headers, args.warmup, args.concurrency))
+                if provider is not None:
+                    expected += args.warmup
+                written_before = wait_for_writes(client, expected)
+                start = time.perf_counter()
+                samples, errors, seconds = asyncio.run(
+                    drive(api_url, path, provider, stream, headers, args.requests, args.concurrency)
+                )
+                if provider is not None:
+                    expected += args.requests
+                written = wait_for_writes(client, expected) - written_before
+                write_seconds = time.perf_counter() - start
+                rss, peak_rss = memory_mb(api.pid)
+                result = {
+                    "requests": args.requests,
+                    "errors": errors,
+                    "seconds": round(seconds, 3),
+                    "throughput_rps": round(args.requests / seconds, 1),
+                    **latency_summary(samples),
+                    "db_writes_per_s": round(written / write_seconds, 1),
+                    "rss_mb": rss and round(rss, 1),
+                    "peak_rss_mb": peak_rss and round(peak_rss, 1),
+                }
+                if upstream_path is not None:
+                    direct, _, _ = asyncio.run(
+                        drive(args.mock_url, upstream_path, provider, stream, {}, args.requests, args.concurrency)
+                    )
+                    direct_summary = latency_summary(direct)
+                    result["direct"] = direct_summary
+                    result["overhead"] = {key: round(result[key] - value, 3) for key, value in direct_summary.items()}
+                results[name] = result
+                print_result(database_url, name, result)
+    finally:
+        api.terminate()
+        api.wait()
+    return results
+
+
+def print_result(database_url: str, name: str, result: dict) -> None:
+    overhead = result.get("overhead", {})
+    print(f"{database_url.split(':')[0]:<12} {name:<17} {result['throughput_rps']:>8.1f} rps  "
+          f"p50/p95/p99 {result.get('p50_ms', 0):7.2f} {result.get('p95_ms', 0):7.2f} {result.get('p99_ms', 0):7.2f} ms  "
+          + (f"overhead p50/p99 {overhead['p50_ms']:6.2f} {overhead['p99_ms']:6.2f} ms  " if overhead else "")
+          + f"{result['db_writes_per_s']:>7.1f} writes/s  rss {result['rss_mb']} MB  errors {result['errors']}")
+
+
+def compare(results: dict, baseline_path: str) -> None:
+    """Print throughput and latency changes against an earlier results file"""
+    with open(baseline_path) as handle:
+        baseline = json.load(handle)
+    print(f"\ncompared with {baseline.get('commit')} ({baseline_path}):")
+    for database, scenarios in results["databases"].items():
+        for name, result in scenarios.items():
+            before = baseline.get("databases", {}).get(database, {}).get(name)
+            if not before:
+                continue
+            changes = []
+            for key in ("throughput_rps", "p50_ms", "p99_ms"):
+                if before.get(key):
+                    changes.append(f"{key} {(result[key] - before[key]) / before[key] * 100:+.1f}%")
+            print(f"  {database:<12} {name:<17} " + "  ".join(changes))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--requests", type=int, default=2000, help="Measured requests per scenario")
+    parser.add_argument("--warmup", type=int, default=100)
+    parser.add_argument("--concurrency", type=int, default=32)
+    parser.add_argument("--scenarios", default=",".join(SCENARIOS))
+    parser.add_argument("--database-url", action="append", default=None,
+                        help="Repeatable; defaults to a fresh SQLite file")
+    parser.add_argument("--latency-ms", type=float, default=50.0, help="Mock upstream latency")
+    parser.add_argument("--chunk-delay-ms", type=float, default=1.0, help="Mock delay between streamed chunks")
+    parser.add_argument("--input-tokens", type=int, default=25)
+    parser.add_argument("--output-tokens", type=int, default=50)
+    parser.add_argument("--error-rate", type=float, default=0.0)
+    parser.add_argument("--error-status", type=int, default=500)
+    parser.add_argument("--mock-port", type=int, default=9400)
+    parser.add_argument("--api-port", type=int, default=9401)
+    parser.add_argument("--output", default=None, help="Results file (default benchmarks/results/<commit>.json)")
+    parser.add_argument("--compare", default=None, help="Earlier results file to compare against")
+    args = parser.parse_args()
+    args.scenarios = [name.strip() for name in args.scenarios.split(",")]
+    unknown = set(args.scenarios) - set(SCENARIOS)
+    if unknown:
+        parser.error(f"unknown scenarios: {', '.join(sorted(unknown))}")
+    args.mock_url = f"http://127.0.0.1:{args.mock_port}"
+    database_urls = args.database_url or [
+        f"sqlite:///{os.path.join(tempfile.mkdtemp(prefix='aca-load-'), 'load.db')}"
+    ]
+
+    mock = subprocess.Popen(
+        [sys.executable, "benchmarks/mock_upstream.py", "--port", str(args.mock_port),
+         "--latency-ms", str(args.latency_ms), "--chunk-delay-ms", str(args.chunk_delay_ms),
+         "--input-tokens", str(args.input_tokens), "--output-tokens", str(args.output_tokens),
+         "--error-rate", str(args.error_rate), "--error-status", str(args.error_status), "--seed", "1"],
+        cwd=BACKEND_DIR
+    )
+    commit = git_commit()
+    results = {
+        "commit": commit,
+        "created_at": datetime.now(timezone.utc).isoformat(timespec="seconds"),
+        "config": {key: value for key, value in vars(args).items() if key not in ("output", "compare", "database_url")},
+        "databases": {},
+    }
+    try:
+        # The mock answers 405 to GET, which is enough to know it is up
+        wait_until_up(f"{args.mock_url}/v1/messages", mock)
+        for database_url in database_urls:
+            # Keyed by backend, so runs on different hosts or files compare
+            results["databases"][database_url.split(":")[0].split("+")[0]] = run_database(database_url, args)
+    finally:
+        mock.terminate()
+        mock.wait()
+
+    output = args.output or os.path.join(BACKEND_DIR, "benchmarks", "results", f"{commit}.json")
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+    with open(output, "w") as handle:
+        json.dump(results, handle, indent=2)
+    print(f"\nresults written to {output}")
+    if args.compare:
+        compare(results, args.compare)
+
+
+if __name__ == "__main__":
+    main()
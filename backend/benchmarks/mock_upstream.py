@@ -0,0 +1,339 @@
+"""Local mock of the OpenAI and Anthropic APIs for benchmarks"""
+import sys
+import os
+import asyncio
+import random
+import threading
+import time
+import json
+import uuid
+sys.path.insert(0, os.path.dirname(os.path.dirname(__file__)))
+
+import uvicorn
+from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse, StreamingResponse
+
+
+def _sse(data: dict, event: str = None) -> bytes:
+    """Encode one server-sent event"""
+    prefix = f"event: {event}\n" if event else ""
+    return f"{prefix}data: {json.dumps(data)}\n\n".encode()
+
+
+def create_mock_app(
+    latency_ms: float = 0.0,
+    input_tokens: int = 25,
+    output_tokens: int = 50,
+    chunk_delay_ms: float = 0.0,
+    error_rate: float = 0.0,
+    error_status: int = 500,
+    seed: int = None,
+    embedding_dims: int = 16,
+    batch_seconds: float = 0.0
+) -> FastAPI:
+    """Create a mock upstream app with a fixed latency and token usage
+
+    Streaming requests emit one chunk per output token, `chunk_delay_ms` apart.
+    A share `error_rate` of requests fails with `error_status` after the
+    latency, with the provider's error body (and Retry-After on 429).
+    Embeddings are derived from each input, so the same input always gets
+    the same vector, and bill about one token per 4 characters of text.
+    Batches complete `batch_seconds` after they are created, when polled;
+    each input line fails with `error_rate` into the error file, and the
+    result files are generated as they are downloaded.
+    """
+    app = FastAPI()
+    rng = random.Random(seed)
+
+    def failure(body: dict):
+        if not error_rate or rng.random() >= error_rate:
+            return None
+        headers = {"Retry-After": "1"} if error_status == 429 else None
+        return JSONResponse(body, status_code=error_status, headers=headers)
+
+    async def openai_stream(model: str, include_usage: bool):
+        completion_id = f"chatcmpl-{uuid.uuid4().hex}"
+        for _ in range(output_tokens):
+            if chunk_delay_ms:
+                await asyncio.sleep(chunk_delay_ms / 1000)
+            chunk = {
+                "id": completion_id,
+                "object": "chat.completion.chunk",
+                "model": model,
+                "choices": [{"index": 0, "delta": {"content": "ok "}, "finish_reason": None}]
+            }
+            if include_usage:
+                chunk["usage"] = None
+            yield _sse(chunk)
+        if include_usage:
+            yield _sse({
+                "id": completion_id,
+                "object": "chat.completion.chunk",
+                "model": model,
+                "choices": [],
+                "usage": {
+                    "prompt_tokens": input_tokens,
+                    "completion_tokens": output_tokens,
+                    "total_tokens": input_tokens + output_tokens
+                }
+            })
+        yield b"data: [DONE]\n\n"
+
+    async def anthropic_stream(model: str):
+        message_id = f"msg_{uuid.uuid4().hex}"
+        yield _sse({
+            "type": "message_start",
+            "message": {
+                "id": message_id, "type": "message", "role": "assistant", "model": model,
+                "content": [], "usage": {"input_tokens": input_tokens, "output_tokens": 1}
+            }
+        }, "message_start")
+        yield _sse({"type": "content_block_start", "index": 0,
+                    "content_block": {"type": "text", "text": ""}}, "content_block_start")
+        for _ in range(output_tokens):
+            if chunk_delay_ms:
+                await asyncio.sleep(chunk_delay_ms / 1000)
+            yield _sse({"type": "content_block_delta", "index": 0,
+                        "delta": {"type": "text_delta", "text": "ok "}}, "content_block_delta")
+        yield _sse({"type": "content_block_stop", "index": 0}, "content_block_stop")
+        yield _sse({"type": "message_delta", "delta": {"stop_reason": "end_turn"},
+                    "usage": {"output_tokens": output_tokens}}, "message_delta")
+        yield _sse({"type": "message_stop"}, "message_stop")
+
+    @app.post("/v1/chat/completions")
+    async def chat_completions(request: Request):
+        body = await request.json()
+        if latency_ms:
+            await asyncio.sleep(latency_ms / 1000)
+        error = failure({"error": {"message": "Mock upstream error", "type": "server_error", "code": None}})
+        if error is not None:
+            return error
+        if body.get("stream"):
+            include_usage = bool((body.get("stream_options") or {}).get("include_usage"))
+            return StreamingResponse(
+                openai_stream(body.get("model", "gpt-4o-mini"), include_usage),
+                media_type="text/event-stream"
+            )
+        return {
+            "id": f"chatcmpl-{uuid.uuid4().hex}",
+            "object": "chat.completion",
+            "created": int(time.time()),
+            "model": body.get("model", "gpt-4o-mini"),
+            "choices": [{
+                "index": 0,
+                "message": {"role": "assistant", "content": "ok " * output_tokens},
+                "finish_reason": "stop"
+            }],
+            "usage": {
+                "prompt_tokens": input_tokens,
+                "completion_tokens": output_tokens,
+                "total_tokens": input_tokens + output_tokens
+            }
+        }
+
+    @app.post("/v1/embeddings")
+    async def embeddings(request: Request):
+        body = await request.json()
+        if latency_ms:
+            await asyncio.sleep(latency_ms / 1000)
+        error = failure({"error": {"message": "Mock upstream error", "type": "server_error", "code": None}})
+        if error is not None:
+            return error
+        inputs = body.get("input")
+        if isinstance(inputs, str) or (inputs and isinstance(inputs[0], int)):
+            inputs = [inputs]
+        dims = body.get("dimensions") or embedding_dims
+        data = []
+        tokens = 0
+        for index, item in enumerate(inputs):
+            vector = random.Random(json.dumps(item))
+            data.append({
+                "object": "embedding",
+                "index": index,
+                "embedding": [round(vector.uniform(-1, 1), 6) for _ in range(dims)]
+            })
+            tokens += len(item) if isinstance(item, list) else max(1, len(item) // 4)
+        return {
+            "object": "list",
+            "data": data,
+            "model": body.get("model", "text-embedding-3-small"),
+            "usage": {"prompt_tokens": tokens, "total_tokens": tokens}
+        }
+
+    files = {}  # file id -> metadata plus "content": bytes, or a function yielding result lines
+    batches = {}
+
+    def batch_results(input_file_id: str, failed: bool):
+        def lines():
+            for line in files[input_file_id]["content"].splitlines():
+                if not line.strip():
+                    continue
+                request = json.loads(line)
+                # Decided per line, so the output and error files agree
+                if (bool(error_rate) and random.Random(line).random() < error_rate) != failed:
+                    continue
+                if failed:
+                    body = {"error": {"message": "Mock upstream error", "type": "server_error", "code": None}}
+                    status = error_status
+                elif request.get("url") == "/v1/embeddings":
+                    body = {"object": "list", "data": [], "model": request["body"].get("model"),
+                            "usage": {"prompt_tokens": input_tokens, "total_tokens": input_tokens}}
+                    status = 200
+                else:
+                    body = {
+                        "id": f"chatcmpl-{uuid.uuid4().hex}",
+                        "object": "chat.completion",
+                        "model": request["body"].get("model"),
+                        "choices": [{"index": 0, "message": {"role": "assistant", "content": "ok " * output_tokens},
+                                     "finish_reason": "stop"}],
+                        "usage": {"prompt_tokens": input_tokens, "completion_tokens": output_tokens,
+                                  "total_tokens": input_tokens + output_tokens}
+                    }
+                    status = 200
+                yield (json.dumps({
+                    "id": f"batch_req_{uuid.uuid4().hex}",
+                    "custom_id": request.get("custom_id"),
+                    "response": {"status_code": status, "request_id": uuid.uuid4().hex, "body": body},
+                    "error": None
+                }) + "\n").encode()
+        return lines
+
+    def add_file(purpose: str, content, filename: str) -> dict:
+        file_id = f"file-{uuid.uuid4().hex}"
+        files[file_id] = {
+            "id": file_id, "object": "file", "bytes": len(content) if isinstance(content, bytes) else 0,
+            "created_at": int(time.time()), "filename": filename, "purpose": purpose, "content": content
+        }
+        return files[file_id]
+
+    def file_object(entry: dict) -> dict:
+        return {name: value for name, value in entry.items() if name != "content"}
+
+    def not_found(what: str):
+        return JSONResponse({"error": {"message": f"No such {what}", "type": "invalid_request_error"}}, 404)
+
+    @app.post("/v1/files")
+    async def upload_file(request: Request):
+        form = await request.form()
+        upload = form["file"]
+        return file_object(add_file(form.get("purpose"), await upload.read(), upload.filename))
+
+    @app.get("/v1/files/{file_id}")
+    async def get_file(file_id: str):
+        return file_object(files[file_id]) if file_id in files else not_found("file")
+
+    @app.get("/v1/files/{file_id}/content")
+    async def file_content(file_id: str):
+        if file_id not in files:
+            return not_found("file")
+        content = files[file_id]["content"]
+        return StreamingResponse(
+            iter([content]) if isinstance(content, bytes) else content(), media_type="application/octet-stream"
+        )
+
+    @app.post("/v1/batches")
+    async def create_batch(request: Request):
+        body = await request.json()
+        if body.get("input_file_id") not in files:
+            return not_found("file")
+        batch_id = f"batch_{uuid.uuid4().hex}"
+        batches[batch_id] = {
+            "id": batch_id, "object": "batch", "endpoint": body.get("endpoint"), "errors": None,
+            "input_file_id": body["input_file_id"], "completion_window": body.get("completion_window", "24h"),
+            "status": "in_progress", "output_file_id": None, "error_file_id": None,
+            "created_at": int(time.time()), "completed_at": None, "cancelled_at": None,
+            "metadata": body.get("metadata")
+        }
+        return batches[batch_id]
+
+    @app.get("/v1/batches/{batch_id}")
+    async def get_batch(batch_id: str):
+        batch = batches.get(batch_id)
+        if batch is None:
+            return not_found("batch")
+        if batch["status"] == "in_progress" and time.time() - batch["created_at"] >= batch_seconds:
+            input_file_id = batch["input_file_id"]
+            batch["output_file_id"] = add_file("batch_output", batch_results(input_file_id, False), "output.jsonl")["id"]
+            if error_rate:
+                batch["error_file_id"] = add_file("batch_output", batch_results(input_file_id, True), "errors.jsonl")["id"]
+            batch["status"] = "completed"
+            batch["completed_at"] = int(time.time())
+        return batch
+
+    @app.post("/v1/batches/{batch_id}/cancel")
+    async def cancel_batch(batch_id: str):
+        batch = batches.get(batch_id)
+        if batch is None:
+            return not_found("batch")
+        if batch["status"] == "in_progress":
+            batch["status"] = "cancelled"
+            batch["cancelled_at"] = int(time.time())
+        return batch
+
+    @app.post("/v1/messages")
+    async def messages(request: Request):
+        body = await request.json()
+        if latency_ms:
+            await asyncio.sleep(latency_ms / 1000)
+        error = failure({"type": "error", "error": {"type": "api_error", "message": "Mock upstream error"}})
+        if error is not None:
+            return error
+        if body.get("stream"):
+            return StreamingResponse(
+                anthropic_stream(body.get("model", "claude-3-5-sonnet-20241022")),
+                media_type="text/event-stream"
+            )
+        return {
+            "id": f"msg_{uuid.uuid4().hex}",
+            "type": "message",
+            "role": "assistant",
+            "model": body.get("model", "claude-3-5-sonnet-20241022"),
+            "content": [{"type": "text", "text": "ok " * output_tokens}],
+            "stop_reason": "end_turn",
+            "usage": {"input_tokens": input_tokens, "output_tokens": output_tokens}
+        }
+
+    return app
+
+
+class MockUpstreamServer:
+    """Run a mock upstream app with uvicorn in a background thread"""
+
+    def __init__(self, app: FastAPI, host: str = "127.0.0.1", port: int = 9100):
+        self.url = f"http://{host}:{port}"
+        config = uvicorn.Config(app, host=host, port=port, log_level="warning", access_log=False)
+        self.server = uvicorn.Server(config)
+        self.thread = threading.Thread(target=self.server.run, daemon=True)
+
+    def __enter__(self):
+        self.thread.start()
+        while not self.server.started:
+            time.sleep(0.01)
+        return self
+
+    def __exit__(self, *exc):
+        self.server.should_exit = True
+        self.thread.join(timeout=5)
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=9100)
+    parser.add_argument("--latency-ms", type=float, default=0.0)
+    parser.add_argument("--input-tokens", type=int, default=25)
+    parser.add_argument("--output-tokens", type=int, default=50)
+    parser.add_argument("--chunk-delay-ms", type=float, default=0.0)
+    parser.add_argument("--error-rate", type=float, default=0.0, help="Share of requests that fail")
+    parser.add_argument("--error-status", type=int, default=500)
+    parser.add_argument("--seed", type=int, default=None)
+    parser.add_argument("--embedding-dims", type=int, default=16)
+    parser.add_argument("--batch-seconds", type=float, default=0.0, help="Time until a batch completes")
+    args = parser.parse_args()
+    app = create_mock_app(
+        args.latency_ms, args.input_tokens, args.output_tokens, args.chunk_delay_ms,
+        args.error_rate, args.error_status, args.seed, args.embedding_dims, args.batch_seconds
+    )
+    uvicorn.run(app, host=args.host, port=args.port, log_level="warning")
@@ -0,0 +1,42 @@
+"""Rebuild usage_rollups from raw usage_events
+
+Usage: python scripts/backfill_rollups.py [--since YYYY-MM-DD] [--until YYYY-MM-DD]
+
+The range is rounded out to whole days and replaced in one transaction.
+Events are read from usage_events and any rolled SQLite month tables;
+months already moved to the archive keep their existing rollups.
+Live ingest also updates rollups, so run this while proxy traffic is paused
+or restrict --until to days that are already closed.
+"""
+import sys
+import os
+import argparse
+from datetime import datetime
+sys.path.insert(0, os.path.dirname(os.path.dirname(__file__)))
+
+from app.database import SessionLocal, engine, Base
+from app.rollups import backfill_rollups
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--since", type=datetime.fromisoformat, default=None)
+    parser.add_argument("--until", type=datetime.fromisoformat, default=None)
+    args = parser.parse_args()
+
+    Base.metadata.create_all(bind=engine)
+    db = SessionLocal()
+    try:
+        count = backfill_rollups(db, since=args.since, until=args.until)
+        db.commit()
+        print(f"✓ Rebuilt rollups from {count} usage events")
+    except Exception as e:
+        print(f"❌ Error rebuilding rollups: {e}")
+        db.rollback()
+        raise
+    finally:
+        db.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,68 @@
+"""Keep monthly usage_events storage in shape; run daily from cron
+
+Usage: python scripts/maintain_usage_events.py [--retention-months N] [--batch-size N] [--dry-run]
+
+Postgres: creates monthly partitions USAGE_PARTITION_MONTHS_AHEAD months ahead.
+SQLite: rolls closed months (all but the current and previous one) out of
+usage_events into per-month tables.
+Both: when a retention is set (USAGE_RETENTION_MONTHS or --retention-months),
+writes older months to Parquet under USAGE_ARCHIVE_DIR (needs pyarrow) and
+removes them from the database. Archived months stay readable through
+GET /api/metrics/periods/{period}.
+Near-duplicate prompt clusters not seen for NEAR_DUPLICATE_RETENTION_DAYS,
+or since before the retained months, are deleted with their LSH bands
+and rollups.
+
+Every step works in batches of short transactions, so it can run while the
+proxy is serving traffic.
+"""
+import sys
+import os
+import argparse
+from datetime import datetime, timedelta
+sys.path.insert(0, os.path.dirname(os.path.dirname(__file__)))
+
+from app.config import settings
+from app.database import engine, Base
+from app.partitions import add_months, current_period, ensure_partitions, month_start, partitions, roll_over_sqlite
+from app.archive import archive_expired
+from app.near_duplicates import prune_prompt_clusters
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--retention-months", type=int, default=settings.USAGE_RETENTION_MONTHS,
+                        help="Months kept in the database, current one included; 0 keeps everything")
+    parser.add_argument("--batch-size", type=int, default=settings.USAGE_ARCHIVE_BATCH_SIZE)
+    parser.add_argument("--dry-run", action="store_true", help="List stored months and what would be archived")
+    args = parser.parse_args()
+
+    Base.metadata.create_all(bind=engine)
+    if args.dry_run:
+        cutoff = add_months(current_period(), 1 - args.retention_months) if args.retention_months > 0 else None
+        with engine.connect() as conn:
+            for partition in partitions(conn):
+                action = "archive" if cutoff and partition.period < cutoff else "keep"
+                print(f"{partition.period}  {partition.table:<24}  {action}")
+        return
+
+    with engine.begin() as conn:
+        created = ensure_partitions(conn, settings.USAGE_PARTITION_MONTHS_AHEAD)
+    if created:
+        print(f"✓ Ensured partitions {', '.join(created)}")
+    rolled = roll_over_sqlite(engine, args.batch_size)
+    if rolled:
+        print(f"✓ Rolled {', '.join(rolled)} out of usage_events")
+    for manifest in archive_expired(engine, args.retention_months, args.batch_size):
+        print(f"✓ Archived {manifest['period']}: {manifest['rows']} rows, ${manifest['total_cost']:.2f}")
+
+    cluster_cutoff = datetime.utcnow() - timedelta(days=settings.NEAR_DUPLICATE_RETENTION_DAYS)
+    if args.retention_months > 0:
+        cluster_cutoff = max(cluster_cutoff, month_start(add_months(current_period(), 1 - args.retention_months)))
+    pruned = prune_prompt_clusters(engine, cluster_cutoff, args.batch_size)
+    if pruned:
+        print(f"✓ Pruned {pruned} near-duplicate clusters idle since before {cluster_cutoff:%Y-%m-%d}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,76 @@
+"""Recompute usage event costs from the current model prices
+
+Usage: python scripts/recost_usage.py [--since YYYY-MM-DD] [--until YYYY-MM-DD]
+                                      [--provider P] [--model M] [--apply] [--report report.json]
+
+Prices come from model_prices, with the OPENAI_PRICING / ANTHROPIC_PRICING
+defaults outside its periods. Events whose model has no known price are
+left alone. Without --apply this is a dry run that prints the difference
+per model; with it, changed events are updated and usage_rollups,
+prompt_cluster_rollups and spend_ledger are adjusted in the same
+transaction per chunk. With REDIS_ENABLED the live budget counters for the
+current month are corrected too; otherwise restart the API to reload them.
+"""
+import sys
+import os
+import argparse
+import asyncio
+from datetime import datetime
+sys.path.insert(0, os.path.dirname(os.path.dirname(__file__)))
+
+from app.database import SessionLocal, engine, Base
+from app.json_scan import dumps
+from app.ledger import current_period, spend_ledger
+from app.models import ModelPrice
+from app.pricing import PriceBook
+from app.recost import recost_usage_events
+
+
+async def adjust_live_ledger(ledger) -> None:
+    period = current_period()
+    for (scope_type, scope_id, month), amount in ledger.items():
+        if month == period:
+            await spend_ledger.adjust(scope_type, scope_id, month, amount)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--since", type=datetime.fromisoformat, default=None)
+    parser.add_argument("--until", type=datetime.fromisoformat, default=None)
+    parser.add_argument("--provider", default=None)
+    parser.add_argument("--model", default=None)
+    parser.add_argument("--apply", action="store_true", help="Write the new costs (default: dry run)")
+    parser.add_argument("--chunk-size", type=int, default=100000)
+    parser.add_argument("--report", default=None, help="Also write the report as JSON to this path")
+    args = parser.parse_args()
+
+    Base.metadata.create_all(bind=engine)
+    prices = PriceBook(refresh_interval=0)
+    db = SessionLocal()
+    try:
+        prices.replace(db.query(ModelPrice).all())
+    finally:
+        db.close()
+
+    report = recost_usage_events(
+        engine, prices,
+        since=args.since, until=args.until, provider=args.provider, model=args.model,
+        dry_run=not args.apply, chunk_size=args.chunk_size
+    )
+    if args.apply and report.ledger:
+        asyncio.run(adjust_live_ledger(report.ledger))
+
+    summary = report.to_dict()
+    print(f"{'provider':<10}  {'model':<32}  {'changed':>10}  {'old cost':>14}  {'new cost':>14}  {'difference':>12}")
+    for row in summary["models"]:
+        print(f"{row['provider']:<10}  {row['model']:<32}  {row['changed']:>10}  "
+              f"{row['old_cost']:>14.6f}  {row['new_cost']:>14.6f}  {row['difference']:>+12.6f}")
+    print(f"{'✓ Updated' if args.apply else 'Dry run:'} {summary['changed']} of {summary['scanned']} events "
+          f"(${summary['old_cost']:.2f} -> ${summary['new_cost']:.2f}); {summary['unpriced']} without a known price")
+    if args.report:
+        with open(args.report, "wb") as handle:
+            handle.write(dumps(summary))
+
+
+if __name__ == "__main__":
+    main()